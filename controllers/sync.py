@@ -120,11 +120,11 @@ def sync():
         if "_" in tablename:
 
             # URL variables from peer:
-            # repository ID, msince and sync filters
+            # repository ID, msince, paging and sync filters
             get_vars_new = Storage(include_deleted=True)
             
             for k, v in get_vars.items():
-                if k in ("repository", "msince") or \
+                if k in ("repository", "msince", "limit", "next") or \
                    k[0] == "[" and "]" in k:
                     get_vars_new[k] = v
 
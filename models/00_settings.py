@@ -276,6 +276,7 @@ s3.content_type = Storage(
     rss = "application/rss+xml", # RSS
     georss = "application/rss+xml", # GeoRSS
     kml = "application/vnd.google-earth.kml+xml", # KML
+    mvt = "application/vnd.mapbox-vector-tile", # Mapbox Vector Tiles
 )
 
 # JSON Formats
@@ -169,11 +169,51 @@ def gis_update_location_tree(feature, user_id=None):
     # Run the Task & return the result
     feature = json.loads(feature)
     path = gis.update_location_tree(feature)
+    # Refresh the precomputed simplified geometries (if-configured)
+    gis.update_simplified(feature["id"])
     db.commit()
     return path
 
 tasks["gis_update_location_tree"] = gis_update_location_tree
 
+# -----------------------------------------------------------------------------
+def gis_rebuild_simplified(force=False, user_id=None):
+    """
+        Precompute the simplified geometries of all locations
+            - e.g. after changing settings.gis.simplify_levels
+
+        @param force: re-compute even where the WKT is unchanged
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    result = gis.rebuild_simplified(force=force)
+    db.commit()
+    return result
+
+tasks["gis_rebuild_simplified"] = gis_rebuild_simplified
+
+# -----------------------------------------------------------------------------
+def gis_publish_feeds(force=False, user_id=None):
+    """
+        Regenerate the static GeoJSON feeds (settings.gis.feeds) whose
+        data have changed
+            - designed to be run on a schedule
+
+        @param force: regenerate even if the data are unchanged
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task & return the result
+    result = s3base.S3GeoJSONFeed.publish_all(force=force)
+    return result
+
+tasks["gis_publish_feeds"] = gis_publish_feeds
+
 # -----------------------------------------------------------------------------
 def org_facility_geojson(user_id=None):
     """
@@ -5,13 +5,24 @@
 # Set settings.base.prepopulate to 0 in Production
 # (to save 1x DAL hit every page).
 pop_list = settings.get_base_prepopulate()
+# Resume an interrupted prepopulate?
+pop_resume = False
 if pop_list == 0:
     pop_list = []
 else:
     table = db[auth.settings.table_group_name]
     # The query used here takes 2/3 the time of .count().
     if db(table.id > 0).select(table.id, limitby=(0, 1)).first():
-        pop_list = []
+        # Only if not still running in another process
+        S3BulkImporter = s3base.S3BulkImporter
+        if S3BulkImporter.pending() and S3BulkImporter.acquire_lock():
+            pop_resume = True
+        else:
+            pop_list = []
+    else:
+        s3base.S3BulkImporter.acquire_lock()
+        # Discard the checkpoint of any earlier database
+        s3base.S3BulkImporter().clear_checkpoint()
     if not isinstance(pop_list, (list, tuple)):
         pop_list = [pop_list]
 
@@ -25,6 +36,8 @@ if len(pop_list) > 0:
     import sys
 
     print >> sys.stdout, "Please be patient whilst the database is populated"
+    if pop_resume:
+        print >> sys.stdout, "Resuming interrupted pre-populate"
 
     # Shortcuts
     acl = auth.permission
@@ -88,44 +101,46 @@ if len(pop_list) > 0:
     #
 
     has_module = settings.has_module
-    if has_module("msg"):
-
-        # Send Messages from Outbox
-        # SMS every minute
-        s3task.schedule_task("msg_process_outbox",
-                             vars={"contact_method":"SMS"},
-                             period=120,  # seconds
-                             timeout=120, # seconds
-                             repeats=0    # unlimited
-                             )
-        # Emails every 5 minutes
-        s3task.schedule_task("msg_process_outbox",
-                             vars={"contact_method":"EMAIL"},
-                             period=300,  # seconds
-                             timeout=300, # seconds
-                             repeats=0    # unlimited
+    # (already configured when resuming)
+    if not pop_resume:
+        if has_module("msg"):
+
+            # Send Messages from Outbox
+            # SMS every minute
+            s3task.schedule_task("msg_process_outbox",
+                                 vars={"contact_method":"SMS"},
+                                 period=120,  # seconds
+                                 timeout=120, # seconds
+                                 repeats=0    # unlimited
+                                 )
+            # Emails every 5 minutes
+            s3task.schedule_task("msg_process_outbox",
+                                 vars={"contact_method":"EMAIL"},
+                                 period=300,  # seconds
+                                 timeout=300, # seconds
+                                 repeats=0    # unlimited
+                                 )
+            # Tweets every minute
+            #s3task.schedule_task("msg_process_outbox",
+            #                     vars={"contact_method":"TWITTER"},
+            #                     period=120,  # seconds
+            #                     timeout=120, # seconds
+            #                     repeats=0    # unlimited
+            #                     )
+
+            # Subscription notifications
+            s3task.schedule_task("notify_check_subscriptions",
+                                 period=300,
+                                 timeout=300,
+                                 repeats=0)
+
+        # Daily maintenance
+        s3task.schedule_task("maintenance",
+                             vars={"period":"daily"},
+                             period=86400, # seconds, so 1/day
+                             timeout=600,  # seconds
+                             repeats=0     # unlimited
                              )
-        # Tweets every minute
-        #s3task.schedule_task("msg_process_outbox",
-        #                     vars={"contact_method":"TWITTER"},
-        #                     period=120,  # seconds
-        #                     timeout=120, # seconds
-        #                     repeats=0    # unlimited
-        #                     )
-
-        # Subscription notifications
-        s3task.schedule_task("notify_check_subscriptions",
-                             period=300,
-                             timeout=300,
-                             repeats=0)
-
-    # Daily maintenance
-    s3task.schedule_task("maintenance",
-                         vars={"period":"daily"},
-                         period=86400, # seconds, so 1/day
-                         timeout=600,  # seconds
-                         repeats=0     # unlimited
-                         )
 
     # =========================================================================
     # Import PrePopulate data
@@ -143,57 +158,59 @@ if len(pop_list) > 0:
     path_join = os.path.join
     request_folder = request.folder
 
-    if settings.get_auth_opt_in_to_email():
-        table = db.pr_group
-        for team in settings.get_auth_opt_in_team_list():
-            table.insert(name = team, group_type = 5)
-
-    # Synchronisation
-    db.sync_config.insert() # Defaults are fine
-
-    # Messaging Module
-    if has_module("msg"):
-        update_super = s3db.update_super
-        # To read inbound email, set username (email address), password, etc.
-        # here. Insert multiple records for multiple email sources.
-        table = db.msg_email_channel
-        id = table.insert(server = "imap.gmail.com",
-                          protocol = "imap",
-                          use_ssl = True,
-                          port = 993,
-                          username = "example-username",
-                          password = "password",
-                          delete_from_server = False
-                          )
-        update_super(table, dict(id=id))
-        # Need entries for the Settings/1/Update URLs to work
-        table = db.msg_twitter_channel
-        id = table.insert(enabled = False)
-        update_super(table, dict(id=id))
-
-    # Budget Module
-    if has_module("budget"):
-        db.budget_parameter.insert() # Defaults are fine
-
-    # Climate Module
-    if has_module("climate"):
-        s3db.climate_first_run()
-
-    # Incident Reporting System
-    if has_module("irs"):
-        # Categories visible to ends-users by default
-        table = db.irs_icategory
-        table.insert(code = "flood")
-        table.insert(code = "geophysical.landslide")
-        table.insert(code = "roadway.bridgeClosure")
-        table.insert(code = "roadway.roadwayClosure")
-        table.insert(code = "other.buildingCollapsed")
-        table.insert(code = "other.peopleTrapped")
-        table.insert(code = "other.powerFailure")
-
-    # Supply Module
-    if has_module("supply"):
-        db.supply_catalog.insert(name = settings.get_supply_catalog_default())
+    # Default data (already present when resuming)
+    if not pop_resume:
+        if settings.get_auth_opt_in_to_email():
+            table = db.pr_group
+            for team in settings.get_auth_opt_in_team_list():
+                table.insert(name = team, group_type = 5)
+
+        # Synchronisation
+        db.sync_config.insert() # Defaults are fine
+
+        # Messaging Module
+        if has_module("msg"):
+            update_super = s3db.update_super
+            # To read inbound email, set username (email address), password, etc.
+            # here. Insert multiple records for multiple email sources.
+            table = db.msg_email_channel
+            id = table.insert(server = "imap.gmail.com",
+                              protocol = "imap",
+                              use_ssl = True,
+                              port = 993,
+                              username = "example-username",
+                              password = "password",
+                              delete_from_server = False
+                              )
+            update_super(table, dict(id=id))
+            # Need entries for the Settings/1/Update URLs to work
+            table = db.msg_twitter_channel
+            id = table.insert(enabled = False)
+            update_super(table, dict(id=id))
+
+        # Budget Module
+        if has_module("budget"):
+            db.budget_parameter.insert() # Defaults are fine
+
+        # Climate Module
+        if has_module("climate"):
+            s3db.climate_first_run()
+
+        # Incident Reporting System
+        if has_module("irs"):
+            # Categories visible to ends-users by default
+            table = db.irs_icategory
+            table.insert(code = "flood")
+            table.insert(code = "geophysical.landslide")
+            table.insert(code = "roadway.bridgeClosure")
+            table.insert(code = "roadway.roadwayClosure")
+            table.insert(code = "other.buildingCollapsed")
+            table.insert(code = "other.peopleTrapped")
+            table.insert(code = "other.powerFailure")
+
+        # Supply Module
+        if has_module("supply"):
+            db.supply_catalog.insert(name = settings.get_supply_catalog_default())
 
     # Ensure DB population committed when running through shell
     db.commit()
@@ -281,6 +298,10 @@ if len(pop_list) > 0:
                     pass
             print >> sys.stderr, _errorLine
 
+    # Report the slowest tasks first
+    for timingLine in bi.timing_report():
+        print >> sys.stdout, timingLine
+
     # Restore setting for strict email-matching
     settings.pr.import_update_requires_email = email_required
 
@@ -361,6 +382,10 @@ if len(pop_list) > 0:
         # autovacuum should be on anyway so will run ANALYZE after 50 rows inserted/updated/deleted
         #db.executesql("VACUUM ANALYZE;")
 
+    # Pre-populate complete, no need to resume
+    bi.clear_checkpoint()
+    bi.release_lock()
+
     # Restore view
     response.view = "default/index.html"
 
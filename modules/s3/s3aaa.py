@@ -38,7 +38,10 @@ __all__ = ("AuthS3",
            )
 
 import datetime
+import hashlib
 #import re
+import threading
+import time
 from uuid import uuid4
 
 try:
@@ -3168,6 +3171,7 @@ $.filterOptionsS3({
             # Realms:
             # Permissions of a group apply only for records owned by any of
             # the entities which belong to the realm of the group membership
+            self.user.pop("subsidiaries", None)
 
             if not self.permission.entity_realm:
                 # Group memberships have no realms (policy 5 and below)
@@ -3266,6 +3270,11 @@ $.filterOptionsS3({
                             d = descendants[p]
                             pmap[p] = [e for e in all_entities if e in d] or [p]
 
+                    if current.deployment_settings.get_auth_realm_closure():
+                        # Remember the subsidiaries, so that realm_query
+                        # can look them up from the closure table
+                        self.user["subsidiaries"] = descendants
+
                     # Add the subsidiaries to the realms
                     for group_id in realms:
                         realm = realms[group_id]
@@ -4491,6 +4500,95 @@ $.filterOptionsS3({
         if not row:
             return
 
+        data = self.s3_record_owner_data(table, row,
+                                         force_update=force_update,
+                                         **fields)
+
+        self.s3_update_record_owner(table, row, update=force_update, **data)
+        return
+
+    # -------------------------------------------------------------------------
+    def s3_set_record_owners(self, table, record_ids):
+        """
+            Set the record owned_by_user, owned_by_group and realm_entity
+            for multiple new records (auto-detect values), with one update
+            per distinct set of values rather than one per record
+
+            To be called by the Importer after a bulk insert.
+
+            @param table: the Table
+            @param record_ids: list of record IDs
+        """
+
+        if not record_ids:
+            return
+
+        # Ownership fields
+        ownership_fields = ("owned_by_user", "owned_by_group", "realm_entity")
+
+        # Entity reference fields
+        entity_fields = ("pe_id", "organisation_id", "site_id", "group_id",
+                         "person_id")
+
+        fields_in_table = [f for f in ownership_fields if f in table.fields]
+        if not fields_in_table:
+            return
+        fields_in_table += [f for f in entity_fields if f in table.fields]
+
+        db = current.db
+
+        fields_to_load = [table._id] + [table[f] for f in fields_in_table]
+        rows = db(table._id.belongs(record_ids)).select(*fields_to_load)
+
+        # Group the records by ownership values
+        updates = {}
+        for row in rows:
+            data = self.s3_record_owner_data(table, row)
+            if not data:
+                continue
+            key = tuple(sorted(data.items()))
+            if key in updates:
+                updates[key].append(row[table._id.name])
+            else:
+                updates[key] = [row[table._id.name]]
+
+        for key, ids in updates.items():
+            data = dict(key)
+            query = (table._id.belongs(ids))
+            db(query).update(**data)
+            self.update_shared_fields(table, query, **data)
+        return
+
+    # -------------------------------------------------------------------------
+    def s3_record_owner_data(self, table, row, force_update=False, **fields):
+        """
+            Auto-detect the ownership field values for a record, helper
+            method for s3_set_record_owner(s)
+
+            @param table: the Table
+            @param row: the record, containing all ownership and entity
+                        reference fields available in table
+            @param force_update: determine the realm entity even if the
+                                 record already has one
+            @param fields: override auto-detected values, see
+                           s3_set_record_owner
+
+            @return: dict {fieldname: value}
+        """
+
+        # Ownership fields
+        OUSR = "owned_by_user"
+        OGRP = "owned_by_group"
+        REALM = "realm_entity"
+
+        # Entity reference fields
+        EID = "pe_id"
+        PID = "person_id"
+
+        s3db = current.s3db
+        tablename = table._tablename
+        fields_in_table = table.fields
+
         # Prepare the udpate
         data = Storage()
 
@@ -4550,8 +4648,7 @@ $.filterOptionsS3({
                                                      entity=entity)
                 data[REALM] = realm_entity
 
-        self.s3_update_record_owner(table, row, update=force_update, **data)
-        return
+        return data
 
     # -------------------------------------------------------------------------
     def set_realm_entity(self, table, records, entity=0, force_update=False):
@@ -5070,6 +5167,10 @@ class S3Permission(object):
         self.page_acls = Storage()
         self.table_acls = Storage()
 
+        # Shared ACL cache
+        self.use_cache = settings.get_security_acl_cache()
+        self.realms_key = None
+
         # Pages which never require permission:
         # Make sure that any data access via these pages uses
         # accessible_query explicitly!
@@ -5116,6 +5217,9 @@ class S3Permission(object):
                             *(s3_uid()+s3_timestamp()+s3_deletion_status()))
             self.table = db[self.tablename]
 
+        if self.use_cache:
+            S3PermissionCache.attach(self.table)
+
     # -------------------------------------------------------------------------
     # ACL Management
     # -------------------------------------------------------------------------
@@ -5159,6 +5263,7 @@ class S3Permission(object):
             del s3["permissions"]
         if "restricted_tables" in s3:
             del s3["restricted_tables"]
+        S3PermissionCache.clear()
 
         if c is None and f is None and t is None:
             return None
@@ -5509,10 +5614,62 @@ class S3Permission(object):
             public = (table[OENT] == None)
             if len(entities) == 1:
                 return (table[OENT] == entities[0]) | public
-            else:
-                return (table[OENT].belongs(entities)) | public
+            query = self.realm_closure_query(table, entities)
+            if query is None:
+                query = (table[OENT].belongs(entities))
+            return query | public
         return None
 
+    # -------------------------------------------------------------------------
+    def realm_closure_query(self, table, entities):
+        """
+            Returns a query to select the records owned by one of the
+            entities, looking up the subsidiaries of realm entities with
+            a join on the closure table (settings.auth.realm_closure)
+            rather than listing them
+
+            @param table: the table
+            @param entities: list of entities
+            @return: a web2py Query instance, or None if no realm entity
+                     in entities includes all of its subsidiaries (as at
+                     the time the user realms were set)
+        """
+
+        if not current.deployment_settings.get_auth_realm_closure():
+            return None
+
+        user = self.auth.user
+        subsidiaries = user.get("subsidiaries") if user else None
+        if not subsidiaries:
+            return None
+
+        entities = set(entities)
+        roots = set()
+        inherited = set()
+        for entity in entities:
+            descendants = subsidiaries.get(entity)
+            if descendants and entities.issuperset(descendants):
+                roots.add(entity)
+                inherited.update(descendants)
+        if not roots:
+            return None
+
+        s3db = current.s3db
+        ctable = s3db.pr_pentity_closure
+        etable = s3db.pr_pentity
+        # Same subsidiaries as pr_descendants (no persons)
+        join = (ctable.ancestor_pe_id.belongs(sorted(roots))) & \
+               (etable.pe_id == ctable.descendant_pe_id) & \
+               (etable.instance_type != "pr_person")
+        subquery = current.db(join)._select(ctable.descendant_pe_id)
+
+        OENT = "realm_entity"
+        query = (table[OENT].belongs(subquery))
+        others = entities - inherited
+        if others:
+            query |= (table[OENT].belongs(sorted(others)))
+        return query
+
     # -------------------------------------------------------------------------
     def permitted_realms(self, tablename, method="read"):
         """
@@ -6180,6 +6337,17 @@ class S3Permission(object):
             # No roles available (deny all)
             return acls
 
+        # Look up the decision in the shared cache
+        if self.use_cache:
+            tablename = str(t) if t else None
+            key = (self.get_realms_key(realms, delegations),
+                   racl, c, f, tablename, entity or None)
+            result = S3PermissionCache.get(key)
+            if result is not None:
+                return Storage(result)
+        else:
+            key = None
+
         # Base query
         query = (table.deleted != True) & \
                 (table.group_id.belongs(roles))
@@ -6206,7 +6374,9 @@ class S3Permission(object):
             table_restricted = self.table_restricted(t)
 
         # Retrieve the ACLs
-        if q:
+        if q and key:
+            rows = self.compiled_acls(roles, c, f, t)
+        elif q:
             query &= q
             rows = db(query).select(table.group_id,
                                     table.controller,
@@ -6405,8 +6575,105 @@ class S3Permission(object):
         #for pe in result:
             #print "ACL for PE %s: %04X %04X" % (pe, result[pe][0], result[pe][1])
 
+        if key:
+            S3PermissionCache.set(key, dict(result))
+
         return result
 
+    # -------------------------------------------------------------------------
+    def compiled_acls(self, roles, c=None, f=None, t=None):
+        """
+            Get the ACLs for a controller/function/table from the compiled
+            ACLs of the role set (shared cache), i.e. the equivalent of the
+            ACL lookup query in applicable_acls, without database access
+
+            @param roles: the role IDs
+            @param c: the controller name
+            @param f: the function name
+            @param t: the tablename
+
+            @return: list of ACLs (as Storage)
+        """
+
+        roles = tuple(sorted(set(roles)))
+
+        rules = S3PermissionCache.get(roles)
+        if rules is None:
+            table = self.table
+            query = (table.deleted != True) & \
+                    (table.group_id.belongs(roles))
+            rows = current.db(query).select(table.group_id,
+                                            table.controller,
+                                            table.function,
+                                            table.tablename,
+                                            table.unrestricted,
+                                            table.entity,
+                                            table.uacl,
+                                            table.oacl,
+                                            )
+            rules = {}
+            for row in rows:
+                acl = Storage(group_id = row.group_id,
+                              controller = row.controller,
+                              function = row.function,
+                              tablename = row.tablename,
+                              unrestricted = row.unrestricted,
+                              entity = row.entity,
+                              uacl = row.uacl,
+                              oacl = row.oacl,
+                              )
+                if row.controller is not None:
+                    # Page ACL
+                    rkey = (row.controller, row.function)
+                elif row.function is None and row.tablename is not None:
+                    # Table ACL
+                    rkey = row.tablename
+                else:
+                    continue
+                if rkey in rules:
+                    rules[rkey].append(acl)
+                else:
+                    rules[rkey] = [acl]
+            S3PermissionCache.set(roles, rules)
+
+        acls = []
+        if self.page_restricted(c=c, f=f):
+            acls.extend(rules.get((c, None), []))
+            if f and self.use_facls:
+                acls.extend(rules.get((c, f), []))
+        if t and self.use_tacls:
+            acls.extend(rules.get(str(t), []))
+        return acls
+
+    # -------------------------------------------------------------------------
+    def get_realms_key(self, realms, delegations):
+        """
+            Get a hash key for the realms and delegations of the current
+            user, to look up decisions in the shared ACL cache
+
+            @param realms: the realms
+            @param delegations: the delegations
+        """
+
+        realms_key = self.realms_key
+        if realms_key is not None and \
+           realms_key[0] is realms and realms_key[1] is delegations:
+            return realms_key[2]
+
+        items = [self.policy]
+        for group_id in sorted(realms):
+            entities = realms[group_id]
+            if entities is not None:
+                entities = sorted(entities)
+            items.append((group_id, entities))
+        if delegations:
+            items.append(sorted((group_id, sorted(delegations[group_id].items()))
+                                for group_id in delegations))
+
+        key = hashlib.md5(repr(items)).hexdigest()
+        self.realms_key = (realms, delegations, key)
+        return key
+
     # -------------------------------------------------------------------------
     # Utilities
     # -------------------------------------------------------------------------
@@ -6440,13 +6707,21 @@ class S3Permission(object):
         s3 = current.response.s3
 
         if not "restricted_tables" in s3:
-            table = self.table
-            query = (table.deleted != True) & \
-                    (table.controller == None) & \
-                    (table.function == None)
-            rows = current.db(query).select(table.tablename,
-                                            groupby=table.tablename)
-            s3.restricted_tables = [row.tablename for row in rows]
+            restricted_tables = None
+            if self.use_cache:
+                restricted_tables = S3PermissionCache.get("restricted_tables")
+            if restricted_tables is None:
+                table = self.table
+                query = (table.deleted != True) & \
+                        (table.controller == None) & \
+                        (table.function == None)
+                rows = current.db(query).select(table.tablename,
+                                                groupby=table.tablename)
+                restricted_tables = set(row.tablename for row in rows)
+                if self.use_cache:
+                    S3PermissionCache.set("restricted_tables",
+                                          restricted_tables)
+            s3.restricted_tables = restricted_tables
 
         return str(t) in s3.restricted_tables
 
@@ -6596,6 +6871,90 @@ class S3Permission(object):
                     del permissions[key]
         return
 
+# =============================================================================
+class S3PermissionCache(object):
+    """
+        Process-wide cache for compiled ACLs and permission decisions,
+        shared across requests:
+
+            - role set => ACLs per controller/function/table
+            - realms/delegations + (racl, c, f, t, entity) => applicable ACLs
+
+        Cache entries are dropped whenever ACLs are written (update_acl,
+        or any DAL write to the permissions table), and after
+        settings.security.acl_cache_expire seconds to catch up with
+        ACL changes made by other processes. Changes of role memberships
+        become effective immediately since they change the realms of
+        the user (see AuthS3.s3_set_roles).
+    """
+
+    store = {}
+    expires = None
+    lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, key):
+        """
+            Look up an item
+
+            @param key: the cache key
+
+            @return: the cached item, or None if not found
+        """
+
+        expires = cls.expires
+        if expires is not None and expires < time.time():
+            cls.clear()
+            return None
+        return cls.store.get(key)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def set(cls, key, value):
+        """
+            Add an item to the cache
+
+            @param key: the cache key
+            @param value: the item
+        """
+
+        settings = current.deployment_settings
+        with cls.lock:
+            store = cls.store
+            if not store:
+                cls.expires = time.time() + \
+                              settings.get_security_acl_cache_expire()
+            elif len(store) >= settings.get_security_acl_cache_size():
+                # Start over rather than tracking the usage of items
+                store.clear()
+            store[key] = value
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls, *args):
+        """ Drop all cached items (also used as DAL callback) """
+
+        with cls.lock:
+            cls.store = {}
+            cls.expires = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def attach(cls, table):
+        """
+            Invalidate the cache upon any DAL write to the permissions table
+
+            @param table: the permissions table
+        """
+
+        if not hasattr(table, "_acl_cache"):
+            clear = cls.clear
+            table._after_insert.append(clear)
+            table._after_update.append(clear)
+            table._after_delete.append(clear)
+            table._acl_cache = True
+
 # =============================================================================
 class S3Audit(object):
     """ S3 Audit Trail Writer Class """
@@ -75,6 +75,9 @@ class S3XLS(S3Codec):
 
             @param resource: the resource
             @param list_fields: fields to include in list views
+
+            @return: tuple (title, types, lfields, heading, rows), where
+                     rows is a generator
         """
 
         title = self.crud_string(resource.tablename, "title_list")
@@ -87,17 +90,17 @@ class S3XLS(S3Codec):
         if orderby is None:
             orderby = resource.get_config("orderby", None)
 
-        result = resource.select(list_fields,
-                                 left=left,
-                                 limit=None,
-                                 count=True,
-                                 getids=True,
-                                 orderby=orderby,
-                                 represent=True,
-                                 show_links=False)
+        rfields = resource.resolve_selectors(list_fields,
+                                             extra_fields=False)[0]
 
-        rfields = result["rfields"]
-        rows = result["rows"]
+        # Extract the rows chunk by chunk
+        chunks = resource.iter_select(list_fields,
+                                      left=left,
+                                      limit=None,
+                                      orderby=orderby,
+                                      represent=True,
+                                      show_links=False)
+        rows = (row for data in chunks for row in data.rows)
 
         types = []
         lfields = []
@@ -179,17 +182,17 @@ class S3XLS(S3Codec):
             headers = data_source[0]
             types = data_source[1]
             rows = data_source[2:]
+            if len(rows) > 0 and len(headers) != len(rows[0]):
+                msg = """modules/s3/codecs/xls: There is an error in the list_items, a field doesn't exist"
+requesting url %s
+Headers = %d, Data Items = %d
+Headers     %s
+List Fields %s""" % (request.url, len(headers), len(rows[0]), headers, list_fields)
+                current.log.error(msg)
         else:
             (title, types, lfields, headers, rows) = self.extractResource(data_source,
                                                                           list_fields)
         report_groupby = lfields[group] if group else None
-        if len(rows) > 0 and len(headers) != len(rows[0]):
-            msg = """modules/s3/codecs/xls: There is an error in the list_items, a field doesn't exist"
-requesting url %s
-Headers = %d, Data Items = %d
-Headers     %s
-List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fields)
-            current.log.error(msg)
         groupby_label = headers[report_groupby] if report_groupby else None
 
         # Date/Time formats from L10N deployment settings
@@ -294,6 +297,7 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
 
         # Initialize counters
         totalCols = colCnt
+        flush_rows = settings.get_ui_export_chunk_size()
         #rowCnt = 2
         rowCnt = 0
 
@@ -394,6 +398,11 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
                     fieldWidths[colCnt] = width
                     sheet1.col(writeCol).width = width
                 colCnt += 1
+
+            # Serialize the rows written so far to release memory
+            if rowCnt % flush_rows == 0:
+                sheet1.flush_row_data()
+
         sheet1.panes_frozen = True
         #sheet1.horz_split_pos = 3
         sheet1.horz_split_pos = 1
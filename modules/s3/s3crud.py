@@ -1442,9 +1442,13 @@ class S3CRUD(S3Method):
                                                     limit=limit,
                                                     left=left,
                                                     orderby=orderby,
-                                                    distinct=distinct)
+                                                    distinct=distinct,
+                                                    seek=True)
             displayrows = totalrows
 
+            # Remember the cursor for the next page
+            self._cursor(list_id, resource, orderby, start, limit, dt)
+
             if not dt.data:
                 # Empty table - or just no match?
                 #if dt.empty:
@@ -1498,13 +1502,19 @@ class S3CRUD(S3Method):
 
             # Get a data table
             if totalrows != 0:
+                # Continue after the previous page if possible
+                seek = self._cursor(list_id, resource, orderby, start)
                 dt, displayrows, ids = resource.datatable(fields=list_fields,
                                                           start=start,
                                                           limit=limit,
                                                           left=left,
                                                           orderby=orderby,
                                                           distinct=distinct,
-                                                          getids=False)
+                                                          getids=False,
+                                                          seek=seek)
+
+                # Remember the cursor for the next page
+                self._cursor(list_id, resource, orderby, start, limit, dt)
             else:
                 dt, displayrows = None, 0
             if totalrows is None:
@@ -3126,4 +3136,53 @@ class S3CRUD(S3Method):
 
         return start, limit
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _cursor(list_id, resource, orderby, start, limit=None, dt=None):
+        """
+            Look up or store the keyset pagination cursor for a page of
+            a data table in the session, so that subsequent page requests
+            can continue after the last record of the previous page
+            rather than counting through all previous records
+
+            @param list_id: the data table ID
+            @param resource: the resource (filtered)
+            @param orderby: the orderby expression
+            @param start: the index of the first record of the page
+            @param limit: the page length (when storing)
+            @param dt: the S3DataTable for the page (when storing)
+
+            @return: the cursor for the page starting at start, or True
+                     if no cursor is available (when looking up)
+        """
+
+        # Cursors are only valid for the same query and order
+        key = "%s|%s|%s" % (resource.tablename,
+                            resource.get_query(),
+                            orderby,
+                            )
+
+        s3 = current.session.s3
+        cursors = s3.dt_cursors
+        if cursors is None:
+            cursors = s3.dt_cursors = {}
+
+        item = cursors.get(list_id)
+        if item is None or item[0] != key:
+            item = cursors[list_id] = (key, {})
+        pages = item[1]
+
+        start = start or 0
+        if dt is None:
+            # Look up
+            return pages.get(start, True)
+
+        elif dt.cursor and limit and len(dt.data) == limit:
+            # Store, limit the number of stored cursors per table
+            if len(pages) >= 50:
+                pages.clear()
+            pages[start + limit] = dt.cursor
+
+        return None
+
 # END =========================================================================
@@ -35,7 +35,8 @@ import datetime
 import re
 import sys
 
-from itertools import product, islice
+from array import array
+from itertools import chain, islice
 
 from gluon import current
 from gluon.html import *
@@ -46,6 +47,11 @@ from s3dal import Expression
 from s3utils import s3_flatlist, s3_has_foreign_key, s3_orderby_fields, s3_unicode, S3MarkupStripper, s3_represent_value, s3_set_extension
 from s3validators import IS_NUMBER
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEBUG = False
 if DEBUG:
     print >> sys.stderr, "S3 Data Representations: DEBUG MODE"
@@ -72,6 +78,7 @@ class S3DataTable(object):
                  filterString=None,
                  orderby=None,
                  empty=False,
+                 cursor=None,
                  ):
         """
             S3DataTable constructor
@@ -83,11 +90,13 @@ class S3DataTable(object):
             @param limit: the (maximum) number of records to return
             @param filterString: The string that was used in filtering the records
             @param orderby: the DAL orderby construct
+            @param cursor: the keyset pagination cursor for the next page
         """
 
         self.data = data
         self.rfields = rfields
         self.empty = empty
+        self.cursor = cursor
 
         colnames = []
         heading = {}
@@ -1252,7 +1261,11 @@ class S3PivotTable(object):
                #"std": "Standard Deviation"
                }
 
-    def __init__(self, resource, rows, cols, layers, strict=True):
+    #: Aggregation methods which can be computed in the database
+    DB_METHODS = ("count", "min", "max", "sum", "avg")
+
+    def __init__(self, resource, rows, cols, layers, strict=True,
+                 db_aggregate=None):
         """
             Constructor - extracts all unique records, generates a
             pivot table from them with the given dimensions and
@@ -1265,6 +1278,13 @@ class S3PivotTable(object):
                            for the value aggregation(s)
             @param strict: filter out dimension values which don't match
                            the resource filter
+            @param db_aggregate: compute the aggregates in the database
+                                 if possible (default: deployment setting
+                                 ui.report_db_aggregate)
+
+            @note: with db_aggregate, cells, rows and cols do not contain
+                   the record IDs (records=[]), so the cell contents
+                   lookup in json() will not be available
         """
 
         # Initialize ----------------------------------------------------------
@@ -1293,6 +1313,8 @@ class S3PivotTable(object):
 
         self.empty = False
         """ Empty-flag (True if no records could be found) """
+        self.numrecords = None
+        """ The number of records (if aggregated in the database) """
         self.numrows = None
         """ The number of rows in the pivot table """
         self.numcols = None
@@ -1349,10 +1371,24 @@ class S3PivotTable(object):
             _start = datetime.datetime.now()
             _debug("S3PivotTable %s starting" % tablename)
 
+        if db_aggregate is None:
+            settings = current.deployment_settings
+            db_aggregate = settings.get_ui_report_db_aggregate()
+
+        # Aggregate in the database? ------------------------------------------
+        #
+        if db_aggregate and self._db_aggregatable():
+            self._db_pivot()
+            drows = None
+
         # Retrieve the records ------------------------------------------------
         #
-        data = resource.select(self.rfields.keys(), limit=None)
-        drows = data["rows"]
+        else:
+            data = resource.select(self.rfields.keys(), limit=None)
+            drows = data["rows"]
+            if not drows:
+                self.empty = True
+
         if drows:
 
             key = str(resource.table._id)
@@ -1361,7 +1397,6 @@ class S3PivotTable(object):
             # Generate the data frame -----------------------------------------
             #
             gfields = self.gfields
-            pkey_colname = gfields[self.pkey]
             rows_colname = gfields[rows]
             cols_colname = gfields[cols]
 
@@ -1374,72 +1409,40 @@ class S3PivotTable(object):
             else:
                 axisfilter = None
 
-            dataframe = []
-            extend = dataframe.extend
-            #insert = dataframe.append
-            expand = self._expand
-
-            for _id in records:
-                row = records[_id]
-                item = {key: _id}
-                if rows_colname:
-                    item[rows_colname] = row[rows_colname]
-                if cols_colname:
-                    item[cols_colname] = row[cols_colname]
-                extend(expand(item, axisfilter=axisfilter))
-
             self.records = records
 
+            frame = self._frame(records,
+                                rows_colname,
+                                cols_colname,
+                                axisfilter=axisfilter)
+            rnames, cnames = frame[-2:]
+
             #if DEBUG:
                 #duration = datetime.datetime.now() - _start
                 #duration = '{:.2f}'.format(duration.total_seconds())
                 #_debug("Dataframe complete after %s seconds" % duration)
 
-            # Group the records -----------------------------------------------
+            # Initialize columns, rows and cells ------------------------------
             #
-            matrix, rnames, cnames = self._pivot(dataframe,
-                                                 pkey_colname,
-                                                 rows_colname,
-                                                 cols_colname)
+            self.col = [Storage({"value": v}) for v in cnames]
+            self.numcols = len(self.col)
 
-            #if DEBUG:
-                #duration = datetime.datetime.now() - _start
-                #duration = '{:.2f}'.format(duration.total_seconds())
-                #_debug("Pivoting complete after %s seconds" % duration)
-
-            # Initialize columns and rows -------------------------------------
-            #
-            if cols:
-                self.col = [Storage({"value": v}) for v in cnames]
-                self.numcols = len(self.col)
-            else:
-                self.col = [Storage({"value": None})]
-                self.numcols = 1
+            self.row = [Storage({"value": v}) for v in rnames]
+            self.numrows = len(self.row)
 
-            if rows:
-                self.row = [Storage({"value": v}) for v in rnames]
-                self.numrows = len(self.row)
-            else:
-                self.row = [Storage({"value": None})]
-                self.numrows = 1
+            self._init_cells(frame)
 
             # Add the layers --------------------------------------------------
             #
             add_layer = self._add_layer
-            layers = list(self.layers)
             for f, m in self.layers:
-                add_layer(matrix, f, m)
+                add_layer(frame, f, m)
 
             #if DEBUG:
                 #duration = datetime.datetime.now() - _start
                 #duration = '{:.2f}'.format(duration.total_seconds())
                 #_debug("Layers complete after %s seconds" % duration)
 
-        else:
-            # No items to report on -------------------------------------------
-            #
-            self.empty = True
-
         if DEBUG:
             duration = datetime.datetime.now() - _start
             duration = '{:.2f}'.format(duration.total_seconds())
@@ -1453,7 +1456,7 @@ class S3PivotTable(object):
 
         items = self.records
         if items is None:
-            return 0
+            return self.numrecords or 0
         else:
             return len(self.records)
 
@@ -2060,78 +2063,249 @@ class S3PivotTable(object):
     # -------------------------------------------------------------------------
     # Internal methods
     # -------------------------------------------------------------------------
-    @staticmethod
-    def _pivot(items, pkey_colname, rows_colname, cols_colname):
+    def _frame(self, records, rows_colname, cols_colname, axisfilter=None):
         """
-            2-dimensional pivoting of a list of unique items
+            Generate the columnar data frame: each record is expanded
+            into one item per combination of its row/column dimension
+            values (list:types), and the items are stored as arrays of
+            integer codes rather than as dicts
 
-            @param items: list of unique items as dicts
-            @param pkey_colname: column name of the primary key
+            @param records: the records as dict {record_id: row}
             @param rows_colname: column name of the row dimension
             @param cols_colname: column name of the column dimension
+            @param axisfilter: dict of filtered field values by column names
+
+            @return: tuple (ids, index, cellcodes, rnames, cnames):
+                     ids: the record IDs, in frame order
+                     index: the index (in ids) of the record of each item
+                     cellcodes: the cell code (row * numcols + col)
+                                of each item
+                     rnames: the row dimension values, by row code
+                     cnames: the column dimension values, by column code
+        """
+
+        ids = array("l")
+        index = array("l")
+        rcodes = array("l")
+        ccodes = array("l")
+
+        rvalues = {}
+        cvalues = {}
+
+        # Same field for both axes => only one value per item
+        diagonal = rows_colname == cols_colname
+
+        axis_values = self._axis_values
+        for i, record_id in enumerate(records):
+            row = records[record_id]
+            ids.append(record_id)
+
+            codes = []
+            for cvalue in axis_values(row, cols_colname, axisfilter):
+                c = cvalues.get(cvalue)
+                if c is None:
+                    c = cvalues[cvalue] = len(cvalues)
+                codes.append(c)
+
+            for rvalue in axis_values(row, rows_colname, axisfilter):
+                r = rvalues.get(rvalue)
+                if r is None:
+                    r = rvalues[rvalue] = len(rvalues)
+                for c in codes if not diagonal else (cvalues[rvalue],):
+                    index.append(i)
+                    rcodes.append(r)
+                    ccodes.append(c)
+
+        numcols = len(cvalues)
+        cellcodes = array("l", (rcodes[k] * numcols + ccodes[k]
+                                for k in xrange(len(rcodes))))
 
-            @return: tuple of (cell matrix, row headers, column headers),
-                     where cell matrix is a 2-dimensional array [rows[columns]]
-                     and row headers and column headers each are lists (in the
-                     same order as the cell matrix)
+        rnames = [None] * len(rvalues)
+        for k, v in rvalues.items():
+            rnames[v] = k
+
+        cnames = [None] * numcols
+        for k, v in cvalues.items():
+            cnames[v] = k
+
+        return ids, index, cellcodes, rnames, cnames
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _axis_values(row, colname, axisfilter=None):
         """
+            Get the dimension values of a record
 
-        rvalues = Storage()
-        cvalues = Storage()
-        cells = Storage()
+            @param row: the record
+            @param colname: the column name of the dimension
+            @param axisfilter: dict of filtered field values by column names
 
-        # All unique rows values
-        rindex = 0
-        cindex = 0
-        for item in items:
+            @return: list of dimension values
+        """
 
-            rvalue = item[rows_colname] if rows_colname else None
-            cvalue = item[cols_colname] if cols_colname else None
+        if not colname:
+            return [None]
 
-            if rvalue not in rvalues:
-                r = rvalues[rvalue] = rindex
-                rindex += 1
-            else:
-                r = rvalues[rvalue]
-            if cvalue not in cvalues:
-                c = cvalues[cvalue] = cindex
-                cindex += 1
-            else:
-                c = cvalues[cvalue]
+        value = row[colname]
+        if type(value) is list:
+            if not value:
+                return [None]
+            if axisfilter and colname in axisfilter:
+                allowed = axisfilter[colname]
+                value = [v for v in value if v in allowed]
+                if not value:
+                    raise RuntimeError("record does not match query")
+            return value
+        else:
+            return [value]
 
-            if (r, c) not in cells:
-                cells[(r, c)] = [item[pkey_colname]]
-            else:
-                cells[(r, c)].append(item[pkey_colname])
+    # -------------------------------------------------------------------------
+    def _init_cells(self, frame):
+        """
+            Initialize the cells, and the records per cell, row and column
 
-        matrix = []
-        for r in xrange(len(rvalues)):
-            row = []
-            for c in xrange(len(cvalues)):
-                row.append(cells[(r, c)])
-            matrix.append(row)
+            @param frame: the data frame (see _frame)
+        """
 
-        rnames = [None] * len(rvalues)
-        for k, v in rvalues.items():
-            rnames[v] = k
+        ids, index, cellcodes = frame[:3]
 
-        cnames = [None] * len(cvalues)
-        for k, v in cvalues.items():
-            cnames[v] = k
+        numrows = self.numrows
+        numcols = self.numcols
 
-        return matrix, rnames, cnames
+        crecords = [[] for i in xrange(numrows * numcols)]
+        for k in xrange(len(cellcodes)):
+            crecords[cellcodes[k]].append(ids[index[k]])
+
+        RECORDS = "records"
+
+        self.cell = cells = []
+        for r in xrange(numrows):
+            row = self.row[r]
+            row_records = row[RECORDS] = []
+            cells.append([])
+            for c in xrange(numcols):
+                records = crecords[r * numcols + c]
+                cells[r].append(Storage({RECORDS: records}))
+                row_records.extend(records)
+
+        for c in xrange(numcols):
+            col = self.col[c]
+            col_records = col[RECORDS] = []
+            for r in xrange(numrows):
+                col_records.extend(cells[r][c][RECORDS])
+        return
+
+    # -------------------------------------------------------------------------
+    def _facts(self, ids, fact):
+        """
+            Extract and integer-encode the values of a fact for all
+            records (list:types and multiple values from joined tables
+            are flattened, None-values are skipped)
+
+            @param ids: the record IDs (in frame order)
+            @param fact: the fact field selector
+
+            @return: tuple (offsets, vcodes, vnames), where the value
+                     codes of the i-th record are in
+                     vcodes[offsets[i]:offsets[i+1]], and vnames are
+                     the values by code
+        """
+
+        records = self.records
+        extract = self._extract
+
+        offsets = array("l", [0])
+        vcodes = array("l")
+        vmap = {}
+        vnames = []
+
+        append = vcodes.append
+        for record_id in ids:
+            value = extract(records[record_id], fact)
+            if value is not None:
+                if type(value) is list:
+                    values = s3_flatlist(value)
+                else:
+                    values = (value,)
+                for v in values:
+                    if v is None:
+                        continue
+                    code = vmap.get(v)
+                    if code is None:
+                        code = vmap[v] = len(vnames)
+                        vnames.append(v)
+                    append(code)
+            offsets.append(len(vcodes))
+
+        return offsets, vcodes, vnames
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _pairs(frame, offsets, vcodes, unique=False):
+        """
+            Explode the data frame items into (cell, value) pairs
+
+            @param frame: the data frame (see _frame)
+            @param offsets: the value offsets per record (see _facts)
+            @param vcodes: the value codes (see _facts)
+            @param unique: only return unique pairs
+
+            @return: tuple of arrays (cells, values), containing the
+                     cell code and the value code of each pair
+        """
+
+        index, cellcodes = frame[1:3]
+
+        if numpy is not None and len(index):
+
+            index = numpy.asarray(index, dtype=numpy.int_)
+            offsets = numpy.asarray(offsets, dtype=numpy.int_)
+            counts = (offsets[1:] - offsets[:-1])[index]
+
+            cells = numpy.repeat(numpy.asarray(cellcodes, dtype=numpy.int_),
+                                 counts)
+            if not len(cells):
+                return cells, cells
+            starts = numpy.repeat(offsets[:-1][index] - \
+                                  (numpy.cumsum(counts) - counts), counts)
+            values = numpy.asarray(vcodes, dtype=numpy.int_)
+            values = values[starts + numpy.arange(len(cells))]
+
+            if unique:
+                numvalues = int(values.max()) + 1
+                keys = numpy.unique(cells * numvalues + values)
+                cells = keys // numvalues
+                values = keys % numvalues
+
+        else:
+            cells = array("l")
+            values = array("l")
+            seen = set()
+            for k in xrange(len(index)):
+                i = index[k]
+                cell = cellcodes[k]
+                for code in vcodes[offsets[i]:offsets[i+1]]:
+                    if unique:
+                        if (cell, code) in seen:
+                            continue
+                        seen.add((cell, code))
+                    cells.append(cell)
+                    values.append(code)
+
+        return cells, values
 
     # -------------------------------------------------------------------------
-    def _add_layer(self, matrix, fact, method):
+    def _add_layer(self, frame, fact, method):
         """
-            Compute an aggregation layer, updates:
+            Compute an aggregation layer in one pass over the data frame,
+            updates:
 
                 - self.cell: the aggregated values per cell
                 - self.row: the totals per row
                 - self.col: the totals per column
                 - self.totals: the overall totals per layer
 
-            @param matrix: the cell matrix
+            @param frame: the data frame (see _frame)
             @param fact: the fact field
             @param method: the aggregation method
         """
@@ -2139,115 +2313,410 @@ class S3PivotTable(object):
         if method not in self.METHODS:
             raise SyntaxError("Unsupported aggregation method: %s" % method)
 
-        #items = self.records
-        #rfields = self.rfields
-        rows = self.row
-        cols = self.col
-        records = self.records
-        extract = self._extract
-        aggregate = self._aggregate
+        if method is None:
+            method = "list"
+        layer = (fact, method)
+
+        numrows = self.numrows
+        numcols = self.numcols
+        numcells = numrows * numcols
+
+        offsets, vcodes, vnames = self._facts(frame[0], fact)
+
+        unique = method in ("list", "count")
+        pcells, pvalues = self._pairs(frame, offsets, vcodes, unique=unique)
+
+        numeric = all(type(v) in (int, long, float) for v in vnames)
+        if method == "count" or \
+           numeric and method in ("sum", "min", "max", "avg"):
+            # Numeric accumulation
+            values = vnames if numeric and method != "count" else None
+            cells, rows, cols, total = self._accumulate(pcells,
+                                                        pvalues,
+                                                        values,
+                                                        method,
+                                                        numrows,
+                                                        numcols,
+                                                        )
+            integer = all(type(v) is not float for v in vnames)
+            result = lambda state: self._result(state, method, integer)
+        else:
+            # Generic accumulation of value lists
+            cells = [[] for i in xrange(numcells)]
+            for k in xrange(len(pcells)):
+                cells[pcells[k]].append(vnames[pvalues[k]])
+            rows = [[] for r in xrange(numrows)]
+            cols = [[] for c in xrange(numcols)]
+            for cell in xrange(numcells):
+                values = cells[cell]
+                rows[cell // numcols].extend(values)
+                cols[cell % numcols].extend(values)
+            total = list(chain.from_iterable(rows))
+            aggregate = self._aggregate
+            result = lambda values: aggregate(values, method)
+
+        for r in xrange(numrows):
+            row = self.cell[r]
+            for c in xrange(numcols):
+                row[c][layer] = result(cells[r * numcols + c])
+            self.row[r][layer] = result(rows[r])
+        for c in xrange(numcols):
+            self.col[c][layer] = result(cols[c])
+        self.totals[layer] = result(total)
+
+        self.values[layer] = vnames
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _accumulate(pcells, pvalues, vnames, method, numrows, numcols):
+        """
+            Accumulate numeric (cell, value) pairs into states per cell,
+            row, column and in total, state being a tuple (count, sum,
+            min, max)
+
+            @param pcells: the cell codes of the pairs
+            @param pvalues: the value codes of the pairs
+            @param vnames: the numeric values by code (None to only count)
+            @param method: the aggregation method
+            @param numrows: the number of rows
+            @param numcols: the number of columns
+
+            @return: tuple (cells, rows, cols, total) of states
+        """
+
+        numcells = numrows * numcols
+        count_only = vnames is None
+
+        if numpy is not None:
+
+            pcells = numpy.asarray(pcells, dtype=numpy.int_)
+            counts = numpy.bincount(pcells, minlength=numcells)
+            if count_only or not len(pcells):
+                sums = numpy.zeros(numcells)
+                mins = maxs = sums
+            else:
+                values = numpy.array(vnames, dtype=float)
+                values = values[numpy.asarray(pvalues, dtype=numpy.int_)]
+                sums = numpy.bincount(pcells, weights=values,
+                                      minlength=numcells)
+                mins = maxs = sums
+                if method in ("min", "max"):
+                    # Sort by cell and value, and pick the first/last
+                    # value for each cell
+                    order = numpy.lexsort((values, pcells))
+                    scells = pcells[order]
+                    svalues = values[order]
+                    boundary = scells[1:] != scells[:-1]
+                    mins = numpy.zeros(numcells)
+                    maxs = numpy.zeros(numcells)
+                    first = numpy.concatenate(([True], boundary))
+                    last = numpy.concatenate((boundary, [True]))
+                    mins[scells[first]] = svalues[first]
+                    maxs[scells[last]] = svalues[last]
+
+            shape = (numrows, numcols)
+            ccounts = counts.reshape(shape)
+            csums = sums.reshape(shape)
+            cmins = numpy.where(ccounts > 0, mins.reshape(shape), numpy.inf)
+            cmaxs = numpy.where(ccounts > 0, maxs.reshape(shape), -numpy.inf)
+
+            def states(counts, sums, mins, maxs):
+                return [(int(counts[i]),
+                         sums[i],
+                         mins[i] if counts[i] else None,
+                         maxs[i] if counts[i] else None,
+                         ) for i in xrange(len(counts))]
+
+            cells = states(counts, sums, mins, maxs)
+            rows = states(ccounts.sum(axis=1),
+                          csums.sum(axis=1),
+                          cmins.min(axis=1),
+                          cmaxs.max(axis=1),
+                          )
+            cols = states(ccounts.sum(axis=0),
+                          csums.sum(axis=0),
+                          cmins.min(axis=0),
+                          cmaxs.max(axis=0),
+                          )
+            total = states([counts.sum()],
+                           [sums.sum()],
+                           [cmins.min() if numcells else None],
+                           [cmaxs.max() if numcells else None],
+                           )[0]
+
+        else:
+
+            counts = array("l", [0]) * numcells
+            sums = [0] * numcells
+            mins = [None] * numcells
+            maxs = [None] * numcells
+
+            for k in xrange(len(pcells)):
+                cell = pcells[k]
+                counts[cell] += 1
+                if count_only:
+                    continue
+                value = vnames[pvalues[k]]
+                sums[cell] += value
+                if mins[cell] is None or value < mins[cell]:
+                    mins[cell] = value
+                if maxs[cell] is None or value > maxs[cell]:
+                    maxs[cell] = value
+
+            def merge(indices):
+                count = 0
+                total = 0
+                vmin = vmax = None
+                for i in indices:
+                    if not counts[i]:
+                        continue
+                    count += counts[i]
+                    total += sums[i]
+                    if vmin is None or mins[i] < vmin:
+                        vmin = mins[i]
+                    if vmax is None or maxs[i] > vmax:
+                        vmax = maxs[i]
+                return (count, total, vmin, vmax)
+
+            cells = [merge((i,)) for i in xrange(numcells)]
+            rows = [merge(xrange(r * numcols, (r + 1) * numcols))
+                    for r in xrange(numrows)]
+            cols = [merge(xrange(c, numcells, numcols))
+                    for c in xrange(numcols)]
+            total = merge(xrange(numcells))
+
+        return cells, rows, cols, total
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _result(state, method, integer=False):
+        """
+            Compute the aggregate from an accumulator state, producing
+            the same results as _aggregate would for the underlying values
+
+            @param state: the state, a tuple (count, sum, min, max)
+            @param method: the aggregation method
+            @param integer: the values are integers
+        """
+
+        count, total, vmin, vmax = state
+
+        if method == "count":
+            return int(count)
+
+        convert = (lambda v: int(round(v))) if integer else float
+        if method == "sum":
+            return convert(total) if count else 0
+        elif method == "min":
+            return convert(vmin) if vmin is not None else None
+        elif method == "max":
+            return convert(vmax) if vmax is not None else None
+        elif method == "avg":
+            return float(total) / count if count else 0.0
+        else:
+            return None
+
+    # -------------------------------------------------------------------------
+    def _db_aggregatable(self):
+        """
+            Check whether all layers of this pivot table can be computed
+            by a single GROUPBY query in the database: requires that there
+            is no virtual field filter, that all methods are in DB_METHODS,
+            that all facts other than counts are numeric, and that all
+            axes and facts are real fields which are not list-types, and
+            which are either in the master table or in tables referenced
+            by foreign keys (=at most one value per record)
+
+            @return: True|False
+        """
+
         resource = self.resource
+        if resource.get_filter() is not None:
+            return False
 
-        RECORDS = "records"
-        VALUES = "values"
+        rfields = self.rfields
+        selectors = [s for s in (self.rows, self.cols) if s]
+        for fact, method in self.layers:
+            if method not in self.DB_METHODS:
+                return False
+            if method != "count":
+                # Other aggregates of non-numeric values (e.g. min/max of
+                # dates) are reported with their records, which the
+                # database path doesn't retrieve
+                rfield = rfields.get(fact)
+                if rfield is None or \
+                   rfield.ftype not in ("integer", "double") and \
+                   rfield.ftype[:7] != "decimal":
+                    return False
+            selectors.append(fact)
 
-        table = resource.table
-        pkey = table._id.name
+        alias = resource.alias
+        prefix = "%s." % alias
+        for selector in selectors:
+            rfield = rfields.get(selector)
+            if rfield is None or rfield.field is None:
+                return False
+            ftype = rfield.ftype
+            if ftype[:5] == "list:" or ftype == "json":
+                return False
+            path = rfield.selector
+            if path[:2] == "~.":
+                path = path[2:]
+            elif path.startswith(prefix):
+                path = path[len(prefix):]
+            if "." in path or "(" in path:
+                # Component, link table or context => can be multiple
+                return False
+        return True
 
-        if method is None:
-            method = "list"
-        layer = (fact, method)
+    # -------------------------------------------------------------------------
+    def _db_pivot(self):
+        """
+            Compute the pivot table with a single GROUPBY query in the
+            database: selects the partial aggregates per cell, and then
+            derives the row, column and grand totals from these (the same
+            way the Python path computes them)
+        """
 
-        numcols = len(self.col)
-        numrows = len(self.row)
+        resource = self.resource
+        rfields = self.rfields
 
-        # Initialize cells
-        if self.cell is None:
-            self.cell = [[Storage()
-                          for i in xrange(numcols)]
-                         for j in xrange(numrows)]
-        cells = self.cell
+        rows_rfield = rfields[self.rows] if self.rows else None
+        cols_rfield = rfields[self.cols] if self.cols else None
+
+        dimensions = [rfield for rfield in (rows_rfield, cols_rfield) if rfield]
+        groupby = [rfield.field for rfield in dimensions]
+        selectors = [rfield.selector for rfield in dimensions]
+
+        # Build the aggregate expressions, as layer => (index, index)
+        aggregate = []
+        expressions = {}
+        def add(expression):
+            colname = str(expression)
+            for index, expr in enumerate(aggregate):
+                if str(expr) == colname:
+                    return index
+            aggregate.append(expression)
+            return len(aggregate) - 1
+
+        pkey = resource._id
+        count = add(pkey.count(distinct=True))
+
+        for layer in self.layers:
+            fact, method = layer
+            rfield = rfields[fact]
+            if rfield.selector not in selectors:
+                selectors.append(rfield.selector)
+            field = rfield.field
+            if method == "count":
+                expressions[layer] = (add(field.count(distinct=True)),)
+            elif method == "avg":
+                expressions[layer] = (add(field.sum()), add(field.count()))
+            else:
+                expressions[layer] = (add(getattr(field, method)()),)
 
-        all_values = []
-        for r in xrange(numrows):
+        data = resource.select(selectors,
+                               limit=None,
+                               groupby=groupby,
+                               aggregate=aggregate,
+                               )
+        drows = data.rows
+        if not drows:
+            self.empty = True
+            return
 
-            # Initialize row header
-            row = rows[r]
-            row[RECORDS] = []
-            row[VALUES] = []
+        # Collect the partial aggregates per cell
+        rows_colname = str(rows_rfield.field) if rows_rfield else None
+        cols_colname = str(cols_rfield.field) if cols_rfield else None
 
-            row_records = row[RECORDS]
-            row_values = row[VALUES]
+        rvalues = {}
+        cvalues = {}
+        partials = {}
+        for row in drows:
+            rvalue = row[rows_colname] if rows_colname else None
+            cvalue = row[cols_colname] if cols_colname else None
+            r = rvalues.setdefault(rvalue, len(rvalues))
+            c = cvalues.setdefault(cvalue, len(cvalues))
+            partials[(r, c)] = [row[expr] for expr in aggregate]
 
-            for c in xrange(numcols):
+        numrows = self.numrows = len(rvalues)
+        numcols = self.numcols = len(cvalues)
 
-                # Initialize column header
-                col = cols[c]
-                if RECORDS not in col:
-                    col[RECORDS] = []
-                col_records = col[RECORDS]
-                if VALUES not in col:
-                    col[VALUES] = []
-                col_values = col[VALUES]
-
-                # Get the records
-                cell = cells[r][c]
-                if RECORDS in cell and cell[RECORDS] is not None:
-                    ids = cell[RECORDS]
-                else:
-                    data = matrix[r][c]
-                    if data:
-                        remove = data.remove
-                        while None in data:
-                            remove(None)
-                        ids = data
-                    else:
-                        ids = []
-                    cell[RECORDS] = ids
-                row_records.extend(ids)
-                col_records.extend(ids)
-
-                # Get the values
-                if fact is None:
-                    fact = pkey
-                    values = ids
-                    row_values = row_records
-                    col_values = row_records
-                    all_values = records.keys()
-                else:
-                    values = []
-                    append = values.append
-                    for i in ids:
-                        value = extract(records[i], fact)
-                        if value is None:
-                            continue
-                        append(value)
-                    values = list(s3_flatlist(values))
-                    if method in ("list", "count"):
-                        values =  list(set(values))
-                    row_values.extend(values)
-                    col_values.extend(values)
-                    all_values.extend(values)
-
-                # Aggregate values
-                value = aggregate(values, method)
-                cell[layer] = value
-
-            # Compute row total
-            row[layer] = aggregate(row_values, method)
-            del row[VALUES]
-
-        # Compute column total
-        for c in xrange(numcols):
-            col = cols[c]
-            col[layer] = aggregate(col[VALUES], method)
-            del col[VALUES]
+        rnames = [None] * numrows
+        for k, v in rvalues.items():
+            rnames[v] = k
+        cnames = [None] * numcols
+        for k, v in cvalues.items():
+            cnames[v] = k
+
+        self.row = [Storage(value=v, records=[]) for v in rnames]
+        self.col = [Storage(value=v, records=[]) for v in cnames]
+        self.cell = [[Storage(records=[]) for c in xrange(numcols)]
+                     for r in xrange(numrows)]
+
+        # Number of records
+        self.numrecords = sum(p[count] or 0 for p in partials.values())
+
+        # Group the partial aggregates by row and column
+        rpartials = [[] for r in xrange(numrows)]
+        cpartials = [[] for c in xrange(numcols)]
+        for (r, c), p in partials.items():
+            rpartials[r].append(p)
+            cpartials[c].append(p)
 
-        # Compute overall total
-        self.totals[layer] = aggregate(all_values, method)
-        self.values[layer] = all_values
+        # Compute the layers
+        combine = self._db_combine
+        cells = self.cell
+        empty = ()
+        for layer in self.layers:
+            method = layer[1]
+            indices = expressions[layer]
+            for r in xrange(numrows):
+                for c in xrange(numcols):
+                    p = partials.get((r, c))
+                    cells[r][c][layer] = combine([p] if p else empty,
+                                                 indices, method)
+                self.row[r][layer] = combine(rpartials[r], indices, method)
+            for c in xrange(numcols):
+                self.col[c][layer] = combine(cpartials[c], indices, method)
+            self.totals[layer] = combine(partials.values(), indices, method)
+            self.values[layer] = None
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _db_combine(partials, indices, method):
+        """
+            Combine partial aggregates from the database into a total,
+            producing the same results as _aggregate would for the
+            underlying values
+
+            @param partials: list of lists of partial aggregates
+            @param indices: the indices of the partial aggregates for
+                            the layer (one index, or two indices (sum,
+                            count) for avg)
+            @param method: the aggregation method
+        """
+
+        index = indices[0]
+        values = [p[index] for p in partials if p[index] is not None]
+
+        if method in ("count", "sum"):
+            return sum(values)
+        elif method == "min":
+            return min(values) if values else None
+        elif method == "max":
+            return max(values) if values else None
+        elif method == "avg":
+            numvalues = sum(p[indices[1]] or 0 for p in partials)
+            if numvalues:
+                return sum(values) / float(numvalues)
+            else:
+                return 0.0
+        else:
+            return None
+
     # -------------------------------------------------------------------------
     @staticmethod
     def _aggregate(values, method):
@@ -2528,39 +2997,6 @@ class S3PivotTable(object):
         except AttributeError:
             return None
 
-    # -------------------------------------------------------------------------
-    def _expand(self, row, axisfilter=None):
-        """
-            Expand a data frame row into a list of rows for list:type values
-
-            @param row: the row
-            @param field: the field to expand (None for all fields)
-            @param axisfilter: dict of filtered field values by column names
-        """
-
-        pairs = []
-        append = pairs.append
-        for colname in self.gfields.values():
-            if not colname:
-                continue
-            value = row[colname]
-            if type(value) is list:
-                if not value:
-                    value = [None]
-                if axisfilter and colname in axisfilter:
-                    p = [(colname, v) for v in value
-                                       if v in axisfilter[colname]]
-                    if not p:
-                        raise RuntimeError("record does not match query")
-                    else:
-                        append(p)
-                else:
-                    append([(colname, v) for v in value])
-            else:
-                append([(colname, value)])
-        result = [dict(i) for i in product(*pairs)]
-        return result
-
     # -------------------------------------------------------------------------
     @staticmethod
     def _get_field_label(rfields, field, resource, key):
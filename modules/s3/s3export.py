@@ -33,8 +33,11 @@
 
 __all__ = ("S3Exporter",)
 
+import tempfile
+
 from gluon import current
 from gluon.storage import Storage
+from gluon.streamer import DEFAULT_CHUNK_SIZE
 
 from s3codec import S3Codec
 
@@ -66,8 +69,25 @@ class S3Exporter(object):
             response.headers["Content-Type"] = contenttype(".csv")
             response.headers["Content-disposition"] = "attachment; filename=%s" % filename
 
-        rows = resource.select(None, as_rows=True)
-        return str(rows)
+        # Write the rows chunk by chunk into a temporary file (which
+        # is kept in memory unless it becomes too large)
+        output = tempfile.SpooledTemporaryFile(max_size=DEFAULT_CHUNK_SIZE * 16)
+        colnames = True
+        for data in resource.iter_select(None, as_rows=True):
+            data.rows.export_to_csv_file(output, write_colnames=colnames)
+            colnames = False
+        if colnames:
+            # No matching records => export just the column names
+            rows = resource.select(None, as_rows=True)
+            rows.export_to_csv_file(output)
+        output.seek(0)
+
+        if response:
+            return response.stream(output,
+                                   chunk_size=DEFAULT_CHUNK_SIZE,
+                                   request=request)
+        else:
+            return output.read()
 
     # -------------------------------------------------------------------------
     def json(self, resource,
@@ -117,16 +137,8 @@ class S3Exporter(object):
                 if tooltip not in fields:
                     fields.append(tooltip)
 
-        # Get the rows and return as json
-        rows = resource.select(fields,
-                               start=start,
-                               limit=limit,
-                               orderby=orderby,
-                               as_rows=True)
-
         if tooltip:
             import sys
-            from s3utils import s3_unicode
             if tooltip_function:
                 # Resolve key and value names against the resource
                 try:
@@ -134,56 +146,105 @@ class S3Exporter(object):
                     vrfield = resource.resolve_selector(vname)
                 except (AttributeError, SyntaxError):
                     current.log.error(sys.exc_info()[1])
-                else:
-                    # Extract key and value fields from each row and
-                    # build options dict for function call
-                    options = []
-                    items = {}
-                    for row in rows:
-                        try:
-                            k = krfield.extract(row)
-                        except KeyError:
-                            break
-                        try:
-                            v = vrfield.extract(row)
-                        except KeyError:
-                            break
-                        items[k] = row
-                        options.append((k, v))
-                    # Call tooltip rendering function
-                    try:
-                        tooltips = tooltip_function(options)
-                    except:
-                        current.log.error(sys.exc_info()[1])
-                    else:
-                        # Add tooltips as "_tooltip" to the corresponding rows
-                        if isinstance(tooltips, dict):
-                            for k, v in tooltips.items():
-                                if k in items:
-                                    items[k]["_tooltip"] = s3_unicode(v)
-                pass
+                    tooltip = None
             else:
                 # Resolve the tooltip field name against the resource
                 try:
                     tooltip_rfield = resource.resolve_selector(tooltip)
                 except (AttributeError, SyntaxError):
                     current.log.error(sys.exc_info()[1])
+                    tooltip = None
+
+        # Get the rows chunk by chunk and return as json
+        output = []
+        append = output.append
+        for data in resource.iter_select(fields,
+                                         start=start,
+                                         limit=limit,
+                                         orderby=orderby,
+                                         as_rows=True):
+            rows = data.rows
+
+            if tooltip:
+                if tooltip_function:
+                    self._tooltips(rows, tooltip_function, krfield, vrfield)
                 else:
-                    # Extract the tooltip field from each row
-                    # and add it as _tooltip
-                    for row in rows:
-                        try:
-                            value = tooltip_rfield.extract(row)
-                        except KeyError:
-                            break
-                        if value:
-                            row["_tooltip"] = s3_unicode(value)
+                    self._tooltip(rows, tooltip_rfield)
+
+            # Strip the brackets to join the chunks into a single list
+            chunk = rows.json()[1:-1]
+            if chunk:
+                append(chunk)
 
         response = current.response
         if response:
             response.headers["Content-Type"] = "application/json"
 
-        return rows.json()
+        return "[%s]" % ",".join(output)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _tooltips(rows, tooltip_function, krfield, vrfield):
+        """
+            Add tooltips rendered by a function as "_tooltip" to the rows
+
+            @param rows: the Rows
+            @param tooltip_function: the tooltip rendering function
+            @param krfield: the S3ResourceField for the key
+            @param vrfield: the S3ResourceField for the value
+        """
+
+        import sys
+        from s3utils import s3_unicode
+
+        # Extract key and value fields from each row and
+        # build options dict for function call
+        options = []
+        items = {}
+        for row in rows:
+            try:
+                k = krfield.extract(row)
+            except KeyError:
+                break
+            try:
+                v = vrfield.extract(row)
+            except KeyError:
+                break
+            items[k] = row
+            options.append((k, v))
+        # Call tooltip rendering function
+        try:
+            tooltips = tooltip_function(options)
+        except:
+            current.log.error(sys.exc_info()[1])
+        else:
+            # Add tooltips as "_tooltip" to the corresponding rows
+            if isinstance(tooltips, dict):
+                for k, v in tooltips.items():
+                    if k in items:
+                        items[k]["_tooltip"] = s3_unicode(v)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _tooltip(rows, tooltip_rfield):
+        """
+            Add the value of a tooltip field as "_tooltip" to the rows
+
+            @param rows: the Rows
+            @param tooltip_rfield: the S3ResourceField for the tooltip
+        """
+
+        from s3utils import s3_unicode
+
+        # Extract the tooltip field from each row
+        # and add it as _tooltip
+        for row in rows:
+            try:
+                value = tooltip_rfield.extract(row)
+            except KeyError:
+                break
+            if value:
+                row["_tooltip"] = s3_unicode(value)
 
     # -------------------------------------------------------------------------
     def pdf(self, *args, **kwargs):
@@ -30,7 +30,12 @@
 """
 
 import datetime
+import hashlib
 import sys
+import threading
+import time
+
+from collections import OrderedDict
 from itertools import chain
 from uuid import uuid4
 
@@ -221,7 +226,8 @@ class S3Represent(object):
                                                     represent_row,
                                                     link
         @group Internal Methods: _setup,
-                                 _lookup
+                                 _lookup,
+                                 _cache_key
     """
 
     def __init__(self,
@@ -284,6 +290,7 @@ class S3Represent(object):
         self.lazy_show_link = False
 
         self.rows = {}
+        self.cache_key = None
 
         # Attributes to simulate being a function for sqlhtml's represent()
         # Make sure we indicate only 1 position argument
@@ -605,9 +612,62 @@ class S3Represent(object):
         else:
             self.htemplate = "%s > %s"
 
+        # Shared representation cache
+        if self.table is not None and \
+           current.deployment_settings.get_base_represent_cache():
+            self.cache_key = self._cache_key()
+            if self.cache_key:
+                S3RepresentCache.attach(self.table)
+
         self.setup = True
         return
 
+    # -------------------------------------------------------------------------
+    def _cache_key(self):
+        """
+            Generate a key for the shared representation cache from the
+            configuration of this instance (and the current language)
+
+            @return: the key, or None if the representations of this
+                     instance can not be shared
+        """
+
+        cls = self.__class__
+
+        # Links may depend on the looked-up rows, which are not cached
+        if self.show_link and cls.link.im_func is not S3Represent.link.im_func:
+            return None
+
+        simple = (basestring, int, long, float, bool, type(None))
+        def is_simple(value):
+            if isinstance(value, (tuple, list)):
+                return all(is_simple(v) for v in value)
+            return isinstance(value, simple)
+
+        config = [cls.__module__, cls.__name__]
+        for name, value in sorted(self.__dict__.items()):
+            if name in S3RepresentCache.SKIP:
+                continue
+            if callable(value) and hasattr(value, "func_code"):
+                if getattr(value, "im_self", None) is not None or \
+                   value.func_closure:
+                    # Bound methods and closures depend on state which
+                    # their code location does not identify
+                    return None
+                defaults = value.func_defaults
+                if defaults and not is_simple(defaults):
+                    return None
+                # Identify functions by their code location
+                code = value.func_code
+                value = (code.co_filename, code.co_firstlineno, defaults)
+            elif not is_simple(value):
+                # Unknown configuration => can not share
+                return None
+            config.append((name, value))
+        config.append(current.T.accepted_language)
+
+        return hashlib.md5(repr(config)).hexdigest()
+
     # -------------------------------------------------------------------------
     def _lookup(self, values, rows=None):
         """
@@ -644,6 +704,18 @@ class S3Represent(object):
         if table is None or not lookup:
             return items
 
+        # Check whether values are in the shared cache
+        cache_key = self.cache_key
+        if cache_key:
+            cached = S3RepresentCache.get(cache_key,
+                                          table._tablename,
+                                          lookup.keys())
+            for k, v in cached.items():
+                del lookup[k]
+                items[keys.get(k, k)] = theset[k] = v
+            if not lookup:
+                return items
+
         if table and self.hierarchy:
             # Does the lookup table have a hierarchy?
             from s3hierarchy import S3Hierarchy
@@ -714,6 +786,13 @@ class S3Represent(object):
                     lookup.pop(k, None)
                     items[keys.get(k, k)] = theset[k] = represent_row(row)
 
+            # Store the new representations in the shared cache
+            if cache_key:
+                S3RepresentCache.set(cache_key,
+                                     table._tablename,
+                                     dict((k, theset[k])
+                                          for k in rows if k in theset))
+
         if lookup:
             for k in lookup:
                 items[keys.get(k, k)] = self.default
@@ -755,6 +834,156 @@ class S3Represent(object):
         theset[value] = result
         return result
 
+# =============================================================================
+class S3RepresentCache(object):
+    """
+        Process-wide, size-bounded cache for S3Represent lookups, shared
+        between requests (the per-instance S3Represent.theset being the
+        first level of caching)
+
+        Items are invalidated by updates or deletions in the lookup
+        table (using DAL callbacks), and expire after a configurable
+        time to limit the effect of changes which bypass the DAL (or
+        happen in other processes, or in tables other than the lookup
+        table which are used in custom lookups).
+    """
+
+    # Instance attributes of S3Represent which are no configuration
+    SKIP = ("cache_key",
+            "clabels",
+            "custom_lookup",
+            "default",
+            "func_code",
+            "func_defaults",
+            "htemplate",
+            "lazy",
+            "lazy_show_link",
+            "lookup_rows",
+            "none",
+            "queries",
+            "rows",
+            "setup",
+            "slabels",
+            "table",
+            "theset",
+            )
+
+    # {(key, value): (version, expires, representation, translate)}
+    store = OrderedDict()
+
+    # {tablename: version}
+    versions = {}
+
+    lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, key, tablename, values):
+        """
+            Look up representations in the cache
+
+            @param key: the cache key of the S3Represent instance
+            @param tablename: the name of the lookup table
+            @param values: the values to look up
+
+            @return: dict {value: representation} of all values found
+        """
+
+        now = time.time()
+        store = cls.store
+
+        items = {}
+        with cls.lock:
+            version = cls.versions.get(tablename, 0)
+            for value in values:
+                k = (key, value)
+                item = store.pop(k, None)
+                if item is not None and \
+                   item[0] == version and item[1] > now:
+                    # Re-insert as most recently used
+                    store[k] = item
+                    items[value] = item[2:]
+
+        T = current.T
+        return dict((value, T(representation) if translate else representation)
+                    for value, (representation, translate) in items.items())
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def set(cls, key, tablename, items):
+        """
+            Add representations to the cache
+
+            @param key: the cache key of the S3Represent instance
+            @param tablename: the name of the lookup table
+            @param items: dict {value: representation}
+        """
+
+        settings = current.deployment_settings
+        expires = time.time() + settings.get_base_represent_cache_expire()
+        size = settings.get_base_represent_cache_size()
+
+        store = cls.store
+        with cls.lock:
+            version = cls.versions.get(tablename, 0)
+            for value, representation in items.items():
+                translate = False
+                if isinstance(representation, lazyT):
+                    if representation.s:
+                        representation = s3_unicode(representation)
+                    else:
+                        # Translate again when retrieving
+                        representation = representation.m
+                        translate = True
+                elif not isinstance(representation, basestring):
+                    # Can not share markup or other objects
+                    continue
+                k = (key, value)
+                store.pop(k, None)
+                store[k] = (version, expires, representation, translate)
+            while len(store) > size:
+                # Evict the least recently used item
+                store.popitem(last=False)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def invalidate(cls, tablename):
+        """
+            Invalidate all cached representations from a lookup table
+
+            @param tablename: the name of the lookup table
+        """
+
+        with cls.lock:
+            cls.versions[tablename] = cls.versions.get(tablename, 0) + 1
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def attach(cls, table):
+        """
+            Add callbacks to a lookup table to invalidate the cache
+            upon updates or deletions
+
+            @param table: the lookup Table
+        """
+
+        if getattr(table, "_represent_cache", False):
+            return
+        tablename = table._tablename
+
+        invalidate = cls.invalidate
+        table._after_update.append(lambda s, f: invalidate(tablename))
+        table._after_delete.append(lambda s: invalidate(tablename))
+        table._represent_cache = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls):
+        """ Remove all items from the cache """
+
+        with cls.lock:
+            cls.store.clear()
+
 # =============================================================================
 class S3RepresentLazy(object):
     """
@@ -30,6 +30,7 @@
 """
 
 __all__ = ("S3DateFilter",
+           "S3FacetCache",
            "S3Filter",
            "S3FilterForm",
            "S3FilterString",
@@ -45,6 +46,7 @@ __all__ = ("S3DateFilter",
 
 import datetime
 import re
+import threading
 
 try:
     import json # try stdlib (Python 2.6)
@@ -67,6 +69,7 @@ from gluon.tools import callback
 
 from s3rest import S3Method
 from s3query import S3ResourceField, S3ResourceQuery, S3URLQuery
+from s3report import S3ReportCache
 from s3utils import s3_get_foreign_key, s3_unicode, S3TypeConverter
 from s3validators import *
 from s3widgets import ICON, S3DateWidget, S3DateTimeWidget, S3GroupedOptionsWidget, S3MultiSelectWidget, S3HierarchyWidget
@@ -242,6 +245,10 @@ class S3FilterWidget(object):
                                  (L{S3OptionsFilter} with "groupedopts" widget)
             @keyword none: label for explicit None-option in many-to-many
                            fields (L{S3OptionsFilter})
+            @keyword counts: show the number of matching records next to
+                             the options (L{S3OptionsFilter},
+                             L{S3LocationFilter}), default see
+                             settings.ui.filter_option_counts
             @keyword fieldtype: explicit field type "date" or "datetime" to
                                 use for context or virtual fields
                                 (L{S3DateFilter})
@@ -463,6 +470,62 @@ class S3FilterWidget(object):
         else:
             return []
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _facets(resource, selectors):
+        """
+            Get all distinct combinations of values of the given fields
+            in the filtered resource, with the number of matching records
+            for each combination, in a single GROUPBY query
+
+            @param resource: the S3Resource
+            @param selectors: the field selectors
+
+            @return: list of tuples (values, count), where values is a
+                     tuple of field values in the order of selectors,
+                     or None if the facets can not be determined in
+                     the database (virtual fields or virtual filters)
+        """
+
+        if not current.deployment_settings.get_ui_filter_facets():
+            return None
+        if resource.get_filter() is not None:
+            return None
+
+        rfields = []
+        for selector in selectors:
+            try:
+                rfield = S3ResourceField(resource, selector)
+            except (AttributeError, SyntaxError):
+                return None
+            if rfield.field is None:
+                return None
+            rfields.append(rfield)
+
+        def facets():
+            count = resource._id.count(distinct=True)
+            data = resource.select([rfield.selector for rfield in rfields],
+                                   limit=None,
+                                   groupby=[rfield.field for rfield in rfields],
+                                   aggregate=[count],
+                                   virtual=False,
+                                   )
+            colnames = [rfield.colname for rfield in rfields]
+            return [(tuple(row[colname] for colname in colnames), row[count])
+                    for row in data.rows]
+
+        cache = S3FacetCache(resource, "facets", selectors, selectors)
+        return cache(facets)
+
+    # -------------------------------------------------------------------------
+    def _show_counts(self):
+        """ Whether to show record counts next to the options """
+
+        counts = self.opts.get("counts")
+        if counts is None:
+            counts = current.deployment_settings.get_ui_filter_option_counts()
+        return counts
+
     # -------------------------------------------------------------------------
     @classmethod
     def _variable(cls, selector, operator):
@@ -928,7 +991,7 @@ class S3LocationFilter(S3FilterWidget):
 
             # Add one widget per level
             for level in levels:
-                options = levels[level]["options"]
+                options = self._add_counts(levels[level])
                 groupedopts = S3GroupedOptionsWidget(cols = cols,
                                                      size = opts["size"] or 12,
                                                      )
@@ -981,7 +1044,7 @@ class S3LocationFilter(S3FilterWidget):
                 if first:
                     # Visible Multiselect Widget added to the page
                     attr["_class"] = _class
-                    options = levels[level]["options"]
+                    options = self._add_counts(levels[level])
                     dummy_field = Storage(name=name,
                                           type=ftype,
                                           requires=IS_IN_SET(options,
@@ -1057,6 +1120,29 @@ class S3LocationFilter(S3FilterWidget):
                 opts["%s-%s" % (base_id, level)] = options
         return opts
 
+    # -------------------------------------------------------------------------
+    def _add_counts(self, level):
+        """
+            Add the record counts to the option labels of a level,
+            if configured
+
+            @param level: the level dict from _options
+
+            @return: the options for IS_IN_SET
+        """
+
+        options = level["options"]
+        counts = level.get("counts")
+        if counts is None or not self._show_counts():
+            return options
+
+        if isinstance(options, dict):
+            items = options.items()
+        else:
+            items = [(option, option) for option in options]
+        return OrderedDict((k, "%s (%s)" % (s3_unicode(v), counts.get(k, 0)))
+                           for k, v in items)
+
     # -------------------------------------------------------------------------
     @staticmethod
     def __options(row, levels, inject_hierarchy, hierarchy, _level, translate, name_l10n):
@@ -1189,10 +1275,29 @@ class S3LocationFilter(S3FilterWidget):
             return default
 
         # Find the options
-        rows = resource.select(fields=fields,
-                               limit=None,
-                               virtual=False,
-                               as_rows=True)
+        counts = None
+        facets = self._facets(resource, fields[1:]) if joined else None
+        if facets is not None:
+            # Distinct combinations of Lx (and path) with record counts
+            names = levels.keys()
+            if translate:
+                names.append("path")
+            counts = dict((level, {}) for level in levels)
+            rows = []
+            for values, count in facets:
+                row = Storage(zip(names, values))
+                for level in levels:
+                    value = row[level]
+                    if value:
+                        level_counts = counts[level]
+                        level_counts[value] = level_counts.get(value, 0) + count
+                rows.append(row)
+            joined = False
+        else:
+            rows = resource.select(fields=fields,
+                                   limit=None,
+                                   virtual=False,
+                                   as_rows=True)
         rows2 = []
         if not rows:
             if values:
@@ -1265,6 +1370,7 @@ class S3LocationFilter(S3FilterWidget):
                 first = False
             levels[level] = {"label": levels[level],
                              "options": {} if translate else [],
+                             "counts": counts.get(level) if counts else None,
                              }
 
         # Generate a name localization lookup dict
@@ -1593,6 +1699,8 @@ class S3OptionsFilter(S3FilterWidget):
 
         # Find the options
         opt_keys = []
+        counts = None
+        show_counts = self._show_counts()
 
         multiple = ftype[:5] == "list:"
         if opts.options is not None:
@@ -1621,6 +1729,12 @@ class S3OptionsFilter(S3FilterWidget):
                 rows = None
                 if field:
                     ktablename, key, m = s3_get_foreign_key(field, m2m=False)
+                    if ktablename and show_counts and \
+                       not opts.get("location_filter") and \
+                       not opts.get("org_filter"):
+                        # Counts must respect the resource filter
+                        # => use the forward lookup (facets) instead
+                        ktablename = None
                     if ktablename:
 
                         multiple = m
@@ -1685,8 +1799,21 @@ class S3OptionsFilter(S3FilterWidget):
 
                 # If we can not perform a reverse lookup, then we need
                 # to do a forward lookup of all unique values of the
-                # search field from all records in the table :/ still ok,
-                # but not endlessly scalable:
+                # search field from all records in the table => try to
+                # get them (with counts) with a single GROUPBY query:
+                if rows is None and field:
+                    facets = self._facets(resource, [selector])
+                    if facets is not None:
+                        counts = {}
+                        for values, count in facets:
+                            value = values[0]
+                            keys = (value or []) if multiple else [value]
+                            for key in keys:
+                                counts[key] = counts.get(key, 0) + count
+                        rows = []
+
+                # ...otherwise from all records :/ still ok, but not
+                # endlessly scalable:
                 if rows is None:
                     rows = resource.select([selector],
                                            limit=None,
@@ -1696,7 +1823,9 @@ class S3OptionsFilter(S3FilterWidget):
                                            as_rows=True)
 
                 opt_keys = [] # Can't use set => would make orderby pointless
-                if rows:
+                if counts is not None:
+                    opt_keys = sorted(counts.keys())
+                elif rows:
                     kappend = opt_keys.append
                     kextend = opt_keys.extend
                     for row in rows:
@@ -1812,6 +1941,10 @@ class S3OptionsFilter(S3FilterWidget):
                 opt_list.sort(key=lambda item: item[1])
             except:
                 opt_list.sort(key=lambda item: s3_unicode(item[1]))
+        if show_counts and counts is not None:
+            opt_list = [(k, "%s (%s)" % (s3_unicode(v), counts.get(k, 0)))
+                        for k, v in opt_list]
+
         options = []
         empty = False
         none = opts["none"]
@@ -3139,4 +3272,36 @@ class S3FilterString(object):
             # FIXME: resource not defined here!
             return query.represent(resource)
 
+# =============================================================================
+class S3FacetCache(S3ReportCache):
+    """
+        Cross-request cache for filter options with record counts (see
+        S3FilterWidget._facets), keyed by the fields, resource filter,
+        access rules and the version stamps of all involved tables
+    """
+
+    # Process-wide LRU store, {key: (expires, data)}
+    store = OrderedDict()
+    lock = threading.Lock()
+
+    # Cache statistics
+    hits = 0
+    misses = 0
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def config():
+        """
+            Get the cache configuration from deployment settings
+
+            @return: tuple (enabled, backend, size, expire)
+        """
+
+        settings = current.deployment_settings
+        return (settings.get_ui_filter_facet_cache(),
+                settings.get_ui_filter_facet_cache_backend(),
+                settings.get_ui_filter_facet_cache_size(),
+                settings.get_ui_filter_facet_cache_expire(),
+                )
+
 # END =========================================================================
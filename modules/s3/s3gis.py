@@ -30,15 +30,24 @@
 """
 
 __all__ = ("GIS",
+           "S3GeoJSONFeed",
+           "S3Choropleth",
            "S3Map",
+           "S3MapTileCache",
+           "S3MapConfigCache",
+           "S3SpatialIndex",
            "S3ExportPOI",
            "S3ImportPOI",
            )
 
+from copy import deepcopy
 import datetime         # Needed for Feed Refresh checks & web2py version check
+import hashlib          # Needed for Simplified Geometry checksums
 import os
 import re
 import sys
+import threading
+import time
 #import logging
 import urllib           # Needed for urlencoding
 import urllib2          # Needed for quoting & error handling on fetch
@@ -82,9 +91,11 @@ from gluon.storage import Storage
 from s3dal import Rows
 from s3datetime import s3_format_datetime, s3_parse_datetime
 from s3fields import s3_all_meta_field_names
+from s3query import S3ResourceField
+from s3report import S3ReportCache
 from s3rest import S3Method
 from s3track import S3Trackable
-from s3utils import s3_include_ext, s3_unicode
+from s3utils import S3TableVersion, s3_include_ext, s3_unicode
 
 DEBUG = False
 if DEBUG:
@@ -117,6 +128,14 @@ CLUSTER_ATTRIBUTE = "colour"
 CLUSTER_DISTANCE = 20   # pixels
 CLUSTER_THRESHOLD = 2   # minimum # of features to form a cluster
 
+# Map Tiles (XYZ scheme)
+TILE_SIZE = 256         # pixels
+TILE_EXTENT = 4096      # Mapbox Vector Tile coordinate extent
+TILE_MAX_ZOOM = 30
+
+# Bounding box index (gis_location.quadkey)
+QUADKEY_ZOOM = 16       # deepest quadtree level, ~0.005 degrees longitude
+
 # Garmin GPS Symbols
 GPS_SYMBOLS = ("Airport",
                "Amusement Park"
@@ -728,6 +747,13 @@ class GIS(object):
                     results = {}
                     for row in rows:
                         results[row.level] = row.id
+                elif current.deployment_settings.get_gis_spatial_index():
+                    from shapely.geometry import Point
+                    levels = current.gis.hierarchy_level_keys
+                    results = {}
+                    for location_id, level in S3SpatialIndex.intersects(Point(lon, lat),
+                                                                        levels=levels):
+                        results[level] = location_id
                 else:
                     # Oh dear, this is going to be slow :/
                     # Filter to the BBOX initially
@@ -1901,7 +1927,8 @@ class GIS(object):
             query &= (table.deleted == False)
         # @ToDo: Check AAA (do this as a resource filter?)
 
-        features = db(query).select(locations.wkt,
+        features = db(query).select(locations.id,
+                                    locations.wkt,
                                     locations.lat,
                                     locations.lon,
                                     table.ALL)
@@ -1909,7 +1936,27 @@ class GIS(object):
         # @ToDo: provide option to use PostGIS/Spatialite
         # settings = current.deployment_settings
         # if settings.gis.spatialdb and settings.database.db_type == "postgres":
-        if lon_min is None:
+        if current.deployment_settings.get_gis_spatial_index():
+            # Polygons from the spatial index, Points by their Lat/Lon
+            from shapely.geometry import Point
+            from shapely.prepared import prep
+            prepared = prep(polygon)
+            matches = set(item[0] for item in S3SpatialIndex.intersects(polygon))
+            for row in features:
+                _location = row.gis_location
+                if _location.id in matches:
+                    output.records.append(row)
+                    continue
+                wkt = _location.wkt
+                if wkt and not wkt.startswith("POI"):
+                    # Polygon not intersecting
+                    continue
+                lat = _location.lat
+                lon = _location.lon
+                if lat is not None and lon is not None and \
+                   prepared.intersects(Point(lon, lat)):
+                    output.records.append(row)
+        elif lon_min is None:
             # We have no BBOX so go straight to the full geometry check
             for row in features:
                 _location = row.gis_location
@@ -2241,11 +2288,15 @@ class GIS(object):
                       query,
                       join = True,
                       geojson = True,
+                      tolerance = None,
                       ):
         """
             Returns the locations for an XML export
             - used by GIS.get_location_data() and S3PivotTable.geojson()
 
+            @param tolerance: the simplification tolerance, defaults to
+                              settings.gis.simplify_tolerance
+
             @ToDo: Support multiple locations for a single resource
                    (e.g. a Project wworking in multiple Communities)
         """
@@ -2254,10 +2305,37 @@ class GIS(object):
         tablename = table._tablename
         gtable = current.s3db.gis_location
         settings = current.deployment_settings
-        tolerance = settings.get_gis_simplify_tolerance()
+        if tolerance is None:
+            tolerance = settings.get_gis_simplify_tolerance()
 
         output = {}
 
+        if geojson and GIS.get_simplify_level(tolerance) is not None:
+            # Use precomputed simplified geometries where available
+            if join:
+                rows = db(query).select(table.id, gtable.id)
+                records = {}
+                for row in rows:
+                    location_id = row["gis_location"].id
+                    if location_id in records:
+                        records[location_id].append(row[tablename].id)
+                    else:
+                        records[location_id] = [row[tablename].id]
+            else:
+                rows = db(query).select(table.id)
+                records = dict((row.id, [row.id]) for row in rows)
+            simplified = GIS.get_simplified(records.keys(), tolerance)
+            for location_id, geometry in simplified.items():
+                for record_id in records[location_id]:
+                    output[record_id] = geometry
+            # Simplify the rest on-the-fly
+            missing = [location_id for location_id in records
+                       if location_id not in simplified]
+            if not missing:
+                return output
+            elif simplified:
+                query &= (gtable.id.belongs(missing))
+
         if settings.get_gis_spatialdb():
             if geojson:
                 # Do the Simplify & GeoJSON direct from the DB
@@ -2317,7 +2395,10 @@ class GIS(object):
 
     # -------------------------------------------------------------------------
     @staticmethod
-    def get_location_data(resource, attr_fields=None):
+    def get_location_data(resource,
+                          attr_fields=None,
+                          tolerance=None,
+                          geojson=None):
         """
             Returns the locations, markers and popup tooltips for an XML export
             e.g. Feature Layers or Search results (Feature Resources)
@@ -2327,6 +2408,10 @@ class GIS(object):
             @param: resource - S3Resource instance (required)
             @param: attr_fields - list of attr_fields to use instead of reading
                                   from get_vars or looking up in gis_layer_feature
+            @param: tolerance - the simplification tolerance for polygons
+                                (defaults to settings.gis.simplify_tolerance)
+            @param: geojson - whether to build attributes and GeoJSON geometries
+                              (defaults to whether the request format is geojson)
         """
 
         tablename = resource.tablename
@@ -2420,7 +2505,8 @@ class GIS(object):
         _pkey = table[pkey]
         # Ensure there are no ID represents to confuse things
         _pkey.represent = None
-        geojson = current.auth.permission.format == "geojson"
+        if geojson is None:
+            geojson = current.auth.permission.format == "geojson"
         if geojson:
             # Build the Attributes now so that representations can be
             # looked-up in bulk rather than as a separate lookup per record
@@ -2588,57 +2674,16 @@ class GIS(object):
                     index += 1
 
         if not latlons:
-            join = True
-            #custom = False
-            if "location_id" in table.fields:
-                query = (table.id.belongs(resource._ids)) & \
-                        (table.location_id == gtable.id)
-            elif "site_id" in table.fields:
-                stable = s3db.org_site
-                query = (table.id.belongs(resource._ids)) & \
-                        (table.site_id == stable.site_id) & \
-                        (stable.location_id == gtable.id)
-            elif tablename == "gis_location":
-                join = False
-                query = (table.id.belongs(resource._ids))
-            else:
-                # Look at the Context
-                context = resource.get_config("context")
-                if context:
-                    location_context = context.get("location")
-                else:
-                    location_context = None
-                if not location_context:
-                    # Can't display this resource on the Map
-                    return None
-                # @ToDo: Proper system rather than this hack_which_works_for_current_usecase
-                # Resolve selector (which automatically attaches any required component)
-                rfield = resource.resolve_selector(location_context)
-                if "." in location_context:
-                    # Component
-                    alias, cfield = location_context.split(".", 1)
-                    try:
-                        component = resource.components[alias]
-                    except:
-                        # Invalid alias
-                        # Can't display this resource on the Map
-                        return None
-                    ctablename = component.tablename
-                    ctable = s3db[ctablename]
-                    query = (table.id.belongs(resource._ids)) & \
-                            rfield.join[ctablename] & \
-                            (ctable[cfield] == gtable.id)
-                    #custom = True
-                    # Clear components again
-                    resource.components = Storage()
-                # @ToDo:
-                #elif "$" in location_context:
-                else:
-                    # Can't display this resource on the Map
-                    return None
+            location_query = GIS.get_location_query(resource, resource._ids)
+            if location_query is None:
+                # Can't display this resource on the Map
+                return None
+            query, join = location_query
 
             if geojson and not points:
-                geojsons[tablename] = GIS.get_locations(table, query, join, geojson)
+                geojsons[tablename] = GIS.get_locations(table, query, join, geojson,
+                                                        tolerance = tolerance,
+                                                        )
             # @ToDo: Support Polygons in KML, GPX & GeoRSS
             #else:
             #    wkts[tablename] = GIS.get_locations(table, query, join, geojson)
@@ -2680,6 +2725,75 @@ class GIS(object):
                     styles = styles,
                     )
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_location_query(resource, ids=None):
+        """
+            Returns a query joining the given records of a resource with
+            their locations
+            - used by GIS.get_location_data() and S3Map.tile()
+
+            @param resource: the S3Resource
+            @param ids: the record IDs (None for all records)
+
+            @return: tuple (query, join) with join=False if the resource
+                     is gis_location itself, or None if the resource
+                     has no locations
+        """
+
+        s3db = current.s3db
+        table = resource.table
+        gtable = s3db.gis_location
+
+        if ids is None:
+            query = (table.id > 0)
+        else:
+            query = (table.id.belongs(ids))
+
+        join = True
+        #custom = False
+        if "location_id" in table.fields:
+            query &= (table.location_id == gtable.id)
+        elif "site_id" in table.fields:
+            stable = s3db.org_site
+            query &= (table.site_id == stable.site_id) & \
+                     (stable.location_id == gtable.id)
+        elif resource.tablename == "gis_location":
+            join = False
+        else:
+            # Look at the Context
+            context = resource.get_config("context")
+            if context:
+                location_context = context.get("location")
+            else:
+                location_context = None
+            if not location_context:
+                return None
+            # @ToDo: Proper system rather than this hack_which_works_for_current_usecase
+            # Resolve selector (which automatically attaches any required component)
+            rfield = resource.resolve_selector(location_context)
+            if "." in location_context:
+                # Component
+                alias, cfield = location_context.split(".", 1)
+                try:
+                    component = resource.components[alias]
+                except:
+                    # Invalid alias
+                    return None
+                ctablename = component.tablename
+                ctable = s3db[ctablename]
+                query &= rfield.join[ctablename] & \
+                         (ctable[cfield] == gtable.id)
+                #custom = True
+                # Clear components again
+                resource.components = Storage()
+            # @ToDo:
+            #elif "$" in location_context:
+            else:
+                return None
+
+        return query, join
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_marker(controller=None,
@@ -3020,9 +3134,6 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
         #    for row in rows:
         #        geojsons[row["gis_theme_data.id"]] = row.geojson
         #else:
-        rows = current.db(query).select(table.id,
-                                        gtable.level,
-                                        gtable.wkt)
         simplify = GIS.simplify
         tolerance = {"L0": 0.01,
                      "L1": 0.005,
@@ -3031,6 +3142,41 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                      "L4": 0.0003125,
                      "L5": 0.00015625,
                      }
+
+        if current.deployment_settings.get_gis_simplify_levels():
+            # Use precomputed simplified geometries where available
+            rows = current.db(query).select(table.id,
+                                            gtable.id,
+                                            gtable.level)
+            levels = {}
+            for row in rows:
+                grow = row.gis_location
+                level = grow.level
+                if level in levels:
+                    levels[level].append((grow.id, row["gis_theme_data.id"]))
+                else:
+                    levels[level] = [(grow.id, row["gis_theme_data.id"])]
+            missing = []
+            for level, items in levels.items():
+                simplified = GIS.get_simplified([item[0] for item in items],
+                                                tolerance.get(level))
+                for location_id, record_id in items:
+                    if location_id in simplified:
+                        geojsons[record_id] = simplified[location_id]
+                    else:
+                        missing.append(record_id)
+            # Simplify the rest on-the-fly
+            if missing:
+                query &= (table.id.belongs(missing))
+                rows = current.db(query).select(table.id,
+                                                gtable.level,
+                                                gtable.wkt)
+            else:
+                rows = []
+        else:
+            rows = current.db(query).select(table.id,
+                                            gtable.level,
+                                            gtable.wkt)
         for row in rows:
             grow = row.gis_location
             # Simplify the polygon to reduce download size
@@ -3534,7 +3680,9 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
     def import_admin_areas(self,
                            source="gadmv1",
                            countries=[],
-                           levels=["L0", "L1", "L2"]
+                           levels=["L0", "L1", "L2"],
+                           workers=None,
+                           progress=None,
                           ):
         """
            Import Admin Boundaries into the Locations table
@@ -3545,6 +3693,14 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                               defaults to all countries
            @param levels - Which levels of the hierarchy to import.
                            defaults to all 3 supported levels
+           @param workers - Number of processes to parse the geometries,
+                            defaults to the number of CPUs
+           @param progress - callback progress(level, stats) called after
+                             every batch, stats being a dict with the
+                             numbers of features processed/imported/skipped
+
+           NB Interrupted imports can be resumed by running them again:
+              features which have already been imported are skipped
         """
 
         if source == "gadmv1":
@@ -3555,11 +3711,14 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                 return
 
             if "L0" in levels:
-                self.import_gadm1_L0(ogr, countries=countries)
+                self.import_gadm1_L0(ogr, countries=countries,
+                                     workers=workers)
             if "L1" in levels:
-                self.import_gadm1(ogr, "L1", countries=countries)
+                self.import_gadm1(ogr, "L1", countries=countries,
+                                  workers=workers, progress=progress)
             if "L2" in levels:
-                self.import_gadm1(ogr, "L2", countries=countries)
+                self.import_gadm1(ogr, "L2", countries=countries,
+                                  workers=workers, progress=progress)
 
             current.log.debug("All done!")
 
@@ -3587,7 +3746,7 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
     # -------------------------------------------------------------------------
     @staticmethod
-    def import_gadm1_L0(ogr, countries=[]):
+    def import_gadm1_L0(ogr, countries=[], workers=None, batch_size=20):
         """
            Import L0 Admin Boundaries into the Locations table from GADMv1
            - designed to be called from import_admin_areas()
@@ -3596,6 +3755,9 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
            @param ogr - The OGR Python module
            @param countries - List of ISO2 countrycodes to download data for
                               defaults to all countries
+           @param workers - Number of processes to parse the geometries,
+                            defaults to the number of CPUs
+           @param batch_size - Number of countries per batch (=transaction)
         """
 
         db = current.db
@@ -3674,55 +3836,104 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         codeField = layer["codefield"]
         code2Field = layer["code2field"]
-        for feat in lyr:
-            code = feat.GetField(codeField)
-            if not code:
-                # Skip the entries which aren't countries
-                continue
-            if countries and code not in countries:
-                # Skip the countries which we're not interested in
-                continue
 
-            geom = feat.GetGeometryRef()
-            if geom is not None:
+        # In-memory index of the countries {ISO2: location_id}
+        query = (table.id == ttable.location_id) & \
+                (table.level == "L0") & \
+                (ttable.tag == "ISO2") & \
+                (ttable.deleted != True)
+        index = dict((row[ttable.value], row[table.id])
+                     for row in db(query).select(table.id, ttable.value))
+
+        # Countries which already have an ISO3 tag
+        query = (ttable.tag == "ISO3") & \
+                (ttable.deleted != True)
+        tagged = set(row.location_id
+                     for row in db(query).select(ttable.location_id))
+
+        pool = GIS.import_pool(workers)
+        tolerances = current.deployment_settings.get_gis_simplify_levels()
+        stable = s3db.gis_location_simplified
+
+        def flush(batch):
+            """ Parse a batch of features and bulk-update the countries """
+
+            items = [(item[2], tolerances) for item in batch]
+            if pool:
+                results = pool.map(_import_geometry, items)
+            else:
+                results = [_import_geometry(item) for item in items]
+
+            updates = {}
+            tags = []
+            simplified = []
+            for (location_id, code2, wkt), result in zip(batch, results):
+                if result is None:
+                    current.log.error("Skipping location %s: invalid geometry" % location_id)
+                    continue
+                location, geometries = result
+                updates[location_id] = location
+                if location_id not in tagged:
+                    tags.append({"location_id": location_id,
+                                 "tag": "ISO3",
+                                 "value": code2,
+                                 })
+                    tagged.add(location_id)
+                if geometries:
+                    checksum = hashlib.md5(location["wkt"]).hexdigest()
+                    simplified.extend({"location_id": location_id,
+                                       "tolerance": tolerance,
+                                       "geojson": geojson,
+                                       "checksum": checksum,
+                                       } for tolerance, geojson in geometries)
+
+            if updates:
+                # _bulk_update also sets the_geom if using a spatial DB
+                GIS._bulk_update(table, updates)
+                if tags:
+                    ttable.bulk_insert(tags)
+                if tolerances:
+                    db(stable.location_id.belongs(updates.keys())).delete()
+                    if simplified:
+                        stable.bulk_insert(simplified)
+            db.commit()
+
+        batch = []
+        try:
+            for feat in lyr:
+                code = feat.GetField(codeField)
+                if not code:
+                    # Skip the entries which aren't countries
+                    continue
+                if countries and code not in countries:
+                    # Skip the countries which we're not interested in
+                    continue
+
+                geom = feat.GetGeometryRef()
+                if geom is None:
+                    current.log.debug("No geometry\n")
+                    continue
                 if geom.GetGeometryType() == ogr.wkbPoint:
-                    pass
-                else:
-                    query = (table.id == ttable.location_id) & \
-                            (ttable.tag == "ISO2") & \
-                            (ttable.value == code)
-                    wkt = geom.ExportToWkt()
-                    if wkt.startswith("LINESTRING"):
-                        gis_feature_type = 2
-                    elif wkt.startswith("POLYGON"):
-                        gis_feature_type = 3
-                    elif wkt.startswith("MULTIPOINT"):
-                        gis_feature_type = 4
-                    elif wkt.startswith("MULTILINESTRING"):
-                        gis_feature_type = 5
-                    elif wkt.startswith("MULTIPOLYGON"):
-                        gis_feature_type = 6
-                    elif wkt.startswith("GEOMETRYCOLLECTION"):
-                        gis_feature_type = 7
-                    code2 = feat.GetField(code2Field)
-                    #area = feat.GetField("Shape_Area")
-                    try:
-                        id = db(query).select(table.id,
-                                              limitby=(0, 1)).first().id
-                        query = (table.id == id)
-                        db(query).update(gis_feature_type=gis_feature_type,
-                                         wkt=wkt)
-                        ttable.insert(location_id = id,
-                                      tag = "ISO3",
-                                      value = code2)
-                        #ttable.insert(location_id = location_id,
-                        #              tag = "area",
-                        #              value = area)
-                    except db._adapter.driver.OperationalError, exception:
-                        current.log.error(sys.exc_info[1])
+                    continue
 
-            else:
-                current.log.debug("No geometry\n")
+                location_id = index.get(code)
+                if not location_id:
+                    current.log.warning("Skipping - cannot find country with ISO2 %s" % code)
+                    continue
+
+                batch.append((location_id,
+                              feat.GetField(code2Field),
+                              geom.ExportToWkt(),
+                              ))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
         # Close the shapefile
         ds.Destroy()
@@ -3735,16 +3946,30 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
         return
 
     # -------------------------------------------------------------------------
-    def import_gadm1(self, ogr, level="L1", countries=[]):
+    def import_gadm1(self,
+                     ogr,
+                     level="L1",
+                     countries=[],
+                     workers=None,
+                     batch_size=200,
+                     progress=None,
+                     ):
         """
             Import L1 Admin Boundaries into the Locations table from GADMv1
             - designed to be called from import_admin_areas()
             - assumes a fresh database with just Countries imported
+            - streams the features in batches, parses and simplifies
+              the geometries in a process pool, resolves the parents
+              from an in-memory index and bulk-inserts the locations
 
             @param ogr - The OGR Python module
             @param level - "L1" or "L2"
             @param countries - List of ISO2 countrycodes to download data for
                                defaults to all countries
+            @param workers - Number of processes to parse the geometries,
+                             defaults to the number of CPUs
+            @param batch_size - Number of features per batch (=transaction)
+            @param progress - callback progress(level, stats)
         """
 
         if level == "L1":
@@ -3785,7 +4010,6 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         db = current.db
         s3db = current.s3db
-        cache = s3db.cache
         table = s3db.gis_location
         ttable = s3db.gis_location_tag
 
@@ -3992,108 +4216,142 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
         parentSourceCodeField = layer["parentSourceCodeField"]
         parentLevel = layer["parent"]
         parentEdenCodeField = layer["parentEdenCodeField"]
-        parentCodeQuery = (ttable.tag == parentEdenCodeField)
-        count = 0
-        for row in rows:
-            # Read Attributes
-            feat = lyr[count]
-
-            parentCode = feat.GetField(parentSourceCodeField)
-            query = (table.level == parentLevel) & \
-                    parentCodeQuery & \
-                    (ttable.value == parentCode)
-            parent = db(query).select(table.id,
-                                      ttable.value,
-                                      limitby=(0, 1),
-                                      cache=cache).first()
-            if not parent:
-                # Skip locations for which we don't have a valid parent
-                current.log.warning("Skipping - cannot find parent with key: %s, value: %s" % \
-                            (parentEdenCodeField, parentCode))
-                count += 1
-                continue
 
-            if countries:
-                # Skip the countries which we're not interested in
-                if level == "L1":
-                    if parent["gis_location_tag"].value not in countries:
-                        #current.log.warning("Skipping %s as not in countries list" % parent["gis_location_tag"].value)
-                        count += 1
-                        continue
-                else:
-                    # Check grandparent
-                    country = self.get_parent_country(parent.id,
-                                                      key_type="code")
-                    if country not in countries:
-                        count += 1
-                        continue
+        # In-memory index of the parents {code: (location_id, ISO2)}
+        parents = self.import_parent_index(parentLevel, parentEdenCodeField)
 
-            # This is got from CSV in order to be able to handle the encoding
-            name = row.pop(nameField)
-            name.encode("utf8")
+        # Skip features which have already been imported
+        # (=resume an interrupted import)
+        query = (ttable.tag == edenCodeField) & \
+                (ttable.deleted != True)
+        imported = set(row.value for row in db(query).select(ttable.value))
 
-            code = feat.GetField(sourceCodeField)
-            #area = feat.GetField("Shape_Area")
+        pool = self.import_pool(workers)
+        spatialdb = current.deployment_settings.get_gis_spatialdb()
+        tolerances = current.deployment_settings.get_gis_simplify_levels()
+        stable = s3db.gis_location_simplified
 
-            geom = feat.GetGeometryRef()
-            if geom is not None:
-                if geom.GetGeometryType() == ogr.wkbPoint:
-                    lat = geom.GetX()
-                    lon = geom.GetY()
-                    id = table.insert(name=name,
-                                      level=level,
-                                      gis_feature_type=1,
-                                      lat=lat,
-                                      lon=lon,
-                                      parent=parent.id)
-                    ttable.insert(location_id = id,
-                                  tag = edenCodeField,
-                                  value = code)
-                    # ttable.insert(location_id = id,
-                                  # tag = "area",
-                                  # value = area)
-                else:
-                    wkt = geom.ExportToWkt()
-                    if wkt.startswith("LINESTRING"):
-                        gis_feature_type = 2
-                    elif wkt.startswith("POLYGON"):
-                        gis_feature_type = 3
-                    elif wkt.startswith("MULTIPOINT"):
-                        gis_feature_type = 4
-                    elif wkt.startswith("MULTILINESTRING"):
-                        gis_feature_type = 5
-                    elif wkt.startswith("MULTIPOLYGON"):
-                        gis_feature_type = 6
-                    elif wkt.startswith("GEOMETRYCOLLECTION"):
-                        gis_feature_type = 7
-                    id = table.insert(name=name,
-                                      level=level,
-                                      gis_feature_type=gis_feature_type,
-                                      wkt=wkt,
-                                      parent=parent.id)
-                    ttable.insert(location_id = id,
-                                  tag = edenCodeField,
-                                  value = code)
-                    # ttable.insert(location_id = id,
-                                  # tag = "area",
-                                  # value = area)
+        new_ids = []
+        stats = {"processed": 0, "imported": 0, "skipped": 0}
+
+        def flush(batch):
+            """ Parse a batch of features and bulk-insert the locations """
+
+            items = [(item[3], tolerances) for item in batch]
+            if pool:
+                results = pool.map(_import_geometry, items)
             else:
-                current.log.debug("No geometry\n")
+                results = [_import_geometry(item) for item in items]
+
+            locations = []
+            tags = []
+            simplified = []
+            for (name, code, parent_id, wkt), result in zip(batch, results):
+                if result is None:
+                    current.log.error("Skipping %s: invalid geometry" % name)
+                    stats["skipped"] += 1
+                    continue
+                location, geometries = result
+                location["name"] = name
+                location["level"] = level
+                location["parent"] = parent_id
+                if spatialdb:
+                    location["the_geom"] = location["wkt"]
+                locations.append(location)
+                tags.append(code)
+                simplified.append(geometries)
+
+            if locations:
+                ids = table.bulk_insert(locations)
+                ttable.bulk_insert([{"location_id": location_id,
+                                     "tag": edenCodeField,
+                                     "value": code,
+                                     } for location_id, code in zip(ids, tags)])
+                items = []
+                for location_id, location, geometries in \
+                    zip(ids, locations, simplified):
+                    if geometries:
+                        checksum = hashlib.md5(location["wkt"]).hexdigest()
+                        items.extend({"location_id": location_id,
+                                      "tolerance": tolerance,
+                                      "geojson": geojson,
+                                      "checksum": checksum,
+                                      } for tolerance, geojson in geometries)
+                if items:
+                    stable.bulk_insert(items)
+                new_ids.extend(ids)
+                stats["imported"] += len(ids)
+
+            # Commit per batch, so that an interrupted import can be resumed
+            db.commit()
+
+            if progress:
+                progress(level, stats)
+            else:
+                current.log.debug("%s: %s features processed, %s imported, %s skipped" % \
+                                  (level,
+                                   stats["processed"],
+                                   stats["imported"],
+                                   stats["skipped"],
+                                   ))
+
+        # Read the features in parallel with the names from the CSV
+        batch = []
+        try:
+            for row in rows:
+                feat = lyr.GetNextFeature()
+                if feat is None:
+                    break
+                stats["processed"] += 1
+
+                parentCode = feat.GetField(parentSourceCodeField)
+                parent = parents.get(str(parentCode))
+                if not parent:
+                    # Skip locations for which we don't have a valid parent
+                    current.log.warning("Skipping - cannot find parent with key: %s, value: %s" % \
+                                        (parentEdenCodeField, parentCode))
+                    stats["skipped"] += 1
+                    continue
 
-            count += 1
+                parent_id, country = parent
+                if countries and country not in countries:
+                    # Skip the countries which we're not interested in
+                    continue
+
+                code = str(feat.GetField(sourceCodeField))
+                if code in imported:
+                    # Already imported
+                    stats["skipped"] += 1
+                    continue
+
+                geom = feat.GetGeometryRef()
+                if geom is None:
+                    current.log.debug("No geometry\n")
+                    stats["skipped"] += 1
+                    continue
+
+                # This is got from CSV in order to be able to handle the encoding
+                name = row.pop(nameField)
+
+                batch.append((name, code, parent_id, geom.ExportToWkt()))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
         # Close the shapefile
         ds.Destroy()
 
-        db.commit()
-
+        # Build path & Lx for the new locations (bounds and centroids
+        # have already been computed during the import)
         current.log.debug("Updating Location Tree...")
-        try:
-            self.update_location_tree()
-        except MemoryError:
-            # If doing all L2s, it can break memory limits
-            # @ToDo: Check now that we're doing by level
-            current.log.critical("Memory error when trying to update_location_tree()!")
+        if new_ids:
+            self.rebuild_location_tree(new_ids)
 
         db.commit()
 
@@ -4102,6 +4360,76 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def import_pool(workers=None):
+        """
+            Get a process pool to parse & simplify imported geometries
+
+            @param workers: the number of processes, defaults to the
+                            number of CPUs
+
+            @return: a multiprocessing.Pool, or None to parse in-process
+        """
+
+        try:
+            import multiprocessing
+        except ImportError:
+            return None
+
+        if workers is None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        if workers < 2:
+            return None
+        return multiprocessing.Pool(workers)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def import_parent_index(level, tag):
+        """
+            Get an in-memory index of the potential parents of imported
+            locations, to avoid per-feature lookups
+
+            @param level: the level of the parents ("L0" or "L1")
+            @param tag: the gis_location_tag holding the source code
+                        of the parents
+
+            @return: dict {code: (location_id, ISO2 of the country)}
+        """
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location
+        ttable = s3db.gis_location_tag
+
+        # ISO2 codes of all countries
+        query = (table.id == ttable.location_id) & \
+                (table.level == "L0") & \
+                (ttable.tag == "ISO2") & \
+                (ttable.deleted != True)
+        iso2 = dict((row[table.id], row[ttable.value])
+                    for row in db(query).select(table.id, ttable.value))
+
+        query = (table.id == ttable.location_id) & \
+                (table.level == level) & \
+                (table.deleted != True) & \
+                (ttable.tag == tag) & \
+                (ttable.deleted != True)
+        rows = db(query).select(table.id, table.parent, ttable.value)
+
+        index = {}
+        for row in rows:
+            location_id = row[table.id]
+            if level == "L0":
+                country = iso2.get(location_id)
+            else:
+                country = iso2.get(row[table.parent])
+            index[row[ttable.value]] = (location_id, country)
+        return index
+
     # -------------------------------------------------------------------------
     @staticmethod
     def import_gadm2(ogr, level="L0", countries=[]):
@@ -4374,6 +4702,7 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
             finally:
                 fc = "PPL"
 
+        new_ids = []
         deleted = (table.deleted == False)
         query = deleted & (table.level == parent_level)
         # Do the DB query once (outside loop)
@@ -4467,9 +4796,13 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                 ttable.insert(location_id=new_id,
                               tag="geonames",
                               value=geonameid)
+                new_ids.append(new_id)
             else:
                 continue
 
+        # Build Path & Lx for the new locations
+        self.rebuild_location_tree(new_ids)
+
         current.log.debug("All done!")
         return
 
@@ -4555,27 +4888,12 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
             table = db.gis_location
         except:
             table = current.s3db.gis_location
-        spatial = current.deployment_settings.get_gis_spatialdb()
+        settings = current.deployment_settings
+        spatial = settings.get_gis_spatialdb()
+        simplify_levels = settings.get_gis_simplify_levels()
         update_location_tree = GIS.update_location_tree
         wkt_centroid = GIS.wkt_centroid
 
-        fields = (table.id,
-                  table.name,
-                  table.level,
-                  table.path,
-                  table.parent,
-                  table.L0,
-                  table.L1,
-                  table.L2,
-                  table.L3,
-                  table.L4,
-                  table.L5,
-                  table.lat,
-                  table.lon,
-                  table.wkt,
-                  table.inherited
-                  )
-
         # ---------------------------------------------------------------------
         def fixup(feature):
             """
@@ -4614,6 +4932,9 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                     db(table.id == feature.id).update(**form_vars)
                 except MemoryError:
                     current.log.error("S3GIS: Unable to set bounds & centroid for feature %s: MemoryError" % feature.id)
+                else:
+                    if simplify_levels:
+                        GIS.update_simplified(feature.id, wkt)
 
         # ---------------------------------------------------------------------
         def propagate(parent):
@@ -4626,41 +4947,18 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
             """
 
             query = (table.parent == parent) & \
-                    (table.inherited == True)
-            rows = db(query).select(*fields)
-            for row in rows:
-                try:
-                    update_location_tree(row)
-                except RuntimeError:
-                    current.log.error("Cannot propagate inherited latlon to child %s of location ID %s: too much recursion" % \
-                        (row.id, parent))
+                    (table.level != "L0") & \
+                    (table.deleted != True)
+            rows = db(query).select(table.id)
+            if rows:
+                # Rebuild the subtrees (also updates Path & Lx of the
+                # descendants, e.g. if the parent has been renamed)
+                GIS.rebuild_location_tree([row.id for row in rows])
 
 
         if not feature:
-            # We are updating all locations.
-            all_locations = True
-            # Do in chunks to save memory and also do in correct order
-            all_fields = (table.id, table.name, table.gis_feature_type,
-                          table.L0, table.L1, table.L2, table.L3, table.L4,
-                          table.lat, table.lon, table.wkt, table.inherited,
-                          # Handle Countries which start with Bounds set, yet are Points
-                          table.lat_min, table.lon_min, table.lat_max, table.lon_max,
-                          table.path, table.parent)
-            for level in ("L0", "L1", "L2", "L3", "L4", "L5", None):
-                query = (table.level == level) & (table.deleted == False)
-                try:
-                    features = db(query).select(*all_fields)
-                except MemoryError:
-                    current.log.error("S3GIS: Unable to update Location Tree for level %s: MemoryError" % level)
-                else:
-                    for feature in features:
-                        feature["level"] = level
-                        wkt = feature["wkt"]
-                        if wkt and not wkt.startswith("POI"):
-                            # Polygons aren't inherited
-                            feature["inherited"] = False
-                        update_location_tree(feature)  # all_locations is False here
-            # All Done!
+            # We are updating all locations => set-based rebuild
+            GIS.rebuild_location_tree()
             return
 
 
@@ -5651,64 +5949,367 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
     # -------------------------------------------------------------------------
     @staticmethod
-    def wkt_centroid(form):
+    def rebuild_location_tree(ids=None, batch_size=500):
         """
-            OnValidation callback:
-            If a WKT is defined: validate the format,
-                calculate the LonLat of the Centroid, and set bounds
-            Else if a LonLat is defined: calculate the WKT for the Point.
+            Set-based rebuild of the Materialized path, Lx names, inherited
+            Lat/Lon and Bounds of GIS Locations
+            - loads the hierarchy into memory once, computes the tree
+              top-down in a single pass, and writes back only the changed
+              records, with batched UPDATEs
+            - replaces the per-feature recursion of update_location_tree
+              for bulk updates (e.g. after prepopulate, import_admin_areas
+              or import_geonames)
+
+            @param ids: list of gis_location record IDs to rebuild only the
+                        subtrees under these locations (incremental mode),
+                        default: the whole tree
+            @param batch_size: the maximum number of records per query
+
+            @return: the number of updated records
         """
 
-        form_vars = form.vars
+        # During prepopulate, the tree is built once at the end
+        if GIS.disable_update_location_tree:
+            return 0
 
-        if form_vars.get("gis_feature_type", None) == "1":
-            # Point
-            lat = form_vars.get("lat", None)
-            lon = form_vars.get("lon", None)
-            if (lon is None and lat is None) or \
-               (lon == "" and lat == ""):
-                # No Geometry available
-                # Don't clobber existing records (e.g. in Prepop)
-                #form_vars.gis_feature_type = "0"
-                # Cannot create WKT, so Skip
-                return
-            elif lat is None or lat == "":
-                # Can't just have lon without lat
-                form.errors["lat"] = current.messages.lat_empty
-            elif lon is None or lon == "":
-                form.errors["lon"] = current.messages.lon_empty
-            else:
-                form_vars.wkt = "POINT(%(lon)s %(lat)s)" % form_vars
-                radius = form_vars.get("radius", None)
-                if radius:
-                    bbox = GIS.get_bounds_from_radius(lat, lon, radius)
-                    form_vars.lat_min = bbox["lat_min"]
-                    form_vars.lon_min = bbox["lon_min"]
-                    form_vars.lat_max = bbox["lat_max"]
-                    form_vars.lon_max = bbox["lon_max"]
-                else:
-                    if "lon_min" not in form_vars or form_vars.lon_min is None:
-                        form_vars.lon_min = lon
-                    if "lon_max" not in form_vars or form_vars.lon_max is None:
-                        form_vars.lon_max = lon
-                    if "lat_min" not in form_vars or form_vars.lat_min is None:
-                        form_vars.lat_min = lat
-                    if "lat_max" not in form_vars or form_vars.lat_max is None:
-                        form_vars.lat_max = lat
+        db = current.db
+        table = current.s3db.gis_location
+        not_deleted = (table.deleted != True)
 
-        elif form_vars.get("wkt", None):
-            # Parse WKT for LineString, Polygon, etc
-            from shapely.wkt import loads as wkt_loads
-            try:
-                shape = wkt_loads(form_vars.wkt)
-            except:
-                try:
-                    # Perhaps this is really a LINESTRING (e.g. OSM import of an unclosed Way)
-                    linestring = "LINESTRING%s" % form_vars.wkt[8:-1]
-                    shape = wkt_loads(linestring)
-                    form_vars.wkt = linestring
-                except:
-                    form.errors["wkt"] = current.messages.invalid_wkt
+        hierarchy_levels = ("L0", "L1", "L2", "L3", "L4", "L5")
+
+        # Hierarchy graph: {id: (parent, level)}
+        graph = {}
+        graph_fields = (table.id, table.parent, table.level)
+        if ids is None:
+            rows = db(not_deleted).select(*graph_fields)
+            for row in rows:
+                graph[row.id] = (row.parent, row.level)
+        else:
+            # Collect the subtrees level by level
+            frontier = set(int(i) for i in ids if i)
+            rows = []
+            for chunk in GIS._chunks(list(frontier), batch_size):
+                query = (table.id.belongs(chunk)) & not_deleted
+                rows.extend(db(query).select(*graph_fields))
+            while rows:
+                frontier = []
+                for row in rows:
+                    if row.id not in graph:
+                        graph[row.id] = (row.parent, row.level)
+                        frontier.append(row.id)
+                rows = []
+                for chunk in GIS._chunks(frontier, batch_size):
+                    query = (table.parent.belongs(chunk)) & \
+                            (table.level != "L0") & \
+                            not_deleted
+                    rows.extend(db(query).select(*graph_fields))
+        if not graph:
+            return 0
+
+        # Children per parent, and the roots of the (sub)trees
+        children = {}
+        roots = []
+        context = set()
+        for record_id, (parent, level) in graph.iteritems():
+            if level == "L0" or not parent:
+                roots.append(record_id)
+            elif parent in graph:
+                if parent in children:
+                    children[parent].append(record_id)
+                else:
+                    children[parent] = [record_id]
+            else:
+                # Parent outside of the subtree (or deleted)
+                roots.append(record_id)
+                context.add(parent)
+
+        # Order top-down
+        order = []
+        queue = roots
+        while queue:
+            order.extend(queue)
+            queue = [child for record_id in queue
+                           for child in children.get(record_id, ())]
+        if len(order) < len(graph):
+            current.log.error("S3GIS: Cannot update Location Tree for location IDs %s: circular parent references" % \
+                              ", ".join(str(i) for i in set(graph) - set(order)))
+
+        # Load the records (and the parents outside of the subtrees)
+        fields = [table.id,
+                  table.parent,
+                  table.level,
+                  table.name,
+                  table.path,
+                  table.inherited,
+                  table.lat,
+                  table.lon,
+                  table.lat_min,
+                  table.lat_max,
+                  table.lon_min,
+                  table.lon_max,
+                  table.radius,
+                  ] + [table[level] for level in hierarchy_levels]
+        records = {}
+        point_wkt = {}
+        is_point = (table.wkt == None) | \
+                   (table.wkt == "") | \
+                   (table.wkt.startswith("POI"))
+        if ids is None:
+            rows = db(not_deleted).select(*fields)
+            for row in rows:
+                records[row.id] = row
+            rows = db(not_deleted & is_point).select(table.id, table.wkt)
+            for row in rows:
+                point_wkt[row.id] = row.wkt
+        else:
+            for chunk in GIS._chunks(list(set(order) | context), batch_size):
+                rows = db(table.id.belongs(chunk)).select(*fields)
+                for row in rows:
+                    records[row.id] = row
+                query = (table.id.belongs(chunk)) & is_point
+                rows = db(query).select(table.id, table.wkt)
+                for row in rows:
+                    point_wkt[row.id] = row.wkt
+
+        wkt_centroid = GIS.wkt_centroid
+        get_bounds_from_radius = GIS.get_bounds_from_radius
+        bounds = ("lat_min", "lat_max", "lon_min", "lon_max")
+
+        # Compute the tree top-down
+        updates = {}
+        for record_id in order:
+            row = records.get(record_id)
+            if not row:
+                continue
+            level = row.level
+            parent = None if level == "L0" else row.parent
+            parent_row = records.get(parent) if parent else None
+
+            new = {}
+
+            # Path & Lx
+            if parent_row:
+                if parent_row.path:
+                    new["path"] = "%s/%s" % (parent_row.path, record_id)
+                else:
+                    new["path"] = "%s/%s" % (parent, record_id)
+                for Lx in hierarchy_levels:
+                    new[Lx] = parent_row[Lx]
+            else:
+                new["path"] = str(record_id)
+                for Lx in hierarchy_levels:
+                    new[Lx] = None
+            if level in hierarchy_levels:
+                new[level] = row.name
+                for Lx in hierarchy_levels[hierarchy_levels.index(level) + 1:]:
+                    new[Lx] = None
+
+            # Lat/Lon & Bounds
+            lat = row.lat
+            lon = row.lon
+            if record_id in point_wkt:
+                # Point (or no geometry)
+                if level == "L0":
+                    new["inherited"] = False
+                elif row.inherited or lat is None or lon is None:
+                    new["inherited"] = True
+                    if parent_row:
+                        lat = parent_row.lat
+                        lon = parent_row.lon
+                    else:
+                        lat = lon = None
+                else:
+                    new["inherited"] = False
+                new["lat"] = lat
+                new["lon"] = lon
+                if lat is not None and lon is not None:
+                    new["wkt"] = "POINT(%s %s)" % (lon, lat)
+                    if lat != row.lat or lon != row.lon or \
+                       any(row[b] is None for b in bounds):
+                        if row.radius:
+                            new.update(get_bounds_from_radius(lat, lon, row.radius))
+                        else:
+                            new.update(lat_min=lat, lat_max=lat,
+                                       lon_min=lon, lon_max=lon)
+            else:
+                # Polygons aren't inherited
+                new["inherited"] = False
+                if lat is None or lon is None or \
+                   any(row[b] is None for b in bounds):
+                    # Calculate Centroid & Bounds
+                    wkt = db(table.id == record_id).select(table.wkt,
+                                                           limitby=(0, 1)
+                                                           ).first().wkt
+                    form = Storage(vars=Storage(wkt=wkt), errors=Storage())
+                    wkt_centroid(form)
+                    if form.errors:
+                        current.log.error("S3GIS: %s" % form.errors)
+                    else:
+                        form_vars = form.vars
+                        for fn in ("lat", "lon") + bounds:
+                            new[fn] = form_vars[fn]
+
+            # Keep the new values for the children
+            for fn, value in new.items():
+                old = point_wkt.get(record_id) if fn == "wkt" else row[fn]
+                if value != old:
+                    if record_id in updates:
+                        updates[record_id][fn] = value
+                    else:
+                        updates[record_id] = {fn: value}
+                if fn != "wkt":
+                    row[fn] = value
+
+        if updates:
+            # Updated bounds must be complete to compute the quadkey
+            for record_id, values in updates.iteritems():
+                if any(b in values for b in bounds):
+                    row = records[record_id]
+                    for b in bounds:
+                        if b not in values:
+                            values[b] = row[b]
+            GIS._bulk_update(table, updates, batch_size)
+        return len(updates)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _bulk_update(table, updates, batch_size=500):
+        """
+            Update many records with individual values, using one
+            UPDATE ... SET field=CASE id WHEN ... END per batch of records
+            with the same set of changed fields
+
+            @param table: the Table
+            @param updates: dict {record_id: {fieldname: value}}
+            @param batch_size: the maximum number of records per UPDATE
+        """
+
+        db = current.db
+        represent = db._adapter.represent
+        tablename = table._tablename
+        now = represent(current.request.utcnow, "datetime")
+
+        # Computed fields (the DAL only computes these for its own writes)
+        computed = [fn for fn in table.fields if table[fn].compute]
+        if computed:
+            for values in updates.itervalues():
+                for fn in computed:
+                    if fn not in values:
+                        try:
+                            values[fn] = table[fn].compute(dict(values))
+                        except (KeyError, AttributeError):
+                            # Not all required fields updated
+                            pass
+
+        # Group records by their set of changed fields
+        groups = {}
+        for record_id, values in updates.iteritems():
+            key = tuple(sorted(values.keys()))
+            if key in groups:
+                groups[key].append(record_id)
+            else:
+                groups[key] = [record_id]
+
+        spatial = "wkt" in table.fields and \
+                  current.deployment_settings.get_gis_spatialdb()
+        for fieldnames, record_ids in groups.iteritems():
+            for chunk in GIS._chunks(record_ids, batch_size):
+                assignments = []
+                for fn in fieldnames:
+                    ftype = table[fn].type
+                    cases = " ".join("WHEN %s THEN %s" % \
+                                     (record_id,
+                                      represent(updates[record_id][fn], ftype))
+                                     for record_id in chunk)
+                    # ELSE keeps the column type for NULL-only batches
+                    assignments.append("%s=CASE id %s ELSE %s END" % \
+                                       (fn, cases, fn))
+                if "modified_on" in table.fields:
+                    assignments.append("modified_on=%s" % now)
+                if spatial and "wkt" in fieldnames:
+                    # Also update the spatial field
+                    assignments.append("the_geom=ST_GeomFromText(CASE id %s END, 4326)" % \
+                                       " ".join("WHEN %s THEN %s" % \
+                                                (record_id,
+                                                 represent(updates[record_id]["wkt"], "text"))
+                                                for record_id in chunk))
+                db.executesql("UPDATE %s SET %s WHERE id IN (%s);" % \
+                              (tablename,
+                               ",".join(assignments),
+                               ",".join(str(record_id) for record_id in chunk)))
+        if groups:
+            # Raw SQL bypasses the DAL callbacks
+            S3TableVersion.renew(tablename)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _chunks(items, size):
+        """ Split a list into chunks of at most size items """
+
+        for i in xrange(0, len(items), size):
+            yield items[i:i + size]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def wkt_centroid(form):
+        """
+            OnValidation callback:
+            If a WKT is defined: validate the format,
+                calculate the LonLat of the Centroid, and set bounds
+            Else if a LonLat is defined: calculate the WKT for the Point.
+        """
+
+        form_vars = form.vars
+
+        if form_vars.get("gis_feature_type", None) == "1":
+            # Point
+            lat = form_vars.get("lat", None)
+            lon = form_vars.get("lon", None)
+            if (lon is None and lat is None) or \
+               (lon == "" and lat == ""):
+                # No Geometry available
+                # Don't clobber existing records (e.g. in Prepop)
+                #form_vars.gis_feature_type = "0"
+                # Cannot create WKT, so Skip
+                return
+            elif lat is None or lat == "":
+                # Can't just have lon without lat
+                form.errors["lat"] = current.messages.lat_empty
+            elif lon is None or lon == "":
+                form.errors["lon"] = current.messages.lon_empty
+            else:
+                form_vars.wkt = "POINT(%(lon)s %(lat)s)" % form_vars
+                radius = form_vars.get("radius", None)
+                if radius:
+                    bbox = GIS.get_bounds_from_radius(lat, lon, radius)
+                    form_vars.lat_min = bbox["lat_min"]
+                    form_vars.lon_min = bbox["lon_min"]
+                    form_vars.lat_max = bbox["lat_max"]
+                    form_vars.lon_max = bbox["lon_max"]
+                else:
+                    if "lon_min" not in form_vars or form_vars.lon_min is None:
+                        form_vars.lon_min = lon
+                    if "lon_max" not in form_vars or form_vars.lon_max is None:
+                        form_vars.lon_max = lon
+                    if "lat_min" not in form_vars or form_vars.lat_min is None:
+                        form_vars.lat_min = lat
+                    if "lat_max" not in form_vars or form_vars.lat_max is None:
+                        form_vars.lat_max = lat
+
+        elif form_vars.get("wkt", None):
+            # Parse WKT for LineString, Polygon, etc
+            from shapely.wkt import loads as wkt_loads
+            try:
+                shape = wkt_loads(form_vars.wkt)
+            except:
+                try:
+                    # Perhaps this is really a LINESTRING (e.g. OSM import of an unclosed Way)
+                    linestring = "LINESTRING%s" % form_vars.wkt[8:-1]
+                    shape = wkt_loads(linestring)
+                    form_vars.wkt = linestring
+                except:
+                    form.errors["wkt"] = current.messages.invalid_wkt
                     return
             gis_feature_type = shape.type
             if gis_feature_type == "Point":
@@ -5780,12 +6381,194 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
         """
 
         table = current.s3db.gis_location
-        query = (table.lat_min <= lat_max) & \
+        query = GIS.query_quadkey(table, lon_min, lat_min, lon_max, lat_max) & \
+                (table.lat_min <= lat_max) & \
                 (table.lat_max >= lat_min) & \
                 (table.lon_min <= lon_max) & \
                 (table.lon_max >= lon_min)
         return query
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_quadkey(lon_min, lat_min, lon_max, lat_max):
+        """
+            Get the key of the smallest tile of a lat/lon quadtree which
+            contains a bounding box, for indexed bounding box queries on
+            non-spatial databases (see query_quadkey)
+
+            - every level splits a tile into 4 quadrants, numbered
+              0=NW, 1=NE, 2=SW, 3=SE, so the key of a tile is a prefix
+              of the keys of all tiles inside it
+
+            @param lon_min: the western boundary
+            @param lat_min: the southern boundary
+            @param lon_max: the eastern boundary
+            @param lat_max: the northern boundary
+
+            @return: the quadkey (string of up to QUADKEY_ZOOM digits,
+                     "" for bounds which span the equator or the
+                     prime meridian), or None if bounds are missing
+        """
+
+        if lon_min is None or lat_min is None or \
+           lon_max is None or lat_max is None:
+            return None
+
+        x0, x1 = -180.0, 180.0
+        y0, y1 = -90.0, 90.0
+        key = []
+        for _ in xrange(QUADKEY_ZOOM):
+            xm = (x0 + x1) / 2
+            ym = (y0 + y1) / 2
+            if lon_max < xm:
+                x = 0
+                x1 = xm
+            elif lon_min >= xm:
+                x = 1
+                x0 = xm
+            else:
+                break
+            if lat_min >= ym:
+                y = 0
+                y0 = ym
+            elif lat_max < ym:
+                y = 2
+                y1 = ym
+            else:
+                break
+            key.append(str(x + y))
+        return "".join(key)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def query_quadkey(table, lon_min, lat_min, lon_max, lat_max):
+        """
+            Query for all locations whose quadkey tile intersects a bounding
+            box, i.e. a small number of prefix-range and equality lookups on
+            the quadkey index, to narrow down range comparisons on the
+            lat/lon or bounds columns (which can not use an index)
+
+            @param table: the gis_location table (or an alias of it)
+            @param lon_min: the western boundary
+            @param lat_min: the southern boundary
+            @param lon_max: the eastern boundary
+            @param lat_max: the northern boundary
+
+            @return: the Query
+        """
+
+        import math
+
+        # Allow for locations exactly on the boundaries
+        epsilon = 1e-9
+        lon_min = max(float(lon_min) - epsilon, -180.0)
+        lon_max = min(float(lon_max) + epsilon, 180.0)
+        lat_min = max(float(lat_min) - epsilon, -90.0)
+        lat_max = min(float(lat_max) + epsilon, 90.0)
+
+        # Choose the level where the bbox covers at most 2x2 tiles
+        width = max(lon_max - lon_min, epsilon)
+        height = max(lat_max - lat_min, epsilon)
+        zoom = int(math.floor(min(math.log(360.0 / width, 2),
+                                  math.log(180.0 / height, 2))))
+        zoom = max(0, min(zoom, QUADKEY_ZOOM))
+
+        n = 2 ** zoom
+        tile_width = 360.0 / n
+        tile_height = 180.0 / n
+        column = lambda lon: max(0, min(int((lon + 180.0) / tile_width), n - 1))
+        row = lambda lat: max(0, min(int((90.0 - lat) / tile_height), n - 1))
+
+        keys = set()
+        for x in xrange(column(lon_min), column(lon_max) + 1):
+            for y in xrange(row(lat_max), row(lat_min) + 1):
+                digits = []
+                for i in xrange(zoom, 0, -1):
+                    mask = 1 << (i - 1)
+                    digits.append(str((1 if x & mask else 0) + \
+                                      (2 if y & mask else 0)))
+                keys.add("".join(digits))
+
+        quadkey = table.quadkey
+        # Locations without quadkey (e.g. not yet updated)
+        query = (quadkey == None)
+        prefixes = set()
+        for key in keys:
+            if key:
+                # Locations within the tile
+                query |= (quadkey >= key) & (quadkey < "%s4" % key)
+            else:
+                query |= (quadkey != None)
+            # Larger locations containing the tile
+            prefixes.update(key[:i] for i in xrange(len(key)))
+        if prefixes:
+            query |= (quadkey.belongs(prefixes))
+        return query
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_quadkeys(force=False):
+        """
+            Set the quadkey of all locations which don't have one yet
+            (e.g. after upgrading an existing database)
+
+            @param force: re-compute the quadkeys of all locations
+
+            @return: the number of updated records
+        """
+
+        db = current.db
+        table = current.s3db.gis_location
+        query = (table.lat_min != None) & \
+                (table.lat_max != None) & \
+                (table.lon_min != None) & \
+                (table.lon_max != None)
+        if not force:
+            query &= (table.quadkey == None)
+        rows = db(query).select(table.id,
+                                table.lon_min,
+                                table.lat_min,
+                                table.lon_max,
+                                table.lat_max,
+                                )
+
+        get_quadkey = GIS.get_quadkey
+        updates = {}
+        for row in rows:
+            updates[row.id] = {"quadkey": get_quadkey(row.lon_min,
+                                                      row.lat_min,
+                                                      row.lon_max,
+                                                      row.lat_max,
+                                                      )}
+        if updates:
+            GIS._bulk_update(table, updates)
+        return len(updates)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_tile_bounds(z, x, y):
+        """
+            Returns the bounding box of a map tile in the XYZ tiling scheme
+            (Spherical Mercator, as used by OpenStreetMap/Google)
+
+            @param z: the zoom level
+            @param x: the tile column (counting from the west)
+            @param y: the tile row (counting from the north)
+
+            @return: tuple (lon_min, lat_min, lon_max, lat_max)
+        """
+
+        import math
+
+        n = 2.0 ** z
+        lat = lambda row: math.degrees(math.atan(math.sinh(math.pi * \
+                                                           (1 - 2 * row / n))))
+        return (x / n * 360.0 - 180.0,
+                lat(y + 1),
+                (x + 1) / n * 360.0 - 180.0,
+                lat(y),
+                )
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_features_by_bbox(lon_min, lat_min, lon_max, lat_max):
@@ -5820,11 +6603,31 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
             current.log.info("S3GIS",
                              "Upgrade Shapely for Performance enhancements")
 
+        db = current.db
         table = current.s3db.gis_location
         in_bbox = current.gis.query_features_by_bbox(*shape.bounds)
         has_wkt = (table.wkt != None) & (table.wkt != "")
 
-        for loc in current.db(in_bbox & has_wkt).select():
+        if current.deployment_settings.get_gis_spatial_index():
+            # Polygons from the spatial index, Points by their Lat/Lon
+            from shapely.geometry import Point
+            from shapely.prepared import prep
+            prepared = prep(shape)
+            query = in_bbox & has_wkt & (table.gis_feature_type == 1)
+            rows = db(query).select(table.id,
+                                    table.lat,
+                                    table.lon,
+                                    )
+            ids = [row.id for row in rows
+                   if row.lat is not None and row.lon is not None and \
+                      prepared.intersects(Point(row.lon, row.lat))]
+            ids.extend(item[0] for item in S3SpatialIndex.intersects(shape))
+            if ids:
+                for loc in db(table.id.belongs(ids)).select():
+                    yield loc
+            return
+
+        for loc in db(in_bbox & has_wkt).select():
             try:
                 location_shape = wkt_loads(loc.wkt)
                 if location_shape.intersects(shape):
@@ -6005,6 +6808,151 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_simplify_level(tolerance=None):
+        """
+            Find the precomputed simplification level to use for a
+            requested tolerance, i.e. the coarsest of the
+            settings.gis.simplify_levels which is not coarser than
+            the requested tolerance
+
+            @param tolerance: the requested tolerance (defaults to
+                              settings.gis.simplify_tolerance)
+
+            @return: the level (tolerance), or None if there is no
+                     suitable level
+        """
+
+        settings = current.deployment_settings
+        levels = settings.get_gis_simplify_levels()
+        if not levels:
+            return None
+        if tolerance is None:
+            tolerance = settings.get_gis_simplify_tolerance()
+        levels = [level for level in levels if level <= tolerance]
+        return max(levels) if levels else None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_simplified(location_ids, tolerance=None):
+        """
+            Look up precomputed simplified geometries
+
+            @param location_ids: the gis_location record IDs
+            @param tolerance: the requested tolerance (defaults to
+                              settings.gis.simplify_tolerance)
+
+            @return: dict {location_id: GeoJSON}, containing only those
+                     locations for which a simplified geometry is stored
+        """
+
+        output = {}
+        if not location_ids:
+            return output
+
+        level = GIS.get_simplify_level(tolerance)
+        if level is None:
+            return output
+
+        table = current.s3db.gis_location_simplified
+        query = (table.location_id.belongs(location_ids)) & \
+                (table.tolerance == level)
+        rows = current.db(query).select(table.location_id,
+                                        table.geojson,
+                                        )
+        for row in rows:
+            output[row.location_id] = row.geojson
+        return output
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_simplified(location_id, wkt=None, force=False):
+        """
+            Precompute the simplified geometries of a location at all
+            settings.gis.simplify_levels
+            - called by update_location_tree and the
+              gis_update_simplified task
+
+            @param location_id: the gis_location record ID
+            @param wkt: the WKT of the location (if already known)
+            @param force: re-compute even if the WKT is unchanged
+        """
+
+        levels = current.deployment_settings.get_gis_simplify_levels()
+        if not levels:
+            return
+
+        import math
+
+        db = current.db
+        s3db = current.s3db
+        table = s3db.gis_location_simplified
+        query = (table.location_id == location_id)
+
+        if wkt is None:
+            gtable = s3db.gis_location
+            row = db(gtable.id == location_id).select(gtable.wkt,
+                                                      limitby=(0, 1)
+                                                      ).first()
+            wkt = row.wkt if row else None
+
+        if not wkt or wkt.startswith("POI"):
+            # Points don't need simplification
+            db(query).delete()
+            return
+
+        checksum = hashlib.md5(wkt).hexdigest()
+        if not force:
+            rows = db(query).select(table.tolerance,
+                                    table.checksum,
+                                    )
+            if set(row.tolerance for row in rows) == set(levels) and \
+               all(row.checksum == checksum for row in rows):
+                # Up-to-date
+                return
+
+        db(query).delete()
+        simplify = GIS.simplify
+        for tolerance in levels:
+            # No need for more decimals than the tolerance
+            decimals = max(int(math.ceil(-math.log10(tolerance))) + 1, 2)
+            geojson = simplify(wkt,
+                               tolerance = tolerance,
+                               output = "geojson",
+                               decimals = decimals,
+                               )
+            if geojson:
+                table.insert(location_id = location_id,
+                             tolerance = tolerance,
+                             geojson = geojson,
+                             checksum = checksum,
+                             )
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def rebuild_simplified(force=False):
+        """
+            Precompute the simplified geometries of all (non-point)
+            locations, e.g. after changing settings.gis.simplify_levels
+            - called by the gis_rebuild_simplified task
+
+            @param force: re-compute even where the WKT is unchanged
+        """
+
+        if not current.deployment_settings.get_gis_simplify_levels():
+            return
+
+        db = current.db
+        table = current.s3db.gis_location
+        query = (table.gis_feature_type != 1) & \
+                (table.deleted == False)
+        location_ids = [row.id for row in db(query).select(table.id)]
+
+        update_simplified = GIS.update_simplified
+        for location_id in location_ids:
+            update_simplified(location_id, force=force)
+
     # -------------------------------------------------------------------------
     def show_map(self,
                  id = "default_map",
@@ -6190,28 +7138,315 @@ page.render('%(filename)s', {format: 'jpeg', quality: '100'});''' % \
                    )
 
 # =============================================================================
-class MAP(DIV):
+class S3SpatialIndex(object):
     """
-        HTML Helper to render a Map
-        - allows the Map to be generated only when being rendered
-        - used by gis.show_map()
+        In-process spatial index (R-tree) of the prepared geometries of
+        all non-point locations, per hierarchy level, for intersection
+        and point-in-polygon lookups without a spatial database
+        (settings.gis.spatial_index)
+
+        - the index for a level is built lazily on first use, and rebuilt
+          whenever the number or the latest modification date of the
+          locations of that level change (so that writes in other
+          processes are picked up too), while point locations being
+          added don't cause a rebuild of the polygon indexes
+        - these are re-read whenever the S3TableVersion stamp of
+          gis_location changes, otherwise at most every
+          settings.gis.spatial_index_check seconds (catching writes
+          which bypass the DAL, e.g. by external scripts)
+        - uses shapely.strtree.STRtree where available, otherwise
+          a bounding box scan
     """
 
-    def __init__(self, **opts):
+    # Indexes per level, {level: {"stamp", "tree", "geoms", ...}}
+    indexes = {}
+    lock = threading.Lock()
+
+    # Status of the indexed locations, (version, checked, {level: stamp})
+    status = None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def base_query():
+        """ Query for all indexed locations """
+
+        table = current.s3db.gis_location
+        return (table.gis_feature_type != 1) & \
+               (table.wkt != None) & \
+               (table.wkt != "") & \
+               (table.deleted != True)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def stamps(cls):
         """
-            :param **opts: options to pass to the Map for server-side processing
+            Get the current status of the indexed locations per level,
+            re-read from the database if gis_location has been written
+            to since the last check, or the last check is too old
+
+            @return: dict {level: (count, latest modified_on)}
         """
 
-        # We haven't yet run _setup()
-        self.setup = False
-        self.callback = None
+        table = current.s3db.gis_location
+        S3TableVersion.attach(table)
+        version = S3TableVersion.get("gis_location")
+
+        now = time.time()
+        interval = current.deployment_settings.get_gis_spatial_index_check()
+
+        with cls.lock:
+            status = cls.status
+        if status is not None and \
+           status[0] == version and now - status[1] < interval:
+            return status[2]
+
+        count = table.id.count()
+        modified_on = table.modified_on.max()
+        rows = current.db(cls.base_query()).select(table.level,
+                                                   count,
+                                                   modified_on,
+                                                   groupby = table.level,
+                                                   )
+        stamps = dict((row[table.level], (row[count], str(row[modified_on])))
+                      for row in rows)
+        with cls.lock:
+            cls.status = (version, now, stamps)
+        return stamps
 
-        # Options for server-side processing
-        self.opts = opts
-        self.id = map_id = opts.get("id", "default_map")
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get_index(cls, level, stamp):
+        """
+            Get the index for a level, (re-)build it if necessary
 
-        # Options for client-side processing
-        self.options = {}
+            @param level: the hierarchy level (None for specific locations)
+            @param stamp: the current status of the level (from stamps())
+        """
+
+        with cls.lock:
+            index = cls.indexes.get(level)
+        if index is None or index["stamp"] != stamp:
+            index = cls.build(level, stamp)
+            with cls.lock:
+                cls.indexes[level] = index
+        return index
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def build(cls, level, stamp):
+        """
+            Build the index for a level
+
+            @param level: the hierarchy level (None for specific locations)
+            @param stamp: the current status of the level (from stamps())
+        """
+
+        from shapely.prepared import prep
+        from shapely.wkt import loads as wkt_loads
+        try:
+            from shapely.strtree import STRtree
+        except ImportError:
+            # Shapely < 1.4
+            STRtree = None
+
+        table = current.s3db.gis_location
+        query = cls.base_query() & (table.level == level)
+        rows = current.db(query).select(table.id,
+                                        table.wkt,
+                                        )
+        ids = []
+        geoms = []
+        for row in rows:
+            try:
+                geom = wkt_loads(row.wkt)
+            except:
+                current.log.error("Error reading wkt of location with id",
+                                  row.id)
+                continue
+            ids.append(row.id)
+            geoms.append(geom)
+
+        return {"stamp": stamp,
+                "ids": ids,
+                "geoms": geoms,
+                "positions": dict((location_id, i)
+                                  for i, location_id in enumerate(ids)),
+                "prepared": [prep(geom) for geom in geoms],
+                "tree": STRtree(geoms) if STRtree and geoms else None,
+                # Shapely < 2.0 returns geometries rather than indices
+                "lookup": dict((id(geom), i) for i, geom in enumerate(geoms)),
+                }
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def candidates(index, shape):
+        """
+            Find the positions of all geometries in an index whose
+            bounding box intersects the bounding box of a shape
+
+            @param index: the index
+            @param shape: the shape (Shapely geometry)
+        """
+
+        tree = index["tree"]
+        if tree is not None:
+            lookup = index["lookup"]
+            for item in tree.query(shape):
+                try:
+                    yield int(item)
+                except TypeError:
+                    yield lookup[id(item)]
+        else:
+            x_min, y_min, x_max, y_max = shape.bounds
+            for i, geom in enumerate(index["geoms"]):
+                bounds = geom.bounds
+                if bounds[0] <= x_max and bounds[2] >= x_min and \
+                   bounds[1] <= y_max and bounds[3] >= y_min:
+                    yield i
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def intersects(cls, shape, levels=None):
+        """
+            Find all non-point locations which intersect a shape
+
+            @param shape: the shape (Shapely geometry)
+            @param levels: the hierarchy levels to search (None for
+                           specific locations), default all levels
+
+            @return: list of tuples (location_id, level)
+        """
+
+        stamps = cls.stamps()
+        if levels is None:
+            levels = stamps.keys()
+
+        output = []
+        for level in levels:
+            stamp = stamps.get(level)
+            if stamp is None:
+                continue
+            index = cls.get_index(level, stamp)
+            ids = index["ids"]
+            prepared = index["prepared"]
+            for i in cls.candidates(index, shape):
+                if prepared[i].intersects(shape):
+                    output.append((ids[i], level))
+        return output
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def contains(cls, location_id, lat, lon):
+        """
+            Check whether the geometry of a location contains a point
+
+            @param location_id: the gis_location record ID
+            @param lat: the latitude
+            @param lon: the longitude
+
+            @return: True|False, or None if the location has no indexed
+                     geometry (e.g. is a point)
+        """
+
+        table = current.s3db.gis_location
+        query = cls.base_query() & (table.id == location_id)
+        row = current.db(query).select(table.level,
+                                       limitby=(0, 1)
+                                       ).first()
+        if not row:
+            return None
+        level = row.level
+
+        stamp = cls.stamps().get(level)
+        if stamp is None:
+            return None
+        index = cls.get_index(level, stamp)
+        i = index["positions"].get(location_id)
+        if i is None:
+            return None
+
+        from shapely.geometry import Point
+        return index["prepared"][i].intersects(Point(lon, lat))
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls, level=False):
+        """
+            Remove indexes from the process (e.g. after writes)
+
+            @param level: the hierarchy level, default all levels
+        """
+
+        with cls.lock:
+            cls.status = None
+            if level is False:
+                cls.indexes.clear()
+            else:
+                cls.indexes.pop(level, None)
+
+# =============================================================================
+def _import_geometry(item):
+    """
+        Parse (and simplify) an imported geometry
+        - module-level function, so that it can be run in a process pool
+          (see GIS.import_gadm1)
+
+        @param item: tuple (wkt, tolerances), tolerances being the
+                     settings.gis.simplify_levels to precompute
+
+        @return: tuple (location, simplified), location being a dict of
+                 the gis_location fields (see GIS.parse_location) and
+                 simplified a list of tuples (tolerance, geojson),
+                 or None if the WKT is invalid
+    """
+
+    import math
+
+    wkt, tolerances = item
+    try:
+        location = GIS.parse_location(wkt)
+    except Exception:
+        return None
+
+    simplified = []
+    if tolerances and location["gis_feature_type"] != 1:
+        simplify = GIS.simplify
+        for tolerance in tolerances:
+            # No need for more decimals than the tolerance
+            decimals = max(int(math.ceil(-math.log10(tolerance))) + 1, 2)
+            geojson = simplify(wkt,
+                               tolerance = tolerance,
+                               output = "geojson",
+                               decimals = decimals,
+                               )
+            if geojson:
+                simplified.append((tolerance, geojson))
+
+    return location, simplified
+
+# =============================================================================
+class MAP(DIV):
+    """
+        HTML Helper to render a Map
+        - allows the Map to be generated only when being rendered
+        - used by gis.show_map()
+    """
+
+    def __init__(self, **opts):
+        """
+            :param **opts: options to pass to the Map for server-side processing
+        """
+
+        # We haven't yet run _setup()
+        self.setup = False
+        self.callback = None
+
+        # Options for server-side processing
+        self.opts = opts
+        self.id = map_id = opts.get("id", "default_map")
+
+        # Options for client-side processing
+        self.options = {}
 
         # Components
         # Map (Embedded not Window)
@@ -6746,7 +7981,115 @@ class MAP(DIV):
             options["feature_resources"] = addFeatureResources(feature_resources)
 
         # Layers
+        # - compiled per config, user roles and language, and cached
+        #   across requests if settings.gis.config_cache is enabled
+        catalogue_layers = opts.get("catalogue_layers", False)
+        cache = S3MapConfigCache(config,
+                                 "layers",
+                                 catalogue_layers,
+                                 s3.debug,
+                                 get_vars.get("layers", None),
+                                 )
+        generated = []
+        def generate():
+            generated.append(True)
+            return self._compile_layers(config, catalogue_layers)
+        compiled = cache(generate)
+        if not generated:
+            # Compiled layers from the cache => refresh the caches of the
+            # KML/GeoRSS feeds which would otherwise be refreshed during
+            # compilation
+            self._refresh_feeds(compiled["feeds"])
+
+        # Copy, so that the options can be modified after _setup()
+        # without altering the cached data
+        options.update(deepcopy(compiled["layers"]))
+        scripts = list(compiled["scripts"])
+        if compiled["get_feature_info"]:
+            s3.gis.get_feature_info = True
+        for script in compiled["s3_scripts"]:
+            if script not in s3.scripts:
+                s3.scripts.append(script)
+        for script in compiled["js_global"]:
+            if script not in s3.js_global:
+                s3.js_global.append(script)
+        if compiled["warning"]:
+            response.warning += compiled["warning"]
+
+        # WMS getFeatureInfo
+        # (loads conditionally based on whether queryable WMS Layers have been added)
+        if s3.gis.get_feature_info and settings.get_gis_getfeature_control():
+            # Presence of label turns feature on
+            # @ToDo: Provide explicit option to support multiple maps in a page
+            #        with different options
+            i18n["gis_get_feature_info"] = T("Get Feature Info")
+            i18n["gis_feature_info"] = T("Feature Info")
+
+        # Callback can be set before _setup()
+        if not self.callback:
+            self.callback = opts.get("callback", "DEFAULT")
+        # These can be read/modified after _setup() & before xml()
+        self.options = options
+
+        self.globals = js_globals
+        self.i18n = i18n
+        self.scripts = scripts
+
+        # Set up map plugins
+        # - currently just used by Climate
+        # @ToDo: Get these working with new loader
+        # This, and any code it generates, is done last
+        # However, map plugin should not assume this.
+        self.plugin_callbacks = []
+        plugins = opts.get("plugins", None)
+        if plugins:
+            for plugin in plugins:
+                plugin.extend_gis_map(self)
+
+        # Flag to xml() that we've already been run
+        self.setup = True
+
+        return options
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _compile_layers(config, catalogue_layers=False):
+        """
+            Resolve the layers of a map configuration into the client-side
+            layer options (expensive: several queries and permission checks
+            per layer type, hence cached by S3MapConfigCache)
+
+            @param config: the map configuration (GIS.get_config)
+            @param catalogue_layers: add all enabled layers from the
+                                     catalogue, not just the base layer
+
+            @return: dict {"layers": {dictname: [layer options]},
+                           "scripts": [scripts to load with the map],
+                           "get_feature_info": whether there are queryable
+                                               WMS layers,
+                           "s3_scripts": [scripts added to s3.scripts],
+                           "js_global": [scripts added to s3.js_global],
+                           "warning": error messages for the user,
+                           "feeds": [(layer class name, refresh_feed
+                                      parameters) for KML/GeoRSS feeds],
+                           }
+        """
+
         db = current.db
+        s3db = current.s3db
+        s3 = current.response.s3
+        ctable = db.gis_config
+        settings = current.deployment_settings
+
+        # Record the side-effects of the layer classes, so that they can
+        # be replayed when the compiled layers are read from the cache
+        s3_scripts = s3.scripts
+        js_global = s3.js_global
+        num_scripts = len(s3_scripts)
+        num_globals = len(js_global)
+        get_feature_info = s3.gis.get_feature_info
+        s3.gis.get_feature_info = False
+
         ltable = db.gis_layer_config
         etable = db.gis_layer_entity
         query = (ltable.deleted == False)
@@ -6759,7 +8102,7 @@ class MAP(DIV):
                   ltable.dir,
                   ]
 
-        if opts.get("catalogue_layers", False):
+        if catalogue_layers:
             # Add all enabled Layers from the Catalogue
             stable = db.gis_style
             mtable = db.gis_marker
@@ -6866,57 +8209,69 @@ class MAP(DIV):
 
         # Make unique
         layer_types = set(layer_types)
+        options = {}
         scripts = []
         scripts_append = scripts.append
+        warnings = []
+        feeds = []
         for LayerType in layer_types:
             try:
                 # Instantiate the Class
                 layer = LayerType(layers)
-                layer.as_dict(options)
+                # NB options is still empty here, so the layer
+                #    returns its dict rather than adding it
+                result = layer.as_dict()
+                if result is not None:
+                    options[layer.dictname] = result
                 for script in layer.scripts:
                     scripts_append(script)
+                if hasattr(LayerType, "refresh_feed"):
+                    # Remember the feeds to refresh at cache hits
+                    for sublayer in layer.sublayers:
+                        feed = sublayer.feed()
+                        if feed:
+                            feeds.append((LayerType.__name__, feed))
             except Exception, exception:
                 error = "%s not shown: %s" % (LayerType.__name__, exception)
                 current.log.error(error)
                 if s3.debug:
                     raise HTTP(500, error)
                 else:
-                    response.warning += error
-
-        # WMS getFeatureInfo
-        # (loads conditionally based on whether queryable WMS Layers have been added)
-        if s3.gis.get_feature_info and settings.get_gis_getfeature_control():
-            # Presence of label turns feature on
-            # @ToDo: Provide explicit option to support multiple maps in a page
-            #        with different options
-            i18n["gis_get_feature_info"] = T("Get Feature Info")
-            i18n["gis_feature_info"] = T("Feature Info")
-
-        # Callback can be set before _setup()
-        if not self.callback:
-            self.callback = opts.get("callback", "DEFAULT")
-        # These can be read/modified after _setup() & before xml()
-        self.options = options
-
-        self.globals = js_globals
-        self.i18n = i18n
-        self.scripts = scripts
+                    warnings.append(error)
+
+        compiled = {"layers": options,
+                    "scripts": scripts,
+                    "get_feature_info": bool(s3.gis.get_feature_info),
+                    "s3_scripts": s3_scripts[num_scripts:],
+                    "js_global": js_global[num_globals:],
+                    "warning": "".join(warnings),
+                    "feeds": feeds,
+                    }
+        s3.gis.get_feature_info = get_feature_info
+        return compiled
 
-        # Set up map plugins
-        # - currently just used by Climate
-        # @ToDo: Get these working with new loader
-        # This, and any code it generates, is done last
-        # However, map plugin should not assume this.
-        self.plugin_callbacks = []
-        plugins = opts.get("plugins", None)
-        if plugins:
-            for plugin in plugins:
-                plugin.extend_gis_map(self)
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _refresh_feeds(feeds):
+        """
+            Refresh the caches of KML/GeoRSS feeds (download if expired),
+            as the layer classes would do when compiling the layers
 
-        # Flag to xml() that we've already been run
-        self.setup = True
+            @param feeds: the feeds of the compiled layers, list of
+                          tuples (layer class name, refresh_feed parameters)
+        """
 
-        return options
+        layer_types = {"LayerGeoRSS": LayerGeoRSS,
+                       "LayerKML": LayerKML,
+                       }
+        for name, feed in feeds:
+            layer_type = layer_types.get(name)
+            if layer_type is None:
+                continue
+            try:
+                layer_type.refresh_feed(**feed)
+            except Exception, exception:
+                current.log.error("%s not refreshed: %s" % (name, exception))
 
     # -------------------------------------------------------------------------
     def xml(self):
@@ -7844,6 +9199,16 @@ class LayerFeature(Layer):
                       "url": url,
                       }
 
+            if not self.aggregate and \
+               current.deployment_settings.get_gis_feature_tiles():
+                # Tiled endpoint (S3Map.tile)
+                tiles = "%s.geojson?layer=%i&z={z}&x={x}&y={y}" % \
+                    (URL(c=self.controller, f=self.function, args="map"),
+                     self.layer_id)
+                if self.filter:
+                    tiles = "%s&%s" % (tiles, self.filter)
+                output["tiles"] = tiles
+
             popup_format = self.popup_format
             if popup_format:
                 # New-style
@@ -7947,66 +9312,90 @@ class LayerGeoRSS(Layer):
         super(LayerGeoRSS, self).__init__(all_layers)
         LayerGeoRSS.SubLayer.cachetable = current.s3db.gis_cache
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def refresh_feed(url, refresh=None, data=None, image=None):
+        """
+            Download the feed to the cache if the cached copy has expired
+
+            @param url: the feed URL
+            @param refresh: the refresh interval (seconds)
+            @param data: the data field
+            @param image: the image field
+        """
+
+        db = current.db
+        request = current.request
+        response = current.response
+        cachetable = current.s3db.gis_cache
+
+        # Check to see if we should Download layer to the cache
+        download = True
+        query = (cachetable.source == url)
+        existing_cached_copy = db(query).select(cachetable.modified_on,
+                                                limitby=(0, 1)).first()
+        refresh = refresh or 900 # 15 minutes set if we have no data (legacy DB)
+        if existing_cached_copy:
+            modified_on = existing_cached_copy.modified_on
+            cutoff = modified_on + datetime.timedelta(seconds=refresh)
+            if request.utcnow < cutoff:
+                download = False
+        if download:
+            # Download layer to the Cache
+            from gluon.tools import fetch
+            # @ToDo: Call directly without going via HTTP
+            # @ToDo: Make this async by using S3Task (also use this for the refresh time)
+            fields = ""
+            if data:
+                fields = "&data_field=%s" % data
+            if image:
+                fields = "%s&image_field=%s" % (fields, image)
+            _url = "%s%s/update.georss?fetchurl=%s%s" % (current.deployment_settings.get_base_public_url(),
+                                                         URL(c="gis", f="cache_feed"),
+                                                         url,
+                                                         fields)
+            # Keep Session for local URLs
+            import Cookie
+            cookie = Cookie.SimpleCookie()
+            cookie[response.session_id_name] = response.session_id
+            current.session._unlock(response)
+            try:
+                # @ToDo: Need to commit to not have DB locked with SQLite?
+                fetch(_url, cookie=cookie)
+                if existing_cached_copy:
+                    # Clear old selfs which are no longer active
+                    query = (cachetable.source == url) & \
+                            (cachetable.modified_on < cutoff)
+                    db(query).delete()
+            except Exception, exception:
+                current.log.error("GeoRSS %s download error" % url, exception)
+                # Feed down
+                if existing_cached_copy:
+                    # Use cached copy
+                    # Should we Update timestamp to prevent every
+                    # subsequent request attempting the download?
+                    #query = (cachetable.source == url)
+                    #db(query).update(modified_on=request.utcnow)
+                    pass
+                else:
+                    response.warning += "%s down & no cached copy available" % url
+
     # -------------------------------------------------------------------------
     class SubLayer(Layer.SubLayer):
+        def feed(self):
+            """ Parameters for LayerGeoRSS.refresh_feed """
+
+            return {"url": self.url,
+                    "refresh": self.refresh,
+                    "data": self.data,
+                    "image": self.image,
+                    }
+
         def as_dict(self):
-            db = current.db
-            request = current.request
-            response = current.response
-            cachetable = self.cachetable
 
-            url = self.url
-            # Check to see if we should Download layer to the cache
-            download = True
-            query = (cachetable.source == url)
-            existing_cached_copy = db(query).select(cachetable.modified_on,
-                                                    limitby=(0, 1)).first()
-            refresh = self.refresh or 900 # 15 minutes set if we have no data (legacy DB)
-            if existing_cached_copy:
-                modified_on = existing_cached_copy.modified_on
-                cutoff = modified_on + datetime.timedelta(seconds=refresh)
-                if request.utcnow < cutoff:
-                    download = False
-            if download:
-                # Download layer to the Cache
-                from gluon.tools import fetch
-                # @ToDo: Call directly without going via HTTP
-                # @ToDo: Make this async by using S3Task (also use this for the refresh time)
-                fields = ""
-                if self.data:
-                    fields = "&data_field=%s" % self.data
-                if self.image:
-                    fields = "%s&image_field=%s" % (fields, self.image)
-                _url = "%s%s/update.georss?fetchurl=%s%s" % (current.deployment_settings.get_base_public_url(),
-                                                             URL(c="gis", f="cache_feed"),
-                                                             url,
-                                                             fields)
-                # Keep Session for local URLs
-                import Cookie
-                cookie = Cookie.SimpleCookie()
-                cookie[response.session_id_name] = response.session_id
-                current.session._unlock(response)
-                try:
-                    # @ToDo: Need to commit to not have DB locked with SQLite?
-                    fetch(_url, cookie=cookie)
-                    if existing_cached_copy:
-                        # Clear old selfs which are no longer active
-                        query = (cachetable.source == url) & \
-                                (cachetable.modified_on < cutoff)
-                        db(query).delete()
-                except Exception, exception:
-                    current.log.error("GeoRSS %s download error" % url, exception)
-                    # Feed down
-                    if existing_cached_copy:
-                        # Use cached copy
-                        # Should we Update timestamp to prevent every
-                        # subsequent request attempting the download?
-                        #query = (cachetable.source == url)
-                        #db(query).update(modified_on=request.utcnow)
-                        pass
-                    else:
-                        response.warning += "%s down & no cached copy available" % url
+            LayerGeoRSS.refresh_feed(**self.feed())
 
+            url = self.url
             name_safe = self.safe_name
 
             # Pass the GeoJSON URL to the client
@@ -8229,49 +9618,78 @@ class LayerKML(Layer):
         LayerKML.cachepath = cachepath
 
     # -------------------------------------------------------------------------
-    class SubLayer(Layer.SubLayer):
-        def as_dict(self):
-            db = current.db
-            request = current.request
+    @staticmethod
+    def cache_filename(name):
+        """
+            The name of the file to cache a KML feed in
 
-            cachetable = LayerKML.cachetable
-            cacheable = LayerKML.cacheable
-            #cachepath = LayerKML.cachepath
+            @param name: the layer name
+        """
 
-            name = self.name
-            if cacheable:
-                _name = urllib2.quote(name)
-                _name = _name.replace("%", "_")
-                filename = "%s.file.%s.kml" % (cachetable._tablename,
-                                               _name)
+        _name = urllib2.quote(name)
+        _name = _name.replace("%", "_")
+        return "gis_cache2.file.%s.kml" % _name
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def refresh_feed(record_id, name, refresh=None):
+        """
+            Download the feed to the cache (async, if workers alive)
+            if the cached copy has expired
 
-                # Should we download a fresh copy of the source file?
-                download = True
-                query = (cachetable.name == name)
-                cached = db(query).select(cachetable.modified_on,
-                                          limitby=(0, 1)).first()
-                refresh = self.refresh or 900 # 15 minutes set if we have no data (legacy DB)
-                if cached:
-                    modified_on = cached.modified_on
-                    cutoff = modified_on + datetime.timedelta(seconds=refresh)
-                    if request.utcnow < cutoff:
-                        download = False
-
-                if download:
-                    # Download file (async, if workers alive)
-                    response = current.response
-                    session_id_name = response.session_id_name
-                    session_id = response.session_id
-                    current.s3task.async("gis_download_kml",
-                                         args=[self.id, filename, session_id_name, session_id])
-                    if cached:
-                        db(query).update(modified_on=request.utcnow)
-                    else:
-                        cachetable.insert(name=name, file=filename)
+            @param record_id: the gis_layer_kml record ID
+            @param name: the layer name
+            @param refresh: the refresh interval (seconds)
+        """
+
+        db = current.db
+        request = current.request
+        cachetable = current.s3db.gis_cache2
+        filename = LayerKML.cache_filename(name)
+
+        # Should we download a fresh copy of the source file?
+        download = True
+        query = (cachetable.name == name)
+        cached = db(query).select(cachetable.modified_on,
+                                  limitby=(0, 1)).first()
+        refresh = refresh or 900 # 15 minutes set if we have no data (legacy DB)
+        if cached:
+            modified_on = cached.modified_on
+            cutoff = modified_on + datetime.timedelta(seconds=refresh)
+            if request.utcnow < cutoff:
+                download = False
+
+        if download:
+            # Download file (async, if workers alive)
+            response = current.response
+            session_id_name = response.session_id_name
+            session_id = response.session_id
+            current.s3task.async("gis_download_kml",
+                                 args=[record_id, filename, session_id_name, session_id])
+            if cached:
+                db(query).update(modified_on=request.utcnow)
+            else:
+                cachetable.insert(name=name, file=filename)
+
+    # -------------------------------------------------------------------------
+    class SubLayer(Layer.SubLayer):
+        def feed(self):
+            """ Parameters for LayerKML.refresh_feed """
+
+            if not LayerKML.cacheable:
+                return None
+            return {"record_id": self.id,
+                    "name": self.name,
+                    "refresh": self.refresh,
+                    }
+
+        def as_dict(self):
 
+            feed = self.feed()
+            if feed:
+                LayerKML.refresh_feed(**feed)
                 url = URL(c="default", f="download",
-                          args=[filename])
+                          args=[LayerKML.cache_filename(self.name)])
             else:
                 # No caching possible (e.g. GAE), display file direct from remote (using Proxy)
                 # (Requires OpenLayers.Layer.KML to be available)
@@ -8945,6 +10363,8 @@ class S3Map(S3Method):
             representation = r.representation
             if representation == "html":
                 return self.page(r, **attr)
+            elif representation in ("geojson", "mvt"):
+                return self.tile(r, **attr)
 
         else:
             r.error(405, current.ERROR.BAD_METHOD)
@@ -9112,6 +10532,1192 @@ class S3Map(S3Method):
                            )
         return map
 
+    # -------------------------------------------------------------------------
+    def tile(self, r, **attr):
+        """
+            Map tile of a Feature Layer, containing only the features
+            within the tile bounds, e.g.:
+                /org/facility/map.geojson?layer=1&z=5&x=16&y=10
+
+            - geometries are simplified to the tile resolution
+            - points are clustered server-side up to
+              settings.gis.tile_cluster_zoom
+            - encoded as compact GeoJSON, or as Mapbox Vector Tile
+              (.mvt, requires mapbox_vector_tile and Shapely)
+
+            @param r: the S3Request instance
+            @param attr: controller attributes for the request
+        """
+
+        get_vars = r.get_vars
+        try:
+            z, x, y = [int(get_vars[k]) for k in ("z", "x", "y")]
+        except (KeyError, TypeError, ValueError):
+            r.error(400, current.ERROR.BAD_REQUEST)
+        n = 2 ** z
+        if not 0 <= z <= TILE_MAX_ZOOM or \
+           not 0 <= x < n or \
+           not 0 <= y < n:
+            r.error(400, current.ERROR.BAD_REQUEST)
+
+        representation = r.representation
+        if representation == "mvt":
+            # Check that the encoder is available (imported in encode_mvt)
+            import imp
+            try:
+                imp.find_module("mapbox_vector_tile")
+            except ImportError:
+                r.error(501, current.ERROR.BAD_FORMAT)
+
+        response = current.response
+        s3 = response.s3
+
+        # Set response headers
+        response.headers["Content-Type"] = s3.content_type.get(representation,
+                                                               "application/json")
+
+        resource = self.resource
+
+        # Filter
+        s3_filter = s3.filter
+        if s3_filter is not None:
+            resource.add_filter(s3_filter)
+
+        # Feature Layer
+        layer = None
+        layer_id = get_vars.get("layer")
+        if layer_id:
+            ftable = current.s3db.gis_layer_feature
+            layer = current.db(ftable.layer_id == layer_id).select(ftable.attr_fields,
+                                                                   ftable.points,
+                                                                   limitby=(0, 1)
+                                                                   ).first()
+
+        # Cache key covers the layer, the tile, the filter and the
+        # version stamps of the resource and location tables
+        selectors = [self.location_selector(resource)]
+        if layer and layer.attr_fields:
+            selectors.extend(layer.attr_fields)
+        cache = S3MapTileCache(resource, "tile", selectors,
+                               layer_id, z, x, y,
+                               representation,
+                               get_vars.get("attr"),
+                               get_vars.get("popup"),
+                               get_vars.get("markers"),
+                               )
+
+        def generate():
+            bounds = current.gis.get_tile_bounds(z, x, y)
+            points = layer.points if layer else False
+            features = self.tile_features(resource, bounds, z, points=points)
+            if representation == "mvt":
+                return self.encode_mvt(resource.tablename, features, bounds)
+            else:
+                return json.dumps({"type": "FeatureCollection",
+                                   "features": features,
+                                   }, separators=SEPARATORS)
+
+        return cache(generate)
+
+    # -------------------------------------------------------------------------
+    def tile_features(self, resource, bounds, z, points=False):
+        """
+            Extract the features of a resource within the bounds of a tile
+
+            @param resource: the S3Resource
+            @param bounds: the tile bounds (lon_min, lat_min, lon_max, lat_max)
+            @param z: the zoom level
+            @param points: show all features as points (layer.points)
+
+            @return: list of GeoJSON features (dicts)
+        """
+
+        db = current.db
+        s3db = current.s3db
+        gis = current.gis
+
+        tablename = resource.tablename
+        table = resource.table
+        gtable = s3db.gis_location
+
+        bbox = gis.query_features_by_bbox(*bounds)
+
+        # Restrict the resource to records with locations in the tile,
+        # so that only these IDs get loaded
+        bbox_filter = self.bbox_filter(resource, bbox)
+        if bbox_filter is None:
+            # Can't display this resource on the Map
+            return []
+        resource.add_filter(bbox_filter)
+
+        ids = resource.get_id()
+        if not ids:
+            return []
+        elif type(ids) is not list:
+            ids = [ids]
+
+        location_query = gis.get_location_query(resource, ids)
+        if location_query is None:
+            # Can't display this resource on the Map
+            return []
+        query, join = location_query
+        query &= bbox
+
+        features = []
+
+        if z <= current.deployment_settings.get_gis_tile_cluster_zoom():
+            # Cluster points server-side
+            if not points:
+                query &= (gtable.gis_feature_type == 1)
+            rows = db(query).select(table.id,
+                                    gtable.lat,
+                                    gtable.lon,
+                                    )
+            if join:
+                items = [(row[tablename].id,
+                          row["gis_location"].lat,
+                          row["gis_location"].lon,
+                          ) for row in rows]
+            else:
+                items = [(row.id, row.lat, row.lon) for row in rows]
+
+            clusters, singles = self.cluster(items, bounds)
+            clustered = set(item[0] for item in items).difference(singles)
+            if clustered:
+                ids = [record_id for record_id in ids
+                       if record_id not in clustered]
+
+            for lat, lon, count in clusters:
+                features.append({"type": "Feature",
+                                 "geometry": {"type": "Point",
+                                              "coordinates": [lon, lat],
+                                              },
+                                 "properties": {"count": count},
+                                 })
+            if not ids:
+                return features
+
+        # Individual features
+        resource = s3db.resource(tablename, id=ids)
+        resource.get_id()
+        # Simplify polygons to the tile resolution (degrees/pixel)
+        tolerance = 360.0 / (TILE_SIZE * 2 ** z)
+        data = gis.get_location_data(resource,
+                                     tolerance = tolerance,
+                                     geojson = True,
+                                     )
+        if not data:
+            return features
+
+        geojsons = data["geojsons"].get(tablename, {})
+        latlons = data["latlons"].get(tablename, {})
+        attributes = data["attributes"].get(tablename, {})
+        markers = data["markers"].get(tablename)
+        styles = data["styles"].get(tablename, {})
+        if markers and markers.get("image"):
+            # Single Marker for all features
+            marker = markers
+            markers = None
+        else:
+            marker = None
+        marker_url = "/%s/static/img/markers" % current.request.application
+
+        for record_id in ids:
+            if record_id in geojsons:
+                geometry = json.loads(geojsons[record_id])
+            elif record_id in latlons:
+                lat, lon = latlons[record_id]
+                if lat is None or lon is None:
+                    continue
+                geometry = {"type": "Point",
+                            "coordinates": [lon, lat],
+                            }
+            else:
+                continue
+
+            properties = {"id": record_id}
+            attr = attributes.get(record_id)
+            if attr:
+                properties.update(attr)
+            m = marker or markers and markers.get(record_id)
+            if m:
+                properties["marker_url"] = "%s/%s" % (marker_url, m["image"])
+                properties["marker_height"] = m["height"]
+                properties["marker_width"] = m["width"]
+            style = styles.get(record_id)
+            if style:
+                properties["style"] = json.loads(style)
+
+            features.append({"type": "Feature",
+                             "geometry": geometry,
+                             "properties": properties,
+                             })
+
+        return features
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def location_selector(resource):
+        """
+            Selector for the location (gis_location.id) of a resource, as
+            used by GIS.get_location_query()
+
+            @param resource: the S3Resource
+
+            @return: the field selector, or None if the resource has
+                     no locations
+        """
+
+        table = resource.table
+        if resource.tablename == "gis_location":
+            return "id"
+        elif "location_id" in table.fields:
+            return "location_id$id"
+        elif "site_id" in table.fields:
+            return "site_id$location_id$id"
+        else:
+            context = resource.get_config("context")
+            if context and context.get("location"):
+                return "%s$id" % context["location"]
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def bbox_filter(resource, bbox):
+        """
+            Filter query to restrict a resource to records with locations
+            within a bounding box (sub-select on gis_location, so no
+            joins are needed)
+
+            @param resource: the S3Resource
+            @param bbox: the bbox query (from GIS.query_features_by_bbox)
+
+            @return: the filter query, or None if the resource has no
+                     locations
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = resource.table
+        gtable = s3db.gis_location
+
+        if resource.tablename == "gis_location":
+            return bbox
+        elif "location_id" in table.fields:
+            return table.location_id.belongs(db(bbox)._select(gtable.id))
+        elif "site_id" in table.fields:
+            stable = s3db.org_site
+            query = bbox & (stable.location_id == gtable.id)
+            return table.site_id.belongs(db(query)._select(stable.site_id))
+        else:
+            # Context-based location: sub-select via the location query
+            location_query = current.gis.get_location_query(resource)
+            if location_query is None:
+                return None
+            query = location_query[0] & bbox
+            return table.id.belongs(db(query)._select(table.id))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cluster(items, bounds,
+                distance=CLUSTER_DISTANCE,
+                threshold=CLUSTER_THRESHOLD):
+        """
+            Group points which are close to each other on a tile into
+            clusters (grid-based)
+
+            @param items: list of tuples (record_id, lat, lon)
+            @param bounds: the tile bounds (lon_min, lat_min, lon_max, lat_max)
+            @param distance: the grid size in pixels
+            @param threshold: the minimum number of points to form a cluster
+
+            @return: tuple (clusters, singles), where clusters is a list of
+                     tuples (lat, lon, count), and singles a list of the
+                     record IDs of the points not in any cluster
+        """
+
+        import math
+
+        log = math.log
+        tan = math.tan
+        radians = math.radians
+        PI4 = math.pi / 4
+        mercator = lambda lat: log(tan(PI4 + radians(max(min(lat, 85.0511),
+                                                         -85.0511)) / 2))
+
+        lon_min, lat_min, lon_max, lat_max = bounds
+        y_max = mercator(lat_max)
+        scale_x = float(TILE_SIZE) / distance / (lon_max - lon_min)
+        scale_y = float(TILE_SIZE) / distance / (y_max - mercator(lat_min))
+
+        cells = {}
+        for item in items:
+            record_id, lat, lon = item
+            if lat is None or lon is None:
+                continue
+            cell = (int((lon - lon_min) * scale_x),
+                    int((y_max - mercator(lat)) * scale_y),
+                    )
+            if cell in cells:
+                cells[cell].append(item)
+            else:
+                cells[cell] = [item]
+
+        clusters = []
+        singles = []
+        for cell in cells.values():
+            count = len(cell)
+            if count >= threshold:
+                clusters.append((sum(item[1] for item in cell) / count,
+                                 sum(item[2] for item in cell) / count,
+                                 count,
+                                 ))
+            else:
+                singles.extend(item[0] for item in cell)
+
+        return clusters, singles
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode_mvt(name, features, bounds):
+        """
+            Encode features as Mapbox Vector Tile
+
+            @param name: the layer name
+            @param features: list of GeoJSON features (dicts)
+            @param bounds: the tile bounds (lon_min, lat_min, lon_max, lat_max)
+
+            @return: the tile (binary string)
+        """
+
+        import math
+        import mapbox_vector_tile
+        from shapely.geometry import shape
+        from shapely.ops import transform
+
+        # Spherical Mercator (EPSG:900913)
+        R = 6378137.0
+        log = math.log
+        tan = math.tan
+        radians = math.radians
+        PI4 = math.pi / 4
+        def mercator(lon, lat, z=None):
+            lat = max(min(lat, 85.0511), -85.0511)
+            return (R * radians(lon), R * log(tan(PI4 + radians(lat) / 2)))
+
+        items = []
+        append = items.append
+        for feature in features:
+            properties = {}
+            for k, v in feature["properties"].items():
+                if isinstance(v, dict):
+                    v = json.dumps(v, separators=SEPARATORS)
+                properties[k] = v
+            item = {"geometry": transform(mercator, shape(feature["geometry"])),
+                    "properties": properties,
+                    }
+            record_id = properties.get("id")
+            if record_id:
+                item["id"] = record_id
+            append(item)
+
+        lon_min, lat_min, lon_max, lat_max = bounds
+        x_min, y_min = mercator(lon_min, lat_min)
+        x_max, y_max = mercator(lon_max, lat_max)
+
+        return mapbox_vector_tile.encode([{"name": name, "features": items}],
+                                         quantize_bounds = (x_min, y_min, x_max, y_max),
+                                         extents = TILE_EXTENT,
+                                         )
+
+# =============================================================================
+class S3MapTileCache(S3ReportCache):
+    """
+        Cross-request cache for map tiles (see S3Map.tile), keyed by
+        layer, tile coordinates, resource filter, access rules and
+        the version stamps of the resource and location tables
+    """
+
+    # Process-wide LRU store, {key: (expires, data)}
+    store = OrderedDict()
+    lock = threading.Lock()
+
+    # Cache statistics
+    hits = 0
+    misses = 0
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def config():
+        """
+            Get the cache configuration from deployment settings
+
+            @return: tuple (enabled, backend, size, expire)
+        """
+
+        settings = current.deployment_settings
+        return (settings.get_gis_tile_cache(),
+                settings.get_gis_tile_cache_backend(),
+                settings.get_gis_tile_cache_size(),
+                settings.get_gis_tile_cache_expire(),
+                )
+
+# =============================================================================
+class S3MapConfigCache(S3ReportCache):
+    """
+        Cross-request cache for compiled map configurations (see
+        MAP._compile_layers), keyed by config, user roles, language and
+        the version stamps of the config, layer, marker and style tables,
+        so that rendering a map becomes a cache lookup plus a template
+        render
+
+        NB the KML/GeoRSS feed caches are refreshed outside of the cached
+           part (see MAP._refresh_feeds), so they don't go stale
+    """
+
+    # Process-wide LRU store, {key: (expires, data)}
+    store = OrderedDict()
+    lock = threading.Lock()
+
+    # Cache statistics
+    hits = 0
+    misses = 0
+
+    # Tables the compiled map configurations are built from
+    tables = ("gis_config",
+              "gis_layer_config",
+              "gis_layer_entity",
+              "gis_marker",
+              "gis_style",
+              "gis_layer_arcrest",
+              "gis_layer_bing",
+              "gis_layer_coordinate",
+              "gis_layer_empty",
+              "gis_layer_feature",
+              "gis_layer_geojson",
+              "gis_layer_georss",
+              "gis_layer_google",
+              "gis_layer_gpx",
+              "gis_layer_js",
+              "gis_layer_kml",
+              "gis_layer_openstreetmap",
+              "gis_layer_openweathermap",
+              "gis_layer_shapefile",
+              "gis_layer_theme",
+              "gis_layer_tms",
+              "gis_layer_wfs",
+              "gis_layer_wms",
+              "gis_layer_xyz",
+              )
+
+    # -------------------------------------------------------------------------
+    def __init__(self, config, name, *options):
+        """
+            Constructor
+
+            @param config: the map configuration (GIS.get_config)
+            @param name: the name of the compiled item (e.g. "layers")
+            @param options: other options which affect the result
+        """
+
+        self.config_ids = config.ids or [config.id]
+
+        if self.config()[0]:
+            self.key = self.get_key(name, None, options)
+        else:
+            self.key = None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def config():
+        """
+            Get the cache configuration from deployment settings
+
+            @return: tuple (enabled, backend, size, expire)
+        """
+
+        settings = current.deployment_settings
+        return (settings.get_gis_config_cache(),
+                settings.get_gis_config_cache_backend(),
+                settings.get_gis_config_cache_size(),
+                settings.get_gis_config_cache_expire(),
+                )
+
+    # -------------------------------------------------------------------------
+    def get_key(self, name, selectors, options):
+        """
+            Generate the cache key
+
+            @param name: the name of the compiled item
+            @param selectors: not used (no resource involved)
+            @param options: other options which affect the result
+
+            @return: the cache key (string)
+        """
+
+        roles = current.session.s3.roles or []
+        items = [name,
+                 list(self.config_ids),
+                 [str(option) for option in options],
+                 sorted(roles),
+                 current.T.accepted_language,
+                 ]
+
+        # Version stamps of all involved tables (catches layers being
+        # added, edited or removed)
+        tables = list(self.tables)
+        if current.deployment_settings.get_gis_layer_metadata():
+            tables.append("cms_post_layer")
+
+        s3db = current.s3db
+        tablenames = []
+        for tablename in tables:
+            table = s3db.table(tablename)
+            if table is None:
+                continue
+            S3TableVersion.attach(table)
+            tablenames.append(tablename)
+        items.extend(S3TableVersion.lookup(tablenames))
+
+        key = hashlib.md5(json.dumps(items, default=str)).hexdigest()
+        return "%s_%s" % (name, key)
+
+# =============================================================================
+class S3GeoJSONFeed(object):
+    """
+        Static, pre-generated GeoJSON[P] feeds of resources, e.g. to serve
+        high-volume public websites (generalizing org_facility_geojson)
+
+        Feeds are declared in settings.gis.feeds, e.g.:
+
+        settings.gis.feeds = {
+            "facility": {"resource": "org_facility",
+                         "filter": (FS("obsolete") != True),
+                         "fields": ["name",
+                                    ("type", "site_facility_type.facility_type_id"),
+                                    ("addr", "location_id$addr_street"),
+                                    ],
+                         "jsonp": "grid",
+                         "decimals": 4,
+                         },
+            }
+
+        - fields are selectors, or tuples (name, selector) to set the
+          property name, or (name, selector, represent) with a function
+          to encode the raw value (instead of the field representation)
+        - aliases are file names in static/cache to write copies of the
+          feed to, e.g. to keep serving it at a deprecated location
+
+        The gis_publish_feeds task regenerates a feed only if the number
+        or the latest modification date of the records (or of their
+        locations) have changed, and writes it atomically to
+        static/cache/feeds/<name>.json (or .js for GeoJSONP) together
+        with a gzip-compressed copy (.gz), so that it gets served as
+        static file (i.e. without running any models), e.g.:
+
+            /eden/static/cache/feeds/facility.js
+
+        - web2py answers conditional requests with 304, and serves the
+          gzip-compressed copy to clients which accept it
+    """
+
+    def __init__(self, name, config=None):
+        """
+            Constructor
+
+            @param name: the feed name
+            @param config: the feed configuration, default from
+                           settings.gis.feeds
+        """
+
+        if config is None:
+            config = current.deployment_settings.get_gis_feeds().get(name)
+            if config is None:
+                raise KeyError("Undefined feed: %s" % name)
+        self.name = name
+        self.config = config
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def files(name, jsonp=False):
+        """
+            Get the file paths for a feed
+
+            @param name: the feed name
+            @param jsonp: the feed is GeoJSONP
+
+            @return: tuple (data, gzip, meta)
+        """
+
+        folder = os.path.join(current.request.folder,
+                              "static", "cache", "feeds")
+        path = os.path.join(folder, "%s.%s" % (name, "js" if jsonp else "json"))
+        return path, "%s.gz" % path, os.path.join(folder, "%s.meta" % name)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def meta(cls, name):
+        """
+            Read the metadata of the last published version of a feed
+
+            @param name: the feed name
+
+            @return: dict {"stamp", "etag", "modified"}, or None if
+                     the feed has not been published yet
+        """
+
+        path = cls.files(name)[2]
+        try:
+            with open(path, "rb") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    # -------------------------------------------------------------------------
+    def resource(self):
+        """ Get the (filtered) resource for this feed """
+
+        config = self.config
+        return current.s3db.resource(config["resource"],
+                                     filter = config.get("filter"),
+                                     )
+
+    # -------------------------------------------------------------------------
+    def stamp(self):
+        """
+            Get the status of the feed data: number of records and the
+            latest modification dates of records and locations
+
+            @return: the stamp (string)
+        """
+
+        resource = self.resource()
+        location = self.config.get("location", "location_id")
+
+        stamp = [resource.count()]
+        for selector in ("modified_on", "%s$modified_on" % location):
+            rfield = S3ResourceField(resource, selector)
+            rows = resource.select([selector],
+                                   limit = 1,
+                                   orderby = ~rfield.field,
+                                   virtual = False,
+                                   as_rows = True,
+                                   )
+            stamp.append(str(rows.first()[rfield.colname]) if rows else None)
+
+        return hashlib.md5(json.dumps(stamp)).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def generate(self):
+        """
+            Generate the feed
+
+            @return: the GeoJSON[P] (string)
+        """
+
+        config = self.config
+        resource = self.resource()
+        location = config.get("location", "location_id")
+
+        # Properties, as [(name, selector, represent)]
+        properties = []
+        for item in config.get("fields", ()):
+            if isinstance(item, (tuple, list)):
+                if len(item) == 2:
+                    item = tuple(item) + (None,)
+                properties.append(tuple(item))
+            else:
+                name = item.rsplit("$", 1)[-1].rsplit(".", 1)[-1]
+                properties.append((name, item, None))
+
+        lat = "%s$lat" % location
+        lon = "%s$lon" % location
+        selectors = ["id", lat, lon]
+        for _, selector, _ in properties:
+            if selector not in selectors:
+                selectors.append(selector)
+        colnames = dict((selector, S3ResourceField(resource, selector).colname)
+                        for selector in selectors)
+
+        data = resource.select(selectors,
+                               limit = None,
+                               represent = True,
+                               raw_data = True,
+                               show_links = False,
+                               )
+
+        # Limit the number of decimal places
+        formatter = ".%sf" % config.get("decimals", 4)
+
+        id_colname = colnames["id"]
+        lat_colname = colnames[lat]
+        lon_colname = colnames[lon]
+        features = []
+        append = features.append
+        for row in data.rows:
+            raw = row["_row"]
+            x = raw[lon_colname]
+            y = raw[lat_colname]
+            if x is None or y is None:
+                continue
+            attributes = {"id": raw[id_colname]}
+            for name, selector, represent in properties:
+                colname = colnames[selector]
+                value = raw[colname]
+                if represent is not None and value not in (None, "", []):
+                    # Custom encoding of the raw value
+                    value = represent(value)
+                    if value not in (None, "", []):
+                        attributes[name] = value
+                elif value not in (None, "", []):
+                    attributes[name] = s3_unicode(row[colname])
+                # Empty values are skipped to keep the feed small
+            append({"type": "Feature",
+                    "properties": attributes,
+                    "geometry": {"type": "Point",
+                                 "coordinates": [float(format(x, formatter)),
+                                                 float(format(y, formatter)),
+                                                 ],
+                                 },
+                    })
+
+        output = json.dumps({"type": "FeatureCollection",
+                             "features": features,
+                             }, separators=SEPARATORS)
+        callback = config.get("jsonp")
+        if callback:
+            output = "%s(%s)" % (callback, output)
+        return output
+
+    # -------------------------------------------------------------------------
+    def publish(self, force=False):
+        """
+            Regenerate and write the feed if its data have changed
+
+            @param force: regenerate even if the data are unchanged
+
+            @return: True if the feed has been regenerated, else False
+        """
+
+        name = self.name
+        path, gzip_path, meta_path = self.files(name,
+                                                jsonp=bool(self.config.get("jsonp")))
+
+        stamp = self.stamp()
+        meta = self.meta(name)
+        if not force and meta and meta.get("stamp") == stamp and \
+           os.path.exists(path):
+            return False
+
+        output = self.generate()
+
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        import gzip
+        stream = StringIO()
+        gz = gzip.GzipFile(fileobj=stream, mode="wb")
+        gz.write(output)
+        gz.close()
+
+        # Compressed copy after the data, so that it is never older
+        # (web2py would not serve it then)
+        write = self.write
+        write(path, output)
+        write(gzip_path, stream.getvalue())
+
+        aliases = self.config.get("aliases")
+        if aliases:
+            cache = os.path.join(current.request.folder, "static", "cache")
+            for alias in aliases:
+                write(os.path.join(cache, alias), output)
+
+        meta = {"stamp": stamp,
+                "etag": hashlib.md5(output).hexdigest(),
+                "modified": current.request.utcnow.isoformat(),
+                }
+        write(meta_path, json.dumps(meta, separators=SEPARATORS))
+        return True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def publish_all(cls, force=False):
+        """
+            Regenerate all feeds declared in settings.gis.feeds which
+            have changed (called by the gis_publish_feeds task)
+
+            @param force: regenerate even if the data are unchanged
+
+            @return: list of the names of the regenerated feeds
+        """
+
+        published = []
+        for name, config in current.deployment_settings.get_gis_feeds().items():
+            if cls(name, config).publish(force=force):
+                published.append(name)
+        return published
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def write(path, data):
+        """
+            Write a file atomically (write to a temporary file, then
+            rename), so that readers never see a partial file
+
+            @param path: the file path
+            @param data: the file contents
+        """
+
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Windows can't rename onto an existing file
+            os.remove(path)
+            os.rename(tmp, path)
+
+# =============================================================================
+class S3Choropleth(object):
+    """
+        Spatial aggregation of a resource by admin areas, e.g. for
+        choropleth maps (see S3Resource.choropleth)
+
+        - aggregates the records per location in the database (one
+          GROUPBY query), then maps the locations to the areas of the
+          target level using their materialized paths, falling back to
+          ST_Contains (spatial DB) or S3SpatialIndex for locations which
+          are not part of the hierarchy
+        - joins in the (precomputed simplified) area geometries
+        - caches the result per resource filter (S3ReportCache)
+    """
+
+    # Supported aggregation methods
+    METHODS = ("count", "sum", "min", "max", "avg")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, resource, fact="count(id)", level="L0", tolerance=None):
+        """
+            Constructor
+
+            @param resource: the S3Resource
+            @param fact: the fact to aggregate, as "method(selector)",
+                         e.g. "count(id)" or "sum(value)"
+            @param level: the target admin level ("L0".."L5")
+            @param tolerance: the simplification tolerance for the area
+                              geometries (default: settings.gis.simplify_tolerance)
+        """
+
+        match = re.match(r"([a-zA-Z]+)\((.*)\)\Z", fact)
+        if not match or match.group(1) not in self.METHODS:
+            raise SyntaxError("Invalid fact: %s" % fact)
+
+        self.resource = resource
+        self.method = match.group(1)
+        self.selector = resource.prefix_selector(match.group(2))
+        self.level = level
+        self.tolerance = tolerance
+
+        # The location dimension
+        context = resource.get_config("context")
+        if context and "location" in context:
+            self.location = "(location)"
+        else:
+            # Fallback to location_id
+            self.location = "location_id"
+
+    # -------------------------------------------------------------------------
+    def as_dict(self, map_data=None):
+        """
+            Get the choropleth as GeoJSON FeatureCollection
+
+            @param map_data: options for the client, e.g. level and style
+                             (added as "s3" to the FeatureCollection)
+
+            @return: a JSON-serializable dict
+        """
+
+        resource = self.resource
+        selectors = [self.location, "%s$path" % self.location, self.selector]
+        cache = S3ReportCache(resource,
+                              "choropleth",
+                              selectors,
+                              self.method,
+                              self.selector,
+                              self.level,
+                              self.tolerance,
+                              )
+        output = dict(cache(self.features))
+        if map_data:
+            output["s3"] = map_data
+        return output
+
+    # -------------------------------------------------------------------------
+    def json(self, map_data=None):
+        """
+            Get the choropleth as GeoJSON
+
+            @param map_data: options for the client, e.g. level and style
+        """
+
+        return json.dumps(self.as_dict(map_data=map_data),
+                          separators=SEPARATORS)
+
+    # -------------------------------------------------------------------------
+    def features(self):
+        """
+            Compute the choropleth features
+
+            @return: dict {"type": "FeatureCollection", "features": [...]}
+        """
+
+        values = self.aggregate()
+
+        features = []
+        if values:
+            db = current.db
+            gtable = current.s3db.gis_location
+
+            area_ids = values.keys()
+            query = (gtable.id.belongs(area_ids))
+            names = dict((row.id, row.name)
+                         for row in db(query).select(gtable.id, gtable.name))
+            geojsons = current.gis.get_locations(gtable,
+                                                 query,
+                                                 join = False,
+                                                 geojson = True,
+                                                 tolerance = self.tolerance,
+                                                 )
+            for area_id in sorted(area_ids):
+                geojson = geojsons.get(area_id)
+                if not geojson:
+                    continue
+                properties = {"id": area_id,
+                              "name": s3_unicode(names.get(area_id)),
+                              "value": values[area_id],
+                              }
+                features.append({"type": "Feature",
+                                 "geometry": json.loads(geojson),
+                                 "properties": properties,
+                                 })
+
+        return {"type": "FeatureCollection",
+                "features": features,
+                }
+
+    # -------------------------------------------------------------------------
+    def aggregate(self):
+        """
+            Aggregate the fact per area
+
+            @return: dict {area_id: value}
+        """
+
+        # Aggregate per location
+        items = self.aggregate_locations()
+        if not items:
+            return {}
+
+        # Map locations to areas
+        areas = self.areas(items.keys())
+
+        # Aggregate per area
+        method = self.method
+        totals = {}
+        for location_id, (value, count) in items.iteritems():
+            area_id = areas.get(location_id)
+            if area_id is None or value is None:
+                continue
+            if area_id not in totals:
+                totals[area_id] = [value, count]
+                continue
+            total = totals[area_id]
+            if method == "min":
+                total[0] = min(total[0], value)
+            elif method == "max":
+                total[0] = max(total[0], value)
+            else:
+                # count, sum, avg
+                total[0] += value
+            total[1] += count
+
+        if method == "avg":
+            return dict((area_id, float(total) / count if count else None)
+                        for area_id, (total, count) in totals.iteritems())
+        else:
+            return dict((area_id, total[0])
+                        for area_id, total in totals.iteritems())
+
+    # -------------------------------------------------------------------------
+    def aggregate_locations(self):
+        """
+            Aggregate the fact per location
+
+            @return: dict {location_id: (value, count)}, where value is
+                     the sum for avg (to combine locations correctly)
+        """
+
+        resource = self.resource
+        method = self.method
+
+        rlocation = S3ResourceField(resource, self.location)
+        rfact = S3ResourceField(resource, self.selector)
+
+        if rlocation.field is not None and \
+           rfact.field is not None and \
+           resource.get_filter() is None:
+            # Aggregate in the database
+            field = rfact.field
+            if method == "avg":
+                # Records without a value don't count for the average
+                count = field.count()
+            else:
+                count = resource._id.count(distinct=True)
+            if method == "count":
+                if rfact.colname == str(resource._id):
+                    aggregate = count
+                else:
+                    aggregate = field.count(distinct=True)
+            elif method in ("sum", "avg"):
+                aggregate = field.sum()
+            elif method == "min":
+                aggregate = field.min()
+            else:
+                aggregate = field.max()
+
+            aggregates = [aggregate] if aggregate is count else [aggregate, count]
+            data = resource.select([self.location],
+                                   limit = None,
+                                   groupby = [rlocation.field],
+                                   aggregate = aggregates,
+                                   virtual = False,
+                                   )
+            colname = rlocation.colname
+            return dict((row[colname], (row[aggregate], row[count]))
+                        for row in data.rows if row[colname] and row[count])
+
+        # Virtual fields or filters: aggregate in Python
+        data = resource.select([self.location, self.selector],
+                               limit = None,
+                               represent = False,
+                               )
+        lcolname = rlocation.colname
+        fcolname = rfact.colname
+        as_list = lambda v: v if type(v) is list else [v]
+
+        output = {}
+        for row in data.rows:
+            values = [v for v in as_list(row[fcolname]) if v is not None]
+            if not values:
+                continue
+            if method == "count":
+                value = 1 if fcolname == str(resource._id) else len(values)
+            elif method in ("sum", "avg"):
+                value = sum(values)
+            elif method == "min":
+                value = min(values)
+            else:
+                value = max(values)
+            for location_id in as_list(row[lcolname]):
+                if not location_id:
+                    continue
+                if location_id not in output:
+                    output[location_id] = (value, 1)
+                    continue
+                total, count = output[location_id]
+                if method == "min":
+                    total = min(total, value)
+                elif method == "max":
+                    total = max(total, value)
+                else:
+                    total += value
+                output[location_id] = (total, count + 1)
+        return output
+
+    # -------------------------------------------------------------------------
+    def areas(self, location_ids):
+        """
+            Map locations to the areas of the target level
+
+            @param location_ids: the gis_location record IDs
+
+            @return: dict {location_id: area_id}
+        """
+
+        level = self.level
+        db = current.db
+        gtable = current.s3db.gis_location
+        not_deleted = (gtable.deleted != True)
+        chunks = GIS._chunks
+
+        # Use the materialized paths
+        output = {}
+        ancestors = {}
+        candidates = set()
+        for chunk in chunks(list(location_ids), 500):
+            query = (gtable.id.belongs(chunk))
+            rows = db(query).select(gtable.id,
+                                    gtable.level,
+                                    gtable.path,
+                                    )
+            for row in rows:
+                if row.level == level:
+                    output[row.id] = row.id
+                elif row.path:
+                    path = [int(i) for i in row.path.split("/")[:-1] if i]
+                    ancestors[row.id] = path
+                    candidates.update(path)
+
+        targets = set()
+        for chunk in chunks(list(candidates), 500):
+            query = (gtable.id.belongs(chunk)) & \
+                    (gtable.level == level) & \
+                    not_deleted
+            targets.update(row.id for row in db(query).select(gtable.id))
+        for location_id, path in ancestors.iteritems():
+            for ancestor in path:
+                if ancestor in targets:
+                    output[location_id] = ancestor
+                    break
+
+        # Spatial lookup for locations outside of the hierarchy
+        missing = [location_id for location_id in location_ids
+                   if location_id not in output]
+        if missing:
+            settings = current.deployment_settings
+            if settings.get_gis_spatialdb():
+                atable = gtable.with_alias("gis_area")
+                for chunk in chunks(missing, 500):
+                    query = (gtable.id.belongs(chunk)) & \
+                            (atable.level == level) & \
+                            (atable.deleted != True) & \
+                            (atable.the_geom.st_contains(gtable.the_geom))
+                    rows = db(query).select(gtable.id, atable.id)
+                    for row in rows:
+                        output.setdefault(row[gtable.id], row[atable.id])
+            elif settings.get_gis_spatial_index():
+                from shapely.geometry import Point
+                intersects = S3SpatialIndex.intersects
+                for chunk in chunks(missing, 500):
+                    query = (gtable.id.belongs(chunk)) & \
+                            (gtable.lat != None) & \
+                            (gtable.lon != None)
+                    rows = db(query).select(gtable.id,
+                                            gtable.lat,
+                                            gtable.lon,
+                                            )
+                    for row in rows:
+                        found = intersects(Point(row.lon, row.lat),
+                                           levels = [level],
+                                           )
+                        if found:
+                            output[row.id] = found[0][0]
+
+        return output
+
 # =============================================================================
 class S3ExportPOI(S3Method):
     """ Export point-of-interest resources for a location """
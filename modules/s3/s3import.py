@@ -31,11 +31,13 @@
 __all__ = ("S3Importer",
            "S3ImportJob",
            "S3ImportItem",
+           "S3ImportIndex",
            "S3BulkImporter",
            )
 
 import cPickle
 import os
+import re
 import sys
 import urllib2          # Needed for error handling on fetch
 import uuid
@@ -65,9 +67,10 @@ from gluon.storage import Storage, Messages
 from gluon.tools import callback, fetch
 
 from s3datetime import s3_utc
+from s3fields import s3_all_meta_field_names
 from s3rest import S3Method
 from s3resource import S3Resource
-from s3utils import s3_mark_required, s3_has_foreign_key, s3_get_foreign_key, s3_unicode
+from s3utils import S3TableVersion, s3_mark_required, s3_has_foreign_key, s3_get_foreign_key, s3_unicode
 from s3xml import S3XML
 
 DEBUG = False
@@ -410,10 +413,15 @@ class S3Importer(S3Method):
                 single_pass = r.vars["single_pass"]
             else:
                 single_pass = None
-            self._generate_import_job(upload_id,
-                                      upload_file,
-                                      extension,
-                                      commit_job = single_pass)
+            if single_pass:
+                # Import directly (in batches), without review
+                self._import_source(upload_id,
+                                    upload_file,
+                                    extension)
+            else:
+                self._generate_import_job(upload_id,
+                                          upload_file,
+                                          extension)
             if upload_id is None:
                 row = db(query).update(status = 2) # in error
                 if self.error != None:
@@ -547,12 +555,12 @@ class S3Importer(S3Method):
                                              status = 1)
         current.db.commit()
 
-        # Create the import job
-        result = self._generate_import_job(upload_id,
-                                           openFile,
-                                           fileFormat,
-                                           stylesheet=transform
-                                           )
+        # Import the source (in batches)
+        result = self._import_source(upload_id,
+                                     openFile,
+                                     fileFormat,
+                                     stylesheet=transform
+                                     )
         if result is None:
             if self.error != None:
                 if session.error is None:
@@ -565,11 +573,6 @@ class S3Importer(S3Method):
                 else:
                     session.warning += self.warning
         else:
-            items = self._get_all_items(upload_id, True)
-            # Commit the import job
-            self._commit_import_job(upload_id, items)
-            result = self._update_upload_job(upload_id)
-
             # Get the results and display
             messages = self.messages
             msg = "%s : %s %s %s" % (source,
@@ -593,13 +596,29 @@ class S3Importer(S3Method):
         """
 
         _debug("S3Importer.commit_items(%s, %s)" % (upload_id, items))
-        # Save the import items
-        self._commit_import_job(upload_id, items)
-        # Update the upload table
-        # change the status to completed
-        # record the summary details
-        # delete the upload file
-        result = self._update_upload_job(upload_id)
+        result = None
+        source = self._get_upload_source(upload_id, items)
+        if source is not None:
+            # Import the uploaded file again, in batches, rather
+            # than committing the import job as a whole
+            path, extension = source
+            with open(path, "rb") as upload_file:
+                result = self._import_source(upload_id,
+                                             upload_file,
+                                             extension)
+            if result is not None:
+                self.request.resource.import_xml(None,
+                                                 job_id = self.job_id,
+                                                 delete_job = True)
+                current.db.commit()
+        if result is None:
+            # Save the import items
+            self._commit_import_job(upload_id, items)
+            # Update the upload table
+            # change the status to completed
+            # record the summary details
+            # delete the upload file
+            result = self._update_upload_job(upload_id)
         if self.ajax:
             return result
         # redirect to the start page (removes all vars)
@@ -1016,7 +1035,12 @@ class S3Importer(S3Method):
             if errors:
                 current.response.s3.error_report = errors
             query = (self.upload_table.id == upload_id)
-            result = db(query).update(job_id=job_id)
+            extra_data = self.csv_extra_data
+            if extra_data:
+                # Needed to import the source again in batches
+                extra_data = json.dumps(extra_data)
+            result = db(query).update(job_id=job_id,
+                                      extra_data=extra_data or None)
             # @todo: add check that result == 1, if not we are in error
             # Now commit the changes
             db.commit()
@@ -1125,6 +1149,148 @@ class S3Importer(S3Method):
                                 ignore_errors = True)
             return resource.error is None
 
+    # -------------------------------------------------------------------------
+    def _import_source(self,
+                       upload_id,
+                       openFile,
+                       fileFormat,
+                       stylesheet=None):
+        """
+            Import a source file directly, without an import job for
+            review - in batches if settings.base.import_batch_size is
+            set, committing each batch (see S3Resource.import_batches)
+
+            @param upload_id: the upload ID
+            @param openFile: the source file
+            @param fileFormat: the source file format
+            @param stylesheet: the transformation stylesheet (default:
+                               the stylesheet for the controller)
+
+            @return: the totals as tuple (imported, errors, ignored),
+                     or None if the source can not be imported
+        """
+
+        _debug("S3Importer._import_source(%s, %s, %s, %s)" % (upload_id,
+                                                              openFile,
+                                                              fileFormat,
+                                                              stylesheet
+                                                              )
+              )
+
+        if fileFormat in ("csv", "comma-separated-values"):
+            fmt = "csv"
+        elif fileFormat in ("xls", "xlsx"):
+            fmt = "xls"
+        else:
+            msg = self.messages.unsupported_file_type % fileFormat
+            self.error = msg
+            _debug(msg)
+            return None
+
+        # Get the stylesheet
+        if stylesheet == None:
+            stylesheet = self._get_stylesheet()
+        if stylesheet == None:
+            return None
+
+        request = self.request
+        resource = request.resource
+
+        # Before calling import tree ensure the db.table is the controller_table
+        self.table = self.controller_table
+        self.tablename = self.controller_tablename
+
+        # Pass stylesheet arguments
+        args = Storage()
+        mode = request.get_vars.get("xsltmode", None)
+        if mode is not None:
+            args.update(mode=mode)
+
+        # Import the source
+        import_count = resource.import_count
+        resource.import_xml(openFile,
+                            format=fmt,
+                            extra_data=self.csv_extra_data,
+                            stylesheet=stylesheet,
+                            ignore_errors = True,
+                            **args)
+
+        # Error report (of all batches)
+        errors = current.xml.collect_errors(resource)
+        if errors:
+            current.response.s3.error_report = errors
+
+        # Totals
+        error_tree = resource.error_tree
+        if error_tree is None:
+            totalErrors = 0
+        else:
+            totalErrors = len(error_tree.findall(
+                            "resource[@name='%s']" % resource.tablename))
+        totalRecords = resource.import_count - import_count
+        totals = (totalRecords, totalErrors, 0)
+
+        # Update the upload table
+        db = current.db
+        query = (self.upload_table.id == upload_id)
+        db(query).update(summary_added=totalRecords,
+                         summary_error=totalErrors,
+                         summary_ignored=0,
+                         status=3)
+        db.commit()
+
+        return totals
+
+    # -------------------------------------------------------------------------
+    def _get_upload_source(self, upload_id, items):
+        """
+            Get the uploaded source file of an import job, to import it
+            again in batches rather than committing the import job as a
+            whole, if settings.base.import_batch_size is set and all
+            items are selected for import
+
+            @param upload_id: the upload ID
+            @param items: the IDs of the selected items
+
+            @return: tuple (path, extension) of the source file, or
+                     None to commit the import job
+        """
+
+        if not current.deployment_settings.get_base_import_batch_size():
+            return None
+
+        table = self.upload_table
+        row = current.db(table.id == upload_id).select(table.file,
+                                                       table.filename,
+                                                       table.extra_data,
+                                                       table.replace_option,
+                                                       limitby=(0, 1)
+                                                       ).first()
+        if not row or not row.file or not row.filename:
+            return None
+
+        extension = row.filename.rsplit(".", 1).pop()
+        if extension not in ("csv", "xls", "xlsx") or \
+           extension != "csv" and "xls_parser" in current.response.s3:
+            return None
+
+        # Ajax-uploads are not stored in the upload folder
+        path = os.path.join(table.file.uploadfolder, row.file)
+        if not os.path.isfile(path):
+            return None
+
+        # Only if all items are selected
+        if items is None or \
+           set(str(item) for item in items) != \
+           set(self._get_all_items(upload_id, as_string=True)):
+            return None
+
+        if row.extra_data:
+            self.csv_extra_data = Storage(json.loads(row.extra_data))
+        current.response.s3.import_replace = row.replace_option
+
+        return path, extension
+
     # -------------------------------------------------------------------------
     def _store_import_details(self, job_id, key):
         """
@@ -1782,6 +1948,9 @@ class S3ImportItem(object):
         # Items which need a second write to update references
         self.update = []
 
+        # Record data for a deferred (bulk) insert
+        self.bulk_data = None
+
     # -------------------------------------------------------------------------
     def __repr__(self):
         """ Helper method for debugging """
@@ -1826,8 +1995,7 @@ class S3ImportItem(object):
         self.tablename = table._tablename
 
         if original is None:
-            original = S3Resource.original(table, element,
-                                           mandatory=self._mandatory_fields())
+            original = self._original(element)
         postprocess = s3db.get_config(self.tablename, "xml_post_parse")
         data = xml.record(table, element,
                           files=files,
@@ -1891,8 +2059,7 @@ class S3ImportItem(object):
         if self.original is not None:
             original = self.original
         elif self.data:
-            original = S3Resource.original(table, self.data,
-                                           mandatory=mandatory)
+            original = self._original(self.data)
         else:
             original = None
 
@@ -1922,15 +2089,36 @@ class S3ImportItem(object):
                 if data and resolve:
                     resolve(self)
                 if self.id and self.method in (UPDATE, DELETE, MERGE):
-                    fields = S3Resource.import_fields(table, data,
-                                                      mandatory=mandatory)
-                    self.original = current.db(table._id == self.id) \
-                                           .select(limitby=(0, 1),
-                                                   *fields).first()
+                    index = self.job.index
+                    if index is not None:
+                        self.original = index.record(table, self.id)
+                    if self.original is None:
+                        fields = S3Resource.import_fields(table, data,
+                                                          mandatory=mandatory)
+                        self.original = current.db(table._id == self.id) \
+                                               .select(limitby=(0, 1),
+                                                       *fields).first()
                     if original and UID in original:
                         self.uid = original[UID]
                         data.update({UID:self.uid})
 
+    # -------------------------------------------------------------------------
+    def _original(self, record):
+        """
+            Find the original DB record of this item (from the index of
+            the job, if available)
+
+            @param record: the record as dict or S3XML Element
+        """
+
+        index = self.job.index
+        if index is not None:
+            original = index.original
+        else:
+            original = S3Resource.original
+        return original(self.table, record,
+                        mandatory=self._mandatory_fields())
+
     # -------------------------------------------------------------------------
     def authorize(self):
         """
@@ -2372,6 +2560,16 @@ class S3ImportItem(object):
                 if MCI in table.fields:
                     data[MCI] = self.mci
 
+                # Bulk mode: defer the insert to the next bulk commit
+                if job.bulk and self._bulk_insertable():
+                    if not self.uid:
+                        # UID required to look up the record ID afterwards
+                        self.uid = uuid.uuid4().urn
+                    data[UID] = self.uid
+                    self.bulk_data = dict(data)
+                    job.defer(self)
+                    return True
+
                 # Insert the new record
                 try:
                     success = table.insert(**dict(data))
@@ -2472,18 +2670,7 @@ class S3ImportItem(object):
 
         # Audit + onaccept on successful commits
         if self.committed:
-            form = Storage()
-            form.method = method
-            form.vars = self.data
-            prefix, name = tablename.split("_", 1)
-            if self.id:
-                form.vars.id = self.id
-            current.audit(method, prefix, name,
-                          form=form,
-                          record=self.id,
-                          representation="xml")
-            # Update super entity links
-            s3db.update_super(table, form.vars)
+            form = self._accept()
             if method == CREATE:
                 # Set record owner
                 current.auth.s3_set_record_owner(table, self.id)
@@ -2500,27 +2687,84 @@ class S3ImportItem(object):
                 callback(onaccept, form, tablename=tablename)
 
         # Update referencing items
-        if self.update and self.id:
-            for u in self.update:
-                item = u.get("item", None)
-                if not item:
-                    continue
-                field = u.get("field", None)
-                if isinstance(field, (list, tuple)):
-                    pkey, fkey = field
-                    query = (table.id == self.id)
-                    row = db(query).select(table[pkey],
-                                           limitby=(0, 1)).first()
-                    if row:
-                        item._update_reference(fkey, row[pkey])
-                else:
-                    item._update_reference(field, self.id)
+        self._update_referencing_items()
 
         _debug("Success: %s, id=%s %sd" % (tablename, self.id,
                                            self.skip and "skippe" or \
                                            method))
         return True
 
+    # -------------------------------------------------------------------------
+    def _accept(self):
+        """
+            Audit a committed item and update its super-entity links
+
+            @return: the form (Storage) for onaccept callbacks
+        """
+
+        method = self.method
+        tablename = self.tablename
+
+        form = Storage()
+        form.method = method
+        form.vars = self.data
+        prefix, name = tablename.split("_", 1)
+        if self.id:
+            form.vars.id = self.id
+        current.audit(method, prefix, name,
+                      form=form,
+                      record=self.id,
+                      representation="xml")
+        # Update super entity links
+        current.s3db.update_super(self.table, form.vars)
+
+        return form
+
+    # -------------------------------------------------------------------------
+    def _update_referencing_items(self):
+        """
+            Update the foreign keys in items which have been committed
+            before this item (circular references)
+        """
+
+        if not self.update or not self.id:
+            return
+
+        table = self.table
+        for u in self.update:
+            item = u.get("item", None)
+            if not item:
+                continue
+            field = u.get("field", None)
+            if isinstance(field, (list, tuple)):
+                pkey, fkey = field
+                query = (table.id == self.id)
+                row = current.db(query).select(table[pkey],
+                                               limitby=(0, 1)).first()
+                if row:
+                    item._update_reference(fkey, row[pkey])
+            else:
+                item._update_reference(field, self.id)
+
+    # -------------------------------------------------------------------------
+    def _bulk_insertable(self):
+        """
+            Check whether the insert of this item can be deferred to a
+            bulk commit of the job (requires a UID field to identify the
+            new record, and no DAL insert callbacks)
+        """
+
+        table = self.table
+        if current.xml.UID not in table.fields:
+            return False
+        if getattr(table, "_before_insert", None):
+            return False
+        # Version stamps are renewed by bulk_commit itself
+        after_insert = getattr(table, "_after_insert", None) or []
+        if any(not getattr(f, "table_version", False) for f in after_insert):
+            return False
+        return True
+
     # -------------------------------------------------------------------------
     def _dynamic_defaults(self, data):
         """
@@ -2816,7 +3060,8 @@ class S3ImportJob():
                  update_policy=None,
                  conflict_policy=None,
                  last_sync=None,
-                 onconflict=None):
+                 onconflict=None,
+                 bulk=None):
         """
             Constructor
 
@@ -2828,6 +3073,8 @@ class S3ImportJob():
             @param conflict_policy: the conflict resolution policy
             @param last_sync: the last synchronization time stamp (datetime)
             @param onconflict: custom conflict resolver function
+            @param bulk: insert new records in batches (default from
+                         settings.base.import_bulk)
         """
 
         self.error = None # the last error
@@ -2882,6 +3129,23 @@ class S3ImportJob():
         self.last_sync = last_sync
         self.onconflict = onconflict
 
+        # Bulk mode
+        settings = current.deployment_settings
+        if bulk is None:
+            bulk = settings.get_base_import_bulk()
+        self.bulk = bulk
+        self.bulk_size = settings.get_base_import_bulk_size()
+        self.pending = []
+        self.pending_items = set()
+        self.pending_uids = set()
+        self.pending_keys = set()
+
+        # Deduplication index
+        if settings.get_base_import_index():
+            self.index = S3ImportIndex(self)
+        else:
+            self.index = None
+
         if job_id:
             self.__define_tables()
             jobtable = self.job_table
@@ -3331,19 +3595,38 @@ class S3ImportJob():
         tablename = self.table._tablename
 
         self.log = log_items
-        failed = False
+        bulk = self.bulk
+        index = self.index
+        if index is not None:
+            index.index_keys([items[item_id] for item_id in import_list])
+        results = []
         for item_id in import_list:
             item = items[item_id]
-            error = None
+
+            if bulk and self.pending and self.bulk_depends(item):
+                # Item needs the records of the deferred items
+                self.bulk_commit()
 
             if item.accepted is not False:
                 logged = False
                 success = item.commit(ignore_errors=ignore_errors)
+                if index is not None:
+                    index.update(item)
             else:
                 # Field validation failed
                 logged = True
                 success = ignore_errors
+            results.append((item, logged, success))
 
+        if bulk:
+            self.bulk_commit()
+
+        failed = False
+        for item, logged, success in results:
+
+            if item.bulk_data is not None and item.error:
+                # Deferred insert failed
+                success = ignore_errors
             if not success:
                 failed = True
 
@@ -3380,6 +3663,253 @@ class S3ImportJob():
         self.deleted = deleted
         return True
 
+    # -------------------------------------------------------------------------
+    def defer(self, item):
+        """
+            Defer the insert of a new record to the next bulk commit,
+            called by S3ImportItem.commit in bulk mode
+
+            @param item: the S3ImportItem
+        """
+
+        self.pending.append(item)
+        self.pending_items.add(item.item_id)
+        self.pending_uids.add(item.uid)
+        if self.index is not None:
+            self.pending_keys.add(self.index.key(item))
+
+        if len(self.pending) >= self.bulk_size:
+            self.bulk_commit()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _bulk_values(table, data):
+        """
+            Get the values to insert for a record, including defaults
+            and computed fields, as the DAL would insert them
+
+            @param table: the Table
+            @param data: the record data (dict)
+
+            @return: list of tuples (Field, value)
+        """
+
+        if hasattr(table, "_fields_and_values_for_insert"):
+            values = table._fields_and_values_for_insert(data)
+        else:
+            # Older DAL
+            values = table._listify(data)
+        if hasattr(values, "op_values"):
+            values = values.op_values()
+        return values
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _bulk_insert_sql(table, rows):
+        """
+            Construct a multi-row INSERT statement
+
+            @param table: the Table
+            @param rows: the rows to insert, lists of tuples (Field, value),
+                         all with the same fields in the same order
+
+            @return: the SQL statement (string)
+        """
+
+        represent = current.db._adapter.represent
+        fields = [field for field, value in rows[0]]
+
+        tablename = getattr(table, "sqlsafe", None) or table._tablename
+        fieldnames = [getattr(field, "sqlsafe_name", None) or field.name
+                      for field in fields]
+
+        values = ["(%s)" % ",".join(represent(value, field.type)
+                                    for field, value in row)
+                  for row in rows]
+
+        return "INSERT INTO %s(%s) VALUES %s;" % (tablename,
+                                                  ",".join(fieldnames),
+                                                  ",".join(values))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _savepoint(function):
+        """
+            Run a database operation so that a failure does not abort
+            the transaction (with PostgreSQL, in a savepoint; other
+            backends roll back just the failing statement)
+
+            @param function: the function to run
+
+            @return: the return value of the function
+        """
+
+        db = current.db
+        if db._dbname != "postgres":
+            return function()
+
+        db.executesql("SAVEPOINT s3_bulk_commit;")
+        try:
+            result = function()
+        except db._adapter.driver.Error:
+            db.executesql("ROLLBACK TO SAVEPOINT s3_bulk_commit;")
+            raise
+        db.executesql("RELEASE SAVEPOINT s3_bulk_commit;")
+        return result
+
+    # -------------------------------------------------------------------------
+    def bulk_depends(self, item):
+        """
+            Check whether an item must be committed after the currently
+            deferred items, i.e. whether it is for a different table,
+            references or deduplicates against any of the deferred items
+
+            @param item: the S3ImportItem
+        """
+
+        pending = self.pending
+        if not pending:
+            return False
+
+        if item.tablename != pending[0].tablename:
+            return True
+
+        pending_items = self.pending_items
+        parent = item.parent
+        if parent is not None and parent.item_id in pending_items:
+            return True
+        for reference in item.references:
+            entry = reference.entry
+            if entry and entry.item_id in pending_items:
+                return True
+
+        if item.uid and item.uid in self.pending_uids:
+            return True
+
+        if self.index is not None:
+            key = self.index.key(item)
+            if key is not None and key in self.pending_keys:
+                return True
+
+        return False
+
+    # -------------------------------------------------------------------------
+    def bulk_commit(self):
+        """
+            Insert the records of all deferred items with multi-row
+            INSERTs, then set the record owners in batch, and run audit,
+            onaccept and reference updates for the new records
+
+            Tables can configure a "create_bulk_onaccept" (or
+            "bulk_onaccept") callback, which receives the list of all
+            forms of the batch instead of being called per record.
+        """
+
+        items = self.pending
+        if not items:
+            return
+        self.pending = []
+        self.pending_items = set()
+        self.pending_uids = set()
+        self.pending_keys = set()
+
+        db = current.db
+        s3db = current.s3db
+        UID = current.xml.UID
+
+        table = items[0].table
+        tablename = table._tablename
+        size = self.bulk_size
+
+        # Multi-row INSERTs only for backends known to support them,
+        # otherwise insert row by row (still saving the per-item overhead)
+        dbname = db._dbname
+        multirow = dbname in ("postgres", "mysql", "sqlite")
+
+        # Group the items by their set of fields (incl. defaults)
+        groups = {}
+        for item in items:
+            values = self._bulk_values(table, item.bulk_data)
+            key = tuple(field.name for field, value in values)
+            if key in groups:
+                groups[key].append((item, values))
+            else:
+                groups[key] = [(item, values)]
+
+        DBError = db._adapter.driver.Error
+        for group in groups.values():
+            for i in xrange(0, len(group), size):
+                chunk = group[i:i + size]
+                if multirow:
+                    sql = self._bulk_insert_sql(table,
+                                                [values for item, values in chunk])
+                    try:
+                        self._savepoint(lambda: db.executesql(sql))
+                    except DBError:
+                        # Fall back to row-by-row to find the failing rows
+                        pass
+                    else:
+                        continue
+                for item, values in chunk:
+                    try:
+                        self._savepoint(lambda: table.insert(**item.bulk_data))
+                    except DBError:
+                        item.error = sys.exc_info()[1]
+                        item.skip = True
+        if multirow:
+            # Raw SQL bypasses the DAL callbacks
+            S3TableVersion.renew(tablename)
+
+        items = [item for item in items if not item.skip]
+        if not items:
+            return
+
+        # Look up the new record IDs
+        uids = [item.uid for item in items]
+        record_ids = {}
+        for i in xrange(0, len(uids), size):
+            query = (table[UID].belongs(uids[i:i + size]))
+            rows = db(query).select(table._id, table[UID])
+            for row in rows:
+                record_ids[row[UID]] = row[table._id]
+
+        committed = []
+        for item in items:
+            record_id = record_ids.get(item.uid)
+            if record_id:
+                item.id = record_id
+                item.committed = True
+                committed.append(item)
+            else:
+                item.error = current.ERROR.BAD_RECORD
+                item.skip = True
+        if not committed:
+            return
+
+        # Audit and update super entity links
+        forms = [item._accept() for item in committed]
+
+        # Set record owners
+        current.auth.s3_set_record_owners(table,
+                                          [item.id for item in committed])
+
+        # Onaccept
+        get_config = s3db.get_config
+        onaccept = get_config(tablename, "create_bulk_onaccept") or \
+                   get_config(tablename, "bulk_onaccept")
+        if onaccept:
+            callback(onaccept, forms, tablename=tablename)
+        else:
+            get_callback = current.deployment_settings.get_import_callback
+            onaccept = get_callback(tablename, "create_onaccept")
+            if onaccept:
+                for form in forms:
+                    callback(onaccept, form, tablename=tablename)
+
+        for item in committed:
+            item._update_referencing_items()
+            _debug("Success: %s, id=%s created" % (tablename, item.id))
+
     # -------------------------------------------------------------------------
     def __define_tables(self):
         """
@@ -3563,6 +4093,318 @@ class S3ImportJob():
                     item.parent = parent
                 item.load_parent = None
 
+# =============================================================================
+class S3ImportIndex(object):
+    """
+        Job-level index of existing records for import deduplication, to
+        look up the originals of all import items with a few belongs()
+        queries per table rather than one query per item:
+
+        - UIDs and unique fields are indexed from the import tree when
+          the first original for a table is looked up (during parse)
+
+        - tables can declare the fields used by their deduplicate
+          resolver with the "deduplicate_index" setting, e.g.
+          ("name", "level", "parent") - where the first field is matched
+          case-insensitively - resolvers can then use lookup() instead
+          of querying the database; these are indexed before commit
+
+        - values of committed items are removed from the index, so that
+          subsequent lookups for these values fall back to the database
+    """
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, job):
+        """
+            Constructor
+
+            @param job: the S3ImportJob
+        """
+
+        self.job = job
+
+        # Unique fields: {tablename: {fieldname: {value: Row}}}
+        self.originals = {}
+        self.queried = {}
+
+        # Deduplicate keys: {tablename: {key: [Row]}}
+        self.keys = {}
+        self.queried_keys = {}
+
+        # Records by ID: {tablename: {id: Row}}
+        self.records = {}
+
+    # -------------------------------------------------------------------------
+    def original(self, table, record, mandatory=None):
+        """
+            Find the original record for a possible duplicate, like
+            S3Resource.original, but using the index
+
+            @param table: the table
+            @param record: the record as dict or S3XML Element
+            @param mandatory: the mandatory fields of the table
+
+            @return: the original Row, or None if not found
+        """
+
+        tablename = table._tablename
+        if tablename not in self.originals:
+            self.index_originals(table, mandatory=mandatory)
+        originals = self.originals[tablename]
+        queried = self.queried[tablename]
+
+        xml = current.xml
+        UID = xml.UID
+
+        pvalues = S3Resource.original_keys(table, record)
+        if UID in pvalues:
+            pvalues[UID] = xml.import_uid(pvalues[UID])
+        for fn, value in pvalues.items():
+            value = pvalues[fn] = s3_unicode(value)
+            if fn not in queried or value not in queried[fn]:
+                # Not indexed => look up from DB
+                return S3Resource.original(table, record,
+                                           mandatory=mandatory)
+
+        # Exactly one match by non-UID unique keys?
+        pkey = table._id.name
+        matches = {}
+        for fn, value in pvalues.items():
+            if fn == UID:
+                continue
+            row = originals[fn].get(value)
+            if row:
+                matches[row[pkey]] = row
+        if len(matches) == 1:
+            return matches.values()[0]
+
+        # UID match?
+        if UID in pvalues:
+            return originals[UID].get(pvalues[UID])
+
+        return None
+
+    # -------------------------------------------------------------------------
+    def index_originals(self, table, mandatory=None):
+        """
+            Look up existing records for the UIDs and unique field values
+            of all elements for a table in the import tree
+
+            @param table: the table
+            @param mandatory: the mandatory fields of the table
+        """
+
+        tablename = table._tablename
+        originals = self.originals[tablename] = {}
+        queried = self.queried[tablename] = {}
+
+        tree = self.job.tree
+        if tree is None:
+            return
+
+        xml = current.xml
+        UID = xml.UID
+
+        # Collect the unique field values
+        values = {}
+        original_keys = S3Resource.original_keys
+        expr = "//%s[@%s='%s']" % (xml.TAG.resource,
+                                   xml.ATTRIBUTE.name,
+                                   tablename,
+                                   )
+        for element in tree.xpath(expr):
+            for fn, value in original_keys(table, element).items():
+                if fn == UID:
+                    value = xml.import_uid(value)
+                if fn not in values:
+                    values[fn] = set()
+                values[fn].add(value)
+        if not values:
+            return
+
+        db = current.db
+        fields = S3Resource.import_fields(table, values, mandatory=mandatory)
+        size = self.CHUNK_SIZE
+        for fn, value_set in values.items():
+            value_list = list(value_set)
+            field = table[fn]
+            index = originals[fn] = {}
+            for i in xrange(0, len(value_list), size):
+                query = (field.belongs(value_list[i:i + size]))
+                rows = db(query).select(*fields)
+                for row in rows:
+                    index[s3_unicode(row[fn])] = row
+            queried[fn] = set(s3_unicode(value) for value in value_list)
+
+    # -------------------------------------------------------------------------
+    def index_keys(self, items):
+        """
+            Look up existing records for the deduplicate keys of the
+            import items, for tables with a deduplicate_index setting
+
+            @param items: the import items
+        """
+
+        get_config = current.s3db.get_config
+
+        # Collect the key values per table
+        values = {}
+        for item in items:
+            table = item.table
+            data = item.data
+            if table is None or not data:
+                continue
+            tablename = table._tablename
+            if tablename in values:
+                keys, key_values, data_fields = values[tablename]
+            else:
+                keys = get_config(tablename, "deduplicate_index")
+                if not keys:
+                    continue
+                key_values, data_fields = set(), set()
+                values[tablename] = (keys, key_values, data_fields)
+            value = data.get(keys[0])
+            if value:
+                key_values.add(s3_unicode(value).lower())
+                data_fields.update(data.keys())
+
+        db = current.db
+        s3db = current.s3db
+        size = self.CHUNK_SIZE
+        for tablename, (keys, key_values, data_fields) in values.items():
+
+            table = s3db[tablename]
+
+            # Load all fields needed as original for the items
+            data_fields.update(keys)
+            mandatory = self.job.mandatory_fields.get(tablename)
+            fields = S3Resource.import_fields(table, data_fields,
+                                              mandatory=mandatory)
+
+            key = keys[0]
+            field = table[key]
+            pkey = table._id.name
+            index = self.keys[tablename] = {}
+            records = self.records[tablename] = {}
+            value_list = list(key_values)
+            for i in xrange(0, len(value_list), size):
+                query = (field.lower().belongs(value_list[i:i + size]))
+                rows = db(query).select(*fields)
+                for row in rows:
+                    value = s3_unicode(row[key]).lower()
+                    if value in index:
+                        index[value].append(row)
+                    else:
+                        index[value] = [row]
+                    records[row[pkey]] = row
+            self.queried_keys[tablename] = key_values
+
+    # -------------------------------------------------------------------------
+    def lookup(self, table, **values):
+        """
+            Look up existing records by their deduplicate keys, to be
+            used by deduplicate resolvers
+
+            @param table: the table
+            @param values: the field values to match, must include the
+                           first field of the deduplicate_index, and
+                           must only use fields of the deduplicate_index
+
+            @return: list of Rows, or None if the values are not indexed
+                     (=the resolver must look up the records in the DB)
+        """
+
+        tablename = table._tablename
+        if tablename not in self.keys:
+            return None
+
+        keys = current.s3db.get_config(tablename, "deduplicate_index")
+        key = keys[0]
+        value = values.get(key)
+        if not value:
+            return None
+        value = s3_unicode(value).lower()
+        if value not in self.queried_keys[tablename]:
+            return None
+
+        rows = self.keys[tablename].get(value, [])
+        for fn, value in values.items():
+            if fn != key:
+                rows = [row for row in rows if row[fn] == value]
+        return rows
+
+    # -------------------------------------------------------------------------
+    def record(self, table, record_id):
+        """
+            Get an indexed record by its ID
+
+            @param table: the table
+            @param record_id: the record ID
+
+            @return: the Row, or None if not indexed
+        """
+
+        records = self.records.get(table._tablename)
+        if records:
+            return records.get(record_id)
+        return None
+
+    # -------------------------------------------------------------------------
+    def key(self, item):
+        """
+            Get the deduplicate key of an item
+
+            @param item: the S3ImportItem
+
+            @return: tuple (tablename, key), or None if not indexed
+        """
+
+        tablename = item.tablename
+        if tablename not in self.keys or not item.data:
+            return None
+
+        keys = current.s3db.get_config(tablename, "deduplicate_index")
+        value = item.data.get(keys[0])
+        if not value:
+            return None
+        return (tablename, s3_unicode(value).lower())
+
+    # -------------------------------------------------------------------------
+    def update(self, item):
+        """
+            Remove all values of a committed item from the index, so that
+            subsequent lookups for these values use the database
+
+            @param item: the S3ImportItem
+        """
+
+        tablename = item.tablename
+        UID = current.xml.UID
+
+        records = [r for r in (item.data, item.original) if r]
+        if item.uid:
+            records.append({UID: item.uid})
+
+        queried = self.queried.get(tablename)
+        if queried:
+            for fn, value_set in queried.items():
+                for record in records:
+                    value = record.get(fn)
+                    if value:
+                        value_set.discard(s3_unicode(value))
+
+        queried_keys = self.queried_keys.get(tablename)
+        if queried_keys:
+            key = current.s3db.get_config(tablename, "deduplicate_index")[0]
+            for record in records:
+                value = record.get(key)
+                if value:
+                    queried_keys.discard(s3_unicode(value).lower())
+
+        if item.id and tablename in self.records:
+            self.records[tablename].pop(item.id, None)
+
 # =============================================================================
 class S3BulkImporter(object):
     """
@@ -3572,6 +4414,16 @@ class S3BulkImporter(object):
         http://eden.sahanafoundation.org/wiki/DeveloperGuidelines/PrePopulate
     """
 
+    # File to record completed tasks, to resume interrupted prepopulates
+    CHECKPOINT = "prepopulate.chk"
+    # File to lock while a prepopulate is running
+    LOCK = "prepopulate.lock"
+    lock = None
+
+    # Tables written and referenced by CSV stylesheets
+    XSLT_RESOURCE = re.compile(r'<resource\s+name="([a-z0-9]+_[a-z0-9_]+)"')
+    XSLT_REFERENCE = re.compile(r'resource="([a-z0-9]+_[a-z0-9_]+)"')
+
     def __init__(self):
         """ Constructor """
 
@@ -3594,6 +4446,8 @@ class S3BulkImporter(object):
             }
         self.errorList = []
         self.resultList = []
+        self.timings = []
+        self.checkpoint = None
 
     # -------------------------------------------------------------------------
     def load_descriptor(self, path):
@@ -3827,6 +4681,7 @@ class S3BulkImporter(object):
                 # older Python
                 msg = "%s import job completed in %s" % (csvName, duration)
             self.resultList.append(msg)
+            self.timings.append((csvName, (end - start).total_seconds()))
             current.log.debug(msg)
 
     # -------------------------------------------------------------------------
@@ -3863,6 +4718,7 @@ class S3BulkImporter(object):
                 # older Python
                 msg = "%s import job completed in %s" % (fun, duration)
             self.resultList.append(msg)
+            self.timings.append((fun, (end - start).total_seconds()))
             current.log.debug(msg)
 
     # -------------------------------------------------------------------------
@@ -4256,13 +5112,402 @@ class S3BulkImporter(object):
         """
             Load and then execute the import jobs that are listed in the
             descriptor file (tasks.cfg)
+
+            - tasks which have been completed in an earlier, interrupted
+              run are skipped (see load_checkpoint)
+            - with settings.base.prepopulate_workers > 1, independent
+              import tasks run in parallel processes (see execute_parallel)
         """
 
         self.load_descriptor(path)
-        for task in self.tasks:
+
+        checkpoint = self.load_checkpoint()
+        if not checkpoint:
+            # Mark the prepopulate as started
+            self.save_checkpoint()
+
+        tasks = []
+        for index, task in enumerate(self.tasks):
+            key = json.dumps([path, index, task])
+            if key in checkpoint:
+                self.resultList.append("%s skipped (completed in previous run)" %
+                                       task[1:4])
+                continue
+            tasks.append((key, task))
+
+        workers = self.workers()
+        if workers > 1:
+            self.execute_parallel(tasks, workers)
+        else:
+            for key, task in tasks:
+                self.execute_task(key, task)
+
+    # -------------------------------------------------------------------------
+    def execute_task(self, key, task):
+        """
+            Execute a task in this process, and record it as completed
+            if it was successful
+
+            @param key: the checkpoint key of the task
+            @param task: the task
+        """
+
+        errors = len(self.errorList)
+        if task[0] == 1:
+            self.execute_import_task(task)
+        elif task[0] == 2:
+            self.execute_special_task(task)
+        if not self.failed(self.errorList[errors:]):
+            current.db.commit()
+            self.add_checkpoint(key)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def failed(errors):
+        """
+            Check whether the messages of a task indicate a failure
+
+            @param errors: the messages the task added to the errorList
+
+            @return: True if any of the messages is an error rather
+                     than a warning, otherwise False
+        """
+
+        for error in errors:
+            if not str(error).startswith("WARNING"):
+                return True
+        return False
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def workers():
+        """
+            Get the number of processes to run import tasks in
+
+            @return: the number of processes, 1 to run all tasks in
+                     this process
+        """
+
+        workers = current.deployment_settings.get_base_prepopulate_workers()
+        if workers > 1:
+            if current.db._dbname == "sqlite":
+                # No concurrent writes
+                return 1
+            import imp
+            try:
+                imp.find_module("multiprocessing")
+            except ImportError:
+                return 1
+        return workers
+
+    # -------------------------------------------------------------------------
+    def execute_parallel(self, tasks, workers):
+        """
+            Execute tasks in a process pool; special tasks act as barriers,
+            i.e. run in this process after all previous tasks have completed
+            and before any of the following tasks get started
+
+            @param tasks: list of tuples (key, task)
+            @param workers: the number of processes
+        """
+
+        segment = []
+        for key, task in tasks:
             if task[0] == 1:
-                self.execute_import_task(task)
-            elif task[0] == 2:
-                self.execute_special_task(task)
+                segment.append((key, task))
+            else:
+                self.execute_segment(segment, workers)
+                segment = []
+                self.execute_task(key, task)
+        self.execute_segment(segment, workers)
+
+    # -------------------------------------------------------------------------
+    def execute_segment(self, tasks, workers):
+        """
+            Execute import tasks in a process pool, starting every task
+            as soon as all tasks it depends on have completed
+
+            @param tasks: list of tuples (key, task)
+            @param workers: the number of processes
+        """
+
+        if len(tasks) < 2:
+            for key, task in tasks:
+                self.execute_task(key, task)
+            return
+
+        import multiprocessing
+
+        dependencies = self.task_dependencies([task for key, task in tasks])
+
+        # Workers must see all data imported so far
+        current.db.commit()
+
+        pool = multiprocessing.Pool(min(workers, len(tasks)),
+                                    initializer=_bulk_import_init)
+        try:
+            waiting = range(len(tasks))
+            running = {}
+            done = set()
+            while waiting or running:
+                # Start all tasks which have their dependencies completed
+                for index in list(waiting):
+                    if dependencies[index] <= done:
+                        waiting.remove(index)
+                        running[index] = pool.apply_async(_bulk_import_task,
+                                                          (tasks[index][1],))
+                finished = [index for index, result in running.items()
+                            if result.ready()]
+                if not finished:
+                    running.values()[0].wait(0.1)
+                    continue
+                for index in finished:
+                    key, task = tasks[index]
+                    try:
+                        errors, results, timings = running.pop(index).get()
+                    except Exception:
+                        e = sys.exc_info()[1]
+                        errors = ["%s import job failed: %s" % (task[3], e)]
+                        results = timings = []
+                    self.errorList.extend(errors)
+                    self.resultList.extend(results)
+                    self.timings.extend(timings)
+                    if not self.failed(errors):
+                        self.add_checkpoint(key)
+                    done.add(index)
+        finally:
+            pool.close()
+            pool.join()
+
+    # -------------------------------------------------------------------------
+    def task_dependencies(self, tasks):
+        """
+            Determine which import tasks must complete before another one
+            can start: a task depends on all earlier tasks (in tasks.cfg
+            order) which write a table it also writes or references, or
+            which reference a table it writes
+
+            @param tasks: list of import tasks
+            @return: list of sets of indices of the tasks each task
+                     depends on
+        """
+
+        tables = [self.task_tables(task) for task in tasks]
+
+        dependencies = []
+        for index, (writes, supers, reads) in enumerate(tables):
+            depends = set()
+            for idx in xrange(index):
+                w, s, r = tables[idx]
+                # Super-entities are written by many tables, but
+                # concurrent inserts into them do not conflict
+                if w & writes or w & reads or s & reads or \
+                   r & writes or r & supers:
+                    depends.add(idx)
+            dependencies.append(depends)
+
+        return dependencies
+
+    # -------------------------------------------------------------------------
+    def task_tables(self, task):
+        """
+            Determine the tables an import task writes and references
+
+            @param task: the import task
+            @return: tuple of sets of tablenames (writes, supers, reads),
+                     where supers are the super-entities of the written
+                     tables
+        """
+
+        s3db = current.s3db
+
+        tablename = "%s_%s" % (task[1], task[2])
+        details = self.alternateTables.get(tablename)
+        if details and "tablename" in details:
+            tablename = details["tablename"]
+
+        writes = set([tablename])
+        reads = set()
+        try:
+            with open(task[4], "r") as stylesheet:
+                xslt = stylesheet.read()
+        except IOError:
+            pass
+        else:
+            writes |= set(self.XSLT_RESOURCE.findall(xslt))
+            reads |= set(self.XSLT_REFERENCE.findall(xslt))
+
+        meta_fields = s3_all_meta_field_names()
+        supers = set()
+        for tn in writes:
+            table = s3db.table(tn)
+            if not table:
+                continue
+            super_entity = s3db.get_config(tn, "super_entity")
+            if super_entity:
+                if isinstance(super_entity, (list, tuple)):
+                    supers |= set(super_entity)
+                else:
+                    supers.add(super_entity)
+            for fn in table.fields:
+                if fn in meta_fields:
+                    continue
+                ktablename = s3_get_foreign_key(table[fn], m2m=False)[0]
+                if ktablename:
+                    reads.add(ktablename)
+
+        return (writes - supers, supers, reads - writes)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def checkpoint_path(cls):
+        """ The path of the checkpoint file """
+
+        return os.path.join(current.request.folder, "private", cls.CHECKPOINT)
+
+    # -------------------------------------------------------------------------
+    def load_checkpoint(self):
+        """
+            Load the keys of the tasks completed in an earlier run
+            of the prepopulate
+
+            @return: set of task keys
+        """
+
+        if self.checkpoint is None:
+            try:
+                with open(self.checkpoint_path(), "r") as checkpoint:
+                    self.checkpoint = set(json.load(checkpoint))
+            except (IOError, ValueError):
+                self.checkpoint = set()
+        return self.checkpoint
+
+    # -------------------------------------------------------------------------
+    def add_checkpoint(self, key):
+        """
+            Record a task as completed
+
+            @param key: the task key
+        """
+
+        self.load_checkpoint().add(key)
+        self.save_checkpoint()
+
+    # -------------------------------------------------------------------------
+    def save_checkpoint(self):
+        """ Write the checkpoint file (atomically) """
+
+        path = self.checkpoint_path()
+        temp = "%s.tmp" % path
+        with open(temp, "w") as checkpoint:
+            json.dump(sorted(self.load_checkpoint()), checkpoint)
+        os.rename(temp, path)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def pending(cls):
+        """
+            Check whether there is an interrupted prepopulate to resume
+
+            @return: True|False
+        """
+
+        return os.path.exists(cls.checkpoint_path())
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def acquire_lock(cls):
+        """
+            Lock the prepopulate for this process, so that other requests
+            do not resume it while it is still running; the lock is
+            released when the process ends
+
+            @return: True if successful, False if another process
+                     holds the lock
+        """
+
+        if cls.lock is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            # Windows: no locking
+            return True
+        path = os.path.join(current.request.folder, "private", cls.LOCK)
+        lock = open(path, "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return False
+        cls.lock = lock
+        return True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def release_lock(cls):
+        """ Release the prepopulate lock """
+
+        lock = cls.lock
+        if lock is not None:
+            cls.lock = None
+            lock.close()
+
+    # -------------------------------------------------------------------------
+    def clear_checkpoint(self):
+        """ Remove the checkpoint file, i.e. mark the prepopulate as complete """
+
+        self.checkpoint = None
+        try:
+            os.remove(self.checkpoint_path())
+        except OSError:
+            pass
+
+    # -------------------------------------------------------------------------
+    def timing_report(self):
+        """
+            Report the duration of all tasks, longest first
+
+            @return: list of strings
+        """
+
+        timings = sorted(self.timings, key=lambda item: item[1], reverse=True)
+        return ["%9.1fs  %s" % (duration, name) for name, duration in timings]
+
+# =============================================================================
+# Inherited database connections of forked import processes
+_bulk_import_connections = []
+
+def _bulk_import_init():
+    """
+        Initializer for processes of the bulk import pool: open a new
+        database connection rather than sharing the one of the parent
+        process (the inherited connections must be kept open though,
+        since closing them would close the parent's session)
+    """
+
+    adapter = current.db._adapter
+
+    pools = getattr(adapter, "POOLS", None)
+    if pools and adapter.uri in pools:
+        _bulk_import_connections.extend(pools[adapter.uri])
+        pools[adapter.uri] = []
+
+    _bulk_import_connections.append(adapter.connection)
+    adapter.connection = None
+    adapter.reconnect()
+
+# -----------------------------------------------------------------------------
+def _bulk_import_task(task):
+    """
+        Execute an import task in a process of the bulk import pool
+
+        @param task: the import task
+        @return: tuple (errors, results, timings)
+    """
+
+    importer = S3BulkImporter()
+    importer.execute_import_task(task)
+    return (importer.errorList, importer.resultList, importer.timings)
 
 # END =========================================================================
@@ -40,6 +40,7 @@ from gluon.tools import callback
 from s3dal import Table
 from s3navigation import S3ScriptItem
 from s3resource import S3Resource
+from s3utils import S3TableVersion
 from s3validators import IS_ONE_OF
 
 DEFAULT = lambda: None
@@ -351,7 +352,8 @@ class S3Model(object):
     def define_table(cls, tablename, *fields, **args):
         """
             Same as db.define_table except that it does not repeat
-            a table definition if the table is already defined.
+            a table definition if the table is already defined, and
+            that it attaches the version stamp callbacks to the table.
         """
 
         db = current.db
@@ -359,6 +361,7 @@ class S3Model(object):
             table = ogetattr(db, tablename)
         else:
             table = db.define_table(tablename, *fields, **args)
+        S3TableVersion.attach(table)
         return table
 
     # -------------------------------------------------------------------------
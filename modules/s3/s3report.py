@@ -29,8 +29,13 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import hashlib
 import os
 import re
+import threading
+import time
+
+from collections import OrderedDict
 
 try:
     import json # try stdlib (Python 2.6)
@@ -49,6 +54,7 @@ from gluon.validators import IS_IN_SET, IS_EMPTY_OR
 
 from s3query import FS
 from s3rest import S3Method
+from s3utils import S3TableVersion
 from s3xml import S3XMLFormat
 
 layer_pattern = re.compile("([a-zA-Z]+)\((.*)\)\Z")
@@ -149,7 +155,7 @@ class S3Report(S3Method):
                     selector, method = m.group(2), m.group(1)
 
             if not layer or not any([rows, cols]):
-                pivottable = None
+                pivotdata = None
             else:
                 prefix = resource.prefix_selector
                 selector = prefix(selector)
@@ -158,13 +164,11 @@ class S3Report(S3Method):
                 get_vars["cols"] = prefix(cols) if cols else None
                 get_vars["fact"] = "%s(%s)" % (method, selector)
 
-                pivottable = resource.pivottable(rows, cols, [layer])
-        else:
-            pivottable = None
-
-        # Render as JSON-serializable dict
-        if pivottable is not None:
-            pivotdata = pivottable.json(maxrows=maxrows, maxcols=maxcols)
+                # Render as JSON-serializable dict
+                pivotdata = self.pivotdata(resource, rows, cols, layer,
+                                           maxrows = maxrows,
+                                           maxcols = maxcols,
+                                           )
         else:
             pivotdata = None
 
@@ -369,17 +373,14 @@ class S3Report(S3Method):
                 resource.add_filter(FS(rows) != None)
 
         if not output:
-            # Build the Pivot Table
-            cols = None
-            layer = get_vars.get("fact",
-                                 defaults.get("fact",
-                                              "count(id)"))
-            m = layer_pattern.match(layer)
-            selector, method = m.group(2), m.group(1)
-            prefix = resource.prefix_selector
-            selector = prefix(selector)
-            layer = (selector, method)
-            pivottable = resource.pivottable(rows, cols, [layer])
+            # Aggregate per area (in the database, cached per filter)
+            fact = get_vars.get("fact",
+                                defaults.get("fact",
+                                             "count(id)"))
+            try:
+                choropleth = resource.choropleth(fact, level=level)
+            except SyntaxError, e:
+                r.error(400, str(e))
 
             # Extract the Location Data
             #attr_fields = []
@@ -406,26 +407,11 @@ class S3Report(S3Method):
                     #    attr_fields.append(attribute)
                     #attr_fields = ",".join(attr_fields)
 
-            ids, location_data = pivottable.geojson(layer=layer, level=level)
-
             # Export as GeoJSON
-            current.xml.show_ids = True
-            gresource = current.s3db.resource("gis_location", id=ids)
-            output = gresource.export_xml(fields=[],
-                                          mcomponents=None,
-                                          references=[],
-                                          stylesheet=stylesheet,
-                                          as_json=True,
-                                          location_data=location_data,
-                                          # Tell the client that we are
-                                          # displaying aggregated data and
-                                          # the level it is aggregated at
-                                          map_data=dict(level=int(level[1:]),
-                                                        style=style),
-                                          )
-            # Transformation error?
-            if not output:
-                r.error(400, "XSLT Transformation Error: %s " % current.xml.error)
+            # - tell the client that we are displaying aggregated data
+            #   and the level it is aggregated at
+            output = choropleth.json(map_data=dict(level=int(level[1:]),
+                                                   style=style))
 
         return output
 
@@ -491,7 +477,7 @@ class S3Report(S3Method):
                     selector, method = m.group(2), m.group(1)
 
             if not layer or not any([rows, cols]):
-                pivottable = None
+                pivotdata = None
             else:
                 prefix = resource.prefix_selector
                 selector = prefix(selector)
@@ -501,15 +487,13 @@ class S3Report(S3Method):
                 get_vars["fact"] = "%s(%s)" % (method, selector)
 
                 if visible:
-                    pivottable = resource.pivottable(rows, cols, [layer])
+                    # Render as JSON-serializable dict
+                    pivotdata = self.pivotdata(resource, rows, cols, layer,
+                                               maxrows = maxrows,
+                                               maxcols = maxcols,
+                                               )
                 else:
-                    pivottable = None
-        else:
-            pivottable = None
-
-        # Render as JSON-serializable dict
-        if pivottable is not None:
-            pivotdata = pivottable.json(maxrows=maxrows, maxcols=maxcols)
+                    pivotdata = None
         else:
             pivotdata = None
 
@@ -549,6 +533,36 @@ class S3Report(S3Method):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pivotdata(resource, rows, cols, layer, maxrows=None, maxcols=None):
+        """
+            Generate the pivot table data, using the report cache if enabled
+
+            @param resource: the S3Resource
+            @param rows: the rows selector
+            @param cols: the columns selector
+            @param layer: the layer as tuple (selector, method)
+            @param maxrows: maximum number of rows
+            @param maxcols: maximum number of columns
+
+            @return: the pivot table data as JSON-serializable dict
+        """
+
+        def generate():
+            pivottable = resource.pivottable(rows, cols, [layer])
+            return pivottable.json(maxrows=maxrows, maxcols=maxcols)
+
+        selector, method = layer
+        cache = S3ReportCache(resource,
+                              "pivottable",
+                              (rows, cols, selector),
+                              method,
+                              maxrows,
+                              maxcols,
+                              )
+        return cache(generate)
+
 # =============================================================================
 class S3ReportForm(object):
     """ Helper class to render a report form """
@@ -1044,4 +1058,204 @@ class S3ReportForm(object):
                         widgets,
                         **attr)
 
+# =============================================================================
+class S3ReportCache(object):
+    """
+        Cross-request cache for aggregated report data (JSON-serializable
+        dicts, e.g. from S3PivotTable.json or S3TimeSeries.as_dict)
+
+        The cache key covers the resource filter, the report options, the
+        current language, the access rules for all involved tables, and
+        the version stamps of these tables (see S3TableVersion), so that
+        cached data become invalid whenever the underlying data change or
+        a user with different permissions requests the report.
+    """
+
+    # Process-wide LRU store, {key: (expires, data)}
+    store = OrderedDict()
+    lock = threading.Lock()
+
+    # Cache statistics
+    hits = 0
+    misses = 0
+
+    # -------------------------------------------------------------------------
+    def __init__(self, resource, name, selectors, *options):
+        """
+            Constructor
+
+            @param resource: the S3Resource
+            @param name: the report type (e.g. "pivottable")
+            @param selectors: the field selectors used in the report
+            @param options: other report options which affect the result
+        """
+
+        self.resource = resource
+
+        if self.config()[0]:
+            self.key = self.get_key(name, selectors, options)
+        else:
+            self.key = None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def config():
+        """
+            Get the cache configuration from deployment settings
+
+            @return: tuple (enabled, backend, size, expire)
+        """
+
+        settings = current.deployment_settings
+        return (settings.get_ui_report_cache(),
+                settings.get_ui_report_cache_backend(),
+                settings.get_ui_report_cache_size(),
+                settings.get_ui_report_cache_expire(),
+                )
+
+    # -------------------------------------------------------------------------
+    def __call__(self, generate):
+        """
+            Get the report data from the cache, or generate and cache them
+
+            @param generate: function to generate the report data
+
+            @return: the report data
+        """
+
+        key = self.key
+        if key is None:
+            return generate()
+
+        backend, size, expire = self.config()[1:]
+        if backend:
+            # Use web2py cache
+            cache = getattr(current.cache, backend)
+            return cache(key, generate, time_expire=expire)
+
+        cls = self.__class__
+        store = cls.store
+        lock = cls.lock
+
+        now = time.time()
+        with lock:
+            item = store.pop(key, None)
+            if item is not None and item[0] > now:
+                # Re-insert as most recently used
+                store[key] = item
+                cls.hits += 1
+                return item[1]
+
+        data = generate()
+
+        with lock:
+            cls.misses += 1
+            store[key] = (now + expire, data)
+            while len(store) > size:
+                # Evict the least recently used item
+                store.popitem(last=False)
+        return data
+
+    # -------------------------------------------------------------------------
+    def get_key(self, name, selectors, options):
+        """
+            Generate the cache key
+
+            @param name: the report type
+            @param selectors: the field selectors used in the report
+            @param options: other report options which affect the result
+
+            @return: the cache key (string)
+        """
+
+        resource = self.resource
+
+        # Filter (the effective query includes the accessible query
+        # for the master table)
+        query = resource.get_query()
+        rfilter = resource.rfilter
+        url_vars = rfilter.serialize_url()
+        items = [name,
+                 resource.tablename,
+                 resource.alias,
+                 str(query),
+                 str(rfilter.get_filter()),
+                 sorted(url_vars.items()),
+                 [str(option) for option in options],
+                 current.T.accepted_language,
+                 ]
+
+        # All tables involved in the report
+        tables = self.get_tables(selectors)
+
+        # Access rules and version stamps of all involved tables
+        db = current.db
+        accessible_query = current.auth.s3_accessible_query
+        tablenames = sorted(tables)
+        for tablename in tablenames:
+            table = db[tablename]
+            if tablename != resource.tablename:
+                items.append(str(accessible_query("read", table)))
+            # Tables defined outside of S3Model need the callbacks, too
+            S3TableVersion.attach(table)
+        items.extend(S3TableVersion.lookup(tablenames))
+
+        key = hashlib.md5(json.dumps(items, default=str)).hexdigest()
+        return "%s_%s" % (name, key)
+
+    # -------------------------------------------------------------------------
+    def get_tables(self, selectors):
+        """
+            Find all tables involved in the report
+
+            @param selectors: the field selectors used in the report
+
+            @return: set of table names
+        """
+
+        resource = self.resource
+        rfilter = resource.rfilter
+        db = current.db
+
+        tables = set([resource.tablename])
+
+        def add(table):
+            tablename = getattr(table, "_ot", None) or table._tablename
+            if tablename in db:
+                tables.add(tablename)
+
+        # Tables joined by the filter
+        joins = rfilter.get_joins(left=False) + rfilter.get_joins(left=True)
+        for join in joins:
+            add(join.first)
+
+        # Tables of the report fields
+        selectors = [s for s in selectors if s]
+        try:
+            rfields = resource.resolve_selectors(selectors,
+                                                 extra_fields=False,
+                                                 )[0]
+        except (AttributeError, SyntaxError):
+            rfields = []
+        for rfield in rfields:
+            tablename = rfield.tname
+            if tablename in db:
+                tables.add(tablename)
+            left = rfield.left
+            if left:
+                for tn in left:
+                    for join in left[tn]:
+                        add(join.first)
+
+        return tables
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls):
+        """ Remove all items from the in-process cache """
+
+        with cls.lock:
+            cls.store.clear()
+            cls.hits = cls.misses = 0
+
 # END =========================================================================
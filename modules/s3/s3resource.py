@@ -37,6 +37,8 @@ __all__ = ("S3AxisFilter",
            )
 
 import datetime
+import os
+import re
 import sys
 
 from itertools import chain
@@ -74,7 +76,7 @@ from s3fields import S3Represent, s3_all_meta_field_names
 from s3query import FS, S3ResourceField, S3ResourceQuery, S3Joins, S3URLQuery
 from s3utils import s3_has_foreign_key, s3_get_foreign_key, s3_unicode, s3_get_last_record_id, s3_remove_last_record_id
 from s3validators import IS_ONE_OF
-from s3xml import S3XMLFormat
+from s3xml import S3XMLFormat, SEPARATORS
 
 DEBUG = False
 if DEBUG:
@@ -89,6 +91,9 @@ ogetattr = object.__getattribute__
 
 MAXDEPTH = 10
 
+# Row estimate in PostgreSQL query plans
+ESTIMATE = re.compile(r"rows=([0-9]+)")
+
 # Compact JSON encoding
 #SEPARATORS = (",", ":")
 
@@ -522,6 +527,7 @@ class S3Resource(object):
                left=None,
                orderby=None,
                groupby=None,
+               aggregate=None,
                distinct=False,
                virtual=True,
                count=False,
@@ -529,7 +535,8 @@ class S3Resource(object):
                as_rows=False,
                represent=False,
                show_links=True,
-               raw_data=False):
+               raw_data=False,
+               seek=None):
         """
             Extract data from this resource
 
@@ -539,13 +546,17 @@ class S3Resource(object):
             @param left: additional left joins required for filters
             @param orderby: orderby-expression for DAL
             @param groupby: fields to group by (overrides fields!)
+            @param aggregate: aggregate expressions to select with groupby
             @param distinct: select distinct rows
             @param virtual: include mandatory virtual fields
             @param count: include the total number of matching records
+                          (or a number to count only up to, see
+                          S3ResourceData)
             @param getids: include the IDs of all matching records
             @param as_rows: return the rows (don't extract)
             @param represent: render field value representations
             @param raw_data: include raw data in the result
+            @param seek: keyset pagination (see S3ResourceData)
         """
 
         data = S3ResourceData(self,
@@ -555,6 +566,7 @@ class S3Resource(object):
                               left=left,
                               orderby=orderby,
                               groupby=groupby,
+                              aggregate=aggregate,
                               distinct=distinct,
                               virtual=virtual,
                               count=count,
@@ -562,12 +574,76 @@ class S3Resource(object):
                               as_rows=as_rows,
                               represent=represent,
                               show_links=show_links,
-                              raw_data=raw_data)
+                              raw_data=raw_data,
+                              seek=seek)
         if as_rows:
             return data.rows
         else:
             return data
 
+    # -------------------------------------------------------------------------
+    def iter_select(self,
+                    fields,
+                    start=0,
+                    limit=None,
+                    left=None,
+                    orderby=None,
+                    chunksize=None,
+                    virtual=True,
+                    as_rows=False,
+                    represent=False,
+                    show_links=True,
+                    raw_data=False):
+        """
+            Extract data from this resource in chunks of records, so that
+            memory consumption does not grow with the size of the result
+            (e.g. for exports)
+
+            @param fields: the fields to extract (selector strings)
+            @param start: index of the first record
+            @param limit: maximum number of records
+            @param left: additional left joins required for filters
+            @param orderby: orderby-expression for DAL
+            @param chunksize: maximum number of records per chunk,
+                              defaults to the ui.export_chunk_size setting
+            @param virtual: include mandatory virtual fields
+            @param as_rows: return the rows (don't extract)
+            @param represent: render field value representations
+            @param show_links: render representations as links
+            @param raw_data: include raw data in the result
+
+            @return: generator yielding an S3ResourceData instance for
+                     each chunk of records (in order)
+        """
+
+        if chunksize is None:
+            chunksize = current.deployment_settings.get_ui_export_chunk_size()
+
+        # Determine the IDs of all matching records, in order
+        data = S3ResourceData(self,
+                              [self._id.name],
+                              start=start,
+                              limit=limit,
+                              left=left,
+                              orderby=orderby,
+                              virtual=virtual)
+        colname = data.rfields[0].colname
+        ids = [row[colname] for row in data.rows]
+        del data
+
+        # Extract the records chunk by chunk, the resource filter has
+        # already been applied, so the chunk queries only need to join
+        # the tables for the requested fields
+        for index in xrange(0, len(ids), chunksize):
+            yield S3ResourceData(self,
+                                 fields,
+                                 virtual=virtual,
+                                 as_rows=as_rows,
+                                 represent=represent,
+                                 show_links=show_links,
+                                 raw_data=raw_data,
+                                 page=ids[index:index+chunksize])
+
     # -------------------------------------------------------------------------
     def insert(self, **fields):
         """
@@ -1116,7 +1192,8 @@ class S3Resource(object):
                   left=None,
                   orderby=None,
                   distinct=False,
-                  getids=False):
+                  getids=False,
+                  seek=None):
         """
             Generate a data table of this resource
 
@@ -1128,6 +1205,9 @@ class S3Resource(object):
             @param distinct: distinct-flag for DB query
             @param getids: return the record IDs of all records matching the
                            query (used in search to create a filter)
+            @param seek: keyset pagination, True to determine the cursor
+                         for the next page (S3DataTable.cursor), or the
+                         cursor of the previous page (ignores start)
 
             @return: tuple (S3DataTable, numrows, ids), where numrows represents
                      the total number of rows in the table that match the query;
@@ -1149,6 +1229,9 @@ class S3Resource(object):
         id_repr = table._id.represent
         table._id.represent = None
 
+        # Count only up to a limit?
+        count = current.deployment_settings.get_ui_datatables_count_limit()
+
         # Extract the data
         data = self.select(selectors,
                            start=start,
@@ -1156,9 +1239,10 @@ class S3Resource(object):
                            orderby=orderby,
                            left=left,
                            distinct=distinct,
-                           count=True,
+                           count=count or True,
                            getids=getids,
-                           represent=True)
+                           represent=True,
+                           seek=seek)
 
         rows = data["rows"]
 
@@ -1179,7 +1263,11 @@ class S3Resource(object):
 
         # Generate the data table
         rfields = data["rfields"]
-        dt = S3DataTable(rfields, rows, orderby=orderby, empty=empty)
+        dt = S3DataTable(rfields,
+                         rows,
+                         orderby=orderby,
+                         empty=empty,
+                         cursor=data.cursor)
 
         return dt, data["numrows"], data["ids"]
 
@@ -1250,7 +1338,7 @@ class S3Resource(object):
         return dl, numrows, data["ids"]
 
     # -------------------------------------------------------------------------
-    def pivottable(self, rows, cols, layers, strict=True):
+    def pivottable(self, rows, cols, layers, strict=True, db_aggregate=None):
         """
             Generate a pivot table of this resource.
 
@@ -1260,13 +1348,39 @@ class S3Resource(object):
                            the aggregation layers
             @param strict: filter out dimension values which don't match
                            the resource filter
+            @param db_aggregate: compute the aggregates in the database
+                                 where possible (None for deployment
+                                 setting)
 
             @return: an S3PivotTable instance
 
             Supported methods: see S3PivotTable
         """
 
-        return S3PivotTable(self, rows, cols, layers, strict=strict)
+        return S3PivotTable(self, rows, cols, layers,
+                            strict=strict,
+                            db_aggregate=db_aggregate)
+
+    # -------------------------------------------------------------------------
+    def choropleth(self, fact="count(id)", level="L0", tolerance=None):
+        """
+            Aggregate this resource by admin areas, e.g. for choropleth
+            maps (spatial join in the database, cached per filter)
+
+            @param fact: the fact to aggregate as "method(selector)",
+                         e.g. "count(id)" or "sum(value)"
+            @param level: the target admin level ("L0".."L5")
+            @param tolerance: the simplification tolerance for the
+                              area geometries
+
+            @return: an S3Choropleth instance, use as_dict() or json()
+                     to get the GeoJSON FeatureCollection
+
+            Supported methods: see S3Choropleth
+        """
+
+        from s3gis import S3Choropleth
+        return S3Choropleth(self, fact, level=level, tolerance=tolerance)
 
     # -------------------------------------------------------------------------
     def json(self,
@@ -1703,6 +1817,7 @@ class S3Resource(object):
                    pretty_print=False,
                    location_data=None,
                    map_data=None,
+                   orderby=None,
                    **args):
         """
             Export this resource as S3XML
@@ -1732,6 +1847,8 @@ class S3Resource(object):
             @param location_data: dictionary of location data which has been
                                   looked-up in bulk ready for xml.gis_encode()
             @param map_data: dictionary of options which can be read by the map
+            @param orderby: order of the master records (default: by
+                            modification date if msince is given)
             @param args: dict of arguments to pass to the XSLT stylesheet
         """
 
@@ -1740,6 +1857,22 @@ class S3Resource(object):
         output = None
         args = Storage(args)
 
+        # Standard JSON formats can be encoded without XSLT
+        native = self.native_json(stylesheet, args) if as_json else None
+        if native == "geojson":
+            output = self.export_geojson(start=start,
+                                         limit=limit,
+                                         msince=msince,
+                                         filters=filters,
+                                         location_data=location_data,
+                                         map_data=map_data,
+                                         pretty_print=pretty_print)
+            if output is not None:
+                return output
+        elif native == "s3json":
+            # Identity transformation => convert the S3XML tree directly
+            stylesheet = None
+
         xmlformat = S3XMLFormat(stylesheet) if stylesheet else None
 
         # Export as element tree
@@ -1760,7 +1893,8 @@ class S3Resource(object):
                                 maxbounds=maxbounds,
                                 xmlformat=xmlformat,
                                 location_data=location_data,
-                                map_data=map_data)
+                                map_data=map_data,
+                                orderby=orderby)
         #if DEBUG:
             #end = datetime.datetime.now()
             #duration = end - _start
@@ -1807,6 +1941,238 @@ class S3Resource(object):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def native_json(stylesheet, args):
+        """
+            Check whether a JSON export uses the standard (non-customized)
+            export stylesheet of its format, so that it can be encoded
+            natively rather than through XSLT
+
+            @param stylesheet: the stylesheet (pathname)
+            @param args: the stylesheet parameters
+
+            @return: the format ("geojson" or "s3json"), or None if
+                     the export requires the XSLT transformation
+        """
+
+        if not isinstance(stylesheet, basestring) or \
+           "component" in args or "mode" in args:
+            return None
+
+        folder = current.request.folder
+        path = os.path.abspath(stylesheet)
+        for format in ("geojson", "s3json"):
+            standard = os.path.join(folder, "static", "formats", format,
+                                    "export.xsl")
+            if path == os.path.abspath(standard):
+                return format
+        return None
+
+    # -------------------------------------------------------------------------
+    def export_geojson(self,
+                       start=None,
+                       limit=None,
+                       msince=None,
+                       filters=None,
+                       location_data=None,
+                       map_data=None,
+                       pretty_print=False):
+        """
+            Export this resource as GeoJSON, directly from the records and
+            their bulk-looked-up location data, i.e. without building and
+            transforming an S3XML tree; produces the same JSON as the XSLT
+            path (static/formats/geojson/export.xsl + S3XML.tree2json)
+
+            @param start: index of the first record to export
+            @param limit: maximum number of records to export
+            @param msince: minimum modification date of the records
+            @param filters: additional URL filters (Sync)
+            @param location_data: dictionary of location data which has
+                                  been looked-up in bulk
+            @param map_data: dictionary of options which can be read by
+                             the map
+            @param pretty_print: insert newlines/indentation in the output
+
+            @return: the GeoJSON (string), or None if the resource requires
+                     the XSLT transformation (special GIS tables, post-render
+                     hooks, or Sync options)
+        """
+
+        tablename = self.tablename
+        if msince is not None or filters or \
+           tablename in ("gis_location",
+                         "gis_cache",
+                         "gis_feature_query",
+                         "gis_theme_data",
+                         ) or \
+           tablename.startswith("gis_layer_shapefile") or \
+           self.get_config("xml_post_render"):
+            return None
+
+        xml = current.xml
+        table = self.table
+
+        # Filter for MCI >= 0 (setting)
+        if xml.filter_mci and "mci" in table.fields:
+            self.add_filter(table.mci >= 0)
+
+        # Initialize export metadata
+        self.muntil = None
+
+        # Load the records (only IDs required)
+        self.load(fields=[table._id.name],
+                  start=start,
+                  limit=limit,
+                  virtual=False,
+                  cacheable=True)
+
+        results = self.results = self.count()
+
+        if not location_data:
+            if results > current.deployment_settings.get_gis_max_features():
+                headers = {"Content-Type": "application/json"}
+                message = "Too Many Records"
+                status = 509
+                raise HTTP(status,
+                           body=xml.json_message(success=False,
+                                                 statuscode=status,
+                                                 message=message),
+                           web2py_error=message,
+                           **headers)
+            location_data = current.gis.get_location_data(self) or {}
+
+        if results > 0:
+            record_ids = self._ids
+            if len(record_ids) == 1:
+                # Single Feature
+                feature = self.geojson_feature(record_ids[0], location_data)
+                output = feature or {}
+            else:
+                output = {"type": "FeatureCollection", "features": None}
+                if map_data:
+                    output["s3"] = map_data
+                features = []
+                append = features.append
+                for record_id in record_ids:
+                    feature = self.geojson_feature(record_id, location_data)
+                    if feature:
+                        append(feature)
+                if features:
+                    output["features"] = features
+                else:
+                    del output["features"]
+        else:
+            output = {}
+
+        if pretty_print:
+            js = json.dumps(output, indent=4)
+            return "\n".join([l.rstrip() for l in js.splitlines()])
+
+        if "features" not in output:
+            return json.dumps(output, separators=SEPARATORS)
+
+        # Encode feature by feature, keeping the key order of the dict
+        dumps = lambda obj: json.dumps(obj, separators=SEPARATORS)
+        items = []
+        for key in output:
+            if key == "features":
+                value = "[%s]" % ",".join(dumps(f) for f in output[key])
+            else:
+                value = dumps(output[key])
+            items.append("%s:%s" % (dumps(key), value))
+        return "{%s}" % ",".join(items)
+
+    # -------------------------------------------------------------------------
+    def geojson_feature(self, record_id, location_data):
+        """
+            Encode a record of this resource as GeoJSON Feature, as
+            S3XML.gis_encode + static/formats/geojson/export.xsl would
+
+            @param record_id: the record ID
+            @param location_data: the location data from
+                                  GIS.get_location_data
+
+            @return: the Feature (dict), or None if the record
+                     has no geometry
+        """
+
+        tablename = self.tablename
+
+        current.audit("read", self.prefix, self.name,
+                      record=record_id, representation="xml")
+
+        latlons = location_data.get("latlons", [])
+        geojsons = location_data.get("geojsons", [])
+        attributes = location_data.get("attributes", [])
+        markers = location_data.get("markers", [])
+        styles = location_data.get("styles", [])
+
+        # Geometry
+        if tablename in geojsons:
+            geojson = geojsons[tablename].get(record_id)
+            if not geojson or geojson == "null":
+                return None
+            geometry = json.loads(geojson)
+        elif tablename in latlons:
+            latlon = latlons[tablename].get(record_id)
+            if not latlon or latlon[0] is None or latlon[1] is None:
+                return None
+            # Coordinates are strings, like in the XSLT output
+            geometry = {"type": "Point",
+                        "coordinates": ["%.4f" % latlon[1],
+                                        "%.4f" % latlon[0],
+                                        ],
+                        }
+        else:
+            raise RuntimeError("Bulk lookup of GeoJSON or Lat/Lon data failed for %s" % tablename)
+
+        properties = {"id": record_id}
+
+        # Marker
+        if tablename in markers:
+            _markers = markers[tablename]
+            if _markers:
+                if _markers.get("image", None):
+                    # Single Marker here
+                    m = _markers
+                else:
+                    # We have a separate Marker per-Feature
+                    m = _markers.get(record_id)
+                if m:
+                    properties["marker_url"] = "/%s/static/img/markers/%s" % \
+                                               (current.request.application,
+                                                m["image"])
+                    properties["marker_height"] = str(m["height"])
+                    properties["marker_width"] = str(m["width"])
+
+        # Style
+        if tablename in styles:
+            style = styles[tablename].get(record_id)
+            if style:
+                style = json.loads(style)
+                if style:
+                    properties["style"] = style
+
+        # Attributes
+        if tablename in attributes:
+            attrs = attributes[tablename].get(record_id)
+            if attrs:
+                for key, value in attrs.items():
+                    if value is None or isinstance(value, bool):
+                        # Not numeric => text like in the XSLT output
+                        value = json.dumps(value)
+                    elif isinstance(value, (int, long, float)):
+                        if int(value) == value:
+                            value = int(value)
+                    if value is not None and value != "":
+                        properties[key] = value
+
+        return {"type": "Feature",
+                "geometry": geometry,
+                "properties": properties,
+                }
+
     # -------------------------------------------------------------------------
     def export_tree(self,
                     start=0,
@@ -1823,6 +2189,7 @@ class S3Resource(object):
                     xmlformat=None,
                     location_data=None,
                     map_data=None,
+                    orderby=None,
                     ):
         """
             Export the resource as element tree
@@ -1848,6 +2215,8 @@ class S3Resource(object):
             @param location_data: dictionary of location data which has been
                                   looked-up in bulk ready for xml.gis_encode()
             @param map_data: dictionary of options which can be read by the map
+            @param orderby: order of the master records (default: by
+                            modification date if msince is given)
         """
 
         xml = current.xml
@@ -1878,10 +2247,9 @@ class S3Resource(object):
         self.results = 0
 
         # Load slice
-        if msince is not None and "modified_on" in table.fields:
+        if orderby is None and \
+           msince is not None and "modified_on" in table.fields:
             orderby = "%s ASC" % table["modified_on"]
-        else:
-            orderby = None
 
         # Fields to load
         if xmlformat:
@@ -2433,6 +2801,7 @@ class S3Resource(object):
                    conflict_policy=None,
                    last_sync=None,
                    onconflict=None,
+                   batch_size=None,
                    **args):
         """
             XML Importer
@@ -2454,7 +2823,15 @@ class S3Resource(object):
             @param conflict_policy: policy for conflict resolution (sync)
             @param last_sync: last synchronization datetime (sync)
             @param onconflict: callback hook for conflict resolution (sync)
+            @param batch_size: for CSV/XLS imports, import and commit the
+                               source in batches of this number of rows
+                               (default: settings.base.import_batch_size)
             @param args: parameters to pass to the transformation stylesheet
+
+            @note: batch-wise imports commit each batch separately, so
+                   records of previous batches remain imported if a later
+                   batch fails; references across batches are resolved by
+                   deduplication (like in separate imports)
         """
 
         # Check permission for the resource
@@ -2466,8 +2843,12 @@ class S3Resource(object):
 
         xml = current.xml
         tree = None
+        batches = None
         self.job = None
 
+        if batch_size is None:
+            batch_size = current.deployment_settings.get_base_import_batch_size()
+
         if not job_id:
 
             # Additional stylesheet parameters
@@ -2477,9 +2858,21 @@ class S3Resource(object):
                         name=self.name,
                         utcnow=s3_format_datetime())
 
-            # Build import tree
             if not isinstance(source, (list, tuple)):
                 source = [source]
+
+            if batch_size and format in ("csv", "xls") and \
+               stylesheet is not None and commit_job and not id:
+                # Import in batches
+                batches = self.import_batches(source,
+                                              format,
+                                              stylesheet,
+                                              batch_size,
+                                              extra_data=extra_data,
+                                              **args)
+                source = []
+
+            # Build import tree
             for item in source:
                 if isinstance(item, (list, tuple)):
                     resourcename, s = item[:2]
@@ -2530,16 +2923,25 @@ class S3Resource(object):
         response = current.response
         # Flag to let onvalidation/onaccept know this is coming from a Bulk Import
         response.s3.bulk = True
-        success = self.import_tree(id, tree,
-                                   ignore_errors=ignore_errors,
-                                   job_id=job_id,
-                                   commit_job=commit_job,
-                                   delete_job=delete_job,
-                                   strategy=strategy,
-                                   update_policy=update_policy,
-                                   conflict_policy=conflict_policy,
-                                   last_sync=last_sync,
-                                   onconflict=onconflict)
+        if batches is not None:
+            success = self.import_stream(batches,
+                                         ignore_errors=ignore_errors,
+                                         strategy=strategy,
+                                         update_policy=update_policy,
+                                         conflict_policy=conflict_policy,
+                                         last_sync=last_sync,
+                                         onconflict=onconflict)
+        else:
+            success = self.import_tree(id, tree,
+                                       ignore_errors=ignore_errors,
+                                       job_id=job_id,
+                                       commit_job=commit_job,
+                                       delete_job=delete_job,
+                                       strategy=strategy,
+                                       update_policy=update_policy,
+                                       conflict_policy=conflict_policy,
+                                       last_sync=last_sync,
+                                       onconflict=onconflict)
         response.s3.bulk = False
 
         self.files = Storage()
@@ -2576,6 +2978,94 @@ class S3Resource(object):
             return xml.json_message(False, 400,
                                     message=self.error, tree=tree)
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def import_batches(source, format, stylesheet, batch_size,
+                       extra_data=None, **args):
+        """
+            Generator to read CSV/XLS sources in batches of rows and
+            transform each batch into an S3XML tree
+
+            @param source: list of sources, like in import_xml
+            @param format: the source format ("csv" or "xls")
+            @param stylesheet: the transformation stylesheet
+            @param batch_size: the maximum number of rows per batch
+            @param extra_data: dict of extra cols to add to each row
+            @param args: parameters to pass to the stylesheet
+
+            @return: iterator over the root elements of the S3XML trees
+        """
+
+        xml = current.xml
+
+        for item in source:
+            if isinstance(item, (list, tuple)):
+                resourcename, s = item[:2]
+            else:
+                resourcename, s = None, item
+            if format == "csv":
+                trees = xml.csv2trees(s,
+                                      resourcename=resourcename,
+                                      extra_data=extra_data,
+                                      batch_size=batch_size)
+            else:
+                t = xml.xls2tree(s,
+                                 resourcename=resourcename,
+                                 extra_data=extra_data)
+                trees = xml.split_table(t, batch_size)
+            for t in trees:
+                t = xml.transform(t, stylesheet, **args)
+                _debug(t)
+                if not t:
+                    raise SyntaxError(xml.error)
+                yield t.getroot()
+
+    # -------------------------------------------------------------------------
+    def import_stream(self, trees, ignore_errors=False, **options):
+        """
+            Import a sequence of S3XML trees (e.g. batches of a large
+            CSV source) as separate import jobs, and commit each of
+            them to the database, so that memory use is bounded by
+            the batch size rather than by the size of the source
+
+            @param trees: iterable of S3XML root elements
+            @param ignore_errors: continue at errors (=skip invalid elements)
+            @param options: import options for import_tree (strategy,
+                            update_policy, conflict_policy, last_sync,
+                            onconflict)
+
+            @return: True if successful, otherwise False - with the errors
+                     of all batches in self.error and self.error_tree
+        """
+
+        db = current.db
+
+        success = True
+        error = None
+        error_tree = None
+
+        for tree in trees:
+            result = self.import_tree(None, tree,
+                                      ignore_errors=ignore_errors,
+                                      commit_job=True,
+                                      **options)
+            if self.error:
+                error = self.error
+            if self.error_tree is not None:
+                # Collect the errors of all batches in one tree
+                if error_tree is None:
+                    error_tree = self.error_tree
+                else:
+                    error_tree.extend(list(self.error_tree))
+            if not result:
+                success = False
+                break
+            db.commit()
+
+        self.error = error
+        self.error_tree = error_tree
+        return success
+
     # -------------------------------------------------------------------------
     def import_tree(self, id, tree,
                     job_id=None,
@@ -3006,6 +3496,54 @@ class S3Resource(object):
         """
 
         db = current.db
+        xml = current.xml
+        UID = xml.UID
+
+        pvalues = cls.original_keys(table, record)
+
+        # Build match query
+        query = None
+        for f in pvalues:
+            if f == UID:
+                continue
+            _query = (table[f] == pvalues[f])
+            if query is not None:
+                query = query | _query
+            else:
+                query = _query
+
+        fields = cls.import_fields(table, pvalues, mandatory=mandatory)
+
+        # Try to find exactly one match by non-UID unique keys
+        if query is not None:
+            original = db(query).select(limitby=(0, 2), *fields)
+            if len(original) == 1:
+                return original.first()
+
+        # If no match, then try to find a UID-match
+        if UID in pvalues:
+            uid = xml.import_uid(pvalues[UID])
+            query = (table[UID] == uid)
+            original = db(query).select(limitby=(0, 1), *fields).first()
+            if original:
+                return original
+
+        # No match or multiple matches
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def original_keys(table, record):
+        """
+            Get the values for unique fields (including the UID) from
+            a record, helper method for original()
+
+            @param table: the table
+            @param record: the record as dict or S3XML Element
+
+            @return: Storage {fieldname: value}
+        """
+
         xml = current.xml
         xml_decode = xml.xml_decode
 
@@ -3042,35 +3580,7 @@ class S3Resource(object):
         else:
             raise TypeError
 
-        # Build match query
-        query = None
-        for f in pvalues:
-            if f == UID:
-                continue
-            _query = (table[f] == pvalues[f])
-            if query is not None:
-                query = query | _query
-            else:
-                query = _query
-
-        fields = cls.import_fields(table, pvalues, mandatory=mandatory)
-
-        # Try to find exactly one match by non-UID unique keys
-        if query is not None:
-            original = db(query).select(limitby=(0, 2), *fields)
-            if len(original) == 1:
-                return original.first()
-
-        # If no match, then try to find a UID-match
-        if UID in pvalues:
-            uid = xml.import_uid(pvalues[UID])
-            query = (table[UID] == uid)
-            original = db(query).select(limitby=(0, 1), *fields).first()
-            if original:
-                return original
-
-        # No match or multiple matches
-        return None
+        return pvalues
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -4522,6 +5032,16 @@ class S3ResourceFilter(object):
                                       (gtable.lon < float(maxLon)) & \
                                       (gtable.lat > float(minLat)) & \
                                       (gtable.lat < float(maxLat))
+                        if "quadkey" in gtable.fields:
+                            # Use the bounding box index to narrow down
+                            # the range comparisons
+                            bbox_filter = current.gis.query_quadkey(gtable,
+                                                                    minLon,
+                                                                    minLat,
+                                                                    maxLon,
+                                                                    maxLat,
+                                                                    ) & \
+                                          bbox_filter
 
                     # Add bbox filter to query
                     if query is None:
@@ -4682,6 +5202,7 @@ class S3ResourceData(object):
                  left=None,
                  orderby=None,
                  groupby=None,
+                 aggregate=None,
                  distinct=False,
                  virtual=True,
                  count=False,
@@ -4689,7 +5210,9 @@ class S3ResourceData(object):
                  as_rows=False,
                  represent=False,
                  show_links=True,
-                 raw_data=False):
+                 raw_data=False,
+                 page=None,
+                 seek=None):
         """
             Constructor, extracts (and represents) data from a resource
 
@@ -4700,19 +5223,31 @@ class S3ResourceData(object):
             @param left: additional left joins required for custom filters
             @param orderby: orderby-expression for DAL
             @param groupby: fields to group by (overrides fields!)
+            @param aggregate: list of aggregate expressions (e.g.
+                              field.sum()) to select together with the
+                              groupby fields, the aggregated fields must
+                              be included in fields
             @param distinct: select distinct rows
             @param virtual: include mandatory virtual fields
-            @param count: include the total number of matching records
+            @param count: include the total number of matching records,
+                          or a number to count only up to that number
+                          and estimate the total beyond (approximate count)
             @param getids: include the IDs of all matching records
             @param as_rows: return the rows (don't extract/represent)
             @param represent: render field value representations
             @param raw_data: include raw data in the result
+            @param page: list of record IDs to extract (in this order),
+                         the resource filter is not applied again, i.e.
+                         these records must have been filtered before
+            @param seek: keyset pagination, True to order by a unique key
+                         and determine the cursor for the next page
+                         (self.cursor), or the cursor of the previous page
+                         to continue after its last record (ignores start)
 
             @note: as_rows / groupby prevent automatic splitting of
                    large multi-table joins, so use with care!
-            @note: with groupby, only the groupby fields will be returned
-                   (i.e. fields will be ignored), because aggregates are
-                   not supported (yet)
+            @note: with groupby, only the groupby fields and aggregates
+                   will be returned (i.e. fields will be ignored)
         """
 
         # The resource
@@ -4735,8 +5270,13 @@ class S3ResourceData(object):
         # Joins from filters
         # @note: in components, rfilter is None until after get_query!
         rfilter = resource.rfilter
-        filter_tables = set(ijoins.add(rfilter.get_joins(left=False)))
-        filter_tables.update(ljoins.add(rfilter.get_joins(left=True)))
+        if page is None:
+            filter_tables = set(ijoins.add(rfilter.get_joins(left=False)))
+            filter_tables.update(ljoins.add(rfilter.get_joins(left=True)))
+        else:
+            # Pre-filtered page of records
+            master_query = query = table._id.belongs(page)
+            filter_tables = set()
 
         # Left joins from caller
         master_tables = set(ljoins.add(left))
@@ -4745,7 +5285,10 @@ class S3ResourceData(object):
         resolve = resource.resolve_selectors
 
         # Virtual fields and extra fields required by filter
-        virtual_fields = rfilter.get_fields()
+        if page is None:
+            virtual_fields = rfilter.get_fields()
+        else:
+            virtual_fields = []
         vfields, vijoins, vljoins, d = resolve(virtual_fields, show=False)
         extra_tables = set(ijoins.extend(vijoins))
         extra_tables.update(ljoins.extend(vljoins))
@@ -4771,8 +5314,10 @@ class S3ResourceData(object):
             filter_tables.update(tables)
 
         # Virtual fields filter and limitby
-        vfltr = resource.get_filter()
-        if vfltr is None:
+        vfltr = resource.get_filter() if page is None else None
+        if page is not None:
+            limitby = None
+        elif vfltr is None:
             limitby = resource.limitby(start=start, limit=limit)
         else:
             # Skip start/limit in master query if we filter by virtual
@@ -4780,6 +5325,26 @@ class S3ResourceData(object):
             # filter by virtual fields, then apply page limits
             limitby = None
 
+        # Keyset pagination
+        keys = None
+        if seek and limitby and not getids and not groupby:
+            keys = self.keyset(orderby)
+        total_query = query
+        if keys:
+            # Order by the key (must be unique)
+            pkey = str(table._id)
+            if orderby is None:
+                orderby, orderby_aggr, orderby_fields = [], [], []
+            if pkey not in [str(f) for f in orderby_fields]:
+                orderby.append(table._id)
+                orderby_aggr.append(table._id)
+                orderby_fields.append(table._id)
+
+            if isinstance(seek, (list, tuple)) and len(seek) == len(keys):
+                # Continue after the last record of the previous page
+                master_query = query = query & self.seek_query(keys, seek)
+                limitby = resource.limitby(start=0, limit=limit)
+
         # Filter Query:
         # If we need to determine the number and/or ids of all matching
         # records, but not to extract all records, then we run a
@@ -4792,12 +5357,50 @@ class S3ResourceData(object):
         filter_ljoins = ljoins.as_list(tablenames=filter_tables,
                                        aqueries=aqueries)
 
-        ids = page = totalrows = None
-        if getids or count or ljoins or ijoins:
+        if groupby and aggregate and (filter_ijoins or filter_ljoins):
+            # Filter joins can produce multiple rows per record, which
+            # must not be counted more than once in aggregates => use the
+            # filter query as sub-select instead of joining the filter
+            # tables in the master query
+            subselect = current.db(query)._select(table._id,
+                                                  join=filter_ijoins,
+                                                  left=filter_ljoins)
+            master_query = query = table._id.belongs(subselect)
+            filter_ijoins = filter_ljoins = None
+
+        if page is not None:
+            ids = page
+            totalrows = len(page)
+        else:
+            ids = totalrows = None
+        if page is None and (getids or count or ljoins or ijoins):
 
             if not groupby and \
                not vfltr and \
-               (count or limitby or extra_tables != filter_tables):
+               limitby and \
+               not getids:
+
+                # Count the matching records (only if requested)
+                if count:
+                    count_limit = None if count is True else count
+                    totalrows = self.count_query(total_query,
+                                                 join=filter_ijoins,
+                                                 left=filter_ljoins,
+                                                 limit=count_limit or None)
+
+                # Extract only the record IDs of the requested page
+                if ljoins or ijoins:
+                    ids = self.filter_query(query,
+                                            join=filter_ijoins,
+                                            left=filter_ljoins,
+                                            getids=True,
+                                            orderby=orderby_aggr,
+                                            limitby=limitby)[1]
+                    page = ids
+
+            elif not groupby and \
+                 not vfltr and \
+                 (count or limitby or extra_tables != filter_tables):
 
                 # Execute the filter query
                 totalrows, ids = self.filter_query(query,
@@ -4810,17 +5413,19 @@ class S3ResourceData(object):
                         page = ids[limitby[0]:limitby[1]]
                     else:
                         page = ids
-                    # Once we have the ids, we don't need to apply the
-                    # filter query (and the joins it requires) again,
-                    # but can use a simplified master query:
-                    master_query = table._id.belongs(page)
-
-                    # Order and limits are also determined by the page
-                    # (which is an ordered list of record IDs), so we
-                    # do not need to retain them (and join orderby
-                    # fields in subsequent queries) either.
-                    orderby = None
-                    limitby = None
+
+            if page is not None:
+                # Once we have the ids, we don't need to apply the
+                # filter query (and the joins it requires) again,
+                # but can use a simplified master query:
+                master_query = table._id.belongs(page)
+
+                # Order and limits are also determined by the page
+                # (which is an ordered list of record IDs), so we
+                # do not need to retain them (and join orderby
+                # fields in subsequent queries) either.
+                orderby = None
+                limitby = None
 
         # If we don't use a simplified master_query, we must include
         # all necessary joins for filter and orderby (=filter_tables) in
@@ -4835,7 +5440,8 @@ class S3ResourceData(object):
                                                                vfields,
                                                                master_tables,
                                                                as_rows=as_rows,
-                                                               groupby=groupby)
+                                                               groupby=groupby,
+                                                               aggregate=aggregate)
         # Additional tables to join?
         if tables:
             master_tables.update(tables)
@@ -4914,8 +5520,20 @@ class S3ResourceData(object):
         self.rfields = dfields
         self.numrows = 0 if totalrows is None else totalrows
         self.ids = ids
+        self.cursor = None
 
         if groupby or as_rows:
+            if rows and page is not None and not groupby:
+                # Restore the order of the page
+                position = dict((record_id, i)
+                                for i, record_id in enumerate(page))
+                fn = table._id.name
+                key = lambda record: position.get(record[tablename][fn])
+                rows = Rows(db,
+                            records=sorted(rows.records, key=key),
+                            colnames=rows.colnames,
+                            compact=rows.compact)
+
             # Just store the rows, no further queries or extraction
             self.rows = rows
 
@@ -4985,7 +5603,12 @@ class S3ResourceData(object):
                             data = data[0]
                         result[colname] = data
 
-            self.rows = [results[record_id] for record_id in page]
+            self.rows = [results[record_id]
+                         for record_id in page if record_id in results]
+
+            # Cursor for keyset pagination of the next page
+            if keys and page:
+                self.cursor = self.get_cursor(keys, page[-1])
 
     # -------------------------------------------------------------------------
     def init_field_data(self, rfields):
@@ -5146,7 +5769,8 @@ class S3ResourceData(object):
                      join=None,
                      left=None,
                      getids=False,
-                     orderby=None):
+                     orderby=None,
+                     limitby=None):
         """
             Execute a query to determine the number/record IDs of all
             matching rows
@@ -5156,6 +5780,7 @@ class S3ResourceData(object):
             @param left: the left joins for this query
             @param getids: also extract the IDs if all matching records
             @param orderby: ORDERBY expression for this query
+            @param limitby: LIMITBY for this query (with getids only)
 
             @return: tuple of (TotalNumberOfRecords, RecordIDs)
         """
@@ -5184,6 +5809,7 @@ class S3ResourceData(object):
                                 distinct=distinct,
                                 orderby=orderby,
                                 groupby=groupby,
+                                limitby=limitby if getids else None,
                                 cacheable=True)
 
         # Restore the virtual fields
@@ -5199,13 +5825,146 @@ class S3ResourceData(object):
 
         return totalrows, ids
 
+    # -------------------------------------------------------------------------
+    def count_query(self, query, join=None, left=None, limit=None):
+        """
+            Count the matching records, optionally only up to a limit
+            beyond which an estimate is good enough (approximate count)
+
+            @param query: the query
+            @param join: the inner joins for this query
+            @param left: the left joins for this query
+            @param limit: count only up to this number of records, and
+                          use the query planner estimate beyond (if
+                          available, otherwise return limit + 1)
+
+            @return: the number of matching records
+        """
+
+        if not limit:
+            return self.filter_query(query, join=join, left=left)[0]
+
+        db = current.db
+        table = self.table
+
+        # Count only up to limit + 1 records
+        sql = db(query)._select(table._id,
+                                join=join,
+                                left=left,
+                                distinct=True,
+                                limitby=(0, limit + 1))
+        result = db.executesql("SELECT COUNT(*) FROM (%s) capped;" %
+                               sql.rstrip().rstrip(";"))
+        numrows = result[0][0]
+
+        if numrows > limit and db._dbname == "postgres":
+            # Use the query planner estimate for the total number
+            sql = db(query)._select(table._id,
+                                    join=join,
+                                    left=left,
+                                    distinct=True)
+            try:
+                plan = db.executesql("EXPLAIN %s" % sql)
+                estimate = int(ESTIMATE.search(plan[0][0]).group(1))
+            except (AttributeError, IndexError, ValueError):
+                pass
+            else:
+                numrows = max(numrows, estimate)
+
+        return numrows
+
+    # -------------------------------------------------------------------------
+    def keyset(self, orderby):
+        """
+            Determine the key for keyset pagination from the ORDERBY,
+            the key is unique because it always ends with the record ID
+
+            @param orderby: the orderby expression (resolved into Fields)
+
+            @return: list of tuples (Field, descending), or None if the
+                     ORDERBY does not support keyset pagination (i.e.
+                     contains expressions, fields in other tables or
+                     fields which can be NULL)
+        """
+
+        db = current.db
+
+        table = self.table
+        tablename = table._tablename
+        pkey = str(table._id)
+
+        keys = []
+        for expression in orderby or []:
+            if isinstance(expression, Field):
+                field, descending = expression, False
+            elif type(expression) is Expression and \
+                 expression.op == db._adapter.INVERT and \
+                 isinstance(expression.first, Field):
+                field, descending = expression.first, True
+            else:
+                return None
+            fname = str(field)
+            if fname.split(".", 1)[0] != tablename:
+                return None
+            keys.append((field, descending))
+            if fname == pkey:
+                # Unique => subsequent fields are irrelevant
+                return keys
+            elif not field.notnull:
+                return None
+
+        keys.append((table._id, False))
+        return keys
+
+    # -------------------------------------------------------------------------
+    def get_cursor(self, keys, record_id):
+        """
+            Get the key values of a record (=keyset pagination cursor)
+
+            @param keys: the key as list of tuples (Field, descending)
+            @param record_id: the record ID
+
+            @return: list of key values, or None if the record
+                     could not be found
+        """
+
+        fields = [field for field, descending in keys]
+        row = current.db(self.table._id == record_id).select(limitby = (0, 1),
+                                                             *fields).first()
+        if row:
+            return [row[field.name] for field in fields]
+        else:
+            return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def seek_query(keys, values):
+        """
+            Construct a query for all records after the record with the
+            given key values (in key order)
+
+            @param keys: the key as list of tuples (Field, descending)
+            @param values: the key values
+
+            @return: the Query
+        """
+
+        query = None
+        for (field, descending), value in reversed(zip(keys, values)):
+            q = (field < value) if descending else (field > value)
+            if query is not None:
+                q |= (field == value) & query
+            query = q
+        return query
+
     # -------------------------------------------------------------------------
     def master_fields(self,
                       dfields,
                       vfields,
                       joined_tables,
                       as_rows=False,
-                      groupby=None):
+                      groupby=None,
+                      aggregate=None):
         """
             Find all tables and fields to retrieve in the master query
 
@@ -5214,6 +5973,7 @@ class S3ResourceData(object):
             @param joined_tables: the tables joined in the master query
             @param as_rows: whether to produce web2py Rows
             @param groupby: the GROUPBY expression from the caller
+            @param aggregate: aggregate expressions to select with groupby
 
             @return: tuple (tables, fields, extract, groupby):
                      tables: the tables required to join
@@ -5264,23 +6024,18 @@ class S3ResourceData(object):
                 fields[fname] = f
 
                 # Do we need to join additional tables?
-                if tname == tablename:
-                    # no join required
-                    continue
-                else:
-                    # Get joins from dfields
-                    tnames = None
-                    for dfield in dfields:
-                        if dfield.colname == fname:
-                            tnames = self.rfield_tables(dfield)
-                            break
-                if tnames:
-                    tables |= tnames
-                else:
-                    # Join at least the table that holds the fields
-                    tables.add(tname)
+                tables |= self._required_tables(f, tname, dfields)
+
+            # Add the aggregates, joining the tables of the aggregated fields
+            if aggregate:
+                for expression in aggregate:
+                    f = expression.first
+                    if not isinstance(f, Field):
+                        continue
+                    fields[str(expression)] = expression
+                    tables |= self._required_tables(f, f.tablename, dfields)
 
-            # Only extract GROUPBY fields (as we don't support aggregates)
+            # Only extract GROUPBY fields and aggregates
             extract = set(fields.keys())
 
         else:
@@ -5305,6 +6060,35 @@ class S3ResourceData(object):
 
         return tables, fields, extract, groupby
 
+    # -------------------------------------------------------------------------
+    def _required_tables(self, field, tname, dfields):
+        """
+            Find all tables which need to be joined in the master query
+            in order to GROUPBY or aggregate a field
+
+            @param field: the Field
+            @param tname: the name of the table containing the field
+            @param dfields: the requested fields (S3ResourceFields)
+
+            @return: a set of tablenames
+        """
+
+        if tname == self.resource.table._tablename:
+            # no join required
+            return set()
+
+        # Get joins from dfields
+        fname = str(field)
+        tnames = None
+        for dfield in dfields:
+            if dfield.colname == fname:
+                tnames = self.rfield_tables(dfield)
+                break
+        if not tnames:
+            # Join at least the table that holds the field
+            tnames = set([tname])
+        return tnames
+
     # -------------------------------------------------------------------------
     def joined_fields(self, all_fields, master_fields):
         """
@@ -27,11 +27,14 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import base64
+import hashlib
 import sys
 import urllib, urllib2
 import datetime
 import time
 import traceback
+import zlib
 
 try:
     from cStringIO import StringIO # Faster, where available
@@ -55,7 +58,7 @@ except ImportError:
 from gluon import *
 from gluon.storage import Storage
 
-from s3datetime import s3_parse_datetime, s3_utc
+from s3datetime import s3_format_datetime, s3_parse_datetime, s3_utc
 from s3rest import S3Method
 from s3import import S3ImportItem
 from s3query import S3URLQuery
@@ -74,6 +77,9 @@ else:
 class S3Sync(S3Method):
     """ Synchronization Handler """
 
+    # Format of datetimes in continuation tokens (keeping microseconds)
+    TOKEN_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
     # -------------------------------------------------------------------------
     def __init__(self):
         """ Constructor """
@@ -94,6 +100,10 @@ class S3Sync(S3Method):
 
         if r.method == "sync":
 
+            # Tell the peer which request content encodings we accept
+            # (RFC 7694), so it can compress pushed data
+            current.response.headers["Accept-Encoding"] = "gzip, deflate"
+
             if r.http == "GET":
                 # Incoming pull
                 output = self.__send(r, **attr)
@@ -231,6 +241,7 @@ class S3Sync(S3Method):
 
             _debug("S3Sync.synchronize: %s done" % task.resource_name)
 
+        connector.close()
         return success
 
     # -------------------------------------------------------------------------
@@ -368,25 +379,87 @@ class S3Sync(S3Method):
         if not filters:
             filters = None
 
+        # Pull in pages: limit without start => continue with the
+        # token from the previous page (rather than a start index,
+        # which would skip records modified while paging)
+        paged = bool(limit) and start is None
+        orderby = None
+        if paged:
+            table = resource.table
+            pkey = table._id
+            token = _vars.get("next", None)
+            if token:
+                try:
+                    muntil, mtime, last_id = self.decode_token(token)
+                except (TypeError, ValueError):
+                    r.error(400, "Invalid continuation token")
+            else:
+                muntil = datetime.datetime.utcnow().replace(microsecond=0)
+                mtime = last_id = None
+            if "modified_on" in table.fields:
+                MTIME = table.modified_on
+                resource.add_filter(MTIME <= muntil)
+                if last_id is not None:
+                    resource.add_filter((MTIME > mtime) | \
+                                        ((MTIME == mtime) & (pkey > last_id)))
+                orderby = "%s ASC, %s ASC" % (MTIME, pkey)
+            else:
+                muntil = None
+                if last_id is not None:
+                    resource.add_filter(pkey > last_id)
+                orderby = "%s ASC" % pkey
+
         # Export the resource
-        output = resource.export_xml(start=start,
-                                     limit=limit,
-                                     filters=filters,
-                                     msince=msince)
+        tree = resource.export_xml(start=start,
+                                   limit=limit,
+                                   filters=filters,
+                                   msince=msince,
+                                   orderby=orderby,
+                                   as_tree=True)
         count = resource.results
 
+        # Drop the records which have already been exchanged with the
+        # peer in the same version (the records sent here are not
+        # remembered, as we can not know whether the peer imports them)
+        skipped = S3SyncDelta.skip_unchanged(tree, repository_id)[0]
+        if tree is not None:
+            output = current.xml.tostring(tree)
+        else:
+            output = None
+
         # Set content type header
         headers = current.response.headers
         headers["Content-Type"] = "text/xml"
 
+        if paged:
+            if muntil:
+                # Peer to use this as msince for the next pull
+                headers["X-Sync-Muntil"] = s3_format_datetime(muntil)
+            rows = resource._rows
+            if rows and len(rows) >= limit:
+                last = rows[-1]
+                headers["X-Sync-Next"] = self.encode_token(muntil,
+                                                           last.get("modified_on"),
+                                                           last[pkey.name])
+
+        # Compress the output if the peer accepts it
+        encoding = self.accept_encoding(r.env.get("http_accept_encoding"))
+        if output and encoding:
+            output = self.encode_content(output, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Vary"] = "Accept-Encoding"
+
         # Log the operation
+        message = "data sent to peer (%s records)" % count
+        if skipped:
+            message = "%s, %s unchanged records skipped" % (message, skipped)
         log = self.log
         log.write(repository_id=repository_id,
                   resource_name=r.resource.tablename,
                   transmission=log.IN,
                   mode=log.PULL,
                   result=log.SUCCESS,
-                  message="data sent to peer (%s records)" % count)
+                  message=message)
 
         return output
 
@@ -465,6 +538,21 @@ class S3Sync(S3Method):
 
         # Get the source
         source = r.read_body()
+        hashes = None
+        if len(source) == 1 and not isinstance(source[0], tuple):
+            body = source[0]
+            encoding = r.env.get("http_content_encoding")
+            if encoding:
+                try:
+                    body = StringIO(self.decode_content(body.read(),
+                                                        encoding.lower()))
+                except zlib.error:
+                    r.error(400, "Invalid %s content" % encoding)
+            source = current.xml.parse(body)
+            if source is None:
+                r.error(400, current.xml.error)
+            # Skip records which have been exchanged in the same version
+            hashes = S3SyncDelta.skip_unchanged(source, repository.id)[1]
 
         # Import resource
         resource = r.resource
@@ -483,6 +571,9 @@ class S3Sync(S3Method):
             e = sys.exc_info()[1]
             r.error(400, e)
 
+        # Remember the hashes of the imported records
+        S3SyncDelta.update(repository.id, hashes, resource.error_tree)
+
         log = self.log
 
         if resource.error_tree is not None:
@@ -526,6 +617,114 @@ class S3Sync(S3Method):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode_token(muntil, mtime, last_id):
+        """
+            Encode the continuation token for a paged pull
+
+            @param muntil: the upper limit for modified_on of this pull
+            @param mtime: modified_on of the last record sent
+            @param last_id: the record ID of the last record sent
+
+            @return: the token (string)
+        """
+
+        dtfmt = S3Sync.TOKEN_FORMAT
+        encode = lambda dt: dt.strftime(dtfmt) if dt else None
+        token = json.dumps([encode(muntil), encode(mtime), last_id])
+        return base64.urlsafe_b64encode(token)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decode_token(token):
+        """
+            Decode a continuation token
+
+            @param token: the token
+            @return: tuple (muntil, mtime, last_id)
+
+            @raises TypeError, ValueError: for invalid tokens
+        """
+
+        dtfmt = S3Sync.TOKEN_FORMAT
+        decode = lambda s: datetime.datetime.strptime(s, dtfmt) if s else None
+        muntil, mtime, last_id = json.loads(base64.urlsafe_b64decode(str(token)))
+        return (decode(muntil), decode(mtime), int(last_id))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def accept_encoding(header):
+        """
+            Choose a content encoding to compress data with
+
+            @param header: the Accept-Encoding header of the peer
+
+            @return: "gzip", "deflate" or None
+        """
+
+        accepted = set()
+        if header:
+            for item in header.split(","):
+                params = item.split(";")
+                for param in params[1:]:
+                    param = param.strip()
+                    if param[:2] == "q=":
+                        try:
+                            if float(param[2:]) == 0:
+                                break
+                        except ValueError:
+                            break
+                else:
+                    accepted.add(params[0].strip().lower())
+        for encoding in ("gzip", "deflate"):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode_content(data, encoding):
+        """
+            Compress data
+
+            @param data: the data (string)
+            @param encoding: the content encoding, "gzip" or "deflate"
+        """
+
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if encoding == "gzip":
+            wbits = 16 + zlib.MAX_WBITS
+        elif encoding == "deflate":
+            wbits = zlib.MAX_WBITS
+        else:
+            return data
+        compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decode_content(data, encoding):
+        """
+            Decompress data
+
+            @param data: the data (string)
+            @param encoding: the content encoding, "gzip" or "deflate"
+
+            @raises zlib.error: if the data can not be decompressed
+        """
+
+        if encoding == "gzip":
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # Raw deflate stream (without zlib header)
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
     # -------------------------------------------------------------------------
     def onconflict(self, item, repository, resource):
         """
@@ -839,4 +1038,173 @@ class S3SyncBaseAdapter(object):
 
         raise NotImplementedError
 
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Close all connections to the repository """
+
+        pass
+
+# =============================================================================
+class S3SyncDelta(object):
+    """
+        Content hashes of S3XML records, to drop records which have
+        already been exchanged with a repository (sent or received) in
+        the same version from outgoing data before sending it, and from
+        incoming data before importing it
+
+        - the hashes of the records last exchanged with a repository
+          are stored in sync_record_hash, so that local records never
+          need to be exported just to compare them
+    """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def record_hash(cls, element, components=True):
+        """
+            Compute the content hash of a record, i.e. of its field values
+            and references (but not its meta-data, e.g. modified_on)
+
+            @param element: the <resource> element
+            @param components: include the component records (nested
+                               <resource> elements)
+
+            @return: the hash (hex string)
+        """
+
+        xml = current.xml
+        TAG = xml.TAG
+        ATTRIBUTE = xml.ATTRIBUTE
+
+        items = []
+        for child in element:
+            tag = child.tag
+            if tag == TAG.data:
+                value = child.get(ATTRIBUTE.value)
+                if value is None:
+                    value = child.get(ATTRIBUTE.filename, child.text)
+                items.append(["d", child.get(ATTRIBUTE.field), value])
+            elif tag == TAG.reference:
+                items.append(["r",
+                              child.get(ATTRIBUTE.field),
+                              child.get(ATTRIBUTE.resource),
+                              child.get(xml.UID) or child.get(ATTRIBUTE.tuid),
+                              ])
+            elif tag == TAG.resource and components:
+                items.append(["c", cls.record_hash(child)])
+        items.sort()
+
+        content = [element.get(ATTRIBUTE.name),
+                   element.get(xml.DELETED),
+                   element.get(ATTRIBUTE.replaced_by),
+                   items,
+                   ]
+        return hashlib.sha1(json.dumps(content)).hexdigest()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def skip_unchanged(cls, tree, repository_id):
+        """
+            Remove all records from an S3XML tree which are identical
+            to the records last exchanged with a repository
+
+            @param tree: the element tree
+            @param repository_id: the sync_repository record ID
+
+            @return: tuple (skipped, hashes), with the number of removed
+                     records, and the hashes of the remaining records
+                     as dict {(tablename, uid): hash}, to store with
+                     update() once they have been exchanged
+        """
+
+        skipped = 0
+        hashes = {}
+        if tree is None:
+            return skipped, hashes
+
+        xml = current.xml
+
+        UID = xml.UID
+        NAME = xml.ATTRIBUTE.name
+
+        # Hash the records in the tree
+        root = tree.getroot()
+        elements = {}
+        for element in root.findall(xml.TAG.resource):
+            tablename = element.get(NAME)
+            uid = element.get(UID)
+            if tablename and uid:
+                key = (tablename, xml.import_uid(uid))
+                elements[key] = element
+                hashes[key] = cls.record_hash(element)
+
+        if repository_id and hashes:
+            # Remove the records with the same hashes as last exchanged
+            table = current.s3db.sync_record_hash
+            query = (table.repository_id == repository_id) & \
+                    (table.uid.belongs(set(key[1] for key in hashes)))
+            rows = current.db(query).select(table.tablename,
+                                            table.uid,
+                                            table.hash,
+                                            )
+            for row in rows:
+                key = (row.tablename, row.uid)
+                if key in hashes and hashes[key] == row.hash:
+                    root.remove(elements[key])
+                    del hashes[key]
+                    skipped += 1
+
+        _debug("S3SyncDelta.skip_unchanged: %s records skipped" % skipped)
+        return skipped, hashes
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update(repository_id, hashes, error_tree=None):
+        """
+            Store the hashes of the records exchanged with a repository
+
+            @param repository_id: the sync_repository record ID
+            @param hashes: the hashes as dict {(tablename, uid): hash},
+                           as returned from skip_unchanged()
+            @param error_tree: the error tree of the import, to exclude
+                               the records which have failed
+        """
+
+        if not repository_id or not hashes:
+            return
+
+        xml = current.xml
+
+        hashes = dict(hashes)
+        if error_tree is not None:
+            NAME = xml.ATTRIBUTE.name
+            for element in error_tree.findall(xml.TAG.resource):
+                key = (element.get(NAME), xml.import_uid(element.get(xml.UID)))
+                hashes.pop(key, None)
+            if not hashes:
+                return
+
+        db = current.db
+        table = current.s3db.sync_record_hash
+
+        query = (table.repository_id == repository_id) & \
+                (table.uid.belongs(set(key[1] for key in hashes)))
+        rows = db(query).select(table.id,
+                                table.tablename,
+                                table.uid,
+                                table.hash,
+                                )
+        for row in rows:
+            key = (row.tablename, row.uid)
+            if key in hashes:
+                record_hash = hashes.pop(key)
+                if row.hash != record_hash:
+                    row.update_record(hash=record_hash)
+
+        for key, record_hash in hashes.items():
+            table.insert(repository_id = repository_id,
+                         tablename = key[0],
+                         uid = key[1],
+                         hash = record_hash,
+                         )
+
 # End =========================================================================
@@ -59,7 +59,7 @@ from gluon.sqlhtml import OptionsWidget
 from s3datetime import s3_decode_iso_datetime, s3_utc
 from s3rest import S3Method
 from s3query import FS
-from s3report import S3ReportForm
+from s3report import S3ReportCache, S3ReportForm
 from s3utils import s3_flatlist
 
 tp_datetime = lambda *t: datetime.datetime(tzinfo=dateutil.tz.tzutc(), *t)
@@ -141,22 +141,20 @@ class S3TimePlot(S3Method):
         if visible:
             # Create time series
             # @todo: should become resource.timeseries()
-            ts = S3TimeSeries(resource,
-                            start=start,
-                            end=end,
-                            slots=slots,
-                            method=method,
-                            event_start=event_start,
-                            event_end=event_end,
-                            base=base,
-                            slope=slope,
-                            interval=interval,
-                            rows=rows,
-                            cols=cols,
-                            baseline=baseline)
-
-            # Extract aggregated results as JSON-serializable dict
-            data = ts.as_dict()
+            # - extract aggregated results as JSON-serializable dict
+            data = self.timeseries(resource,
+                                   start=start,
+                                   end=end,
+                                   slots=slots,
+                                   method=method,
+                                   event_start=event_start,
+                                   event_end=event_end,
+                                   base=base,
+                                   slope=slope,
+                                   interval=interval,
+                                   rows=rows,
+                                   cols=cols,
+                                   baseline=baseline)
         else:
             data = None
 
@@ -244,22 +242,20 @@ class S3TimePlot(S3Method):
 
         # Create time series
         # @todo: should become resource.timeseries()
-        ts = S3TimeSeries(resource,
-                          start=start,
-                          end=end,
-                          slots=slots,
-                          method=method,
-                          event_start=event_start,
-                          event_end=event_end,
-                          base=base,
-                          slope=slope,
-                          interval=interval,
-                          rows=rows,
-                          cols=cols,
-                          baseline=baseline)
-
-        # Extract aggregated results as JSON-serializable dict
-        data = ts.as_dict()
+        # - extract aggregated results as JSON-serializable dict
+        data = self.timeseries(resource,
+                               start=start,
+                               end=end,
+                               slots=slots,
+                               method=method,
+                               event_start=event_start,
+                               event_end=event_end,
+                               base=base,
+                               slope=slope,
+                               interval=interval,
+                               rows=rows,
+                               cols=cols,
+                               baseline=baseline)
 
         # Widget ID
         widget_id = "timeplot"
@@ -333,6 +329,42 @@ class S3TimePlot(S3Method):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def timeseries(resource, **options):
+        """
+            Generate the time series data, using the report cache if enabled
+
+            @param resource: the S3Resource
+            @param options: keyword arguments for S3TimeSeries
+
+            @return: the time series data as JSON-serializable dict
+        """
+
+        def generate():
+            ts = S3TimeSeries(resource, **options)
+            return ts.as_dict()
+
+        selectors = [options.get(k) for k in ("rows",
+                                              "cols",
+                                              "event_start",
+                                              "event_end",
+                                              "base",
+                                              "slope",
+                                              "baseline",
+                                              )]
+
+        # Relative start/end dates depend on the current time
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+
+        cache = S3ReportCache(resource,
+                              "timeseries",
+                              selectors,
+                              sorted(options.items()),
+                              now,
+                              )
+        return cache(generate)
+
     # -------------------------------------------------------------------------
     def get_target(self, r):
         """
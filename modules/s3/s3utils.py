@@ -38,6 +38,7 @@ import sys
 import time
 import urlparse
 import HTMLParser
+from uuid import uuid4
 
 try:
     import json # try stdlib (Python 2.6)
@@ -281,14 +282,22 @@ def s3_represent_value(field,
     # Get text representation
     if field.represent:
         try:
-            key = "%s_repr_%s" % (field, val)
-            unicode(key)
+            if hasattr(field.represent, "bulk") and \
+               current.deployment_settings.get_base_represent_cache():
+                # S3Represent has its own shared cache
+                key = None
+            else:
+                key = "%s_repr_%s" % (field, val)
+                unicode(key)
         except (UnicodeEncodeError, UnicodeDecodeError):
             text = field.represent(val)
         else:
-            text = cache.ram(key,
-                             lambda: field.represent(val),
-                             time_expire=60)
+            if key is None:
+                text = field.represent(val)
+            else:
+                text = cache.ram(key,
+                                 lambda: field.represent(val),
+                                 time_expire=60)
             if isinstance(text, DIV):
                 text = str(text)
             elif not isinstance(text, basestring):
@@ -2485,4 +2494,171 @@ def s3_strip_markup(text):
         pass
     return text
 
+# =============================================================================
+class S3TableVersion(object):
+    """
+        Version stamps for database tables, renewed by DAL callbacks upon
+        every write to the table, so that caches of derived data (reports,
+        map configurations, spatial indexes) can check their validity
+        without querying the tables
+
+        - the stamps are stored in the s3_table_version table, so that
+          all server processes see them
+        - new stamps are written in the same transaction as the data,
+          immediately before it gets committed, so that other processes
+          can't see a new stamp before the data it stands for (and the
+          rows stay locked only during the commit)
+        - until then, the current transaction sees its own pending stamps
+
+        Writes which bypass the DAL (raw SQL) must call renew() explicitly.
+    """
+
+    TABLENAME = "s3_table_version"
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def attach(cls, table):
+        """
+            Attach the write callbacks to a table (idempotent)
+
+            @param table: the Table
+        """
+
+        if getattr(table, "_table_version", False):
+            return
+
+        tablename = str(table)
+        if tablename == cls.TABLENAME:
+            return
+
+        renew = lambda *args: cls.renew(tablename)
+        # Mark the callback, so that bulk inserts can recognize it
+        renew.table_version = True
+
+        table._after_insert.append(renew)
+        table._after_update.append(renew)
+        table._after_delete.append(renew)
+
+        table._table_version = True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def pending(cls, db):
+        """
+            Get the stamps pending for the current transaction, hook
+            into commit/rollback of the DB adapter to write/discard them
+
+            @param db: the database
+
+            @return: dict {tablename: stamp}
+        """
+
+        adapter = db._adapter
+
+        pending = getattr(adapter, "_table_versions", None)
+        if pending is None:
+            pending = adapter._table_versions = {}
+
+            commit = adapter.commit
+            rollback = adapter.rollback
+
+            def commit_hook(*args, **kwargs):
+                if pending:
+                    cls.write(db, pending)
+                    pending.clear()
+                return commit(*args, **kwargs)
+
+            def rollback_hook(*args, **kwargs):
+                pending.clear()
+                return rollback(*args, **kwargs)
+
+            adapter.commit = commit_hook
+            adapter.rollback = rollback_hook
+
+        return pending
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def write(cls, db, stamps):
+        """
+            Write new version stamps to the database
+
+            @param db: the database
+            @param stamps: dict {tablename: stamp}
+        """
+
+        table = current.s3db[cls.TABLENAME]
+
+        # Always in the same order, so that concurrent commits
+        # can't deadlock
+        for tablename in sorted(stamps):
+            stamp = stamps[tablename]
+            query = (table.tablename == tablename)
+            if not db(query).update(stamp=stamp):
+                table.insert(tablename=tablename, stamp=stamp)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def renew(cls, tablename):
+        """
+            Renew the version stamp of a table (becomes visible to other
+            processes when the current transaction gets committed)
+
+            @param tablename: the table name
+        """
+
+        # New stamp with every write, so that data cached within this
+        # transaction can't be mistaken for the final state
+        cls.pending(current.db)[tablename] = uuid4().hex
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, tablename):
+        """
+            Get the current version stamp of a table
+
+            @param tablename: the table name
+
+            @return: the version stamp (string)
+        """
+
+        return cls.lookup([tablename])[0]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def lookup(cls, tablenames):
+        """
+            Get the current version stamps of multiple tables (with
+            a single query)
+
+            @param tablenames: list of table names
+
+            @return: list of version stamps, in the same order
+        """
+
+        db = current.db
+
+        pending = getattr(db._adapter, "_table_versions", None) or {}
+        lookup = set(tablename for tablename in tablenames
+                     if tablename not in pending)
+
+        stamps = {}
+        if lookup:
+            table = current.s3db[cls.TABLENAME]
+            query = table.tablename.belongs(lookup)
+            rows = db(query).select(table.tablename,
+                                    table.stamp,
+                                    )
+            for row in rows:
+                # Concurrent first writes may have inserted multiple rows
+                stamps.setdefault(row.tablename, []).append(row.stamp)
+
+        result = []
+        for tablename in tablenames:
+            if tablename in pending:
+                result.append(pending[tablename])
+            else:
+                result.append("|".join(sorted(stamps.get(tablename, []))))
+        return result
+
 # END =========================================================================
@@ -36,6 +36,8 @@ import datetime
 import os
 import re
 import sys
+import threading
+import time
 import urllib2
 
 try:
@@ -65,6 +67,9 @@ ogetattr = object.__getattribute__
 # Compact JSON encoding
 SEPARATORS = (",", ":")
 
+# Access control for XSLT stylesheets
+XSLT_ACCESS = {"read_file": True, "read_network": True}
+
 # =============================================================================
 class S3XML(S3Codec):
     """
@@ -250,7 +255,9 @@ class S3XML(S3Codec):
             Transform an element tree with XSLT
 
             @param tree: the element tree
-            @param stylesheet_path: pathname of the XSLT stylesheet
+            @param stylesheet_path: pathname of the XSLT stylesheet, or
+                                    a pre-parsed stylesheet, or a
+                                    compiled etree.XSLT transformer
             @param args: dict of arguments to pass to the stylesheet
         """
 
@@ -261,16 +268,25 @@ class S3XML(S3Codec):
         else:
             _args = None
 
-        if isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
+        transformer = None
+        if isinstance(stylesheet_path, etree.XSLT):
+            # Pre-compiled stylesheet
+            transformer = stylesheet = stylesheet_path
+        elif isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
             # Pre-parsed stylesheet
             stylesheet = stylesheet_path
+        elif isinstance(stylesheet_path, basestring) and \
+             os.path.isfile(stylesheet_path):
+            # Stylesheet file => use compiled transformer from cache
+            stylesheet, transformer = S3XSLTCache.get(stylesheet_path)
         else:
             stylesheet = self.parse(stylesheet_path)
 
         if stylesheet is not None:
             try:
-                ac = etree.XSLTAccessControl(read_file=True, read_network=True)
-                transformer = etree.XSLT(stylesheet, access_control=ac)
+                if transformer is None:
+                    ac = etree.XSLTAccessControl(**XSLT_ACCESS)
+                    transformer = etree.XSLT(stylesheet, access_control=ac)
                 if _args:
                     result = transformer(tree, **_args)
                 else:
@@ -2506,6 +2522,41 @@ class S3XML(S3Codec):
             @todo: add a character encoding parameter to skip the guessing
         """
 
+        trees = cls.csv2trees(source,
+                              resourcename=resourcename,
+                              extra_data=extra_data,
+                              hashtags=hashtags,
+                              delimiter=delimiter,
+                              quotechar=quotechar)
+        return trees.next()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def csv2trees(cls, source,
+                  resourcename=None,
+                  extra_data=None,
+                  hashtags=None,
+                  delimiter=",",
+                  quotechar='"',
+                  batch_size=None):
+        """
+            Generator to convert a table-form CSV source into element trees
+            (see: L{csv2tree}) of at most batch_size rows each, reading the
+            source row by row, so that large sources can be imported with
+            bounded memory
+
+            @param source: the source (file-like object)
+            @param resourcename: the resource name
+            @param extra_data: dict of extra cols {key:value} to add to each row
+            @param hashtags: dict of hashtags for extra cols {key:hashtag}
+            @param delimiter: delimiter for values
+            @param quotechar: quotation character
+            @param batch_size: maximum number of rows per tree, None for
+                               a single tree with all rows
+
+            @return: iterator over etree.ElementTrees (at least one)
+        """
+
         import csv
 
         # Increase field size to be able to import WKTs
@@ -2519,9 +2570,13 @@ class S3XML(S3Codec):
         COL = TAG.col
         SubElement = etree.SubElement
 
-        root = etree.Element(TAG.table)
-        if resourcename is not None:
-            root.set(ATTRIBUTE.name, resourcename)
+        def new_table():
+            root = etree.Element(TAG.table)
+            if resourcename is not None:
+                root.set(ATTRIBUTE.name, resourcename)
+            return root
+        root = new_table()
+        batches = 0
 
         def add_col(row, key, value, hashtags=None):
             col = SubElement(row, COL)
@@ -2593,6 +2648,10 @@ class S3XML(S3Codec):
                     for key in extra_data:
                         if key not in r:
                             add_col(row, key, extra_data[key], hashtags=hashtags)
+                if batch_size and len(root) >= batch_size:
+                    batches += 1
+                    yield etree.ElementTree(root)
+                    root = new_table()
         except csv.Error:
             e = sys.exc_info()[1]
             raise HTTP(400, body=cls.json_message(False, 400, e))
@@ -2600,7 +2659,133 @@ class S3XML(S3Codec):
         # Use this to debug the source tree if needed:
         #print >>sys.stderr, cls.tostring(root, pretty_print=True)
 
-        return  etree.ElementTree(root)
+        if len(root) or not batches:
+            yield etree.ElementTree(root)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def split_table(tree, batch_size):
+        """
+            Generator to split a table-form element tree (as produced by
+            L{xls2tree}) into trees of at most batch_size rows each; the
+            rows are moved from the original tree into the batches
+
+            @param tree: the element tree
+            @param batch_size: the maximum number of rows per tree
+
+            @return: iterator over etree.ElementTrees (at least one)
+        """
+
+        root = tree.getroot()
+        rows = list(root)
+        if not batch_size or len(rows) <= batch_size:
+            yield tree
+            return
+
+        attrib = dict(root.attrib)
+        for index in xrange(0, len(rows), batch_size):
+            table = etree.Element(root.tag, **attrib)
+            table.extend(rows[index:index + batch_size])
+            yield etree.ElementTree(table)
+
+# =============================================================================
+class S3XSLTCache(object):
+    """
+        Process-wide cache of compiled XSLT stylesheets, to skip parsing
+        and compilation of the (large) import/export stylesheets in
+        static/formats for every request or imported file
+
+        - entries are keyed on the absolute path of the stylesheet file
+          and the XSLT access control settings, and get re-compiled
+          whenever the modification time of the file changes
+        - compiled etree.XSLT objects can be called concurrently from
+          multiple threads, so entries are shared between requests
+    """
+
+    # {(path, access): (mtime, tree, transformer)}
+    store = {}
+    lock = threading.Lock()
+
+    # Cache statistics
+    hits = 0
+    misses = 0
+    compile_time = 0.0
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, path):
+        """
+            Get a compiled stylesheet, compile and cache it if necessary
+
+            @param path: the pathname of the stylesheet file
+
+            @return: tuple (tree, transformer), (None, None) if the
+                     stylesheet could not be parsed or compiled, with
+                     the error stored in current.xml.error
+        """
+
+        path = os.path.abspath(path)
+        key = (path, tuple(sorted(XSLT_ACCESS.items())))
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+
+        store = cls.store
+        with cls.lock:
+            item = store.get(key)
+            if item is not None and item[0] == mtime:
+                cls.hits += 1
+                return item[1:]
+
+        start = time.time()
+
+        xml = current.xml
+        tree = xml.parse(path)
+        if tree is None:
+            return (None, None)
+        try:
+            ac = etree.XSLTAccessControl(**XSLT_ACCESS)
+            transformer = etree.XSLT(tree, access_control=ac)
+        except:
+            e = sys.exc_info()[1]
+            xml.error = e
+            current.log.error(e)
+            return (None, None)
+
+        duration = time.time() - start
+        with cls.lock:
+            cls.misses += 1
+            cls.compile_time += duration
+            store[key] = (mtime, tree, transformer)
+
+        return (tree, transformer)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def stats(cls):
+        """
+            Get the cache statistics
+
+            @return: dict {stylesheets, hits, misses, compile_time}
+        """
+
+        with cls.lock:
+            return {"stylesheets": len(cls.store),
+                    "hits": cls.hits,
+                    "misses": cls.misses,
+                    "compile_time": cls.compile_time,
+                    }
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls):
+        """ Remove all compiled stylesheets and reset the statistics """
+
+        with cls.lock:
+            cls.store.clear()
+            cls.hits = cls.misses = 0
+            cls.compile_time = 0.0
 
 # =============================================================================
 class S3XMLFormat(object):
@@ -2613,7 +2798,12 @@ class S3XMLFormat(object):
             @param stylesheet: the stylesheet (pathname or stream)
         """
 
-        self.tree = current.xml.parse(stylesheet)
+        if isinstance(stylesheet, basestring) and os.path.isfile(stylesheet):
+            # Use the cached tree and transformer
+            self.tree, self.transformer = S3XSLTCache.get(stylesheet)
+        else:
+            self.tree = current.xml.parse(stylesheet)
+            self.transformer = None
         if not self.tree:
             current.log.error("%s parse error: %s" %
                               (stylesheet, current.xml.error))
@@ -2726,6 +2916,19 @@ class S3XMLFormat(object):
             current.log.error("XMLFormat: no stylesheet available")
             return tree
 
-        return current.xml.transform(tree, self.tree, **args)
+        transformer = self.transformer
+        if transformer is None:
+            # Compile once, re-use for subsequent transformations
+            try:
+                ac = etree.XSLTAccessControl(**XSLT_ACCESS)
+                transformer = etree.XSLT(self.tree, access_control=ac)
+            except:
+                e = sys.exc_info()[1]
+                current.log.error(e)
+                current.xml.error = e
+                return None
+            self.transformer = transformer
+
+        return current.xml.transform(tree, transformer, **args)
 
 # End =========================================================================
@@ -27,9 +27,18 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import httplib
+import socket
 import sys
 import urllib, urllib2
+import urlparse
 import traceback
+import zlib
+
+try:
+    from cStringIO import StringIO # Faster, where available
+except:
+    from StringIO import StringIO
 
 try:
     from lxml import etree
@@ -47,8 +56,9 @@ except ImportError:
 
 from gluon import *
 
-from ..s3datetime import s3_encode_iso_datetime
-from ..s3sync import S3SyncBaseAdapter
+from ..s3datetime import s3_decode_iso_datetime, s3_encode_iso_datetime, \
+                        s3_parse_datetime, s3_utc
+from ..s3sync import S3Sync, S3SyncBaseAdapter, S3SyncDelta
 
 DEBUG = False
 if DEBUG:
@@ -65,6 +75,24 @@ class S3SyncAdapter(S3SyncBaseAdapter):
         API Adapter for Sahana Eden
     """
 
+    # -------------------------------------------------------------------------
+    def __init__(self, repository):
+        """
+            Constructor
+
+            @param repository: the repository (S3SyncRepository)
+        """
+
+        S3SyncBaseAdapter.__init__(self, repository)
+
+        # Persistent connection to the repository
+        self.connection = None
+        self.connection_key = None
+        self.reused = False
+
+        # Content encodings accepted by the repository
+        self.encodings = None
+
     # -------------------------------------------------------------------------
     def register(self):
         """ Register at the repository """
@@ -208,112 +236,115 @@ class S3SyncAdapter(S3SyncBaseAdapter):
 
         _debug("...pull from URL %s" % url)
 
-        # Figure out the protocol from the URL
-        url_split = url.split("://", 1)
-        if len(url_split) == 2:
-            protocol, path = url_split
-        else:
-            protocol, path = "http", None
-
-        # Create the request
-        req = urllib2.Request(url=url)
-        handlers = []
-
-        # Proxy handling
-        proxy = repository.proxy or config.proxy or None
-        if proxy:
-            _debug("using proxy=%s" % proxy)
-            proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-            handlers.append(proxy_handler)
+        # Pull in pages?
+        page_size = current.deployment_settings.get_sync_page_size()
 
-        # Authentication handling
-        username = repository.username
-        password = repository.password
-        if username and password:
-            # Send auth data unsolicitedly (the only way with Eden instances):
-            import base64
-            base64string = base64.encodestring('%s:%s' %
-                                               (username, password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-            # Just in case the peer does not accept that, add a 401 handler:
-            passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            passwd_manager.add_password(realm=None,
-                                        uri=url,
-                                        user=username,
-                                        passwd=password)
-            auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-            handlers.append(auth_handler)
+        # Get import strategy and update policy
+        strategy = task.strategy
+        update_policy = task.update_policy
+        conflict_policy = task.conflict_policy
 
-        # Install all handlers
-        if handlers:
-            opener = urllib2.build_opener(*handlers)
-            urllib2.install_opener(opener)
+        resource = current.s3db.resource(resource_name)
+        if onconflict:
+            onconflict_callback = lambda item: onconflict(item,
+                                                          repository,
+                                                          resource)
+        else:
+            onconflict_callback = None
 
-        # Execute the request
         remote = False
         output = None
-        response = None
         log = repository.log
-        try:
-            f = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
-            result = log.ERROR
-            remote = True # Peer error
-            code = e.code
-            message = e.read()
+        result = log.SUCCESS
+        message = ""
+        mtime = None
+        muntil = None
+        received = False
+        count = 0
+        skipped = 0
+        token = None
+
+        while True:
+
+            page_url = url
+            if page_size:
+                page_url += "&limit=%s" % page_size
+                if token:
+                    page_url += "&next=%s" % urllib.quote(token)
+
+            # Execute the request
             try:
-                # Sahana-Eden would send a JSON message,
-                # try to extract the actual error message:
-                message_json = json.loads(message)
-                message = message_json.get("message", message)
+                data, headers = self.send(page_url)
+            except urllib2.HTTPError, e:
+                result = log.ERROR
+                remote = True # Peer error
+                code = e.code
+                message = e.read()
+                try:
+                    # Sahana-Eden would send a JSON message,
+                    # try to extract the actual error message:
+                    message_json = json.loads(message)
+                    message = message_json.get("message", message)
+                except:
+                    pass
+                # Prefix as peer error and strip XML markup from the message
+                # @todo: better method to do this?
+                message = "<message>%s</message>" % message
+                try:
+                    markup = etree.XML(message)
+                    message = markup.xpath(".//text()")
+                    if message:
+                        message = " ".join(message)
+                    else:
+                        message = ""
+                except etree.XMLSyntaxError:
+                    pass
+                output = xml.json_message(False, code, message, tree=None)
+                break
             except:
-                pass
-            # Prefix as peer error and strip XML markup from the message
-            # @todo: better method to do this?
-            message = "<message>%s</message>" % message
-            try:
-                markup = etree.XML(message)
-                message = markup.xpath(".//text()")
-                if message:
-                    message = " ".join(message)
-                else:
-                    message = ""
-            except etree.XMLSyntaxError:
-                pass
-            output = xml.json_message(False, code, message, tree=None)
-        except:
-            result = log.FATAL
-            code = 400
-            message = sys.exc_info()[1]
-            output = xml.json_message(False, code, message)
-        else:
-            result = log.SUCCESS
-            response = f
+                result = log.FATAL
+                code = 400
+                message = sys.exc_info()[1]
+                output = xml.json_message(False, code, message)
+                break
 
-        # Process the response
-        mtime = None
-        if response:
+            if not data:
+                break
+            received = True
 
-            # Get import strategy and update policy
-            strategy = task.strategy
-            update_policy = task.update_policy
-            conflict_policy = task.conflict_policy
+            # Parse the response
+            tree = xml.parse(StringIO(data))
+            if tree is None:
+                result = log.FATAL
+                remote = True
+                message = "invalid data received from peer: %s" % xml.error
+                output = xml.json_message(False, 400, message)
+                break
+
+            # Peers which support paging tell the end of the pull
+            # interval, otherwise use the latest received record
+            muntil = s3_utc(s3_parse_datetime(headers.get("x-sync-muntil")))
+            MTIME = xml.MTIME
+            for element in tree.getroot().findall(xml.TAG.resource):
+                if element.get(xml.ATTRIBUTE.name) != resource_name:
+                    continue
+                try:
+                    emtime = s3_utc(s3_decode_iso_datetime(element.get(MTIME)))
+                except (TypeError, ValueError, AttributeError):
+                    continue
+                if mtime is None or emtime > mtime:
+                    mtime = emtime
 
-            success = True
-            message = ""
+            # Skip records which have been exchanged in the same version
+            page_skipped, hashes = S3SyncDelta.skip_unchanged(tree,
+                                                              repository.id)
+            skipped += page_skipped
 
             # Import the data
-            resource = current.s3db.resource(resource_name)
-            if onconflict:
-                onconflict_callback = lambda item: onconflict(item,
-                                                              repository,
-                                                              resource)
-            else:
-                onconflict_callback = None
-            count = 0
+            success = True
             try:
                 success = resource.import_xml(
-                                response,
+                                tree,
                                 ignore_errors=True,
                                 strategy=strategy,
                                 update_policy=update_policy,
@@ -336,12 +367,14 @@ class S3SyncAdapter(S3SyncBaseAdapter):
                           traceback.format_exc()
                 output = xml.json_message(False, 500, sys.exc_info()[1])
 
-            mtime = resource.mtime
+            if resource.mtime and (mtime is None or resource.mtime > mtime):
+                mtime = resource.mtime
 
             # Log all validation errors
             if resource.error_tree is not None:
                 result = log.WARNING
-                message = "%s" % resource.error
+                message = "%s%s" % (message and "%s, " % message or "",
+                                    resource.error)
                 for element in resource.error_tree.findall("resource"):
                     for field in element.findall("data[@error]"):
                         error_msg = field.get("error", None)
@@ -355,22 +388,39 @@ class S3SyncAdapter(S3SyncBaseAdapter):
                             message = "%s, %s" % (message, msg)
 
             # Check for failure
-            if not success:
+            if not success or output is not None:
                 result = log.FATAL
                 if not message:
                     message = "%s" % resource.error
-                output = xml.json_message(False, 400, message)
-                mtime = None
+                if output is None:
+                    output = xml.json_message(False, 400, message)
+                break
 
-            # ...or report success
-            elif not message:
-                message = "data imported successfully (%s records)" % count
+            # Remember the hashes of the imported records
+            S3SyncDelta.update(repository.id, hashes, resource.error_tree)
+
+            # Next page
+            token = headers.get("x-sync-next")
+            if not token:
+                break
 
-        elif result == log.SUCCESS:
+        # Process the result
+        if output is not None:
+            mtime = None
+        elif received:
+            if muntil:
+                mtime = muntil
+            if not message:
+                message = "data imported successfully (%s records)" % count
+                if skipped:
+                    message = "%s, %s unchanged records skipped" % (message,
+                                                                    skipped)
+        else:
             # No data received from peer
             result = log.ERROR
             remote = True
             message = "no data received from peer"
+            mtime = None
 
         # Log the operation
         log.write(repository_id=repository.id,
@@ -427,64 +477,32 @@ class S3SyncAdapter(S3SyncBaseAdapter):
         filters = current.sync.get_filters(task.id)
 
         # Export the resource as S3XML
-        data = resource.export_xml(filters=filters,
-                                   msince=last_push)
-        count = resource.results or 0
+        tree = resource.export_xml(filters=filters,
+                                   msince=last_push,
+                                   as_tree=True)
         mtime = resource.muntil
 
+        # Drop the records which have been exchanged in the same version
+        skipped, hashes = S3SyncDelta.skip_unchanged(tree, repository.id)
+        if tree is not None:
+            data = xml.tostring(tree)
+            count = len(tree.getroot().findall("%s[@%s='%s']" % \
+                                               (xml.TAG.resource,
+                                                xml.ATTRIBUTE.name,
+                                                resource.tablename)))
+        else:
+            data = None
+            count = 0
+
         # Transmit the data via HTTP
         remote = False
         output = None
         log = repository.log
         if data and count:
 
-            # Find the protocol
-            url_split = url.split("://", 1)
-            if len(url_split) == 2:
-                protocol, path = url_split
-            else:
-                protocol, path = "http", None
-
-            # Generate the request
-            import urllib2
-            req = urllib2.Request(url=url, data=data)
-            req.add_header('Content-Type', "text/xml")
-            handlers = []
-
-            # Proxy handling
-            proxy = repository.proxy or config.proxy or None
-            if proxy:
-                _debug("using proxy=%s" % proxy)
-                proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-                handlers.append(proxy_handler)
-
-            # Authentication
-            username = repository.username
-            password = repository.password
-            if username and password:
-                # send auth credentials unsolicitedly
-                import base64
-                base64string = base64.encodestring('%s:%s' %
-                                                   (username, password))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
-                # Just in case the peer does not accept that
-                # => add a 401 handler:
-                passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passwd_manager.add_password(realm=None,
-                                            uri=url,
-                                            user=username,
-                                            passwd=password)
-                auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-                handlers.append(auth_handler)
-
-            # Install all handlers
-            if handlers:
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
-
             # Execute the request
             try:
-                f = urllib2.urlopen(req)
+                self.send(url, data=data, content_type="text/xml")
             except urllib2.HTTPError, e:
                 result = log.FATAL
                 remote = True # Peer error
@@ -506,11 +524,15 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             else:
                 result = log.SUCCESS
                 message = "data sent successfully (%s records)" % count
+                # Remember the hashes of the sent records
+                S3SyncDelta.update(repository.id, hashes)
 
         else:
             # No data to send
             result = log.WARNING
             message = "No data to send"
+        if skipped:
+            message = "%s, %s unchanged records skipped" % (message, skipped)
 
         # Log the operation
         log.write(repository_id=repository.id,
@@ -526,4 +548,157 @@ class S3SyncAdapter(S3SyncBaseAdapter):
             mtime = None
         return (output, mtime)
 
+    # -------------------------------------------------------------------------
+    def send(self, url, data=None, content_type=None):
+        """
+            Send a request to the repository, re-using the connection
+            of previous requests (HTTP keep-alive), with compression
+
+            @param url: the URL
+            @param data: the data to send (POST), None for GET
+            @param content_type: the content type of the data
+
+            @return: tuple (data, headers) with the received data
+                     (decompressed) and a dict of the response headers
+                     (with lower-case names)
+
+            @raises urllib2.HTTPError: if the peer responds with an
+                                       HTTP error status
+        """
+
+        repository = self.repository
+
+        headers = {"Accept-Encoding": "gzip, deflate"}
+
+        # Authentication: send credentials unsolicitedly
+        username = repository.username
+        password = repository.password
+        if username and password:
+            import base64
+            base64string = base64.encodestring('%s:%s' %
+                                               (username, password))[:-1]
+            headers["Authorization"] = "Basic %s" % base64string
+
+        if data is not None:
+            method = "POST"
+            if content_type:
+                headers["Content-Type"] = content_type
+            # Compress if the peer has told us that it accepts that
+            encoding = S3Sync.accept_encoding(self.encodings)
+            if encoding:
+                data = S3Sync.encode_content(data, encoding)
+                headers["Content-Encoding"] = encoding
+        else:
+            method = "GET"
+
+        redirects = 0
+        while True:
+            connection, path = self.connect(url)
+            try:
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if not self.reused:
+                    raise
+                # Peer has closed the connection in the meantime => retry
+                connection, path = self.connect(url)
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            self.reused = True
+
+            status = response.status
+            response_headers = dict(response.getheaders())
+            if response.will_close:
+                self.close()
+
+            # Follow redirects
+            location = response_headers.get("location")
+            if status in (301, 302, 303, 307) and location and redirects < 5:
+                redirects += 1
+                url = urlparse.urljoin(url, location)
+                if status == 303:
+                    method, data = "GET", None
+                continue
+            break
+
+        encodings = response_headers.get("accept-encoding")
+        if encodings:
+            self.encodings = encodings
+
+        # Decompress the response
+        encoding = response_headers.get("content-encoding")
+        if encoding and body:
+            try:
+                body = S3Sync.decode_content(body, encoding.lower())
+            except zlib.error:
+                raise httplib.HTTPException("Invalid %s content" % encoding)
+
+        if status >= 400:
+            raise urllib2.HTTPError(url,
+                                    status,
+                                    response.reason,
+                                    response.msg,
+                                    StringIO(body))
+
+        return body, response_headers
+
+    # -------------------------------------------------------------------------
+    def connect(self, url):
+        """
+            Get a connection to the host of a URL (from a previous
+            request, if possible)
+
+            @param url: the URL
+
+            @return: tuple (connection, path), where path is the path
+                     to request at the connection
+        """
+
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        scheme = scheme or "http"
+        if query:
+            path = "%s?%s" % (path, query)
+
+        repository = self.repository
+        proxy = repository.proxy or repository.config.proxy or None
+        if proxy and scheme == "http":
+            # Request the complete URL from the proxy
+            path = url
+
+        key = (scheme, host)
+        connection = self.connection
+        if connection is not None and self.connection_key == key:
+            return connection, path
+        self.close()
+
+        if scheme == "https":
+            connect = httplib.HTTPSConnection
+        else:
+            connect = httplib.HTTPConnection
+        if proxy:
+            _debug("using proxy=%s" % proxy)
+            proxy_host = urlparse.urlsplit(proxy).netloc or proxy
+            connection = connect(proxy_host)
+            if scheme == "https":
+                connection.set_tunnel(host)
+        else:
+            connection = connect(host)
+
+        self.connection = connection
+        self.connection_key = key
+        self.reused = False
+        return connection, path
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Close the connection to the repository """
+
+        connection = self.connection
+        if connection is not None:
+            self.connection = None
+            connection.close()
+
 # End =========================================================================
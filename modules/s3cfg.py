@@ -542,6 +542,15 @@ class S3Config(Storage):
         """ Hook to determine the owner entity of a record """
         return self.auth.get("realm_entity", None)
 
+    def get_auth_realm_closure(self):
+        """
+            Maintain a closure table of the OU hierarchy (pr_pentity_closure)
+            and use it for ancestor/descendant lookups instead of recursive
+            queries, and to look up the subsidiaries in realm queries
+            (run pr_rebuild_closure once when enabling this)
+        """
+        return self.auth.get("realm_closure", False)
+
     def get_auth_person_realm_human_resource_site_then_org(self):
         """
             Should we set pr_person.realm_entity to that of
@@ -619,6 +628,20 @@ class S3Config(Storage):
         return self.security.get("strict_ownership", True)
     def get_security_map(self):
         return self.security.get("map", False)
+    def get_security_acl_cache(self):
+        """
+            Share compiled ACLs and permission decisions across requests
+        """
+        return self.security.get("acl_cache", False)
+    def get_security_acl_cache_size(self):
+        """ Maximum number of items in the shared ACL cache """
+        return self.security.get("acl_cache_size", 10000)
+    def get_security_acl_cache_expire(self):
+        """
+            Lifetime (seconds) of the shared ACL cache, to catch up with
+            ACL changes made by other processes
+        """
+        return self.security.get("acl_cache_expire", 300)
 
     # -------------------------------------------------------------------------
     # Base settings
@@ -715,6 +738,28 @@ class S3Config(Storage):
             raise HTTP(501, body="Database type '%s' not recognised - please correct file models/000_config.py." % db_type)
         return db_string
 
+    def get_base_represent_cache(self):
+        """
+            Share the representations of foreign keys (S3Represent lookups)
+            between requests in a process-wide cache
+        """
+        return self.base.get("represent_cache", False)
+
+    def get_base_represent_cache_size(self):
+        """
+            Maximum number of representations in the shared cache
+        """
+        return self.base.get("represent_cache_size", 50000)
+
+    def get_base_represent_cache_expire(self):
+        """
+            Time (in seconds) after which representations in the shared
+            cache expire, limits the time for changes of the lookup table
+            which bypass the DAL (or happen in other processes) to become
+            visible
+        """
+        return self.base.get("represent_cache_expire", 300)
+
     def get_base_session_memcache(self):
         """
             Should we store sessions in a Memcache service to allow sharing
@@ -728,6 +773,44 @@ class S3Config(Storage):
         """
         return self.base.get("solr_url", False)
 
+    def get_base_import_bulk(self):
+        """
+            Insert new records of the same table in batches during imports
+            (multi-row INSERTs, batched owner updates), e.g. for prepopulate
+            - assumes that the source contains no duplicates other than
+              by UID (custom deduplicators do not see deferred records)
+        """
+        return self.base.get("import_bulk", False)
+
+    def get_base_import_bulk_size(self):
+        """ Maximum number of records per batch in bulk imports """
+        return self.base.get("import_bulk_size", 500)
+
+    def get_base_prepopulate_workers(self):
+        """
+            Number of processes to run independent prepopulate import
+            tasks in parallel (not for SQLite), 1 to run all tasks in
+            sequence
+        """
+        return self.base.get("prepopulate_workers", 1)
+
+    def get_base_import_batch_size(self):
+        """
+            Import CSV/XLS sources in batches of this number of rows,
+            committing each batch separately (bounded memory for large
+            sources, but no rollback of previous batches at errors),
+            None to import each source as a whole
+        """
+        return self.base.get("import_batch_size", None)
+
+    def get_base_import_index(self):
+        """
+            Look up the originals of import items (by UID, unique fields
+            and the deduplicate_index keys of the table) in batches rather
+            than per item, for large imports and sync
+        """
+        return self.base.get("import_index", False)
+
     def get_import_callback(self, tablename, callback):
         """
             Lookup callback to use for imports in the following order:
@@ -1193,6 +1276,17 @@ class S3Config(Storage):
         """
         return self.gis.get("simplify_tolerance", 0.01)
 
+    def get_gis_simplify_levels(self):
+        """
+            Tolerances at which simplified polygons are precomputed
+            (gis_location_simplified), e.g. (0.01, 0.001, 0.0001)
+            - polygons requested with a tolerance are then served from the
+              coarsest precomputed level which is not coarser than that,
+              rather than simplified on-the-fly
+            - run the gis_rebuild_simplified task after changing this
+        """
+        return self.gis.get("simplify_levels", None)
+
     def get_gis_spatialdb(self):
         """
             Does the database have Spatial extensions?
@@ -1204,6 +1298,102 @@ class S3Config(Storage):
         else:
             return self.gis.get("spatialdb", False)
 
+    def get_gis_config_cache(self):
+        """
+            Cache compiled map configurations (resolved layers, markers
+            and styles) across requests, keyed by config, user roles and
+            language and the version stamps of the GIS tables
+        """
+        return self.gis.get("config_cache", False)
+
+    def get_gis_config_cache_backend(self):
+        """
+            Name of the web2py cache to store compiled map configurations
+            in (e.g. "ram" or "redis"), None to use a size-bounded
+            in-process LRU cache
+        """
+        return self.gis.get("config_cache_backend", None)
+
+    def get_gis_config_cache_size(self):
+        """
+            Maximum number of compiled map configurations in the
+            in-process cache
+        """
+        return self.gis.get("config_cache_size", 100)
+
+    def get_gis_config_cache_expire(self):
+        """
+            Time in seconds after which compiled map configurations expire
+        """
+        return self.gis.get("config_cache_expire", 3600)
+
+    def get_gis_feeds(self):
+        """
+            Static GeoJSON[P] feeds to publish (see S3GeoJSONFeed),
+            as dict {name: {"resource", "filter", "fields", "location",
+                            "jsonp", "decimals"}}
+        """
+        return self.gis.get("feeds", {})
+
+    def get_gis_spatial_index(self):
+        """
+            Use an in-process spatial index (S3SpatialIndex) of the
+            prepared geometries of all polygon locations for lookups
+            without a spatial database (reverse geocoding, features
+            in/by shape, parent boundary checks) - requires Shapely
+        """
+        return self.gis.get("spatial_index", False)
+
+    def get_gis_spatial_index_check(self):
+        """
+            Maximum number of seconds between two checks of the spatial
+            index for changed locations (other than with every write to
+            gis_location through the DAL), 0 to check with every lookup
+        """
+        return self.gis.get("spatial_index_check", 10)
+
+    def get_gis_feature_tiles(self):
+        """
+            Whether Feature Layers should advertise a tiled endpoint
+            (S3Map.tile: /<c>/<f>/map.geojson?layer=<id>&z={z}&x={x}&y={y})
+            as "tiles" URL template in the layer configuration
+        """
+        return self.gis.get("feature_tiles", False)
+
+    def get_gis_tile_cluster_zoom(self):
+        """
+            Maximum zoom level at which points are clustered server-side
+            in Feature Layer tiles
+        """
+        return self.gis.get("tile_cluster_zoom", 10)
+
+    def get_gis_tile_cache(self):
+        """
+            Cache Feature Layer tiles across requests, keyed by layer,
+            tile, filter, access rules and the version stamps of the
+            resource and location tables
+        """
+        return self.gis.get("tile_cache", False)
+
+    def get_gis_tile_cache_backend(self):
+        """
+            Name of the web2py cache to store tiles in (e.g. "ram", "disk"
+            or "redis"), None to use a size-bounded in-process LRU cache
+        """
+        return self.gis.get("tile_cache_backend", None)
+
+    def get_gis_tile_cache_size(self):
+        """
+            Maximum number of tiles in the in-process tile cache
+        """
+        return self.gis.get("tile_cache_size", 1000)
+
+    def get_gis_tile_cache_expire(self):
+        """
+            Time in seconds after which cached tiles expire
+        """
+        return self.gis.get("tile_cache_expire", 3600)
+
     def get_gis_widget_catalogue_layers(self):
         """
             Should Map Widgets display Catalogue Layers?
@@ -1490,6 +1680,15 @@ class S3Config(Storage):
                 return formstyles[setting]
         return setting
 
+    def get_ui_datatables_count_limit(self):
+        """
+            Count the matching records for dataTables only up to this
+            number, and use an estimate beyond (PostgreSQL query planner,
+            otherwise this number) - None for exact counts
+        """
+
+        return self.ui.get("datatables_count_limit", None)
+
     def get_ui_datatables_dom(self):
         """
             DOM layout for dataTables:
@@ -1579,6 +1778,13 @@ class S3Config(Storage):
         return self.ui.get("export_formats",
                            ("cap", "have", "kml", "map", "pdf", "rss", "xls", "xml"))
 
+    def get_ui_export_chunk_size(self):
+        """
+            Number of records to extract at a time when exporting large
+            result sets (CSV, JSON, XLS), to limit memory consumption
+        """
+        return self.ui.get("export_chunk_size", 1000)
+
     def get_ui_hide_report_filter_options(self):
         """
             Show report filter options form by default
@@ -1774,6 +1980,50 @@ class S3Config(Storage):
         """
         return self.ui.get("filter_auto_submit", 800)
 
+    def get_ui_filter_facets(self):
+        """
+            Determine the options of S3OptionsFilter/S3LocationFilter
+            widgets (and their record counts) with a single GROUPBY query
+            per widget wherever the filter fields allow it
+        """
+        return self.ui.get("filter_facets", True)
+
+    def get_ui_filter_option_counts(self):
+        """
+            Show the number of matching records next to the options of
+            S3OptionsFilter/S3LocationFilter widgets (can be overridden
+            per widget with the "counts" option)
+        """
+        return self.ui.get("filter_option_counts", False)
+
+    def get_ui_filter_facet_cache(self):
+        """
+            Cache filter options (facets) across requests, keyed by
+            filter, language, access rules and the version stamps of
+            all involved tables
+        """
+        return self.ui.get("filter_facet_cache", False)
+
+    def get_ui_filter_facet_cache_backend(self):
+        """
+            Name of the web2py cache to store filter options in (e.g.
+            "ram", "disk" or "redis"), None to use a size-bounded
+            in-process LRU cache
+        """
+        return self.ui.get("filter_facet_cache_backend", None)
+
+    def get_ui_filter_facet_cache_size(self):
+        """
+            Maximum number of entries in the in-process filter options cache
+        """
+        return self.ui.get("filter_facet_cache_size", 500)
+
+    def get_ui_filter_facet_cache_expire(self):
+        """
+            Time in seconds after which cached filter options expire
+        """
+        return self.ui.get("filter_facet_cache_expire", 600)
+
     def get_ui_report_auto_submit(self):
         """
             Time in milliseconds after the last filter option change to
@@ -1781,6 +2031,43 @@ class S3Config(Storage):
         """
         return self.ui.get("report_auto_submit", 800)
 
+    def get_ui_report_cache(self):
+        """
+            Cache aggregated report data (pivot tables, time plots)
+            across requests, keyed by filter, report options, language,
+            access rules and the version stamps of all involved tables
+        """
+        return self.ui.get("report_cache", False)
+
+    def get_ui_report_cache_backend(self):
+        """
+            Name of the web2py cache to store report data in (e.g. "ram",
+            "disk" or "redis" if current.cache.redis is configured),
+            None to use a size-bounded in-process LRU cache
+        """
+        return self.ui.get("report_cache_backend", None)
+
+    def get_ui_report_cache_size(self):
+        """
+            Maximum number of entries in the in-process report cache
+        """
+        return self.ui.get("report_cache_size", 100)
+
+    def get_ui_report_cache_expire(self):
+        """
+            Time in seconds after which cached report data expire
+        """
+        return self.ui.get("report_cache_expire", 3600)
+
+    def get_ui_report_db_aggregate(self):
+        """
+            Aggregate pivot table layers in the database (GROUPBY) rather
+            than in Python whenever all report axes and facts allow it
+            (i.e. non-virtual, non-list fields in the master table or in
+            tables referenced by foreign keys)
+        """
+        return self.ui.get("report_db_aggregate", False)
+
     def get_ui_use_button_icons(self):
         """
             Use icons on action buttons (requires corresponding CSS)
@@ -1994,6 +2281,14 @@ class S3Config(Storage):
     # =========================================================================
     # Sync
     #
+    def get_sync_page_size(self):
+        """
+            Number of records to pull from Sahana Eden peers per
+            request (None to pull all records in a single request)
+        """
+
+        return self.sync.get("page_size", None)
+
     def get_sync_mcb_resource_identifiers(self):
         """
             Resource (=data type) identifiers for synchronization with
@@ -48,6 +48,7 @@ __all__ = ("S3LocationModel",
            "gis_rheader",
            )
 
+import datetime
 import os
 
 try:
@@ -75,6 +76,7 @@ class S3LocationModel(S3Model):
     """
 
     names = ("gis_location",
+             "gis_location_simplified",
              #"gis_location_error",
              "gis_location_id",
              "gis_country_id",
@@ -223,6 +225,19 @@ class S3LocationModel(S3Model):
                   readable = False,
                   writable = False,
                   ),
+            # Bounding box index for non-spatial databases
+            # - key of the quadtree tile containing the bounds,
+            #   see GIS.get_quadkey and GIS.query_quadkey
+            Field("quadkey", length=16,
+                  compute = lambda row: \
+                            GIS.get_quadkey(row["lon_min"],
+                                            row["lat_min"],
+                                            row["lon_max"],
+                                            row["lat_max"],
+                                            ),
+                  readable = False,
+                  writable = False,
+                  ),
             # m in height above WGS84 ellipsoid (approximately sea-level).
             Field("elevation", "double",
                   readable = False,
@@ -371,6 +386,12 @@ class S3LocationModel(S3Model):
                        context = {"location": "parent",
                                   },
                        deduplicate = self.gis_location_duplicate,
+                       deduplicate_index = ("name",
+                                            "level",
+                                            "parent",
+                                            "start_date",
+                                            "end_date",
+                                            ),
                        list_fields = list_fields,
                        list_orderby = "gis_location.name",
                        onaccept = self.gis_location_onaccept,
@@ -405,6 +426,22 @@ class S3LocationModel(S3Model):
                             org_site = "location_id",
                             )
 
+        # ---------------------------------------------------------------------
+        # Simplified Geometries
+        # - precomputed GeoJSON of polygons at settings.gis.simplify_levels
+        # - maintained by GIS.update_simplified, do not edit
+        #
+        tablename = "gis_location_simplified"
+        self.define_table(tablename,
+                          Field("location_id", "reference gis_location",
+                                ondelete = "CASCADE",
+                                ),
+                          Field("tolerance", "double"),
+                          Field("geojson", "text"),
+                          # MD5 of the source WKT
+                          Field("checksum", length=32),
+                          )
+
         # ---------------------------------------------------------------------
         # Error
         # - needed for COT support
@@ -461,6 +498,11 @@ class S3LocationModel(S3Model):
             db = current.db
             db(db.gis_location.id == id).update(path=None)
 
+        if current.deployment_settings.get_gis_spatial_index():
+            # Make sure this process re-reads the geometries
+            # (other processes detect the change by its modified_on)
+            S3SpatialIndex.clear(form_vars.get("level", False))
+
         if not auth.override and \
            not auth.rollback:
             # Update the Path (async if-possible)
@@ -629,7 +671,22 @@ class S3LocationModel(S3Model):
                             current.log.error(error)
                             return
 
-                        # @ToDo: Precise (GIS function)
+                        if settings.get_gis_spatial_index():
+                            # Precise check against the Parent's geometry
+                            within = S3SpatialIndex.contains(parent, lat, lon)
+                            if within is False:
+                                if name:
+                                    error = T("Sorry location %(location)s appears to be outside the area of parent %(parent)s.") % \
+                                        dict(location=name, parent=parent_name)
+                                else:
+                                    error = T("Sorry location appears to be outside the area of parent %(parent)s.") % \
+                                        dict(parent=parent_name)
+                                response.error = error
+                                form.errors["lat"] = error
+                                current.log.error(error)
+                                return
+
+                        # @ToDo: Precise (GIS function) without spatial index
                         # (if using PostGIS then don't do a separate BBOX check as this is done within the query)
 
                     else:
@@ -758,6 +815,11 @@ class S3LocationModel(S3Model):
 
         table = item.table
 
+        # Prefer open-ended (=current) records, then the latest end_date
+        # (explicit NULL handling, as the DB order of NULLs varies)
+        latest = datetime.date.max
+        orderby = ~table.end_date.coalesce(latest) | table.id
+
         code = current.deployment_settings.get_gis_lookup_code()
         if code:
             # The name is a Code
@@ -768,7 +830,7 @@ class S3LocationModel(S3Model):
             duplicate = current.db(query).select(table.id,
                                                  table.name,
                                                  table.level,
-                                                 orderby=~table.end_date,
+                                                 orderby=orderby,
                                                  limitby=(0, 1)).first()
 
             if duplicate:
@@ -791,20 +853,42 @@ class S3LocationModel(S3Model):
         # Try the Name
         # @ToDo: Hook for possible duplicates vs definite?
         #query = (table.name.lower().like('%%%s%%' % name.lower()))
-        query = (table.name.lower() == name.lower()) & \
-                (table.level == level)
-        if parent:
-            query &= (table.parent == parent)
-        if end_date:
-            query &= (table.end_date == end_date)
-        if start_date:
-            query &= ((table.start_date == start_date) | \
-                      (table.end_date == None))
+        index = item.job.index
+        if index:
+            keys = {"name": name, "level": level}
+            if parent:
+                keys["parent"] = parent
+            if end_date:
+                keys["end_date"] = end_date
+            rows = index.lookup(table, **keys)
+        else:
+            rows = None
+        if rows is not None:
+            if start_date:
+                rows = [row for row in rows
+                        if row.start_date == start_date or row.end_date is None]
+            # Same order as in the database query below
+            rows = sorted(rows, key=lambda row: row.id)
+            rows = sorted(rows,
+                          key=lambda row: row.end_date or latest,
+                          reverse=True,
+                          )
+            duplicate = rows[0] if rows else None
+        else:
+            query = (table.name.lower() == name.lower()) & \
+                    (table.level == level)
+            if parent:
+                query &= (table.parent == parent)
+            if end_date:
+                query &= (table.end_date == end_date)
+            if start_date:
+                query &= ((table.start_date == start_date) | \
+                          (table.end_date == None))
 
-        duplicate = current.db(query).select(table.id,
-                                             table.level,
-                                             orderby=~table.end_date,
-                                             limitby=(0, 1)).first()
+            duplicate = current.db(query).select(table.id,
+                                                 table.level,
+                                                 orderby=orderby,
+                                                 limitby=(0, 1)).first()
         if duplicate:
             # @ToDo: Import Log
             #current.log.debug("Location Match")
@@ -829,7 +913,7 @@ class S3LocationModel(S3Model):
             duplicate = current.db(query).select(table.id,
                                                  table.name,
                                                  table.level,
-                                                 orderby=~table.end_date,
+                                                 orderby=orderby,
                                                  limitby=(0, 1)).first()
             if duplicate:
                 # @ToDo: Import Log
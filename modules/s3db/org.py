@@ -519,6 +519,7 @@ class S3OrganisationModel(S3Model):
                              },
                   crud_form = crud_form,
                   deduplicate = self.organisation_duplicate,
+                  deduplicate_index = ("name",),
                   filter_widgets = filter_widgets,
                   list_fields = ["id",
                                  "name",
@@ -889,10 +890,14 @@ class S3OrganisationModel(S3Model):
         name = item.data.get("name", None)
         if name:
             table = item.table
-            query = (table.name.lower() == name.lower())
-            duplicate = current.db(query).select(table.id,
-                                                 table.name,
-                                                 limitby=(0, 1)).first()
+            index = item.job.index
+            rows = index.lookup(table, name=name) if index else None
+            if rows is None:
+                query = (table.name.lower() == name.lower())
+                rows = current.db(query).select(table.id,
+                                                table.name,
+                                                limitby=(0, 1))
+            duplicate = rows[0] if rows else None
             if duplicate:
                 item.id = duplicate.id
                 # Retain the correct spelling of the name
@@ -3663,123 +3668,51 @@ class S3FacilityModel(S3Model):
         """
             Produce a static GeoJSON[P] feed of Facility data
             Designed to be run on a schedule to serve a high-volume website
+
+            - published as static/cache/feeds/facility.js (facility.json
+              if jsonp is False), see S3GeoJSONFeed
+            - also written to the previous location
+              static/cache/facility.geojsonp (facility.geojson), which
+              is deprecated and will be dropped in a future release
         """
 
-        from shapely.geometry import Point
-        from ..geojson import dumps
+        def L1(value):
+            # Encode smaller if-possible
+            if value == "New York":
+                return "NY"
+            elif value == "New Jersey":
+                return "NJ"
+            return value
+
+        fields = ["name",
+                  ("type", "site_facility_type.facility_type_id"),
+                  ("open", "opening_times"),
+                  "comments",
+                  ("addr", "location_id$addr_street"),
+                  ("L1", "location_id$L1", L1),
+                  ("L4", "location_id$L4"),
+                  ("ph1", "phone1"),
+                  ("ph2", "phone2"),
+                  "email",
+                  ("web", "website"),
+                  ]
 
-        db = current.db
-        s3db = current.s3db
-        stable = s3db.org_facility
-        ltable = db.org_site_facility_type
-        ttable = db.org_facility_type
-        gtable = db.gis_location
-        ntable = s3db.req_site_needs
-
-        # Limit the number of decimal places
-        formatter = ".%sf" % decimals
-
-        # All Facilities
-        query = (stable.deleted != True) & \
-                (stable.obsolete != True) & \
-                (gtable.id == stable.location_id)
-        lquery = (ntable.deleted != True) & \
-                 (ntable.site_id == stable.site_id)
-        left = [ntable.on(lquery),
-                ltable.on(stable.site_id == ltable.site_id),
-                ttable.on(ttable.facility_type_id == ltable.facility_type_id),
-                ]
-        facs = db(query).select(stable.id,
-                                stable.name,
-                                ttable.name,
-                                stable.comments,
-                                stable.opening_times,
-                                stable.phone1,
-                                stable.phone2,
-                                stable.email,
-                                stable.website,
-                                ntable.needs,
-                                gtable.addr_street,
-                                gtable.L1,
-                                gtable.L4,
-                                gtable.lat,
-                                gtable.lon,
-                                left=left,
-                                )
-        features = []
-        append = features.append
-        for f in facs:
-            g = f.gis_location
-            x = g.lon
-            y = g.lat
-            if x is None or y is None:
-                continue
-            x = float(format(x, formatter))
-            y = float(format(y, formatter))
-            shape = Point(x, y)
-            # Compact Encoding
-            geojson = dumps(shape, separators=SEPARATORS)
-            o = f.org_facility
-            properties = {"id": o.id,
-                          "name": o.name,
-                          }
-            if f.get("org_facility_type.name"):
-                properties["type"] = f["org_facility_type.name"]
-            if o.opening_times:
-                properties["open"] = o.opening_times
-            if o.comments:
-                properties["comments"] = o.comments
-            if g.addr_street:
-                properties["addr"] = g.addr_street
-            if g.L1:
-                # Encode smaller if-possible
-                L1 = g.L1
-                if L1 == "New York":
-                    properties["L1"] = "NY"
-                elif L1 == "New Jersey":
-                    properties["L1"] = "NJ"
-                else:
-                    properties["L1"] = L1
-            if g.L4:
-                properties["L4"] = g.L4
-            if o.phone1:
-                properties["ph1"] = o.phone1
-            if o.phone2:
-                properties["ph2"] = o.phone2
-            if o.email:
-                properties["email"] = o.email
-            if o.website:
-                properties["web"] = o.website
-            n = f.req_site_needs
-            if n:
-                if n.needs:
-                    needs = json.loads(n.needs)
-                    if "urgent" in needs:
-                        properties["urgent"] = needs["urgent"]
-                    if "need" in needs:
-                        properties["need"] = needs["need"]
-                    if "no" in needs:
-                        properties["no"] = needs["no"]
-            f = dict(type = "Feature",
-                     properties = properties,
-                     geometry = json.loads(geojson)
-                     )
-            append(f)
-        data = dict(type = "FeatureCollection",
-                    features = features
-                    )
-        output = json.dumps(data, separators=SEPARATORS)
-        if jsonp:
-            filename = "facility.geojsonp"
-            output = "grid(%s)" % output
-        else:
-            filename = "facility.geojson"
-        path = os.path.join(current.request.folder,
-                            "static", "cache",
-                            filename)
-        File = open(path, "w")
-        File.write(output)
-        File.close()
+        if current.deployment_settings.has_module("req"):
+            # Needs
+            def need(key):
+                return lambda value: json.loads(value).get(key)
+            for key in ("urgent", "need", "no"):
+                fields.append((key, "needs.needs", need(key)))
+
+        config = {"resource": "org_facility",
+                  "filter": (FS("obsolete") != True),
+                  "fields": fields,
+                  "jsonp": "grid" if jsonp else None,
+                  "decimals": decimals,
+                  # Deprecated location
+                  "aliases": ["facility.geojsonp" if jsonp else "facility.geojson"],
+                  }
+        S3GeoJSONFeed("facility", config).publish(force=True)
 
 # -----------------------------------------------------------------------------
 def org_facility_rheader(r, tabs=[]):
@@ -4437,6 +4370,10 @@ def org_parents(organisation_id, path=[]):
     s3db = current.s3db
     otable = s3db.org_organisation
     btable = s3db.org_organisation.with_alias("org_branch_organisation")
+
+    if current.deployment_settings.get_auth_realm_closure():
+        return org_closure_parents(organisation_id) + path
+
     ltable = s3db.org_organisation_branch
 
     query = (btable.id == organisation_id)
@@ -4457,6 +4394,59 @@ def org_parents(organisation_id, path=[]):
         # This is the root org
         return path
 
+# =============================================================================
+def org_closure_parents(organisation_id):
+    """
+        Lookup the parent organisations of a branch organisation using
+        the OU closure table (settings.auth.realm_closure): one query for
+        all OU ancestors, one query for the branch links among them (as
+        other OU affiliations do not make an organisation a parent)
+
+        @param organisation_id: the organisation's record ID
+
+        @return: list of ids of the parent organisations, root first
+                 (like org_parents)
+    """
+
+    db = current.db
+    s3db = current.s3db
+    otable = s3db.org_organisation
+    btable = s3db.org_organisation.with_alias("org_branch_organisation")
+    ctable = s3db.pr_pentity_closure
+
+    query = (btable.id == organisation_id) & \
+            (btable.deleted != True) & \
+            (ctable.descendant_pe_id == btable.pe_id) & \
+            (otable.pe_id == ctable.ancestor_pe_id) & \
+            (otable.deleted != True)
+    rows = db(query).select(otable.id)
+    ancestors = set(row.id for row in rows)
+    if not ancestors:
+        return []
+
+    ltable = s3db.org_organisation_branch
+    query = (ltable.branch_id.belongs(ancestors | set([organisation_id]))) & \
+            (ltable.organisation_id.belongs(ancestors)) & \
+            (ltable.deleted != True)
+    rows = db(query).select(ltable.organisation_id,
+                            ltable.branch_id,
+                            orderby = ltable.id,
+                            )
+    parent = {}
+    for row in rows:
+        if row.branch_id not in parent:
+            parent[row.branch_id] = row.organisation_id
+
+    # Follow the branch links up to the root
+    parents = []
+    node = organisation_id
+    while node in parent:
+        node = parent[node]
+        if node == organisation_id or node in parents:
+            break
+        parents.insert(0, node)
+    return parents
+
 # =============================================================================
 def org_root_organisation(organisation_id):
     """
@@ -4475,6 +4465,11 @@ def org_root_organisation(organisation_id):
     s3db = current.s3db
     otable = s3db.org_organisation
     btable = s3db.org_organisation.with_alias("org_branch_organisation")
+
+    if current.deployment_settings.get_auth_realm_closure():
+        parents = org_closure_parents(organisation_id)
+        return parents[0] if parents else organisation_id
+
     ltable = s3db.org_organisation_branch
 
     query = (btable.id == organisation_id)
@@ -79,6 +79,8 @@ __all__ = ("S3PersonEntity",
            # Internal Path Tools
            "pr_rebuild_path",
            "pr_role_rebuild_path",
+           "pr_update_closure",
+           "pr_rebuild_closure",
            # Helpers for ImageLibrary
            "pr_image_modify",
            "pr_image_resize",
@@ -120,6 +122,7 @@ class S3PersonEntity(S3Model):
 
     names = ("pr_pentity",
              "pr_affiliation",
+             "pr_pentity_closure",
              "pr_person_user",
              "pr_role",
              "pr_role_types",
@@ -339,6 +342,8 @@ class S3PersonEntity(S3Model):
 
         # Resource configuration
         configure(tablename,
+                  onaccept = self.pr_role_onaccept,
+                  ondelete = self.pr_role_ondelete,
                   onvalidation = self.pr_role_onvalidation,
                   )
 
@@ -392,6 +397,20 @@ class S3PersonEntity(S3Model):
                   ondelete = self.pr_affiliation_ondelete,
                   )
 
+        # ---------------------------------------------------------------------
+        # Affiliation Closure
+        # - all ancestor/descendant pairs in the OU hierarchy, for realm
+        #   lookups with a single join (settings.auth.realm_closure)
+        # - maintained by pr_update_closure, do not edit
+        #
+        tablename = "pr_pentity_closure"
+        define_table(tablename,
+                     Field("ancestor_pe_id", "integer"),
+                     Field("descendant_pe_id", "integer"),
+                     # Shortest distance (1 = immediate OU parent)
+                     Field("depth", "integer"),
+                     )
+
         # ---------------------------------------------------------------------
         # Pass names back to global scope (s3.*)
         #
@@ -595,6 +614,65 @@ class S3PersonEntity(S3Model):
                 current.s3db.pr_role_rebuild_path(role_id, clear=True)
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_role_onaccept(form):
+        """
+            Update the closure table for all affiliates of the role (in
+            case the role type has changed)
+
+            @param form: the CRUD form
+        """
+
+        if not current.deployment_settings.get_auth_realm_closure():
+            return
+
+        role_id = form.vars.id
+        if not role_id:
+            return
+
+        atable = current.s3db.pr_affiliation
+        query = (atable.role_id == role_id) & \
+                (atable.deleted != True)
+        rows = current.db(query).select(atable.pe_id)
+        for row in rows:
+            pr_update_closure(row.pe_id)
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_role_ondelete(row):
+        """
+            Update the closure table for all former affiliates of the role
+            (the affiliations may have been removed by a database cascade,
+            so this looks at all immediate OU descendants of the role owner)
+
+            @param row: the deleted Row
+        """
+
+        if not current.deployment_settings.get_auth_realm_closure():
+            return
+
+        db = current.db
+
+        pe_id = row.pe_id if "pe_id" in row else None
+        if not pe_id:
+            rtable = db.pr_role
+            record = db(rtable.id == row.id).select(rtable.deleted_fk,
+                                                    limitby=(0, 1)).first()
+            if record and record.deleted_fk:
+                pe_id = json.loads(record.deleted_fk).get("pe_id")
+        if not pe_id:
+            return
+
+        ctable = current.s3db.pr_pentity_closure
+        query = (ctable.ancestor_pe_id == pe_id) & \
+                (ctable.depth == 1)
+        rows = db(query).select(ctable.descendant_pe_id)
+        for child in rows:
+            pr_update_closure(child.descendant_pe_id)
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def pr_pentity_onaccept(form):
@@ -652,6 +730,7 @@ class S3PersonEntity(S3Model):
             db(query).update(**data)
             # Clear descendant paths
             current.s3db.pr_rebuild_path(pe_id, clear=True)
+            pr_update_closure(pe_id)
         return
 
     # -------------------------------------------------------------------------
@@ -677,6 +756,7 @@ class S3PersonEntity(S3Model):
             pe_id = data.get("pe_id")
             if pe_id:
                 current.s3db.pr_rebuild_path(pe_id, clear=True)
+                pr_update_closure(pe_id)
         return
 
 # =============================================================================
@@ -5978,7 +6058,7 @@ def pr_delete_role(role_id):
         @param role_id: the role ID
     """
 
-    resource = s3db.resource("pr_role", id=role_id)
+    resource = current.s3db.resource("pr_role", id=role_id)
     return resource.delete()
 
 # =============================================================================
@@ -6003,6 +6083,7 @@ def pr_add_to_role(role_id, pe_id):
         atable.insert(role_id=role_id, pe_id=pe_id)
         # Clear descendant paths (triggers lazy rebuild)
         pr_rebuild_path(pe_id, clear=True)
+        pr_update_closure(pe_id)
     return
 
 # =============================================================================
@@ -6031,6 +6112,7 @@ def pr_remove_from_role(role_id, pe_id):
         affiliation.update_record(**data)
         # Clear descendant paths
         pr_rebuild_path(pe_id, clear=True)
+        pr_update_closure(pe_id)
     return
 
 # =============================================================================
@@ -6196,6 +6278,13 @@ def pr_get_ancestors(pe_id):
     """
 
     s3db = current.s3db
+
+    if current.deployment_settings.get_auth_realm_closure():
+        ctable = s3db.pr_pentity_closure
+        query = (ctable.descendant_pe_id == pe_id)
+        rows = current.db(query).select(ctable.ancestor_pe_id)
+        return [row.ancestor_pe_id for row in rows]
+
     atable = s3db.pr_affiliation
     rtable = s3db.pr_role
     query = (atable.deleted != True) & \
@@ -6308,6 +6397,17 @@ def pr_ancestors(entities):
         return Storage()
 
     s3db = current.s3db
+
+    if current.deployment_settings.get_auth_realm_closure():
+        ctable = s3db.pr_pentity_closure
+        query = (ctable.descendant_pe_id.belongs(entities))
+        rows = current.db(query).select(ctable.ancestor_pe_id,
+                                        ctable.descendant_pe_id)
+        ancestors = Storage([(pe_id, []) for pe_id in entities])
+        for row in rows:
+            ancestors[row.descendant_pe_id].append(row.ancestor_pe_id)
+        return ancestors
+
     atable = s3db.pr_affiliation
     rtable = s3db.pr_role
     query = (atable.deleted != True) & \
@@ -6363,6 +6463,26 @@ def pr_descendants(pe_ids, skip=None, root=True):
 
     s3db = current.s3db
     etable = s3db.pr_pentity
+
+    if root and current.deployment_settings.get_auth_realm_closure():
+        ctable = s3db.pr_pentity_closure
+        query = (ctable.ancestor_pe_id.belongs(pe_ids)) & \
+                (etable.pe_id == ctable.descendant_pe_id) & \
+                (etable.instance_type != "pr_person")
+        rows = current.db(query).select(ctable.ancestor_pe_id,
+                                        ctable.descendant_pe_id)
+        reachable = pr_closure_reachable(pe_ids, skip) if skip else None
+        result = {}
+        for row in rows:
+            parent = row.ancestor_pe_id
+            child = row.descendant_pe_id
+            if reachable is not None and child not in reachable[parent]:
+                continue
+            if parent not in result:
+                result[parent] = []
+            result[parent].append(child)
+        return result
+
     rtable = s3db.pr_role
     atable = s3db.pr_affiliation
 
@@ -6440,6 +6560,24 @@ def pr_get_descendants(pe_ids, entity_types=None, skip=None, ids=True):
     db = current.db
     s3db = current.s3db
     etable = s3db.pr_pentity
+
+    if ids and current.deployment_settings.get_auth_realm_closure():
+        ctable = s3db.pr_pentity_closure
+        query = (ctable.ancestor_pe_id.belongs(pe_ids))
+        if entity_types is not None:
+            if not isinstance(entity_types, (tuple, list, set)):
+                entity_types = [entity_types]
+            query &= (etable.pe_id == ctable.descendant_pe_id) & \
+                     (etable.instance_type.belongs(entity_types))
+        rows = db(query).select(ctable.descendant_pe_id, distinct=True)
+        descendants = [row.descendant_pe_id for row in rows]
+        if skip:
+            reachable = pr_closure_reachable(pe_ids, skip)
+            reachable = set().union(*reachable.values())
+            descendants = [pe_id for pe_id in descendants
+                           if pe_id in reachable]
+        return descendants
+
     rtable = db.pr_role
     atable = db.pr_affiliation
 
@@ -6588,6 +6726,188 @@ def pr_role_rebuild_path(role_id, skip=[], clear=False):
 
     return path
 
+# =============================================================================
+# Closure Table
+# =============================================================================
+def pr_update_closure(pe_id):
+    """
+        Update the closure table for a person entity and all its
+        descendants, after the OU affiliations of the entity have changed
+
+        @param pe_id: the person entity ID
+    """
+
+    if not pe_id or \
+       not current.deployment_settings.get_auth_realm_closure():
+        return
+
+    db = current.db
+    ctable = current.s3db.pr_pentity_closure
+
+    # The descendants of the entity are not affected by changes of
+    # its own affiliations, but their ancestors are:
+    query = (ctable.ancestor_pe_id == pe_id)
+    rows = db(query).select(ctable.descendant_pe_id)
+    nodes = set(row.descendant_pe_id for row in rows)
+    nodes.add(pe_id)
+
+    # Load the OU hierarchy above these nodes, one query per level
+    parents = {}
+    seen = set(nodes)
+    level = nodes
+    while level:
+        edges = pr_ou_edges(level)
+        level = set()
+        for parent, child in edges:
+            if child not in parents:
+                parents[child] = set()
+            parents[child].add(parent)
+            if parent not in seen:
+                seen.add(parent)
+                level.add(parent)
+
+    # Replace the ancestor rows of all nodes
+    db(ctable.descendant_pe_id.belongs(nodes)).delete()
+    items = pr_closure_items(parents, nodes)
+    if items:
+        ctable.bulk_insert(items)
+    return
+
+# =============================================================================
+def pr_rebuild_closure():
+    """
+        Rebuild the closure table for the entire OU hierarchy, e.g. after
+        enabling settings.auth.realm_closure or after bulk changes of
+        affiliations bypassing pr_add_to_role/pr_remove_from_role
+
+        @return: the number of ancestor/descendant pairs
+    """
+
+    db = current.db
+    ctable = current.s3db.pr_pentity_closure
+
+    parents = {}
+    for parent, child in pr_ou_edges():
+        if child not in parents:
+            parents[child] = set()
+        parents[child].add(parent)
+
+    db(ctable.id > 0).delete()
+    items = pr_closure_items(parents, parents.keys())
+    if items:
+        ctable.bulk_insert(items)
+    return len(items)
+
+# -----------------------------------------------------------------------------
+def pr_closure_reachable(pe_ids, skip):
+    """
+        Find the descendants of person entities which can be reached
+        without descending into any of the skipped entities (like the
+        recursive lookups do), using the immediate OU links (depth 1)
+        from the closure table
+
+        @param pe_ids: the person entity IDs to start from
+        @param skip: the person entity IDs not to descend into
+
+        @return: dict {pe_id: set of reachable descendant pe_ids}
+    """
+
+    db = current.db
+    ctable = current.s3db.pr_pentity_closure
+
+    query = (ctable.ancestor_pe_id.belongs(pe_ids))
+    rows = db(query).select(ctable.descendant_pe_id, distinct=True)
+    nodes = set(row.descendant_pe_id for row in rows) | set(pe_ids)
+
+    query = (ctable.ancestor_pe_id.belongs(nodes)) & \
+            (ctable.depth == 1)
+    rows = db(query).select(ctable.ancestor_pe_id,
+                            ctable.descendant_pe_id)
+    children = {}
+    for row in rows:
+        parent = row.ancestor_pe_id
+        if parent not in children:
+            children[parent] = set()
+        children[parent].add(row.descendant_pe_id)
+
+    reachable = {}
+    for pe_id in pe_ids:
+        found = set()
+        level = children.get(pe_id)
+        while level:
+            next_level = set()
+            for node in level:
+                if node in found:
+                    continue
+                found.add(node)
+                if node not in skip:
+                    next_level |= children.get(node, set())
+            level = next_level
+        found.discard(pe_id)
+        reachable[pe_id] = found
+    return reachable
+
+# -----------------------------------------------------------------------------
+def pr_ou_edges(pe_ids=None):
+    """
+        Get the OU affiliations of person entities
+
+        @param pe_ids: the person entity IDs (None for all entities)
+
+        @return: list of tuples (parent pe_id, child pe_id)
+    """
+
+    s3db = current.s3db
+    atable = s3db.pr_affiliation
+    rtable = s3db.pr_role
+
+    query = (atable.deleted != True) & \
+            (atable.role_id == rtable.id) & \
+            (rtable.deleted != True) & \
+            (rtable.role_type == OU)
+    if pe_ids is not None:
+        query &= (atable.pe_id.belongs(pe_ids))
+    rows = current.db(query).select(rtable.pe_id, atable.pe_id)
+
+    r = rtable._tablename
+    a = atable._tablename
+    return [(row[r].pe_id, row[a].pe_id) for row in rows]
+
+# -----------------------------------------------------------------------------
+def pr_closure_items(parents, nodes):
+    """
+        Compute the closure table rows for nodes in an OU hierarchy
+
+        @param parents: dict {child: set of parents}, must contain all
+                        ancestors of the nodes
+        @param nodes: the nodes to compute the ancestors for
+
+        @return: list of dicts for bulk_insert into pr_pentity_closure
+    """
+
+    items = []
+    append = items.append
+    for node in nodes:
+        # Breadth-first, so the first hit is the shortest distance
+        depths = {}
+        level = parents.get(node)
+        depth = 1
+        while level:
+            next_level = set()
+            for parent in level:
+                if parent == node or parent in depths:
+                    continue
+                depths[parent] = depth
+                next_level.update(parents.get(parent, ()))
+            level = next_level
+            depth += 1
+        for ancestor, depth in depths.items():
+            append({"ancestor_pe_id": ancestor,
+                    "descendant_pe_id": node,
+                    "depth": depth,
+                    })
+    return items
+
 # =============================================================================
 def pr_image_represent(image_name,
                        format = None,
@@ -27,7 +27,9 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ("S3HierarchyModel",)
+__all__ = ("S3HierarchyModel",
+           "S3TableVersionModel",
+           )
 
 from gluon import *
 from ..s3 import *
@@ -64,4 +66,28 @@ class S3HierarchyModel(S3Model):
         return dict()
 
 
+# =============================================================================
+class S3TableVersionModel(S3Model):
+    """ Model for table version stamps (see S3TableVersion) """
+
+    names = ("s3_table_version",)
+
+    def model(self):
+
+        # -------------------------------------------------------------------------
+        # Table Version Stamps
+        #
+        tablename = "s3_table_version"
+        self.define_table(tablename,
+                          Field("tablename",
+                                length=64),
+                          Field("stamp",
+                                length=64),
+                          )
+
+        # ---------------------------------------------------------------------
+        # Return global names to s3.*
+        #
+        return dict()
+
 # END =========================================================================
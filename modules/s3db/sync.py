@@ -48,7 +48,8 @@ class SyncDataModel(S3Model):
              "sync_task",
              "sync_resource_filter",
              "sync_job",
-             "sync_log"
+             "sync_log",
+             "sync_record_hash",
              )
 
     def model(self):
@@ -527,6 +528,18 @@ class SyncDataModel(S3Model):
                   deletable=True,
                   orderby="sync_log.timestmp desc")
 
+        # -------------------------------------------------------------------------
+        # Record Hashes
+        # -------------------------------------------------------------------------
+        # Content hashes of the records last exchanged with a repository,
+        # see S3SyncDelta
+        tablename = "sync_record_hash"
+        define_table(tablename,
+                     repository_id(),
+                     Field("tablename"),
+                     Field("uid", length=128),
+                     Field("hash", length=40))
+
         # ---------------------------------------------------------------------
         # Return global names to s3.*
         #
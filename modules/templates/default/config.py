@@ -32,6 +32,19 @@ def config(settings):
     # Unless doing a manual DB migration, where prepopulate = 0
     # In Production, prepopulate = 0 (to save 1x DAL hit every page)
     #settings.base.prepopulate = 1
+    # Uncomment to run independent prepopulate import tasks in parallel processes
+    # (not with SQLite)
+    #settings.base.prepopulate_workers = 4
+
+    # Uncomment to insert new records in batches during imports (faster prepopulate,
+    # requires that the data contain no duplicates other than by UUID)
+    #settings.base.import_bulk = True
+    #settings.base.import_bulk_size = 500
+    # Uncomment to look up existing records for import deduplication in batches
+    #settings.base.import_index = True
+    # Uncomment to import large CSV/XLS sources in batches of rows (bounded memory,
+    # each batch gets committed separately)
+    #settings.base.import_batch_size = 1000
 
     # Theme (folder to use for views/layout.html)
     #settings.base.theme = "default"
@@ -39,6 +52,11 @@ def config(settings):
     # Enable Guided Tours
     settings.base.guided_tour = True
 
+    # Uncomment to share the representations of foreign keys between requests
+    # (cached representations expire after represent_cache_expire seconds)
+    #settings.base.represent_cache = True
+    #settings.base.represent_cache_expire = 300
+
     # Authentication settings
     # These settings should be changed _after_ the 1st (admin) user is
     # registered in order to secure the deployment
@@ -304,6 +322,33 @@ def config(settings):
     #settings.gis.search_geonames = False
     # Uncomment to modify the Simplify Tolerance
     #settings.gis.simplify_tolerance = 0.001
+    # Uncomment to precompute simplified polygons at these Tolerances
+    # (run the gis_rebuild_simplified task after changing this)
+    #settings.gis.simplify_levels = (0.01, 0.001, 0.0001)
+    # Uncomment to cache compiled map configurations (layers, markers & styles) across requests
+    #settings.gis.config_cache = True
+    # Uncomment to use a web2py cache for compiled map configurations instead of the in-process cache
+    #settings.gis.config_cache_backend = "ram"
+    # Static GeoJSON feeds, published by the gis_publish_feeds task as static/cache/feeds/<name>.json (.js for JSONP)
+    # NB The org_facility_geojson task now publishes static/cache/feeds/facility.js - its previous location
+    #    static/cache/facility.geojsonp is still written, but deprecated: please update external websites
+    #settings.gis.feeds = {"facility": {"resource": "org_facility",
+    #                                   "fields": ["name", ("addr", "location_id$addr_street")],
+    #                                   "jsonp": "grid",
+    #                                   },
+    #                      }
+    # Uncomment to keep an in-process spatial index of polygons (for deployments without PostGIS)
+    #settings.gis.spatial_index = True
+    # Maximum number of seconds between checks of the spatial index for changed locations
+    #settings.gis.spatial_index_check = 10
+    # Uncomment to advertise tiled endpoints for Feature Layers (z/x/y GeoJSON or MVT)
+    #settings.gis.feature_tiles = True
+    # Maximum zoom level at which points are clustered server-side in tiles
+    #settings.gis.tile_cluster_zoom = 10
+    # Uncomment to cache Feature Layer tiles across requests
+    #settings.gis.tile_cache = True
+    # Uncomment to use a web2py cache for tiles instead of the in-process cache
+    #settings.gis.tile_cache_backend = "disk"
     # Uncomment to Hide the Toolbar from the main Map
     #settings.gis.toolbar = False
     # Uncomment to show Catalogue Layers in Map Widgets (e.g. Profile & Summary pages)
@@ -344,11 +389,20 @@ def config(settings):
     #
     #settings.security.policy = 7 # Organisation-ACLs
 
+    # Maintain a closure table of the OU hierarchy for realm lookups
+    # (populate it once with static/scripts/tools/realm_closure.py)
+    #settings.auth.realm_closure = True
+
     # Ownership-rule for records without owner:
     # True = not owned by any user (strict ownership, default)
     # False = owned by any authenticated user
     #settings.security.strict_ownership = False
 
+    # Share compiled ACLs and permission decisions across requests
+    # (ACL changes made by other processes take effect after acl_cache_expire seconds)
+    #settings.security.acl_cache = True
+    #settings.security.acl_cache_expire = 300
+
     # Audit
     # - can be a callable for custom hooks (return True to also perform normal logging, or False otherwise)
     # NB Auditing (especially Reads) slows system down & consumes diskspace
@@ -388,6 +442,16 @@ def config(settings):
     #settings.ui.social_buttons = True
     # Enable this to show pivot table options form by default
     #settings.ui.hide_report_options = False
+    # Uncomment to aggregate pivot tables in the database where possible
+    #settings.ui.report_db_aggregate = True
+    # Uncomment to cache aggregated report data across requests
+    #settings.ui.report_cache = True
+    # Uncomment to use a web2py cache for report data instead of the in-process cache
+    #settings.ui.report_cache_backend = "disk"
+    # Uncomment to show the number of matching records next to filter options
+    #settings.ui.filter_option_counts = True
+    # Uncomment to cache filter options across requests
+    #settings.ui.filter_facet_cache = True
     # Uncomment to show created_by/modified_by using Names not Emails
     #settings.ui.auth_user_represent = "name"
     # Uncomment to control the dataTables layout: https://datatables.net/reference/option/dom
@@ -397,10 +461,15 @@ def config(settings):
     #settings.ui.datatables_dom = "<'row'<'large-6 columns'l><'large-6 columns'f>r>t<'row'<'large-6 columns'i><'large-6 columns'p>>"
     # Move the export_formats after the pagination control
     #settings.ui.datatables_initComplete = '''$('.dataTables_paginate').after($('.dt-export-options'))'''
+    # Uncomment to count matching records for dataTables only up to a limit
+    # (estimates larger numbers, speeds up pagination of large tables)
+    #settings.ui.datatables_count_limit = 10000
     # Uncomment for dataTables to use a different paging style:
     #settings.ui.datatables_pagingType = "bootstrap"
     # Uncomment to restrict the export formats available
     #settings.ui.export_formats = ("kml", "pdf", "rss", "xls", "xml")
+    # Number of records to extract at a time for CSV/JSON/XLS exports
+    #settings.ui.export_chunk_size = 500
     # Uncomment to change the label/class of FilterForm clear buttons
     #settings.ui.filter_clear = "Clear"
     # Uncomment to include an Interim Save button on CRUD forms
@@ -850,6 +919,11 @@ def config(settings):
     #                                 title = T("Introduction"),
     #                                 video_id = "HR-FtR2XkBU"),]
 
+    # -------------------------------------------------------------------------
+    # Synchronization
+    # Uncomment to pull data from Sahana Eden peers in pages of this number of records
+    #settings.sync.page_size = 500
+
     # -----------------------------------------------------------------------------
     # XForms
     # Configure xform resources (example)
@@ -277,6 +277,60 @@ class S3PerformanceTests(unittest.TestCase):
 
         current.auth.override = False
 
+    def testS3PermissionHasPermission(self):
+        """ Permission checks per page with and without shared ACL cache """
+
+        from s3.s3aaa import S3Permission, S3PermissionCache
+
+        auth = current.auth
+        settings = current.deployment_settings
+        policy = settings.get_security_policy()
+        acl_cache = settings.get_security_acl_cache()
+
+        # Typical permission checks for a page (menus, action buttons)
+        checks = [("read", "org", "organisation", "org_organisation"),
+                  ("create", "org", "organisation", "org_organisation"),
+                  ("update", "org", "organisation", "org_organisation"),
+                  ("read", "org", "office", "org_office"),
+                  ("read", "pr", "person", "pr_person"),
+                  ("read", "hrm", "staff", "hrm_human_resource"),
+                  ("read", "project", "project", "project_project"),
+                  ("read", "gis", "location", "gis_location"),
+                  ]
+
+        def page():
+            # New request => new S3Permission instance, no per-request cache
+            s3 = current.response.s3
+            s3.pop("permissions", None)
+            s3.pop("restricted_tables", None)
+            auth.permission = S3Permission(auth)
+            has_permission = auth.s3_has_permission
+            for method, c, f, t in checks:
+                has_permission(method, c=c, f=f, table=t)
+                has_permission(method, c=c, f=f)
+
+        settings.security.policy = 7
+        auth.s3_impersonate("normaluser@example.com")
+
+        print ""
+        settings.security.acl_cache = False
+        mlt = timeit.Timer(page).timeit(number=100) * 10
+        print "S3Permission.has_permission (per page, no ACL cache) = %s ms" % mlt
+
+        settings.security.acl_cache = True
+        S3PermissionCache.clear()
+        page()
+        cached = timeit.Timer(page).timeit(number=100) * 10
+        print "S3Permission.has_permission (per page, ACL cache) = %s ms" % cached
+
+        settings.security.policy = policy
+        settings.security.acl_cache = acl_cache
+        S3PermissionCache.clear()
+        auth.s3_impersonate(None)
+        auth.permission = S3Permission(auth)
+
+        self.assertTrue(cached < mlt)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -9,7 +9,7 @@ import unittest
 
 from gluon import *
 from gluon.storage import Storage
-from s3.s3aaa import S3EntityRoleManager, S3Permission
+from s3.s3aaa import S3EntityRoleManager, S3Permission, S3PermissionCache
 from s3.s3fields import s3_meta_fields
 
 # =============================================================================
@@ -2644,6 +2644,144 @@ class AccessibleQueryTests(unittest.TestCase):
                                  #(runtime, MAX_RUNTIME))
         #auth.s3_withdraw_role(auth.user.id, self.editor, for_pe=[])
 
+# =============================================================================
+class ACLCacheTests(unittest.TestCase):
+    """ Test the shared ACL cache """
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+
+        auth = current.auth
+        acl = auth.permission
+
+        TESTACLCACHE = "TESTACLCACHE"
+        auth.s3_create_role(TESTACLCACHE, None,
+                            dict(c="org",
+                                 uacl=acl.READ, oacl=acl.READ|acl.UPDATE),
+                            dict(t="org_organisation",
+                                 uacl=acl.READ, oacl=acl.READ|acl.UPDATE),
+                            uid=TESTACLCACHE)
+        current.db.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+
+        current.auth.s3_delete_role("TESTACLCACHE")
+        current.db.commit()
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        auth = current.auth
+
+        # Store current settings
+        settings = current.deployment_settings
+        self.policy = settings.get_security_policy()
+        self.acl_cache = settings.get_security_acl_cache()
+
+        # Use table ACLs with shared ACL cache
+        settings.security.policy = 5
+        settings.security.acl_cache = True
+        auth.permission = S3Permission(auth)
+        auth.permission.define_table()
+        S3PermissionCache.clear()
+
+        gtable = auth.settings.table_group
+        row = current.db(gtable.uuid == "TESTACLCACHE").select(gtable.id,
+                                                               limitby=(0, 1)
+                                                               ).first()
+        self.role = row.id
+
+        auth.s3_impersonate("normaluser@example.com")
+        auth.s3_assign_role(auth.user.id, self.role)
+
+    def tearDown(self):
+
+        current.db.rollback()
+
+        auth = current.auth
+        auth.s3_impersonate(None)
+
+        # Restore settings
+        settings = current.deployment_settings
+        settings.security.policy = self.policy
+        settings.security.acl_cache = self.acl_cache
+        auth.permission = S3Permission(auth)
+        S3PermissionCache.clear()
+
+    # -------------------------------------------------------------------------
+    def testDecisionCache(self):
+        """ Test that decisions are shared across requests """
+
+        auth = current.auth
+        permission = auth.permission
+        realms = auth.user.realms
+
+        assertEqual = self.assertEqual
+
+        acls = permission.applicable_acls(permission.READ,
+                                          realms = realms,
+                                          c = "org",
+                                          f = "organisation",
+                                          t = "org_organisation",
+                                          )
+        self.assertTrue(len(S3PermissionCache.store) > 0)
+
+        # Next request uses the cache
+        auth.permission = permission = S3Permission(auth)
+        permission.table = None
+        cached = permission.applicable_acls(permission.READ,
+                                            realms = realms,
+                                            c = "org",
+                                            f = "organisation",
+                                            t = "org_organisation",
+                                            )
+        assertEqual(cached, acls)
+
+        # Same decision as without cache
+        permission = S3Permission(auth)
+        permission.use_cache = False
+        uncached = permission.applicable_acls(permission.READ,
+                                              realms = realms,
+                                              c = "org",
+                                              f = "organisation",
+                                              t = "org_organisation",
+                                              )
+        assertEqual(uncached, acls)
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test invalidation upon ACL and role membership changes """
+
+        auth = current.auth
+        has_permission = auth.s3_has_permission
+
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        permitted = has_permission("read", c="org", f="organisation",
+                                   table="org_organisation")
+        assertTrue(permitted)
+
+        # Changing the ACL takes effect immediately
+        acl = auth.permission
+        acl.update_acl(self.role, c="org", uacl=acl.NONE, oacl=acl.NONE)
+        permitted = has_permission("read", c="org", f="organisation",
+                                   table="org_organisation")
+        assertFalse(permitted)
+
+        acl.update_acl(self.role, c="org", uacl=acl.READ, oacl=acl.READ)
+        permitted = has_permission("read", c="org", f="organisation",
+                                   table="org_organisation")
+        assertTrue(permitted)
+
+        # Withdrawing the role takes effect immediately
+        auth.s3_withdraw_role(auth.user.id, self.role)
+        permitted = has_permission("read", c="org", f="organisation",
+                                   table="org_organisation")
+        assertFalse(permitted)
+
 # =============================================================================
 class DelegationTests(unittest.TestCase):
     """ Test delegation of roles """
@@ -4257,6 +4395,7 @@ if __name__ == "__main__":
         ACLManagementTests,
         HasPermissionTests,
         AccessibleQueryTests,
+        ACLCacheTests,
         DelegationTests,
         RecordApprovalTests,
         RealmEntityTests,
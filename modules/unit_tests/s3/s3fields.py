@@ -1262,6 +1262,114 @@ class S3ReusableFieldTests(unittest.TestCase):
         # Undefined widget
         self.assertRaises(NameError, rf, widget="other")
 
+# =============================================================================
+class S3RepresentCacheTests(unittest.TestCase):
+    """ Test the shared cache for S3Represent lookups """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.represent_cache = settings.base.get("represent_cache")
+        settings.base.represent_cache = True
+        S3RepresentCache.clear()
+
+        otable = current.s3db.org_organisation
+        org = Storage(name="Represent Cache Test Organisation")
+        org_id = otable.insert(**org)
+        org.update(id=org_id)
+        current.s3db.update_super(otable, org)
+
+        self.org_id = org_id
+        self.name = org.name
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+        current.deployment_settings.base.represent_cache = self.represent_cache
+        S3RepresentCache.clear()
+
+    # -------------------------------------------------------------------------
+    def testSharedLookup(self):
+        """ Test that lookups are shared between instances """
+
+        assertEqual = self.assertEqual
+
+        org_id = self.org_id
+
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r(org_id), self.name)
+        assertEqual(r.queries, 1)
+
+        # Another instance with the same configuration uses the cache
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r.bulk([org_id])[org_id], self.name)
+        assertEqual(r.queries, 0)
+
+        # An instance with a different configuration does not
+        r = S3Represent(lookup="org_organisation", fields=["acronym"])
+        r(org_id)
+        assertEqual(r.queries, 1)
+
+        # Translated representations remain translatable
+        r = S3Represent(lookup="org_organisation", translate=True)
+        r(org_id)
+        r = S3Represent(lookup="org_organisation", translate=True)
+        result = r(org_id)
+        assertEqual(r.queries, 0)
+        self.assertTrue(isinstance(result, lazyT))
+
+    # -------------------------------------------------------------------------
+    def testCallableKeys(self):
+        """ Test cache keys of instances with callable options """
+
+        assertEqual = self.assertEqual
+        assertNotEqual = self.assertNotEqual
+
+        def represent(row):
+            return row.name
+
+        key = lambda f: S3Represent(lookup="org_organisation",
+                                    labels=f)._cache_key()
+
+        # Plain functions are identified by their code
+        assertNotEqual(key(represent), None)
+        assertEqual(key(represent), key(represent))
+
+        # Closures are not shareable (same code, different state)
+        def closure(prefix):
+            return lambda row: "%s %s" % (prefix, row.name)
+        assertEqual(key(closure("A")), None)
+
+        # Bound methods are not shareable (same code, different instance)
+        class Formatter(object):
+            def format(self, row):
+                return row.name
+        assertEqual(key(Formatter().format), None)
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test that updates of the lookup table invalidate the cache """
+
+        assertEqual = self.assertEqual
+
+        org_id = self.org_id
+
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r(org_id), self.name)
+
+        otable = current.s3db.org_organisation
+        current.db(otable.id == org_id).update(name="Renamed Organisation")
+
+        r = S3Represent(lookup="org_organisation")
+        assertEqual(r(org_id), "Renamed Organisation")
+        assertEqual(r.queries, 1)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -1279,6 +1387,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3RepresentTests,
+        S3RepresentCacheTests,
         S3ExtractLazyFKRepresentationTests,
         S3ExportLazyFKRepresentationTests,
         S3ReusableFieldTests,
@@ -7,6 +7,7 @@ import unittest
 
 from gluon import *
 from s3.s3filter import *
+from s3.s3query import FS
 
 # =============================================================================
 class S3FilterWidgetTests(unittest.TestCase):
@@ -126,6 +127,54 @@ class S3FilterWidgetTests(unittest.TestCase):
         self.assertTrue("2" in values)
         self.assertTrue("3" in values)
 
+# =============================================================================
+class S3FilterFacetTests(unittest.TestCase):
+    """ Tests for filter options with record counts """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        table = current.s3db.org_organisation
+        for name, acronym in (("Facet Test Org 1", "FTO1"),
+                              ("Facet Test Org 2", "FTO1"),
+                              ("Facet Test Org 3", "FTO2"),
+                              ):
+            table.insert(name=name, acronym=acronym)
+
+        resource = current.s3db.resource("org_organisation")
+        resource.add_filter(FS("name").like("Facet Test Org%"))
+        self.resource = resource
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testFacets(self):
+        """ Test option values with counts from a single GROUPBY """
+
+        facets = S3FilterWidget._facets(self.resource, ["acronym"])
+
+        self.assertNotEqual(facets, None)
+        self.assertEqual(dict((values[0], count) for values, count in facets),
+                         {"FTO1": 2, "FTO2": 1})
+
+    # -------------------------------------------------------------------------
+    def testOptionCounts(self):
+        """ Test rendering of record counts next to the options """
+
+        widget = S3OptionsFilter("acronym", counts=True)
+        ftype, options, noopt = widget._options(self.resource)
+
+        self.assertEqual(noopt, None)
+        self.assertEqual(dict(options), {"FTO1": "FTO1 (2)",
+                                         "FTO2": "FTO2 (1)",
+                                         })
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -143,6 +192,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3FilterWidgetTests,
+        S3FilterFacetTests,
     )
 
 # END ========================================================================
@@ -7,9 +7,11 @@
 
 import unittest
 import datetime
+import os
 from gluon import *
 from gluon.storage import Storage
 from s3 import *
+from s3.s3gis import MAP, LayerGeoRSS, LayerKML
 
 # =============================================================================
 class S3LocationTreeTests(unittest.TestCase):
@@ -738,6 +740,892 @@ class S3LocationTreeTests(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class S3LocationTreeRebuildTests(unittest.TestCase):
+    """ Tests for the set-based rebuild of the Location Tree """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        table = current.s3db.gis_location
+        self.L0_id = table.insert(level = "L0",
+                                  name = "s3gis.rebuild.L0",
+                                  lat = 10.0,
+                                  lon = -10.0,
+                                  )
+        self.L1_id = table.insert(level = "L1",
+                                  name = "s3gis.rebuild.L1",
+                                  parent = self.L0_id,
+                                  )
+        self.L3_id = table.insert(level = "L3",
+                                  name = "s3gis.rebuild.L3",
+                                  parent = self.L1_id,
+                                  lat = 11.0,
+                                  lon = -11.0,
+                                  )
+        self.specific_id = table.insert(name = "s3gis.rebuild.specific",
+                                        parent = self.L3_id,
+                                        )
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def get(self, record_id):
+        """ Get the tree fields of a location """
+
+        table = current.s3db.gis_location
+        return current.db(table.id == record_id).select(table.path,
+                                                        table.inherited,
+                                                        table.lat,
+                                                        table.lon,
+                                                        table.lat_min,
+                                                        table.wkt,
+                                                        table.L0,
+                                                        table.L1,
+                                                        table.L2,
+                                                        table.L3,
+                                                        limitby = (0, 1),
+                                                        ).first()
+
+    # -------------------------------------------------------------------------
+    def testRebuild(self):
+        """ Test rebuilding the whole tree """
+
+        current.gis.rebuild_location_tree()
+
+        L1 = self.get(self.L1_id)
+        self.assertEqual(L1.path, "%s/%s" % (self.L0_id, self.L1_id))
+        self.assertTrue(L1.inherited)
+        self.assertEqual((L1.lat, L1.lon), (10.0, -10.0))
+        self.assertEqual(L1.lat_min, 10.0)
+        self.assertEqual(L1.L0, "s3gis.rebuild.L0")
+        self.assertEqual(L1.L1, "s3gis.rebuild.L1")
+
+        specific = self.get(self.specific_id)
+        self.assertEqual(specific.path, "%s/%s/%s/%s" % (self.L0_id,
+                                                         self.L1_id,
+                                                         self.L3_id,
+                                                         self.specific_id))
+        self.assertEqual(specific.L0, "s3gis.rebuild.L0")
+        self.assertEqual(specific.L1, "s3gis.rebuild.L1")
+        self.assertEqual(specific.L2, None)
+        self.assertEqual(specific.L3, "s3gis.rebuild.L3")
+        # Inherits from the nearest ancestor with its own Lat/Lon
+        self.assertTrue(specific.inherited)
+        self.assertEqual((specific.lat, specific.lon), (11.0, -11.0))
+        self.assertEqual(specific.wkt, "POINT(-11.0 11.0)")
+
+        # Nothing left to update
+        self.assertEqual(current.gis.rebuild_location_tree(), 0)
+
+    # -------------------------------------------------------------------------
+    def testIncremental(self):
+        """ Test rebuilding only the subtrees under changed locations """
+
+        db = current.db
+        gis = current.gis
+        table = current.s3db.gis_location
+
+        gis.rebuild_location_tree()
+
+        # Rename the L1 and move the Country
+        db(table.id == self.L1_id).update(name = "s3gis.rebuild.L1 renamed")
+        db(table.id == self.L0_id).update(lat = 20.0, lon = -20.0)
+
+        # Only the subtree under the L1
+        updated = gis.rebuild_location_tree([self.L1_id])
+        self.assertEqual(updated, 3)
+
+        L1 = self.get(self.L1_id)
+        self.assertEqual(L1.L1, "s3gis.rebuild.L1 renamed")
+        self.assertEqual((L1.lat, L1.lon), (20.0, -20.0))
+        specific = self.get(self.specific_id)
+        self.assertEqual(specific.L1, "s3gis.rebuild.L1 renamed")
+        self.assertEqual((specific.lat, specific.lon), (11.0, -11.0))
+
+# =============================================================================
+class S3SimplifiedGeometryTests(unittest.TestCase):
+    """ Tests for precomputed simplified geometries """
+
+    POLYGON = "POLYGON ((30 10, 40 40, 20 40, 10 20, 30 10))"
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        gis_settings = current.deployment_settings.gis
+        self.simplify_levels = gis_settings.get("simplify_levels")
+        gis_settings.simplify_levels = (0.1, 0.01)
+
+        table = current.s3db.gis_location
+        self.location_id = table.insert(name = "Simplify Test",
+                                        gis_feature_type = 3,
+                                        wkt = self.POLYGON,
+                                        )
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings.gis.simplify_levels = self.simplify_levels
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testSimplifyLevel(self):
+        """ Test selection of the precomputed level """
+
+        get_simplify_level = current.gis.get_simplify_level
+
+        self.assertEqual(get_simplify_level(0.5), 0.1)
+        self.assertEqual(get_simplify_level(0.1), 0.1)
+        self.assertEqual(get_simplify_level(0.05), 0.01)
+        self.assertEqual(get_simplify_level(0.001), None)
+
+    # -------------------------------------------------------------------------
+    def testUpdateSimplified(self):
+        """ Test precomputing simplified geometries """
+
+        db = current.db
+        gis = current.gis
+        table = current.s3db.gis_location_simplified
+        location_id = self.location_id
+        query = (table.location_id == location_id)
+
+        gis.update_simplified(location_id)
+        rows = db(query).select(table.tolerance, table.geojson)
+        self.assertEqual(set(row.tolerance for row in rows), set([0.1, 0.01]))
+
+        # Unchanged WKT => not re-computed
+        db(query).update(geojson="CACHED")
+        gis.update_simplified(location_id)
+        rows = db(query).select(table.geojson)
+        self.assertTrue(all(row.geojson == "CACHED" for row in rows))
+
+        # Changed WKT => re-computed
+        gis.update_simplified(location_id,
+                              wkt="POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))")
+        rows = db(query).select(table.geojson)
+        self.assertFalse(any(row.geojson == "CACHED" for row in rows))
+
+        # Point => removed
+        gis.update_simplified(location_id, wkt="POINT (1 1)")
+        self.assertEqual(db(query).count(), 0)
+
+    # -------------------------------------------------------------------------
+    def testGetLocations(self):
+        """ Test that get_locations uses precomputed geometries """
+
+        db = current.db
+        gis = current.gis
+        gtable = current.s3db.gis_location
+        table = current.s3db.gis_location_simplified
+        location_id = self.location_id
+
+        gis.update_simplified(location_id)
+        db(table.location_id == location_id).update(geojson="PRECOMPUTED")
+
+        query = (gtable.id == location_id)
+        output = gis.get_locations(gtable, query, join=False, tolerance=0.05)
+        self.assertEqual(output, {location_id: "PRECOMPUTED"})
+
+        # Tolerance finer than all levels => simplified on-the-fly
+        output = gis.get_locations(gtable, query, join=False, tolerance=0.001)
+        self.assertNotEqual(output.get(location_id), "PRECOMPUTED")
+
+# =============================================================================
+class S3MapTileTests(unittest.TestCase):
+    """ Tests for tiled Feature Layers (S3Map.tile) """
+
+    # -------------------------------------------------------------------------
+    def testTileBounds(self):
+        """ Test bounding boxes of XYZ tiles """
+
+        get_tile_bounds = current.gis.get_tile_bounds
+
+        lon_min, lat_min, lon_max, lat_max = get_tile_bounds(0, 0, 0)
+        self.assertEqual(lon_min, -180)
+        self.assertEqual(lon_max, 180)
+        self.assertAlmostEqual(lat_min, -85.0511, 4)
+        self.assertAlmostEqual(lat_max, 85.0511, 4)
+
+        # North-east quadrant
+        lon_min, lat_min, lon_max, lat_max = get_tile_bounds(1, 1, 0)
+        self.assertEqual(lon_min, 0)
+        self.assertEqual(lon_max, 180)
+        self.assertAlmostEqual(lat_min, 0, 10)
+        self.assertAlmostEqual(lat_max, 85.0511, 4)
+
+    # -------------------------------------------------------------------------
+    def testCluster(self):
+        """ Test grid-based clustering of points """
+
+        bounds = current.gis.get_tile_bounds(1, 1, 0)
+        items = [(1, 10.0, 10.0),
+                 (2, 10.01, 10.01),
+                 (3, 10.02, 9.99),
+                 (4, 60.0, 150.0),
+                 (5, None, None),
+                 ]
+
+        clusters, singles = S3Map.cluster(items, bounds)
+
+        self.assertEqual(len(clusters), 1)
+        lat, lon, count = clusters[0]
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(lat, 10.01, 6)
+        self.assertAlmostEqual(lon, 10.0, 6)
+        self.assertEqual(singles, [4])
+
+    # -------------------------------------------------------------------------
+    def testTileFeatures(self):
+        """ Test extraction of the features within a tile """
+
+        current.auth.override = True
+        try:
+            table = current.s3db.gis_location
+            inside = table.insert(name = "Tile Test Inside",
+                                  lat = 10.0,
+                                  lon = 10.0,
+                                  wkt = "POINT(10 10)",
+                                  )
+            outside = table.insert(name = "Tile Test Outside",
+                                   lat = -10.0,
+                                   lon = 10.0,
+                                   wkt = "POINT(10 -10)",
+                                   )
+            current.gis.update_location_tree({"id": inside})
+            current.gis.update_location_tree({"id": outside})
+
+            # Tile 1/1/0 = north-east quadrant, beyond clustering
+            resource = current.s3db.resource("gis_location",
+                                             id = [inside, outside])
+            bounds = current.gis.get_tile_bounds(1, 1, 0)
+            gis_settings = current.deployment_settings.gis
+            cluster_zoom = gis_settings.pop("tile_cluster_zoom", None)
+            gis_settings.tile_cluster_zoom = 0
+            try:
+                features = S3Map().tile_features(resource, bounds, 1)
+            finally:
+                if cluster_zoom is None:
+                    gis_settings.pop("tile_cluster_zoom", None)
+                else:
+                    gis_settings.tile_cluster_zoom = cluster_zoom
+
+            ids = [feature["properties"]["id"] for feature in features]
+            self.assertEqual(ids, [inside])
+            # Only the IDs within the tile have been loaded
+            self.assertEqual(resource.get_id(), inside)
+            geometry = features[0]["geometry"]
+            self.assertEqual(geometry["type"], "Point")
+        finally:
+            current.auth.override = False
+            current.db.rollback()
+
+# =============================================================================
+class S3SpatialIndexTests(unittest.TestCase):
+    """ Tests for the in-process spatial index """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        table = current.s3db.gis_location
+        self.square = table.insert(name = "Spatial Index Square",
+                                   level = "L1",
+                                   gis_feature_type = 3,
+                                   wkt = "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+                                   )
+        self.triangle = table.insert(name = "Spatial Index Triangle",
+                                     level = "L1",
+                                     gis_feature_type = 3,
+                                     wkt = "POLYGON ((20 0, 30 0, 20 10, 20 0))",
+                                     )
+        S3SpatialIndex.clear()
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+        S3SpatialIndex.clear()
+
+    # -------------------------------------------------------------------------
+    def testIntersects(self):
+        """ Test lookup of intersecting polygons """
+
+        from shapely.geometry import Point, box
+
+        intersects = S3SpatialIndex.intersects
+
+        matches = intersects(Point(5, 5), levels=["L1"])
+        self.assertTrue((self.square, "L1") in matches)
+        self.assertFalse((self.triangle, "L1") in matches)
+
+        # Inside the bounding box but outside the triangle
+        matches = intersects(Point(29, 9), levels=["L1"])
+        self.assertFalse((self.triangle, "L1") in matches)
+
+        matches = intersects(box(8, 1, 22, 2), levels=["L1"])
+        self.assertTrue((self.square, "L1") in matches)
+        self.assertTrue((self.triangle, "L1") in matches)
+
+    # -------------------------------------------------------------------------
+    def testContains(self):
+        """ Test point-in-polygon checks """
+
+        contains = S3SpatialIndex.contains
+
+        self.assertTrue(contains(self.triangle, 1, 21))
+        self.assertFalse(contains(self.triangle, 9, 29))
+
+        # Not an indexed polygon
+        self.assertEqual(contains(0, 1, 1), None)
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test that the index picks up changes """
+
+        from shapely.geometry import Point
+
+        intersects = S3SpatialIndex.intersects
+        point = Point(50, 50)
+
+        self.assertFalse((self.square, "L1") in intersects(point, levels=["L1"]))
+        index = S3SpatialIndex.indexes["L1"]
+
+        # Adding a point location doesn't rebuild the polygon index
+        table = current.s3db.gis_location
+        table.insert(name = "Spatial Index Point",
+                     gis_feature_type = 1,
+                     lat = 50,
+                     lon = 50,
+                     )
+        intersects(point, levels=["L1"])
+        self.assertTrue(S3SpatialIndex.indexes["L1"] is index)
+
+        # Updating a polygon rebuilds the index
+        modified_on = current.request.utcnow + datetime.timedelta(seconds=1)
+        current.db(table.id == self.square).update(
+                wkt = "POLYGON ((40 40, 60 40, 60 60, 40 60, 40 40))",
+                modified_on = modified_on,
+                )
+
+        self.assertTrue((self.square, "L1") in intersects(point, levels=["L1"]))
+
+        # Writes which don't renew the version stamp (e.g. raw SQL by
+        # external scripts) are picked up with the next periodic check
+        settings = current.deployment_settings
+        check = settings.get_gis_spatial_index_check()
+        settings.gis.spatial_index_check = 0
+        try:
+            modified_on += datetime.timedelta(seconds=1)
+            current.db(table.id == self.square).update(
+                    wkt = "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+                    modified_on = modified_on,
+                    )
+            current.db._adapter._table_versions.pop("gis_location", None)
+            self.assertFalse((self.square, "L1") in intersects(point, levels=["L1"]))
+        finally:
+            settings.gis.spatial_index_check = check
+
+# =============================================================================
+class S3GeoJSONFeedTests(unittest.TestCase):
+    """ Tests for static GeoJSON feeds """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        location_id = s3db.gis_location.insert(name = "Feed Test Location",
+                                               lat = 10.123456,
+                                               lon = 20.654321,
+                                               )
+        organisation_id = s3db.org_organisation.insert(name = "Feed Test Org")
+        s3db.org_office.insert(name = "Feed Test Office",
+                               organisation_id = organisation_id,
+                               location_id = location_id,
+                               )
+
+        self.feed = S3GeoJSONFeed("unittest", {
+                        "resource": "org_office",
+                        "filter": (FS("name") == "Feed Test Office"),
+                        "fields": ["name",
+                                   ("org", "organisation_id"),
+                                   ("code", "name", lambda v: v.upper()),
+                                   "comments",
+                                   ],
+                        "decimals": 2,
+                        "aliases": ["unittest.geojson"],
+                        })
+        self.alias = os.path.join(current.request.folder,
+                                  "static", "cache", "unittest.geojson")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        for path in S3GeoJSONFeed.files("unittest") + (self.alias,):
+            if os.path.exists(path):
+                os.remove(path)
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testGenerate(self):
+        """ Test generation of the feed """
+
+        import json
+
+        data = json.loads(self.feed.generate())
+
+        features = data["features"]
+        self.assertEqual(len(features), 1)
+        feature = features[0]
+        self.assertEqual(feature["geometry"]["coordinates"], [20.65, 10.12])
+
+        properties = feature["properties"]
+        self.assertEqual(properties["name"], "Feed Test Office")
+        self.assertEqual(properties["org"], "Feed Test Org")
+        # Custom encoding of the raw value
+        self.assertEqual(properties["code"], "FEED TEST OFFICE")
+        # Empty values are skipped
+        self.assertFalse("comments" in properties)
+
+    # -------------------------------------------------------------------------
+    def testPublish(self):
+        """ Test publishing the feed only when the data change """
+
+        import gzip
+
+        feed = self.feed
+
+        self.assertTrue(feed.publish())
+        path, gzip_path = S3GeoJSONFeed.files("unittest")[:2]
+        self.assertTrue(os.path.exists(path))
+        with open(path, "rb") as f:
+            data = f.read()
+        self.assertEqual(gzip.open(gzip_path).read(), data)
+        # Copy at the alias location
+        with open(self.alias, "rb") as f:
+            self.assertEqual(f.read(), data)
+        etag = S3GeoJSONFeed.meta("unittest")["etag"]
+
+        # Unchanged => not regenerated
+        self.assertFalse(feed.publish())
+
+        # Forced => regenerated, same data, same ETag
+        self.assertTrue(feed.publish(force=True))
+        self.assertEqual(S3GeoJSONFeed.meta("unittest")["etag"], etag)
+
+# =============================================================================
+class S3AdminAreaImportTests(unittest.TestCase):
+    """ Tests for the admin area import pipeline (GIS.import_gadm1) """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testImportGeometry(self):
+        """ Test parsing of imported geometries """
+
+        from s3.s3gis import _import_geometry
+
+        wkt = "POLYGON((0 0,2 0,2 2,0 2,0 0))"
+        location, simplified = _import_geometry((wkt, (0.01,)))
+        self.assertEqual(location["gis_feature_type"], 3)
+        self.assertAlmostEqual(location["lat"], 1.0)
+        self.assertAlmostEqual(location["lon"], 1.0)
+        self.assertEqual(location["lon_min"], 0)
+        self.assertEqual(location["lat_max"], 2)
+        self.assertEqual(len(simplified), 1)
+        self.assertEqual(simplified[0][0], 0.01)
+
+        # Points are not simplified
+        location, simplified = _import_geometry(("POINT(10 20)", (0.01,)))
+        self.assertEqual(location["gis_feature_type"], 1)
+        self.assertEqual(location["lat"], 20)
+        self.assertEqual(simplified, [])
+
+        # Invalid WKT
+        self.assertEqual(_import_geometry(("POLYGON((0 0", None)), None)
+
+    # -------------------------------------------------------------------------
+    def testParentIndex(self):
+        """ Test the in-memory index of parent locations """
+
+        s3db = current.s3db
+        table = s3db.gis_location
+        ttable = s3db.gis_location_tag
+
+        l0 = table.insert(name = "Import Test Country",
+                          level = "L0",
+                          )
+        ttable.insert(location_id = l0, tag = "ISO2", value = "XZ")
+        ttable.insert(location_id = l0, tag = "ISO3", value = "XZZ")
+        l1 = table.insert(name = "Import Test Province",
+                          level = "L1",
+                          parent = l0,
+                          )
+        ttable.insert(location_id = l1, tag = "GADM1", value = "99999")
+
+        index = GIS.import_parent_index("L0", "ISO3")
+        self.assertEqual(index.get("XZZ"), (l0, "XZ"))
+
+        index = GIS.import_parent_index("L1", "GADM1")
+        self.assertEqual(index.get("99999"), (l1, "XZ"))
+
+    # -------------------------------------------------------------------------
+    def testImportPool(self):
+        """ Test that a single worker parses in-process """
+
+        self.assertEqual(GIS.import_pool(1), None)
+
+# =============================================================================
+class S3ChoroplethTests(unittest.TestCase):
+    """ Tests for spatial aggregation by admin areas (S3Choropleth) """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+        gis = current.gis
+        table = s3db.gis_location
+
+        # Two countries with a point each, plus one point without parent
+        wkt = "POLYGON((%s 0,%s 0,%s 10,%s 10,%s 0))"
+        self.l0a = table.insert(name = "Choropleth Test Country A",
+                                level = "L0",
+                                gis_feature_type = 3,
+                                wkt = wkt % (0, 10, 10, 0, 0),
+                                )
+        self.l0b = table.insert(name = "Choropleth Test Country B",
+                                level = "L0",
+                                gis_feature_type = 3,
+                                wkt = wkt % (20, 30, 30, 20, 20),
+                                )
+        point_a = table.insert(name = "Choropleth Test Point A",
+                               parent = self.l0a,
+                               lat = 5,
+                               lon = 5,
+                               )
+        point_b = table.insert(name = "Choropleth Test Point B",
+                               parent = self.l0b,
+                               lat = 5,
+                               lon = 25,
+                               )
+        for location_id in (self.l0a, self.l0b, point_a, point_b):
+            gis.update_location_tree({"id": location_id})
+
+        self.point_a = point_a
+
+        otable = s3db.org_office
+        organisation_id = s3db.org_organisation.insert(name = "Choropleth Test Org")
+        self.organisation_id = organisation_id
+        for location_id in (point_a, point_a, point_b):
+            otable.insert(name = "Choropleth Test Office",
+                          organisation_id = organisation_id,
+                          location_id = location_id,
+                          )
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testAggregate(self):
+        """ Test counting records per area """
+
+        resource = current.s3db.resource("org_office",
+                                         filter = (FS("name") == "Choropleth Test Office"),
+                                         )
+        choropleth = resource.choropleth("count(id)", level="L0")
+        values = choropleth.aggregate()
+
+        self.assertEqual(values.get(self.l0a), 2)
+        self.assertEqual(values.get(self.l0b), 1)
+
+    # -------------------------------------------------------------------------
+    def testAverage(self):
+        """ Test that records without a value don't count for averages """
+
+        s3db = current.s3db
+
+        type_id = s3db.org_office_type.insert(name = "Choropleth Test Type")
+        s3db.org_office.insert(name = "Choropleth Test Office",
+                               organisation_id = self.organisation_id,
+                               location_id = self.point_a,
+                               office_type_id = type_id,
+                               )
+
+        # Aggregation in the database (no filter)
+        resource = s3db.resource("org_office")
+        values = resource.choropleth("avg(office_type_id)", level="L0") \
+                         .aggregate()
+        self.assertEqual(values.get(self.l0a), type_id)
+        self.assertEqual(values.get(self.l0b), None)
+
+        # Aggregation in Python (filter) gives the same result
+        resource = s3db.resource("org_office", filter = (FS("id") > 0))
+        values = resource.choropleth("avg(office_type_id)", level="L0") \
+                         .aggregate()
+        self.assertEqual(values.get(self.l0a), type_id)
+        self.assertEqual(values.get(self.l0b), None)
+
+    # -------------------------------------------------------------------------
+    def testFeatureCollection(self):
+        """ Test the GeoJSON output """
+
+        resource = current.s3db.resource("org_office",
+                                         filter = (FS("name") == "Choropleth Test Office"),
+                                         )
+        output = resource.choropleth("count(id)", level="L0") \
+                         .as_dict(map_data={"level": 0})
+
+        self.assertEqual(output["type"], "FeatureCollection")
+        self.assertEqual(output["s3"], {"level": 0})
+
+        features = dict((f["properties"]["id"], f) for f in output["features"])
+        self.assertEqual(set(features.keys()), set([self.l0a, self.l0b]))
+        feature = features[self.l0a]
+        self.assertEqual(feature["properties"]["value"], 2)
+        self.assertEqual(feature["properties"]["name"], "Choropleth Test Country A")
+        self.assertTrue(feature["geometry"]["type"] in ("Polygon", "MultiPolygon"))
+
+    # -------------------------------------------------------------------------
+    def testInvalidFact(self):
+        """ Test that invalid facts are rejected """
+
+        resource = current.s3db.resource("org_office")
+        self.assertRaises(SyntaxError, resource.choropleth, "median(id)")
+
+# =============================================================================
+class S3QuadkeyTests(unittest.TestCase):
+    """ Tests for the bounding box index (gis_location.quadkey) """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def testGetQuadkey(self):
+        """ Test quadkeys of bounding boxes """
+
+        get_quadkey = GIS.get_quadkey
+
+        # Points
+        key = get_quadkey(10.0, 10.0, 10.0, 10.0)
+        self.assertEqual(len(key), 16)
+        self.assertTrue(key.startswith("1"))        # NE
+        self.assertTrue(get_quadkey(-10, -10, -10, -10).startswith("2"))   # SW
+
+        # Contained boxes share the prefix
+        outer = get_quadkey(0.5, 0.5, 1.5, 1.5)
+        self.assertTrue(key.startswith(get_quadkey(5, 5, 15, 15)[:3]))
+        self.assertTrue(get_quadkey(1.0, 1.0, 1.0, 1.0).startswith(outer))
+
+        # Crossing the prime meridian => root tile
+        self.assertEqual(get_quadkey(-1, 10, 1, 11), "")
+
+        # Missing bounds
+        self.assertEqual(get_quadkey(None, 10, 11, 11), None)
+
+    # -------------------------------------------------------------------------
+    def testQueryQuadkey(self):
+        """ Test bounding box queries using the quadkey """
+
+        db = current.db
+        table = current.s3db.gis_location
+
+        inside = table.insert(name = "Quadkey Test Inside",
+                              lat = 10.0,
+                              lon = 10.0,
+                              lat_min = 10.0,
+                              lat_max = 10.0,
+                              lon_min = 10.0,
+                              lon_max = 10.0,
+                              )
+        outside = table.insert(name = "Quadkey Test Outside",
+                               lat = 10.0,
+                               lon = 20.0,
+                               lat_min = 10.0,
+                               lat_max = 10.0,
+                               lon_min = 20.0,
+                               lon_max = 20.0,
+                               )
+        large = table.insert(name = "Quadkey Test Large",
+                             lat = 0.0,
+                             lon = 0.0,
+                             lat_min = -30.0,
+                             lat_max = 30.0,
+                             lon_min = -30.0,
+                             lon_max = 30.0,
+                             )
+        row = db(table.id == inside).select(table.quadkey).first()
+        self.assertEqual(row.quadkey, GIS.get_quadkey(10, 10, 10, 10))
+
+        ids = (inside, outside, large)
+        query = GIS.query_features_by_bbox(9, 9, 11, 11) & \
+                (table.id.belongs(ids))
+        found = set(row.id for row in db(query).select(table.id))
+        self.assertEqual(found, set([inside, large]))
+
+        # On the boundary
+        query = GIS.query_features_by_bbox(8, 8, 10, 10) & \
+                (table.id.belongs(ids))
+        found = set(row.id for row in db(query).select(table.id))
+        self.assertTrue(inside in found)
+        self.assertFalse(outside in found)
+
+# =============================================================================
+class S3MapConfigCacheTests(unittest.TestCase):
+    """ Tests for the compiled map configuration cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        gis_settings = current.deployment_settings.gis
+        self.config_cache = gis_settings.pop("config_cache", None)
+        gis_settings.config_cache = True
+        S3MapConfigCache.clear()
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        gis_settings = current.deployment_settings.gis
+        if self.config_cache is None:
+            gis_settings.pop("config_cache", None)
+        else:
+            gis_settings.config_cache = self.config_cache
+        S3MapConfigCache.clear()
+
+        current.auth.override = False
+        current.db.rollback()
+
+    # -------------------------------------------------------------------------
+    def compile(self, config):
+        """ Compile the layers of a config via the cache """
+
+        cache = S3MapConfigCache(config, "layers", True)
+        return cache(lambda: MAP._compile_layers(config, True))
+
+    # -------------------------------------------------------------------------
+    def testCacheHit(self):
+        """ Test that compiled layers are re-used until the config changes """
+
+        config = current.gis.get_config()
+
+        compiled = self.compile(config)
+        self.assertEqual(S3MapConfigCache.misses, 1)
+        self.assertEqual(S3MapConfigCache.hits, 0)
+        self.assertTrue(isinstance(compiled["layers"], dict))
+
+        # Same config, same roles, same language => cache hit
+        cached = self.compile(config)
+        self.assertEqual(S3MapConfigCache.hits, 1)
+        self.assertEqual(cached, compiled)
+
+        # Result must not depend on whether it came from the cache
+        self.assertEqual(MAP._compile_layers(config, True)["layers"],
+                         compiled["layers"])
+
+        # Modifying the layer configuration invalidates the cache
+        db = current.db
+        ltable = db.gis_layer_config
+        row = db(ltable.id > 0).select(ltable.id,
+                                       ltable.modified_on,
+                                       limitby = (0, 1),
+                                       ).first()
+        if row and row.modified_on:
+            modified_on = row.modified_on + datetime.timedelta(seconds=1)
+            row.update_record(modified_on = modified_on)
+            self.compile(config)
+            self.assertEqual(S3MapConfigCache.misses, 2)
+
+        # Changes committed by other processes invalidate the cache, too
+        self.compile(config)
+        misses = S3MapConfigCache.misses
+        S3TableVersion.write(db, {"gis_style": "other process"})
+        self.compile(config)
+        self.assertEqual(S3MapConfigCache.misses, misses + 1)
+
+    # -------------------------------------------------------------------------
+    def testRefreshFeeds(self):
+        """ Test that KML/GeoRSS feeds are refreshed at cache hits, too """
+
+        refreshed = []
+        def refresh_feed(**feed):
+            refreshed.append(feed)
+
+        layer_types = (LayerGeoRSS, LayerKML)
+        originals = [layer_type.__dict__["refresh_feed"]
+                     for layer_type in layer_types]
+        for layer_type in layer_types:
+            layer_type.refresh_feed = staticmethod(refresh_feed)
+        try:
+            MAP._refresh_feeds([("LayerKML", {"record_id": 1,
+                                              "name": "Test",
+                                              "refresh": 60,
+                                              }),
+                                ("LayerGeoRSS", {"url": "http://example.com/feed",
+                                                 }),
+                                ("LayerUnknown", {}),
+                                ])
+        finally:
+            for layer_type, original in zip(layer_types, originals):
+                layer_type.refresh_feed = original
+
+        self.assertEqual(len(refreshed), 2)
+        self.assertEqual(refreshed[0]["name"], "Test")
+        self.assertEqual(refreshed[1]["url"], "http://example.com/feed")
+
+        # Compiled layers contain the feeds to refresh
+        compiled = self.compile(current.gis.get_config())
+        self.assertTrue(isinstance(compiled["feeds"], list))
+
+    # -------------------------------------------------------------------------
+    def testDisabled(self):
+        """ Test that nothing is cached when the cache is disabled """
+
+        current.deployment_settings.gis.config_cache = False
+
+        config = current.gis.get_config()
+        self.compile(config)
+        self.compile(config)
+        self.assertEqual(S3MapConfigCache.hits, 0)
+        self.assertEqual(S3MapConfigCache.misses, 0)
+        self.assertEqual(len(S3MapConfigCache.store), 0)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -755,6 +1643,15 @@ if __name__ == "__main__":
 
     run_suite(
         S3LocationTreeTests,
+        S3LocationTreeRebuildTests,
+        S3SimplifiedGeometryTests,
+        S3MapTileTests,
+        S3SpatialIndexTests,
+        S3GeoJSONFeedTests,
+        S3AdminAreaImportTests,
+        S3ChoroplethTests,
+        S3QuadkeyTests,
+        S3MapConfigCacheTests,
     )
 
 # END ========================================================================
@@ -5,9 +5,13 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3import.py
 #
+import os
+import shutil
+import tempfile
 import unittest
 
 from gluon import *
+from s3 import S3BulkImporter, S3ImportJob
 
 try:
     import json # try stdlib (Python 2.6)
@@ -384,6 +388,356 @@ class FailedReferenceTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class BulkImportTests(unittest.TestCase):
+    """ Test bulk mode of S3ImportJob """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation" uuid="BITOrganisation1">
+        <data field="name">BITOrganisation1</data>
+    </resource>
+    <resource name="org_organisation" uuid="BITOrganisation2">
+        <data field="name">BITOrganisation2</data>
+    </resource>
+    <resource name="org_organisation" uuid="BITOrganisation3">
+        <data field="name">BITOrganisation3</data>
+    </resource>
+    <resource name="org_office" uuid="BITOffice1">
+        <data field="name">BITOffice1</data>
+        <reference field="organisation_id" resource="org_organisation" uuid="BITOrganisation2"/>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        self.tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        settings = current.deployment_settings
+        self.import_bulk = settings.get_base_import_bulk()
+        settings.base.import_bulk = True
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def testBulkImport(self):
+        """ Test import with deferred inserts """
+
+        db = current.db
+        s3db = current.s3db
+
+        resource = s3db.resource("org_organisation")
+        success = resource.import_xml(self.tree)
+        self.assertTrue(success)
+        self.assertEqual(resource.import_count, 3)
+        self.assertEqual(len(resource.import_created), 3)
+
+        otable = s3db.org_organisation
+        query = (otable.uuid.like("BITOrganisation%"))
+        rows = db(query).select(otable.id,
+                                otable.uuid,
+                                otable.pe_id,
+                                otable.realm_entity)
+        self.assertEqual(len(rows), 3)
+        organisations = {}
+        for row in rows:
+            # Super-entity and realm must be set
+            self.assertNotEqual(row.pe_id, None)
+            self.assertEqual(row.realm_entity, row.pe_id)
+            self.assertTrue(row.id in resource.import_created)
+            organisations[row.uuid] = row.id
+
+        # Reference to a deferred record must be resolved
+        ftable = s3db.org_office
+        query = (ftable.uuid == "BITOffice1")
+        row = db(query).select(ftable.organisation_id,
+                               limitby=(0, 1)).first()
+        self.assertNotEqual(row, None)
+        self.assertEqual(row.organisation_id,
+                         organisations["BITOrganisation2"])
+
+    # -------------------------------------------------------------------------
+    def testBulkImportDuplicateUID(self):
+        """ Test that records with the same UID are not inserted twice """
+
+        from lxml import etree
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation" uuid="BITOrganisation4">
+        <data field="name">BITOrganisation4</data>
+    </resource>
+    <resource name="org_organisation" uuid="BITOrganisation4">
+        <data field="name">BITOrganisation4 Updated</data>
+    </resource>
+</s3xml>"""
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        db = current.db
+        s3db = current.s3db
+
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(tree)
+
+        otable = s3db.org_organisation
+        query = (otable.uuid == "BITOrganisation4")
+        rows = db(query).select(otable.name)
+        self.assertEqual(len(rows), 1)
+
+    # -------------------------------------------------------------------------
+    def testBulkInsertError(self):
+        """ Test that a failing multi-row insert leaves the transaction usable """
+
+        db = current.db
+        otable = current.s3db.org_organisation
+
+        row = db(otable.id > 0).select(otable.id, limitby=(0, 1)).first()
+        if not row:
+            return
+
+        # Duplicate primary key
+        values = S3ImportJob._bulk_values(otable, {"id": row.id,
+                                                   "name": "BITDuplicate",
+                                                   "uuid": "BITDuplicate",
+                                                   })
+        sql = S3ImportJob._bulk_insert_sql(otable, [values])
+        self.assertTrue(sql.startswith("INSERT INTO "))
+
+        self.assertRaises(db._adapter.driver.Error,
+                          S3ImportJob._savepoint,
+                          lambda: db.executesql(sql))
+        self.assertEqual(db(otable.id == row.id).count(), 1)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings.base.import_bulk = self.import_bulk
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class ImportIndexTests(unittest.TestCase):
+    """ Test the deduplication index of S3ImportJob """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        s3db = current.s3db
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.import_index = settings.get_base_import_index()
+        settings.base.import_index = True
+
+        otable = s3db.org_organisation
+        for i in (1, 2):
+            org = {"name": "IITOrganisation%s" % i,
+                   "uuid": "IITOrganisation%s" % i,
+                   }
+            org["id"] = otable.insert(**org)
+            s3db.update_super(otable, org)
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation" uuid="IITOrganisation1">
+        <data field="name">IITOrganisation1</data>
+    </resource>
+    <resource name="org_organisation">
+        <data field="name">iitorganisation2</data>
+    </resource>
+    <resource name="org_organisation">
+        <data field="name">IITOrganisation3</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        self.tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+    # -------------------------------------------------------------------------
+    def testIndexLookups(self):
+        """ Test lookups from the index """
+
+        from s3.s3import import S3ImportJob
+
+        s3db = current.s3db
+
+        otable = s3db.org_organisation
+
+        job = S3ImportJob(otable, tree=self.tree)
+        index = job.index
+        self.assertNotEqual(index, None)
+
+        # UID lookup
+        record = {"uuid": "IITOrganisation1"}
+        original = index.original(otable, record)
+        self.assertNotEqual(original, None)
+        self.assertEqual(original.uuid, "IITOrganisation1")
+        self.assertTrue("IITOrganisation1" in index.queried[otable._tablename]["uuid"])
+
+        # Deduplicate key lookup (case-insensitive)
+        items = []
+        for element in self.tree.getroot():
+            item_id = job.add_item(element=element)
+            items.append(job.items[item_id])
+        index.index_keys(items)
+
+        rows = index.lookup(otable, name="IITORGANISATION2")
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].name, "IITOrganisation2")
+
+        # Queried, but not found
+        rows = index.lookup(otable, name="IITOrganisation3")
+        self.assertEqual(rows, [])
+
+        # Not queried
+        rows = index.lookup(otable, name="IITOrganisation4")
+        self.assertEqual(rows, None)
+
+        # Committed items are removed from the index
+        item = items[2]
+        index.update(item)
+        rows = index.lookup(otable, name="IITOrganisation3")
+        self.assertEqual(rows, None)
+
+    # -------------------------------------------------------------------------
+    def testIndexImport(self):
+        """ Test import with index """
+
+        db = current.db
+        s3db = current.s3db
+
+        resource = s3db.resource("org_organisation")
+        success = resource.import_xml(self.tree)
+        self.assertTrue(success)
+
+        otable = s3db.org_organisation
+        query = (otable.name.lower().like("iitorganisation%")) & \
+                (otable.deleted != True)
+        rows = db(query).select(otable.name)
+        self.assertEqual(len(rows), 3)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings.base.import_index = self.import_index
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class BulkImporterScheduleTests(unittest.TestCase):
+    """ Test task scheduling and checkpoints of S3BulkImporter """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.s3db.load_all_models()
+
+        self.xsl = os.path.join(current.request.folder,
+                                "static", "formats", "s3csv", "org")
+
+        self.path = tempfile.mkdtemp()
+        with open(os.path.join(self.path, "tasks.cfg"), "w") as tasks:
+            tasks.write("*,bulk_importer_test\n")
+
+        self.calls = []
+        current.response.s3.bulk_importer_test = lambda: \
+                                                 self.calls.append(True)
+
+        self.checkpoint = S3BulkImporter.CHECKPOINT
+        S3BulkImporter.CHECKPOINT = "prepopulate_test.chk"
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        S3BulkImporter().clear_checkpoint()
+        S3BulkImporter.CHECKPOINT = self.checkpoint
+        del current.response.s3["bulk_importer_test"]
+        shutil.rmtree(self.path)
+
+    # -------------------------------------------------------------------------
+    def task(self, resourcename, xsl):
+        """ Construct an import task for an org table """
+
+        return [1, "org", resourcename, "%s.csv" % resourcename,
+                os.path.join(self.xsl, xsl), None]
+
+    # -------------------------------------------------------------------------
+    def testTaskTables(self):
+        """ Test detection of tables written and referenced by a task """
+
+        importer = S3BulkImporter()
+        writes, supers, reads = importer.task_tables(self.task("office",
+                                                               "office.xsl"))
+
+        self.assertTrue("org_office" in writes)
+        self.assertTrue("org_office_type" in writes)
+        self.assertTrue("gis_location" in writes)
+        self.assertTrue("org_site" in supers)
+        self.assertFalse("org_site" in writes)
+        self.assertFalse("org_office" in reads)
+
+    # -------------------------------------------------------------------------
+    def testTaskDependencies(self):
+        """ Test dependencies between import tasks """
+
+        importer = S3BulkImporter()
+        tasks = [self.task("office_type", "office_type.xsl"),
+                 self.task("office", "office.xsl"),
+                 ]
+        dependencies = importer.task_dependencies(tasks)
+
+        self.assertEqual(dependencies[0], set())
+        self.assertEqual(dependencies[1], set([0]))
+
+        # Order of tasks.cfg is preserved
+        dependencies = importer.task_dependencies(list(reversed(tasks)))
+        self.assertEqual(dependencies[0], set())
+        self.assertEqual(dependencies[1], set([0]))
+
+    # -------------------------------------------------------------------------
+    def testCheckpoint(self):
+        """ Test resuming an interrupted prepopulate """
+
+        self.assertFalse(S3BulkImporter.pending())
+
+        importer = S3BulkImporter()
+        importer.perform_tasks(self.path)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(importer.errorList, [])
+        self.assertEqual(len(importer.timing_report()), 1)
+
+        # Completed tasks are skipped when resuming
+        self.assertTrue(S3BulkImporter.pending())
+        importer = S3BulkImporter()
+        importer.perform_tasks(self.path)
+        self.assertEqual(len(self.calls), 1)
+
+        # Cleared checkpoint runs all tasks again
+        importer.clear_checkpoint()
+        self.assertFalse(S3BulkImporter.pending())
+        importer = S3BulkImporter()
+        importer.perform_tasks(self.path)
+        self.assertEqual(len(self.calls), 2)
+
+    # -------------------------------------------------------------------------
+    def testCheckpointWarnings(self):
+        """ Test that tasks with warnings (but no errors) are checkpointed """
+
+        failed = S3BulkImporter.failed
+        self.assertFalse(failed([]))
+        self.assertFalse(failed(["WARNING: import error - test"]))
+        self.assertTrue(failed(["WARNING: test", "Could not access test"]))
+
+        current.response.s3.bulk_importer_test = lambda: \
+                                                 "WARNING: test warning"
+        importer = S3BulkImporter()
+        importer.perform_tasks(self.path)
+        self.assertEqual(importer.errorList, ["WARNING: test warning"])
+        self.assertTrue(S3BulkImporter.pending())
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -405,6 +759,9 @@ if __name__ == "__main__":
         ComponentDisambiguationTests,
         PostParseTests,
         FailedReferenceTests,
+        BulkImportTests,
+        ImportIndexTests,
+        BulkImporterScheduleTests,
     )
 
 # END ========================================================================
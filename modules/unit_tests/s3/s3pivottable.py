@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+#
+# S3PivotTable Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3pivottable.py
+#
+import unittest
+
+from gluon import *
+
+from s3.s3data import S3PivotTable
+from s3.s3query import FS
+from s3.s3report import S3ReportCache
+from s3.s3utils import S3TableVersion
+
+# =============================================================================
+class S3PivotTableFrameTests(unittest.TestCase):
+    """ Tests for the columnar data frame of S3PivotTable """
+
+    # -------------------------------------------------------------------------
+    def testAccumulate(self):
+        """ Test vectorized accumulation against _aggregate """
+
+        assertEqual = self.assertEqual
+
+        accumulate = S3PivotTable._accumulate
+        result = S3PivotTable._result
+        aggregate = S3PivotTable._aggregate
+
+        # 2 rows x 2 columns, cell 3 is empty
+        vnames = [3, 5, 8]
+        pcells = [0, 0, 1, 2, 2, 2]
+        pvalues = [0, 1, 2, 0, 0, 2]
+
+        values = [[] for i in xrange(4)]
+        for cell, code in zip(pcells, pvalues):
+            values[cell].append(vnames[code])
+
+        for method in ("sum", "min", "max", "avg"):
+            cells, rows, cols, total = accumulate(pcells, pvalues, vnames,
+                                                  method, 2, 2)
+            for i in xrange(4):
+                assertEqual(result(cells[i], method, True),
+                            aggregate(values[i], method))
+            assertEqual(result(rows[0], method, True),
+                        aggregate(values[0] + values[1], method))
+            assertEqual(result(cols[1], method, True),
+                        aggregate(values[1] + values[3], method))
+            assertEqual(result(total, method, True),
+                        aggregate(sum(values, []), method))
+
+        cells, rows, cols, total = accumulate(pcells, pvalues, None,
+                                              "count", 2, 2)
+        assertEqual([result(c, "count") for c in cells], [2, 1, 3, 0])
+        assertEqual(result(total, "count"), 6)
+
+# =============================================================================
+class S3PivotTableDBAggregateTests(unittest.TestCase):
+    """ Tests for database-side aggregation in S3PivotTable """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testCombine(self):
+        """ Test combination of partial aggregates """
+
+        combine = S3PivotTable._db_combine
+
+        assertEqual = self.assertEqual
+
+        # Partials as [sum, count]
+        partials = [[4, 2], [None, 0], [6, 3]]
+
+        assertEqual(combine(partials, (0,), "sum"), 10)
+        assertEqual(combine(partials, (1,), "count"), 5)
+        assertEqual(combine(partials, (0,), "min"), 4)
+        assertEqual(combine(partials, (0,), "max"), 6)
+        assertEqual(combine(partials, (0, 1), "avg"), 2.0)
+
+        # Same defaults as _aggregate for empty cells
+        assertEqual(combine([], (0,), "sum"), 0)
+        assertEqual(combine([], (0,), "count"), 0)
+        assertEqual(combine([], (0,), "min"), None)
+        assertEqual(combine([], (0,), "max"), None)
+        assertEqual(combine([], (0, 1), "avg"), 0.0)
+
+    # -------------------------------------------------------------------------
+    def testAggregatable(self):
+        """ Test detection of layers which can be aggregated in the DB """
+
+        assertTrue = self.assertTrue
+        assertFalse = self.assertFalse
+
+        resource = current.s3db.resource("org_office")
+
+        # Master table fields and foreign key paths
+        pt = S3PivotTable(resource,
+                          "organisation_id",
+                          "location_id$L1",
+                          [("id", "count")],
+                          db_aggregate=False,
+                          )
+        assertTrue(pt._db_aggregatable())
+
+        # List-method can not be computed in the DB
+        pt = S3PivotTable(resource,
+                          "organisation_id",
+                          None,
+                          [("name", "list")],
+                          db_aggregate=False,
+                          )
+        assertFalse(pt._db_aggregatable())
+
+        # Min/max of non-numeric fields are computed in Python
+        pt = S3PivotTable(resource,
+                          "organisation_id",
+                          None,
+                          [("name", "max")],
+                          db_aggregate=False,
+                          )
+        assertFalse(pt._db_aggregatable())
+
+    # -------------------------------------------------------------------------
+    def testDBAggregate(self):
+        """ Test that DB aggregation gives the same results as Python """
+
+        assertEqual = self.assertEqual
+
+        resource = current.s3db.resource("org_office")
+        rows = "organisation_id"
+        cols = "office_type_id"
+        layer = ("id", "count")
+
+        python = S3PivotTable(resource, rows, cols, [layer],
+                              db_aggregate=False)
+        database = S3PivotTable(resource, rows, cols, [layer],
+                                db_aggregate=True)
+
+        assertEqual(python.empty, database.empty)
+        if python.empty:
+            return
+        assertEqual(len(python), len(database))
+
+        layer = python.layers[0]
+        assertEqual(python.totals[layer], database.totals[layer])
+
+        def cells(pt):
+            result = {}
+            for i, row in enumerate(pt.row):
+                for j, col in enumerate(pt.col):
+                    result[(row.value, col.value)] = pt.cell[i][j][layer]
+            return result
+
+        assertEqual(cells(python), cells(database))
+
+        totals = lambda headers: dict((h.value, h[layer]) for h in headers)
+        assertEqual(totals(python.row), totals(database.row))
+        assertEqual(totals(python.col), totals(database.col))
+
+    # -------------------------------------------------------------------------
+    def testNonNumeric(self):
+        """ Test that non-numeric aggregates give the same output either way """
+
+        resource = current.s3db.resource("org_office")
+        rows = "organisation_id"
+        cols = "office_type_id"
+
+        for layer in (("name", "min"), ("name", "max")):
+            python = S3PivotTable(resource, rows, cols, [layer],
+                                  db_aggregate=False)
+            database = S3PivotTable(resource, rows, cols, [layer],
+                                    db_aggregate=True)
+            self.assertEqual(python.json(), database.json())
+
+# =============================================================================
+class S3ReportCacheTests(unittest.TestCase):
+    """ Tests for the cross-request report cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.settings = dict((k, settings.ui.get(k))
+                             for k in ("report_cache",
+                                       "report_cache_backend",
+                                       "report_cache_size",
+                                       ))
+        settings.ui.report_cache = True
+        settings.ui.report_cache_backend = None
+        settings.ui.report_cache_size = 2
+
+        S3ReportCache.clear()
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+
+        settings = current.deployment_settings
+        for key, value in self.settings.items():
+            settings.ui[key] = value
+
+        S3ReportCache.clear()
+
+    # -------------------------------------------------------------------------
+    def testKey(self):
+        """ Test that the cache key reflects report options and filters """
+
+        assertEqual = self.assertEqual
+        assertNotEqual = self.assertNotEqual
+
+        s3db = current.s3db
+        selectors = ("organisation_id", "location_id$L1", "id")
+
+        key = lambda resource, *options: \
+                     S3ReportCache(resource, "pivottable", selectors, *options).key
+
+        resource = s3db.resource("org_office")
+        key1 = key(resource, "count")
+        assertEqual(key1, key(s3db.resource("org_office"), "count"))
+        assertNotEqual(key1, key(resource, "sum"))
+
+        resource = s3db.resource("org_office")
+        resource.add_filter(FS("location_id$L1") == "Test")
+        assertNotEqual(key1, key(resource, "count"))
+
+        # No key if the cache is disabled
+        current.deployment_settings.ui.report_cache = False
+        assertEqual(key(resource, "count"), None)
+
+    # -------------------------------------------------------------------------
+    def testLRU(self):
+        """ Test caching and eviction of report data """
+
+        assertEqual = self.assertEqual
+
+        resource = current.s3db.resource("org_office")
+        cache = lambda *options: \
+                       S3ReportCache(resource, "pivottable", ["id"], *options)
+
+        calls = []
+        def generate(value):
+            def f():
+                calls.append(value)
+                return {"value": value}
+            return f
+
+        assertEqual(cache(1)(generate(1)), {"value": 1})
+        assertEqual(cache(1)(generate(1)), {"value": 1})
+        assertEqual(calls, [1])
+
+        cache(2)(generate(2))
+        cache(3)(generate(3))
+        assertEqual(len(S3ReportCache.store), 2)
+
+        # Least recently used item has been evicted
+        cache(1)(generate(1))
+        assertEqual(calls, [1, 2, 3, 1])
+
+    # -------------------------------------------------------------------------
+    def testInvalidation(self):
+        """ Test that writes to involved tables invalidate the cache key """
+
+        assertEqual = self.assertEqual
+        assertNotEqual = self.assertNotEqual
+
+        s3db = current.s3db
+        selectors = ("organisation_id", "id")
+
+        key = lambda: S3ReportCache(s3db.resource("org_office"),
+                                    "pivottable", selectors, "count").key
+
+        key0 = key1 = key()
+        assertEqual(key1, key())
+
+        # Update in a related table (without changing the record count)
+        otable = s3db.org_organisation
+        record = current.db(otable.deleted != True).select(otable.id,
+                                                           otable.comments,
+                                                           limitby=(0, 1),
+                                                           ).first()
+        if record:
+            record.update_record(comments=record.comments)
+            key2 = key()
+            assertNotEqual(key1, key2)
+            key1 = key2
+
+        # Raw SQL writes must renew the version stamp explicitly
+        S3TableVersion.renew("org_office")
+        assertNotEqual(key1, key())
+
+        # New stamps are only written upon commit
+        current.db.rollback()
+        assertEqual(key0, key())
+
+    # -------------------------------------------------------------------------
+    def testStampCommit(self):
+        """ Test that new version stamps are written upon commit """
+
+        assertEqual = self.assertEqual
+
+        db = current.db
+        tablename = "s3_table_version_test"
+
+        stamp = S3TableVersion.get(tablename)
+        S3TableVersion.renew(tablename)
+        pending = S3TableVersion.get(tablename)
+        self.assertNotEqual(stamp, pending)
+
+        # Write the stamp as the commit would, but without commit
+        S3TableVersion.write(db, {tablename: pending})
+        db._adapter._table_versions.clear()
+        assertEqual(S3TableVersion.get(tablename), pending)
+
+        # Update the existing stamp
+        S3TableVersion.write(db, {tablename: "stamp"})
+        assertEqual(S3TableVersion.lookup([tablename, tablename]),
+                    ["stamp", "stamp"])
+
+        db.rollback()
+        assertEqual(S3TableVersion.get(tablename), stamp)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3PivotTableFrameTests,
+        S3PivotTableDBAggregateTests,
+        S3ReportCacheTests,
+    )
+
+# END ========================================================================
@@ -5,12 +5,19 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3resource.py
 #
+import os
 import unittest
 import datetime
 from lxml import etree
 from gluon import *
+from gluon.contrib import simplejson as json
 from gluon.storage import Storage
 
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
 from s3dal import Row
 from s3 import *
 
@@ -575,6 +582,125 @@ class ResourceExportTests(unittest.TestCase):
             current.db.rollback()
             auth.override = False
 
+    # -------------------------------------------------------------------------
+    def testExportGeoJSONNative(self):
+        """ Test native GeoJSON export against the XSLT export """
+
+        xml = current.xml
+        auth = current.auth
+
+        auth.override = True
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation">
+        <data field="name">TestExportGeoJSONOrganisation</data>
+        <resource name="org_office" uuid="EGJ1">
+            <data field="name">TestExportGeoJSONOffice1</data>
+        </resource>
+        <resource name="org_office" uuid="EGJ2">
+            <data field="name">TestExportGeoJSONOffice2</data>
+        </resource>
+        <resource name="org_office" uuid="EGJ3">
+            <data field="name">TestExportGeoJSONOffice3</data>
+        </resource>
+    </resource>
+</s3xml>"""
+
+        folder = current.request.folder
+        stylesheet = os.path.join(folder, "static", "formats", "geojson",
+                                  "export.xsl")
+
+        format = auth.permission.format
+        try:
+            xmltree = etree.ElementTree(etree.fromstring(xmlstr))
+            resource = current.s3db.resource("org_organisation")
+            resource.import_xml(xmltree)
+
+            auth.permission.format = "geojson"
+
+            uids = ["EGJ1", "EGJ2", "EGJ3"]
+            resource = current.s3db.resource("org_office", uid=uids)
+            rows = resource.select(["id", "uuid"], as_rows=True)
+            ids = dict((row.uuid, row.id) for row in rows)
+
+            tablename = "org_office"
+            polygon = '{"type":"Polygon","coordinates":[[[0,0],[1,0],[1,1],[0,0]]]}'
+            location_data = {
+                "geojsons": {},
+                "latlons": {tablename: {ids["EGJ1"]: (10.5, 20.25),
+                                        ids["EGJ2"]: (-1.0, 2.0),
+                                        ids["EGJ3"]: (None, None),
+                                        },
+                            },
+                "attributes": {tablename: {ids["EGJ1"]: {"name": "Office 1",
+                                                         "count": 3,
+                                                         "value": 2.5,
+                                                         "zero": 0,
+                                                         "zerofloat": 0.0,
+                                                         "empty": "",
+                                                         },
+                                           ids["EGJ2"]: {"name": "Office 2"},
+                                           },
+                               },
+                "markers": {tablename: {"image": "marker.png",
+                                        "height": 20,
+                                        "width": 10,
+                                        },
+                            },
+                "styles": {tablename: {ids["EGJ2"]: '{"fill":"ff0000"}'}},
+                }
+            map_data = {"style": [{"prop": "name"}]}
+
+            def xslt_export(uids, location_data):
+                resource = current.s3db.resource("org_office", uid=uids)
+                tree = resource.export_tree(location_data=location_data,
+                                            map_data=map_data,
+                                            dereference=False)
+                tree = xml.transform(tree, stylesheet,
+                                     prefix="org", name="office")
+                return json.loads(xml.tree2json(tree))
+
+            def native_export(uids, location_data):
+                resource = current.s3db.resource("org_office", uid=uids)
+                output = resource.export_geojson(location_data=location_data,
+                                                 map_data=map_data)
+                return json.loads(output)
+
+            # Feature collection with points
+            expected = xslt_export(uids, location_data)
+            self.assertEqual(expected["type"], "FeatureCollection")
+            self.assertEqual(len(expected["features"]), 2)
+            self.assertEqual(native_export(uids, location_data), expected)
+            properties = dict((f["properties"]["id"], f["properties"])
+                              for f in expected["features"])[ids["EGJ1"]]
+            self.assertEqual(properties["zero"], 0)
+            self.assertEqual(properties["zerofloat"], 0)
+
+            # Single feature with polygon
+            location_data["latlons"] = {}
+            location_data["geojsons"] = {tablename: {ids["EGJ1"]: polygon}}
+            expected = xslt_export(["EGJ1"], location_data)
+            self.assertEqual(expected["type"], "Feature")
+            self.assertEqual(native_export(["EGJ1"], location_data), expected)
+
+            # No results
+            self.assertEqual(native_export(["EGJX"], location_data),
+                             xslt_export(["EGJX"], location_data))
+
+            # Standard stylesheet detection
+            native_json = resource.native_json
+            self.assertEqual(native_json(stylesheet, {}), "geojson")
+            self.assertEqual(native_json(stylesheet, {"mode": "x"}), None)
+            self.assertEqual(native_json(os.path.join(folder, "static",
+                                                      "formats", "kml",
+                                                      "export.xsl"), {}),
+                             None)
+        finally:
+            auth.permission.format = format
+            current.db.rollback()
+            auth.override = False
+
 # =============================================================================
 class ResourceImportTests(unittest.TestCase):
     """ Test XML imports into resources """
@@ -627,6 +753,46 @@ class ResourceImportTests(unittest.TestCase):
         self.assertTrue(isinstance(msg["created"], list))
         self.assertTrue(len(msg["created"]) == 1)
 
+    # -------------------------------------------------------------------------
+    def testImportCSVInBatches(self):
+        """ Test import of a CSV source in batches """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        names = ["TestImportCSVBatch%s" % i for i in xrange(5)]
+        csv = "Organisation,Comments\n%s\n" % \
+              "\n".join("%s,Batch test" % name for name in names)
+
+        stylesheet = os.path.join(current.request.folder,
+                                  "static", "formats", "s3csv", "org",
+                                  "organisation.xsl")
+
+        table = s3db.org_organisation
+        query = (table.name.belongs(names)) & (table.deleted != True)
+
+        auth.override = True
+        try:
+            resource = s3db.resource("org_organisation")
+            result = resource.import_xml(StringIO(csv),
+                                         format="csv",
+                                         stylesheet=stylesheet,
+                                         batch_size=2)
+            msg = json.loads(result)
+            self.assertEqual(msg["status"], "success")
+            self.assertEqual(resource.import_count, 5)
+            self.assertEqual(resource.error_tree, None)
+
+            rows = db(query).select(table.name)
+            self.assertEqual(set(row.name for row in rows), set(names))
+        finally:
+            s3db.resource("org_organisation",
+                          filter = (FS("name").belongs(names)),
+                          ).delete()
+            db.commit()
+            auth.override = False
+
     # -------------------------------------------------------------------------
     def testImportXMLWithMTime(self):
         """ Test mtime update in imports """
@@ -2828,6 +2994,196 @@ class LinkDeletionTests(unittest.TestCase):
         self.assertNotEqual(row, None,
                             msg = "Unrelated component record deleted")
 
+# =============================================================================
+class ResourceIterSelectTests(unittest.TestCase):
+    """ Test chunked extraction with S3Resource.iter_select """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testIterSelect(self):
+        """ Test that the chunks contain the same rows as select """
+
+        assertEqual = self.assertEqual
+
+        s3db = current.s3db
+        fields = ["id", "name", "organisation_id$name", "location_id$L1"]
+        orderby = "org_office.name desc"
+
+        resource = s3db.resource("org_office")
+        data = resource.select(fields,
+                               limit=None,
+                               orderby=orderby,
+                               represent=True)
+        expected = data["rows"]
+
+        resource = s3db.resource("org_office")
+        chunks = list(resource.iter_select(fields,
+                                           orderby=orderby,
+                                           chunksize=2,
+                                           represent=True))
+        for chunk in chunks:
+            self.assertTrue(len(chunk.rows) <= 2)
+        rows = [row for chunk in chunks for row in chunk.rows]
+        assertEqual(rows, expected)
+
+    # -------------------------------------------------------------------------
+    def testIterSelectAsRows(self):
+        """ Test that chunked rows retain the order """
+
+        assertEqual = self.assertEqual
+
+        resource = current.s3db.resource("org_office")
+        table = resource.table
+        orderby = ~table.id
+
+        expected = resource.select(["id"],
+                                   limit=None,
+                                   orderby=orderby,
+                                   as_rows=True)
+        expected = [row.id for row in expected]
+
+        chunks = resource.iter_select(["id"],
+                                      orderby=orderby,
+                                      chunksize=3,
+                                      as_rows=True)
+        ids = [row.id for chunk in chunks for row in chunk.rows]
+        assertEqual(ids, expected)
+
+# =============================================================================
+class ResourceKeysetPaginationTests(unittest.TestCase):
+    """ Test keyset pagination and approximate counts in S3ResourceData """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+
+    # -------------------------------------------------------------------------
+    def testKeyset(self):
+        """ Test detection of the pagination key from ORDERBY """
+
+        assertEqual = self.assertEqual
+
+        resource = current.s3db.resource("org_office")
+        table = resource.table
+        data = resource.select(["id"], limit=1)
+
+        def keyset(orderby):
+            keys = data.keyset(orderby)
+            if keys is not None:
+                keys = [(str(field), descending) for field, descending in keys]
+            return keys
+
+        assertEqual(keyset([table.name, ~table.id]),
+                    [("org_office.name", False), ("org_office.id", True)])
+        assertEqual(keyset([~table.name]),
+                    [("org_office.name", True), ("org_office.id", False)])
+        assertEqual(keyset(None), [("org_office.id", False)])
+
+        # Fields which can be NULL can not be used as key
+        assertEqual(keyset([table.comments]), None)
+
+        # Fields in other tables can not be used as key
+        otable = current.s3db.org_organisation
+        assertEqual(keyset([otable.name]), None)
+
+    # -------------------------------------------------------------------------
+    def testSeek(self):
+        """ Test that continuing from the cursor gives the next page """
+
+        assertEqual = self.assertEqual
+
+        s3db = current.s3db
+        fields = ["id", "name", "organisation_id$name"]
+        orderby = "org_office.name desc"
+
+        resource = s3db.resource("org_office")
+        expected = resource.select(fields,
+                                   start=2,
+                                   limit=2,
+                                   orderby=orderby,
+                                   count=True,
+                                   represent=True)
+
+        resource = s3db.resource("org_office")
+        data = resource.select(fields,
+                               start=0,
+                               limit=2,
+                               orderby=orderby,
+                               count=True,
+                               represent=True,
+                               seek=True)
+        cursor = data.cursor
+        if len(data.rows) < 2:
+            assertEqual(expected.rows, [])
+            return
+        self.assertNotEqual(cursor, None)
+
+        resource = s3db.resource("org_office")
+        data = resource.select(fields,
+                               start=2,
+                               limit=2,
+                               orderby=orderby,
+                               count=True,
+                               represent=True,
+                               seek=cursor)
+
+        assertEqual(data.rows, expected.rows)
+        assertEqual(data.numrows, expected.numrows)
+
+    # -------------------------------------------------------------------------
+    def testApproximateCount(self):
+        """ Test counting up to a limit """
+
+        resource = current.s3db.resource("org_office")
+        total = resource.count()
+
+        data = resource.select(["id", "organisation_id$name"],
+                               limit=1,
+                               count=1)
+        if total > 1:
+            self.assertTrue(data.numrows > 1)
+        else:
+            self.assertEqual(data.numrows, total)
+
+    # -------------------------------------------------------------------------
+    def testNoCount(self):
+        """ Test that records are not counted unless requested """
+
+        from s3.s3resource import S3ResourceData
+
+        calls = []
+        count_query = S3ResourceData.count_query
+        def count_query_stub(self, *args, **kwargs):
+            calls.append(args)
+            return count_query(self, *args, **kwargs)
+        S3ResourceData.count_query = count_query_stub
+
+        try:
+            resource = current.s3db.resource("org_office")
+            data = resource.select(["id", "organisation_id$name"],
+                                   limit=2,
+                                   count=False)
+        finally:
+            S3ResourceData.count_query = count_query
+
+        self.assertEqual(calls, [])
+        self.assertTrue(len(data.rows) <= 2)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -2854,6 +3210,8 @@ if __name__ == "__main__":
         ResourceAxisFilterTests,
         ResourceDataTableFilterTests,
         ResourceGetTests,
+        ResourceIterSelectTests,
+        ResourceKeysetPaginationTests,
         #ResourceInsertTest,
         #ResourceSelectTests,
         #ResourceUpdateTests,
@@ -5,9 +5,15 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3sync.py
 #
+import datetime
 import unittest
+import urlparse
+
 from gluon import current
+from gluon.storage import Storage
 from lxml import etree
+
+from s3 import S3Sync, S3SyncDelta, S3SyncRepository, s3_format_datetime
 try:
     import json # try stdlib (Python 2.6)
 except ImportError:
@@ -437,6 +443,296 @@ class ImportMergeWithoutExistingRecords(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class SyncDeltaTests(unittest.TestCase):
+    """ Test skipping of already exchanged records by content hash """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation" uuid="TESTSYNCDELTAORG1">
+        <data field="name">TestSyncDeltaOrg1</data>
+    </resource>
+    <resource name="org_organisation" uuid="TESTSYNCDELTAORG2">
+        <data field="name">TestSyncDeltaOrg2</data>
+    </resource>
+</s3xml>"""
+
+        xmltree = etree.ElementTree(etree.fromstring(xmlstr))
+        resource = current.s3db.resource("org_organisation")
+        resource.import_xml(xmltree)
+        self.assertEqual(resource.error, None)
+
+        rtable = current.s3db.sync_repository
+        self.repository_id = rtable.insert(name="TestSyncDelta")
+
+    def testRecordHash(self):
+        """ Test that the content hash ignores meta-data """
+
+        record_hash = S3SyncDelta.record_hash
+
+        element = etree.fromstring("""
+<resource name="org_organisation" uuid="TESTSYNCDELTAORG1" modified_on="2014-01-01T00:00:00">
+    <data field="name">TestSyncDeltaOrg1</data>
+    <data field="acronym">TSDO</data>
+</resource>""")
+        other = etree.fromstring("""
+<resource name="org_organisation" uuid="TESTSYNCDELTAORG1" modified_on="2014-02-01T00:00:00" mci="2">
+    <data field="acronym">TSDO</data>
+    <data field="name">TestSyncDeltaOrg1</data>
+</resource>""")
+        self.assertEqual(record_hash(element), record_hash(other))
+
+        other[0].text = "TestSyncDeltaOrg1 (Changed)"
+        self.assertNotEqual(record_hash(element), record_hash(other))
+
+        other = etree.fromstring("""
+<resource name="org_organisation" uuid="TESTSYNCDELTAORG1" deleted="True"/>""")
+        self.assertNotEqual(record_hash(element), record_hash(other))
+
+    def testSkipUnchanged(self):
+        """ Test that only changed records are kept in the tree """
+
+        repository_id = self.repository_id
+        resource = current.s3db.resource("org_organisation",
+                                         uid=["TESTSYNCDELTAORG1",
+                                              "TESTSYNCDELTAORG2"])
+        export = lambda: resource.export_tree(mcomponents=[],
+                                              dereference=False)
+
+        # Nothing exchanged yet
+        tree = export()
+        skipped, hashes = S3SyncDelta.skip_unchanged(tree, repository_id)
+        self.assertEqual(skipped, 0)
+        self.assertEqual(len(tree.getroot()), 2)
+        self.assertEqual(len(hashes), 2)
+        S3SyncDelta.update(repository_id, hashes)
+
+        # Change one record
+        tree = export()
+        name = tree.xpath("resource[@uuid='TESTSYNCDELTAORG2']/data[@field='name']")[0]
+        name.text = "TestSyncDeltaOrg2 (Changed)"
+
+        skipped, hashes = S3SyncDelta.skip_unchanged(tree, repository_id)
+        self.assertEqual(skipped, 1)
+
+        elements = tree.getroot().findall("resource")
+        self.assertEqual(len(elements), 1)
+        self.assertEqual(elements[0].get("uuid"), "TESTSYNCDELTAORG2")
+        self.assertEqual(hashes.keys(), [("org_organisation",
+                                          "TESTSYNCDELTAORG2")])
+
+        # Nothing skipped for other repositories
+        tree = export()
+        skipped = S3SyncDelta.skip_unchanged(tree, None)[0]
+        self.assertEqual(skipped, 0)
+
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class SyncTransportTests(unittest.TestCase):
+    """ Test paged, compressed pulls/pushes over a persistent connection """
+
+    PAGES = ["""
+<s3xml>
+    <resource name="org_organisation" uuid="TESTSYNCPAGEORG1" modified_on="2014-01-01T10:00:00">
+        <data field="name">TestSyncPageOrg1</data>
+    </resource>
+</s3xml>""", """
+<s3xml>
+    <resource name="org_organisation" uuid="TESTSYNCPAGEORG2" modified_on="2014-01-01T11:00:00">
+        <data field="name">TestSyncPageOrg2</data>
+    </resource>
+</s3xml>"""]
+
+    MUNTIL = "2014-01-01T12:00:00"
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        self.PAGES = list(self.PAGES)
+
+        # Make sure there is a sync configuration
+        db = current.db
+        ctable = current.s3db.sync_config
+        if not db(ctable.id > 0).select(ctable.id, limitby=(0, 1)).first():
+            ctable.insert(uuid="TESTSYNCTRANSPORT")
+
+        # Launch a stand-in peer
+        import BaseHTTPServer
+        import threading
+
+        pages = self.PAGES
+        muntil = self.MUNTIL
+
+        class Peer(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                self.server.connections += 1
+
+            def respond(self, body):
+                body = S3Sync.encode_content(body, "gzip")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/xml")
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Accept-Encoding", "gzip, deflate")
+                self.send_header("Content-Length", str(len(body)))
+                return body
+
+            def do_GET(self):
+                server = self.server
+                server.requests.append((self.path, dict(self.headers)))
+                query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+                index = int(query.get("next", ["0"])[0])
+                body = self.respond(pages[index])
+                self.send_header("X-Sync-Muntil", muntil)
+                if index + 1 < len(pages):
+                    self.send_header("X-Sync-Next", str(index + 1))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                server = self.server
+                length = int(self.headers.get("content-length"))
+                data = self.rfile.read(length)
+                encoding = self.headers.get("content-encoding")
+                server.requests.append((self.path, dict(self.headers)))
+                server.received.append(S3Sync.decode_content(data, encoding))
+                body = self.respond(current.xml.json_message())
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Peer)
+        server.connections = 0
+        server.requests = []
+        server.received = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.server = server
+
+        repository = Storage(name="TestSyncTransport",
+                             url="http://127.0.0.1:%s" % server.server_port,
+                             apitype="eden",
+                             )
+        repository.id = current.s3db.sync_repository.insert(**repository)
+        self.repository = S3SyncRepository(repository)
+
+        settings = current.deployment_settings
+        self.page_size = settings.get_sync_page_size()
+        settings.sync.page_size = 1
+
+    def testPull(self):
+        """ Test paged pull """
+
+        repository = self.repository
+        server = self.server
+
+        task = Storage(id=0,
+                       resource_name="org_organisation",
+                       last_pull=None,
+                       strategy=["create", "update"],
+                       update_policy="NEWER",
+                       conflict_policy="NEWER",
+                       )
+        output, mtime = repository.pull(task)
+        self.assertEqual(output, None)
+        self.assertEqual(s3_format_datetime(mtime), self.MUNTIL)
+
+        # Both pages requested (compressed), through one connection
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.connections, 1)
+        for path, headers in server.requests:
+            self.assertTrue("limit=1" in path)
+            self.assertTrue("gzip" in headers.get("accept-encoding"))
+
+        # Records from both pages imported
+        resource = current.s3db.resource("org_organisation",
+                                         uid=["TESTSYNCPAGEORG1",
+                                              "TESTSYNCPAGEORG2"])
+        self.assertEqual(resource.count(), 2)
+
+        # Records sent again by the peer get skipped in the next pull
+        output, mtime = repository.pull(task)
+        self.assertEqual(output, None)
+        self.assertEqual(len(server.requests), 4)
+        self.assertEqual(server.connections, 1)
+        ltable = current.s3db.sync_log
+        row = current.db(ltable.resource_name == "org_organisation") \
+                        .select(ltable.message,
+                                orderby=~ltable.id,
+                                limitby=(0, 1)).first()
+        self.assertTrue("2 unchanged records skipped" in row.message)
+
+        # Push gets compressed, since the peer accepts that
+        current.s3db.org_organisation.insert(name="TestSyncPushOrg",
+                                             uuid="TESTSYNCPUSHORG")
+        task.last_push = None
+        output, mtime = repository.push(task)
+        self.assertEqual(output, None)
+        self.assertEqual(server.connections, 1)
+        path, headers = server.requests[-1]
+        self.assertEqual(headers.get("content-encoding"), "gzip")
+        self.assertTrue("TESTSYNCPUSHORG" in server.received[-1])
+
+        # Records pushed before are not sent again
+        requests = len(server.requests)
+        output, mtime = repository.push(task)
+        self.assertEqual(output, None)
+        self.assertEqual(len(server.requests), requests)
+
+    def testContinuationToken(self):
+        """ Test encoding/decoding of continuation tokens """
+
+        muntil = datetime.datetime(2014, 1, 1, 12, 0, 0)
+        mtime = datetime.datetime(2014, 1, 1, 11, 30, 0, 123456)
+
+        token = S3Sync.encode_token(muntil, mtime, 17)
+        self.assertEqual(S3Sync.decode_token(token), (muntil, mtime, 17))
+
+        self.assertRaises((TypeError, ValueError),
+                          S3Sync.decode_token, "invalid")
+
+    def testAcceptEncoding(self):
+        """ Test choice of the content encoding """
+
+        accept_encoding = S3Sync.accept_encoding
+
+        self.assertEqual(accept_encoding("gzip, deflate"), "gzip")
+        self.assertEqual(accept_encoding("deflate, gzip;q=0"), "deflate")
+        self.assertEqual(accept_encoding("identity"), None)
+        self.assertEqual(accept_encoding(None), None)
+
+        data = "<s3xml/>" * 100
+        for encoding in ("gzip", "deflate"):
+            encoded = S3Sync.encode_content(data, encoding)
+            self.assertTrue(len(encoded) < len(data))
+            self.assertEqual(S3Sync.decode_content(encoded, encoding), data)
+
+    def tearDown(self):
+
+        self.repository.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+        current.deployment_settings.sync.page_size = self.page_size
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -458,7 +754,9 @@ if __name__ == "__main__":
         ImportMergeWithExistingRecords,
         ImportMergeWithExistingOriginal,
         ImportMergeWithExistingDuplicate,
-        ImportMergeWithoutExistingRecords
+        ImportMergeWithoutExistingRecords,
+        SyncDeltaTests,
+        SyncTransportTests,
     )
 
 # END ========================================================================
@@ -5,6 +5,9 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3xml.py
 #
+import os
+import tempfile
+import time
 import unittest
 from gluon import *
 from gluon.contrib import simplejson as json
@@ -16,7 +19,7 @@ except:
 
 from lxml import etree
 
-from s3 import S3Hierarchy, s3_meta_fields, S3Represent, S3XMLFormat, IS_ONE_OF
+from s3 import S3Hierarchy, s3_meta_fields, S3Represent, S3XMLFormat, S3XSLTCache, IS_ONE_OF
 
 # =============================================================================
 class TreeBuilderTests(unittest.TestCase):
@@ -263,6 +266,164 @@ class XMLFormatTests(unittest.TestCase):
         self.assertEqual(len(root), 0)
         self.assertEqual(root.text, "Test")
 
+# =============================================================================
+class XSLTCacheTests(unittest.TestCase):
+    """ Test the compiled XSLT stylesheet cache """
+
+    STYLESHEET = """<?xml version="1.0"?>
+<xsl:stylesheet
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">
+    <xsl:output method="xml"/>
+    <xsl:template match="/">
+        <test>%s</test>
+    </xsl:template>
+</xsl:stylesheet>"""
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        handle, self.path = tempfile.mkstemp(suffix=".xsl")
+        os.close(handle)
+        self.write("Test")
+
+        xmlstr = """<?xml version="1.0"?><s3xml/>"""
+        self.tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        os.remove(self.path)
+        S3XSLTCache.clear()
+
+    # -------------------------------------------------------------------------
+    def write(self, text, mtime=None):
+        """ Write the test stylesheet """
+
+        with open(self.path, "w") as stylesheet:
+            stylesheet.write(self.STYLESHEET % text)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    # -------------------------------------------------------------------------
+    def testCompileOnce(self):
+        """ Test that repeated transformations re-use the compiled stylesheet """
+
+        xml = current.xml
+        S3XSLTCache.clear()
+
+        for _ in xrange(3):
+            result = xml.transform(self.tree, self.path)
+            self.assertEqual(result.getroot().text, "Test")
+
+        stats = S3XSLTCache.stats()
+        self.assertEqual(stats["stylesheets"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 2)
+
+        # S3XMLFormat shares the cached stylesheet
+        xmlformat = S3XMLFormat(self.path)
+        result = xmlformat.transform(self.tree)
+        self.assertEqual(result.getroot().text, "Test")
+        self.assertEqual(S3XSLTCache.stats()["misses"], 1)
+
+    # -------------------------------------------------------------------------
+    def testRecompileModified(self):
+        """ Test that modified stylesheets get re-compiled """
+
+        xml = current.xml
+        S3XSLTCache.clear()
+
+        result = xml.transform(self.tree, self.path)
+        self.assertEqual(result.getroot().text, "Test")
+
+        self.write("Modified", mtime=time.time() + 10)
+
+        result = xml.transform(self.tree, self.path)
+        self.assertEqual(result.getroot().text, "Modified")
+
+        stats = S3XSLTCache.stats()
+        self.assertEqual(stats["stylesheets"], 1)
+        self.assertEqual(stats["misses"], 2)
+
+    # -------------------------------------------------------------------------
+    def testInvalidStylesheet(self):
+        """ Test that invalid stylesheets are not cached """
+
+        xml = current.xml
+        S3XSLTCache.clear()
+
+        with open(self.path, "w") as stylesheet:
+            stylesheet.write("<invalid")
+
+        self.assertEqual(xml.transform(self.tree, self.path), None)
+        self.assertNotEqual(xml.error, None)
+        self.assertEqual(S3XSLTCache.stats()["stylesheets"], 0)
+
+# =============================================================================
+class CSVBatchTests(unittest.TestCase):
+    """ Test conversion of CSV/XLS sources in batches """
+
+    CSV = """Name,Comments
+#org+name,#meta+comments
+Org1,First
+Org2,Second
+Org3,Third
+Org4,Fourth
+Org5,Fifth
+"""
+
+    # -------------------------------------------------------------------------
+    def testCSVBatches(self):
+        """ Test conversion of a CSV source into batches of rows """
+
+        xml = current.xml
+
+        trees = list(xml.csv2trees(StringIO(self.CSV),
+                                   resourcename="organisation",
+                                   extra_data={"Type": "NGO"},
+                                   batch_size=2))
+        self.assertEqual(len(trees), 3)
+        self.assertEqual([len(t.getroot()) for t in trees], [2, 2, 1])
+
+        names = []
+        for tree in trees:
+            root = tree.getroot()
+            self.assertEqual(root.tag, "table")
+            self.assertEqual(root.get("name"), "organisation")
+            for row in root:
+                names.extend(row.xpath("col[@field='Name']/text()"))
+                col = row.xpath("col[@field='Name']")[0]
+                self.assertEqual(col.get("hashtag"), "#org+name")
+                self.assertEqual(row.xpath("col[@field='Type']/text()"),
+                                 ["NGO"])
+        self.assertEqual(names, ["Org1", "Org2", "Org3", "Org4", "Org5"])
+
+        # Without batch size => all rows in one tree
+        tree = xml.csv2tree(StringIO(self.CSV))
+        self.assertEqual(len(tree.getroot()), 5)
+
+        # Empty source => one empty tree
+        trees = list(xml.csv2trees(StringIO("Name,Comments\n"), batch_size=2))
+        self.assertEqual(len(trees), 1)
+        self.assertEqual(len(trees[0].getroot()), 0)
+
+    # -------------------------------------------------------------------------
+    def testSplitTable(self):
+        """ Test splitting of table-form trees into batches """
+
+        xml = current.xml
+
+        tree = xml.csv2tree(StringIO(self.CSV), resourcename="organisation")
+        trees = list(xml.split_table(tree, 3))
+        self.assertEqual([len(t.getroot()) for t in trees], [3, 2])
+        for t in trees:
+            self.assertEqual(t.getroot().get("name"), "organisation")
+
+        tree = xml.csv2tree(StringIO(self.CSV))
+        trees = list(xml.split_table(tree, 10))
+        self.assertEqual(len(trees), 1)
+        self.assertTrue(trees[0] is tree)
+
 # =============================================================================
 class GetFieldOptionsTests(unittest.TestCase):
     """ Test field options introspection method """
@@ -876,6 +1037,8 @@ if __name__ == "__main__":
         TreeBuilderTests,
         JSONMessageTests,
         XMLFormatTests,
+        XSLTCacheTests,
+        CSVBatchTests,
         GetFieldOptionsTests,
     )
 
@@ -144,6 +144,231 @@ class PRTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class RealmClosureTests(unittest.TestCase):
+    """ Tests for OU hierarchy lookups with the closure table """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        auth = current.auth
+        s3db = current.s3db
+
+        auth.override = True
+
+        settings = current.deployment_settings
+        self.realm_closure = settings.get_auth_realm_closure()
+        settings.auth.realm_closure = True
+
+        otable = s3db.org_organisation
+
+        orgs = []
+        for i in range(4):
+            org = Storage(name="Test Closure Organisation %s" % i)
+            org_id = otable.insert(**org)
+            org.update(id=org_id)
+            s3db.update_super(otable, org)
+            orgs.append((org_id, s3db.pr_get_pe_id("org_organisation", org_id)))
+        self.orgs = orgs
+
+        # Branch hierarchy: 0 => 1 => 2, 0 => 3 => 2
+        ltable = s3db.org_organisation_branch
+        for parent, branch in ((0, 1), (1, 2), (0, 3), (3, 2)):
+            link_id = ltable.insert(organisation_id = orgs[parent][0],
+                                    branch_id = orgs[branch][0],
+                                    )
+            s3db.org_update_affiliations("org_organisation_branch", link_id)
+        self.pe_ids = [pe_id for org_id, pe_id in orgs]
+
+    # -------------------------------------------------------------------------
+    def testClosure(self):
+        """ Test incremental maintenance of the closure table """
+
+        db = current.db
+        s3db = current.s3db
+
+        pe_ids = self.pe_ids
+        ctable = s3db.pr_pentity_closure
+
+        query = (ctable.descendant_pe_id.belongs(pe_ids))
+        rows = db(query).select(ctable.ancestor_pe_id,
+                                ctable.descendant_pe_id,
+                                ctable.depth)
+        closure = dict(((row.ancestor_pe_id, row.descendant_pe_id), row.depth)
+                       for row in rows)
+        self.assertEqual(closure, {(pe_ids[0], pe_ids[1]): 1,
+                                   (pe_ids[0], pe_ids[3]): 1,
+                                   (pe_ids[1], pe_ids[2]): 1,
+                                   (pe_ids[3], pe_ids[2]): 1,
+                                   (pe_ids[0], pe_ids[2]): 2,
+                                   })
+
+        # Removing the top-level affiliation updates the sub-tree
+        s3db.pr_remove_affiliation(pe_ids[0], pe_ids[1], role="Branches")
+        rows = db(query).select(ctable.ancestor_pe_id,
+                                ctable.descendant_pe_id)
+        closure = set((row.ancestor_pe_id, row.descendant_pe_id)
+                      for row in rows)
+        self.assertEqual(closure, set([(pe_ids[0], pe_ids[3]),
+                                       (pe_ids[1], pe_ids[2]),
+                                       (pe_ids[3], pe_ids[2]),
+                                       (pe_ids[0], pe_ids[2]),
+                                       ]))
+
+        # Full rebuild gives the same result
+        s3db.pr_rebuild_closure()
+        rows = db(query).select(ctable.ancestor_pe_id,
+                                ctable.descendant_pe_id)
+        self.assertEqual(set((row.ancestor_pe_id, row.descendant_pe_id)
+                             for row in rows), closure)
+
+    # -------------------------------------------------------------------------
+    def testLookups(self):
+        """ Test that closure lookups match the recursive lookups """
+
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        pe_ids = self.pe_ids
+
+        lookups = (lambda: set(s3db.pr_get_ancestors(pe_ids[2])),
+                   lambda: dict((k, set(v)) for k, v in
+                                s3db.pr_ancestors(pe_ids).items()),
+                   lambda: dict((k, set(v)) for k, v in
+                                s3db.pr_descendants(pe_ids[:2]).items()),
+                   lambda: set(s3db.pr_get_descendants(pe_ids[0])),
+                   lambda: set(s3db.pr_get_descendants(pe_ids[0],
+                                           entity_types="org_organisation")),
+                   lambda: s3db.org_parents(self.orgs[2][0], []),
+                   lambda: s3db.org_root_organisation(self.orgs[2][0]),
+                   )
+
+        results = [lookup() for lookup in lookups]
+        self.assertEqual(results[0], set([pe_ids[0], pe_ids[1], pe_ids[3]]))
+        self.assertEqual(results[3], set(pe_ids[1:]))
+        self.assertEqual(results[5], [self.orgs[0][0], self.orgs[1][0]])
+        self.assertEqual(results[6], self.orgs[0][0])
+
+        settings.auth.realm_closure = False
+        for i, lookup in enumerate(lookups):
+            if i == 5:
+                # Recursive org_parents follows only one parent
+                continue
+            self.assertEqual(lookup(), results[i])
+
+    # -------------------------------------------------------------------------
+    def testSkip(self):
+        """ Test that closure lookups do not descend into skipped entities """
+
+        s3db = current.s3db
+        settings = current.deployment_settings
+
+        pe_ids = self.pe_ids
+
+        lookups = (lambda skip: set(s3db.pr_get_descendants(pe_ids[0],
+                                                            skip=set(skip))),
+                   lambda skip: dict((k, set(v)) for k, v in
+                                     s3db.pr_descendants(pe_ids[:1],
+                                                         skip=set(skip)).items()),
+                   )
+
+        # 2 is still reachable via 3
+        for lookup in lookups:
+            settings.auth.realm_closure = True
+            closure = lookup([pe_ids[1]])
+            settings.auth.realm_closure = False
+            self.assertEqual(closure, lookup([pe_ids[1]]))
+
+        settings.auth.realm_closure = True
+        self.assertEqual(lookups[0]([pe_ids[1], pe_ids[3]]),
+                         set([pe_ids[1], pe_ids[3]]))
+
+    # -------------------------------------------------------------------------
+    def testBranchesOnly(self):
+        """ Test that org_parents follows only branch links """
+
+        s3db = current.s3db
+
+        # Another OU affiliation which is not a branch link
+        otable = s3db.org_organisation
+        org = Storage(name="Test Closure Organisation Partner")
+        org_id = otable.insert(**org)
+        org.update(id=org_id)
+        s3db.update_super(otable, org)
+        pe_id = s3db.pr_get_pe_id("org_organisation", org_id)
+        s3db.pr_add_affiliation(pe_id, self.pe_ids[0], role="Partners")
+
+        self.assertTrue(pe_id in s3db.pr_get_ancestors(self.pe_ids[1]))
+        self.assertEqual(s3db.org_parents(self.orgs[1][0], []),
+                         [self.orgs[0][0]])
+        self.assertEqual(s3db.org_root_organisation(self.orgs[1][0]),
+                         self.orgs[0][0])
+
+    # -------------------------------------------------------------------------
+    def testDeleteRole(self):
+        """ Test that deleting a role updates the closure table """
+
+        db = current.db
+        s3db = current.s3db
+
+        pe_ids = self.pe_ids
+        ctable = s3db.pr_pentity_closure
+        rtable = s3db.pr_role
+
+        query = (rtable.pe_id == pe_ids[0]) & \
+                (rtable.role == "Branches") & \
+                (rtable.deleted != True)
+        role = db(query).select(rtable.id, limitby=(0, 1)).first()
+        s3db.pr_delete_role(role.id)
+
+        query = (ctable.ancestor_pe_id == pe_ids[0])
+        self.assertEqual(db(query).count(), 0)
+
+    # -------------------------------------------------------------------------
+    def testRealmQuery(self):
+        """ Test that realm queries look up subsidiaries with the closure table """
+
+        auth = current.auth
+        db = current.db
+        s3db = current.s3db
+
+        pe_ids = self.pe_ids
+
+        # Each organisation owns its own record
+        otable = s3db.org_organisation
+        org_ids = [org_id for org_id, pe_id in self.orgs]
+        for org_id, pe_id in self.orgs:
+            db(otable.id == org_id).update(realm_entity=pe_id)
+        base = (otable.id.belongs(org_ids))
+
+        def owned(entities):
+            query = auth.permission.realm_query(otable, entities)
+            rows = db(base & query).select(otable.id)
+            return str(query), set(row.id for row in rows)
+
+        try:
+            auth.s3_impersonate("normaluser@example.com")
+            auth.user.subsidiaries = s3db.pr_descendants(pe_ids)
+
+            # Realm of organisation 1 including its subsidiary 2
+            query, records = owned([pe_ids[1], pe_ids[2]])
+            self.assertTrue("pr_pentity_closure" in query)
+            self.assertEqual(records, set(org_ids[1:3]))
+
+            # Subsidiaries of 0 not all included => listed
+            query, records = owned([pe_ids[0], pe_ids[1]])
+            self.assertFalse("pr_pentity_closure" in query)
+            self.assertEqual(records, set(org_ids[:2]))
+        finally:
+            auth.s3_impersonate(None)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings.auth.realm_closure = self.realm_closure
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 class PersonDeduplicateTests(unittest.TestCase):
     """ PR Tests """
@@ -616,6 +841,7 @@ if __name__ == "__main__":
 
     run_suite(
         PRTests,
+        RealmClosureTests,
         PersonDeduplicateTests,
         ContactValidationTests,
     )
@@ -10,7 +10,15 @@ secs = time.mktime(time.localtime())
 # Asia Pacific less TL
 countries = [ "AF", "AU", "BD", "BN", "CK", "CN", "FJ", "FM", "HK", "ID", "IN", "JP", "KH", "KI", "KP", "KR", "LA", "MH", "MM", "MN", "MV", "MY", "NP", "NZ", "PG", "PH", "PK", "PW", "SB", "SG", "SL", "TH", "TO", "TV", "TW", "VN", "VU", "WS"]
 
-gis.import_admin_areas(countries=countries)
+def progress(level, stats):
+    print "%s: %s processed, %s imported, %s skipped" % (level,
+                                                         stats["processed"],
+                                                         stats["imported"],
+                                                         stats["skipped"],
+                                                         )
+
+# NB Can be re-run to resume an interrupted import
+gis.import_admin_areas(countries=countries, progress=progress)
 
 db.commit()
 
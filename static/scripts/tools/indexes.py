@@ -37,3 +37,33 @@ try:
 except:
     # Index already present
     pass
+# Bounding box index, covering the bounds for the range comparisons
+try:
+    db.executesql("CREATE INDEX %s_quadkey__idx on %s(quadkey, lat_min, lat_max, lon_min, lon_max);" % (tablename, tablename))
+except:
+    # Index already present
+    pass
+# Set the quadkeys of existing locations
+gis.update_quadkeys()
+db.commit()
+
+tablename = "pr_pentity_closure"
+field = "ancestor_pe_id"
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+except:
+    # Index already present
+    pass
+field = "descendant_pe_id"
+try:
+    db.executesql("CREATE INDEX %s__idx on %s(%s);" % (field, tablename, field))
+except:
+    # Index already present
+    pass
+
+tablename = "gis_location_simplified"
+try:
+    db.executesql("CREATE INDEX %s_location_id__idx on %s(location_id, tolerance);" % (tablename, tablename))
+except:
+    # Index already present
+    pass
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Script to (re-)build the closure table of the OU hierarchy
+# (pr_pentity_closure), required once after enabling
+# settings.auth.realm_closure
+#
+# Execute like: python web2py.py -S eden -M -R applications/eden/static/scripts/tools/realm_closure.py
+#
+import sys
+auth.override = True
+
+from s3db.pr import pr_rebuild_closure
+count = pr_rebuild_closure()
+
+db.commit()
+auth.override = False
+print >> sys.stderr, "Done (%s ancestor/descendant pairs)." % count